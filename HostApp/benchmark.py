@@ -0,0 +1,269 @@
+import argparse
+import contextlib
+import json
+import os
+import platform
+import sys
+import statistics
+import tempfile
+import time
+import zlib
+
+import cipher
+import cli
+import crc
+import metrics
+import uart_functions
+import virtual_bootloader
+
+# Измерение скорости Host приложения: шифрование, CRC32, подготовка пакетов и прошивка модели загрузчика
+# (virtual_bootloader.py) через псевдотерминал. Результаты записываются в JSON и сравниваются с сохраненными
+# базовыми значениями: если показатель хуже базового больше допустимого отклонения, код возврата - 1,
+# поэтому замедление передачи прошивки останавливает сборку (python benchmark.py --baseline ...).
+# Абсолютная скорость (МБайт/с, секунды) зависит от машины, поэтому базовые значения по умолчанию содержат только
+# относительные показатели (единица "ratio"): скорость передачи блоков относительно скорости линии, скорость CRC32
+# MPEG-2 относительно zlib.crc32. Чтобы сравнивать и абсолютные показатели, сборка записывает базовые значения на своей
+# машине (--update-baseline --absolute) и сравнивает с ними
+
+# Версия формата файла результатов
+results_version = 1
+# Базовые значения по умолчанию: относительные показатели (--update-baseline)
+default_baseline_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "benchmark_baseline.json")
+# Допустимое ухудшение показателя относительно базового значения (доля)
+default_tolerance = 0.25
+
+# Размер данных и число повторов измерений скорости без устройства (лучшее из повторов)
+micro_benchmark_size = 1024 * 1024
+micro_benchmark_repeats = 5
+# Число пар измерений для относительной скорости (медиана отношений)
+relative_benchmark_repeats = 15
+
+# Размеры прошивок для прошивки модели загрузчика. Прошивка записывается в неактивный слот, поэтому
+# не больше большего слота (512 Кбайт)
+flash_benchmark_sizes = [64 * 1024, 256 * 1024, 512 * 1024]
+# Скорость UART и параметры модели: время стирания и записи flash по умолчанию, без паузы перед перезагрузкой
+flash_benchmark_baudrate = 2000000
+flash_benchmark_bootloader = {"restart_delay": 0.0, "seed": 1}
+# Без записей журнала загрузки загрузчик пишет прошивку в слот B
+app_slot_b_address = uart_functions.app_slot_addresses["B"]
+# Счетчики повторов: на линии без ошибок прошивка модели проходит без них. Повтор означает сбой протокола или входа
+# в режим загрузчика, и время такой прошивки сравнивать с базовым нельзя
+retry_counters = ("bootloader_retries_total", "bootloader_resumes_total", "bootloader_nacks_total")
+
+
+def best_time(function, repeats=micro_benchmark_repeats):
+    # Лучшее время из repeats вызовов, с. Вывод функций (сообщения о сжатии и т.п.) не печатается
+    best = None
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        for repeat in range(repeats):
+            started = time.perf_counter()
+            function()
+            elapsed = time.perf_counter() - started
+            best = elapsed if best is None else min(best, elapsed)
+    return best
+
+
+def relative_speed(function, reference, repeats=relative_benchmark_repeats):
+    # Скорость function относительно reference: медиана отношений времени, измеренного парами подряд, поэтому
+    # нагрузка на машину между измерениями почти не влияет на результат
+    ratios = []
+    for repeat in range(repeats):
+        reference_time = best_time(reference, 1)
+        ratios.append(reference_time / best_time(function, 1))
+    return statistics.median(ratios)
+
+
+def result(value, unit, higher_is_better):
+    return {"value": value, "unit": unit, "higher_is_better": higher_is_better}
+
+
+def ratio(value, higher_is_better):
+    # Относительный показатель: отношение двух измерений на одной машине, которое от машины почти не зависит
+    return result(round(value, 3), "ratio", higher_is_better)
+
+
+def is_relative(entry):
+    return entry["unit"] == "ratio"
+
+
+def megabytes_per_second(size, seconds):
+    return result(round(size / seconds / 1024 / 1024, 3), "MB/s", True)
+
+
+def kilobytes_per_second(size, seconds):
+    return result(round(size / seconds / 1024, 3), "KB/s", True)
+
+
+def run_micro_benchmarks(size=micro_benchmark_size):
+    firmware = virtual_bootloader.make_firmware(size)
+    block_size = uart_functions.default_data_block_size
+    data_blocks = uart_functions.split_firmware(firmware, block_size)
+    results = {
+        # Шифрование и расшифровка файла прошивки (encrypt_firmware_file)
+        "xor_encrypt": megabytes_per_second(size, best_time(
+            lambda: cipher.xor_buffer(firmware, virtual_bootloader.default_encryption_key))),
+        # Выбранная при импорте реализация CRC32 MPEG-2 (скорость всех реализаций: python crc.py)
+        "crc32mpeg2": megabytes_per_second(size, best_time(lambda: uart_functions.crc32mpeg2_func(firmware))),
+        # Деление прошивки на блоки с CRC32 каждого блока (open_encrypted_firmware)
+        "split_firmware": megabytes_per_second(size, best_time(
+            lambda: uart_functions.split_firmware(firmware, block_size))),
+    }
+    # Пакеты "data" и "zdat", которые передает send_data
+    for block_format in uart_functions.transfer_formats:
+        results[f"build_packets_{block_format}"] = megabytes_per_second(size, best_time(
+            lambda: uart_functions.build_block_packets(uart_functions.prepare_data_blocks(data_blocks,
+                                                                                          block_format))))
+    # Относительно zlib.crc32 по тем же данным: она есть в любой сборке Python, поэтому переход CRC32 MPEG-2
+    # на медленную реализацию (crcmod или таблицу вместо zlib) заметен на любой машине. Шифрование и сжатие LZ4
+    # так не сравниваются: их скорость зависит от того, установлены ли необязательные пакеты numpy и lz4
+    results["crc32mpeg2_relative"] = ratio(relative_speed(lambda: uart_functions.crc32mpeg2_func(firmware),
+                                                          lambda: zlib.crc32(firmware)), True)
+    return results
+
+
+def get_phase_seconds(port, phase_name):
+    key = ("bootloader_phase_seconds_total", (("phase", phase_name), ("port", port)))
+    return metrics.counters.get(key, 0.0)
+
+
+def get_entry_counters(port):
+    # (число успешных входов в режим загрузчика, число повторов) по порту: имя псевдотерминала может повториться
+    # у следующей модели, поэтому сравниваются значения до и после прошивки
+    entries = metrics.counters.get(("bootloader_phase_total", (("phase", "bootloader_entry"), ("port", port),
+                                                               ("result", "ok"))), 0)
+    retries = sum(value for (name, labels), value in metrics.counters.items()
+                  if name in retry_counters and ("port", port) in labels)
+    return entries, retries
+
+
+def run_flash_benchmark(firmware_path, size):
+    # Полная прошивка новой модели загрузчика командой flash пакетного режима. Время фазы "data" -
+    # передача блоков, полное время включает вход в режим загрузчика, согласование скорости и активацию слота
+    bootloader = virtual_bootloader.VirtualBootloader(**flash_benchmark_bootloader)
+    port = bootloader.start()
+    try:
+        data_seconds = get_phase_seconds(port, "data")
+        entries, retries = get_entry_counters(port)
+        # Прошивка .bin вторым путем - для слота B. Без продолжения передачи: время прошивки с повторами не измеряется
+        argv = ["flash", "-p", port, "-b", str(flash_benchmark_baudrate), "--resume", "0", firmware_path,
+                firmware_path]
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull), \
+                contextlib.redirect_stderr(devnull):
+            started = time.perf_counter()
+            exit_code = cli.main(argv)
+            total_seconds = time.perf_counter() - started
+        if exit_code != cli.exit_success:
+            raise uart_functions.BootloaderError(f"Прошивка модели загрузчика ({size} байт) завершилась с ошибкой")
+        data_seconds = get_phase_seconds(port, "data") - data_seconds
+        # Вход в режим загрузчика ровно один раз и без повторов, иначе результат случайный, а не замедление
+        entries_after, retries_after = get_entry_counters(port)
+        entries, retries = entries_after - entries, retries_after - retries
+        if entries != 1 or retries:
+            raise uart_functions.BootloaderError(f"Прошивка модели загрузчика ({size} байт) прошла с повторами: "
+                                                 f"входов в режим загрузчика {entries}, повторов {retries}")
+    finally:
+        bootloader.stop()
+    name = f"flash_{size // 1024}k"
+    # Модель ограничивает передачу скоростью UART (10 бит на байт), поэтому отношение к времени передачи прошивки
+    # по линии зависит от протокола и времени работы flash модели, а не от машины
+    line_seconds = size * 10 / flash_benchmark_baudrate
+    return {
+        f"{name}_seconds": result(round(total_seconds, 3), "s", False),
+        f"{name}_data": kilobytes_per_second(size, data_seconds),
+        f"{name}_line_efficiency": ratio(line_seconds / data_seconds, True),
+        f"{name}_line_slowdown": ratio(total_seconds / line_seconds, False),
+    }
+
+
+def run_flash_benchmarks(sizes=flash_benchmark_sizes):
+    results = {}
+    with tempfile.TemporaryDirectory() as directory:
+        for size in sizes:
+            firmware_path = os.path.join(directory, f"firmware_{size}.bin")
+            with open(firmware_path, "wb") as firmware_file:
+                firmware_file.write(virtual_bootloader.make_encrypted_firmware(size, app_slot_b_address))
+            results.update(run_flash_benchmark(firmware_path, size))
+    return results
+
+
+def compare_results(results, baseline, tolerance):
+    # Показатели, которые хуже базовых больше чем на tolerance: [(имя, значение, базовое значение)]
+    regressions = []
+    for name, baseline_result in baseline["results"].items():
+        if name not in results:
+            continue
+        value = results[name]["value"]
+        baseline_value = baseline_result["value"]
+        if baseline_result["higher_is_better"]:
+            regressed = value < baseline_value * (1 - tolerance)
+        else:
+            regressed = value > baseline_value * (1 + tolerance)
+        if regressed:
+            regressions.append((name, value, baseline_value))
+    return regressions
+
+
+def print_results(results, baseline):
+    for name, entry in results.items():
+        line = f"{name}: {entry['value']} {entry['unit']}"
+        if baseline is not None and name in baseline["results"]:
+            baseline_value = baseline["results"][name]["value"]
+            line += f" (базовое значение {baseline_value}, {(entry['value'] / baseline_value - 1) * 100:+.1f}%)"
+        print(line)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Измерение скорости Host приложения загрузчика")
+    parser.add_argument("-o", "--output", metavar="PATH", help="записать результаты в файл JSON")
+    parser.add_argument("--baseline", metavar="PATH", default=default_baseline_path,
+                        help="файл базовых значений, с которыми сравниваются результаты")
+    parser.add_argument("--update-baseline", action="store_true",
+                        help="записать результаты как новые базовые значения вместо сравнения")
+    parser.add_argument("--absolute", action="store_true",
+                        help="записать в базовые значения и абсолютные показатели (сравнивать их можно только "
+                             "на той же машине)")
+    parser.add_argument("--tolerance", type=float, default=default_tolerance,
+                        help="допустимое ухудшение показателя относительно базового значения (доля)")
+    parser.add_argument("--no-flash", action="store_true", help="не прошивать модель загрузчика (только расчеты)")
+    arguments = parser.parse_args(argv)
+
+    results = run_micro_benchmarks()
+    if not arguments.no_flash:
+        results.update(run_flash_benchmarks())
+    report = {"version": results_version, "python": platform.python_version(), "machine": platform.machine(),
+              "crc32mpeg2_backend": crc.crc32mpeg2_backend, "results": results}
+
+    if arguments.output is not None:
+        with open(arguments.output, "w", encoding="utf-8") as output_file:
+            json.dump(report, output_file, ensure_ascii=False, indent=2)
+
+    if arguments.update_baseline:
+        baseline = dict(report, results={name: entry for name, entry in results.items()
+                                         if arguments.absolute or is_relative(entry)})
+        with open(arguments.baseline, "w", encoding="utf-8") as baseline_file:
+            json.dump(baseline, baseline_file, ensure_ascii=False, indent=2)
+        print_results(results, None)
+        print(f"Базовые значения записаны в '{arguments.baseline}'")
+        return cli.exit_success
+
+    baseline = None
+    if os.path.isfile(arguments.baseline):
+        with open(arguments.baseline, encoding="utf-8") as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get("version") != results_version:
+            print(f"Версия файла базовых значений {baseline.get('version')} не поддерживается", file=sys.stderr)
+            return cli.exit_error
+    print_results(results, baseline)
+
+    if baseline is None:
+        print(f"Файл базовых значений '{arguments.baseline}' не найден, сравнение пропущено")
+        return cli.exit_success
+    regressions = compare_results(results, baseline, arguments.tolerance)
+    for name, value, baseline_value in regressions:
+        print(f"Замедление {name}: {value}, базовое значение {baseline_value} "
+              f"(допустимо {arguments.tolerance * 100:.0f}%)", file=sys.stderr)
+    return cli.exit_error if regressions else cli.exit_success
+
+
+if __name__ == "__main__":
+    sys.exit(main())
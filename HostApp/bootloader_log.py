@@ -0,0 +1,171 @@
+import struct
+
+# Журнал загрузчика: вместо текста printf загрузчик передает пакеты "loge" (LOG_BINARY_FRAMES) - номер события
+# (log_event_t в bootloader_types.h) и до log_max_arguments целых аргументов. Текст события хранится здесь
+# в том же формате printf, поэтому строки журнала не отличаются от текстового вывода загрузчика.
+# Пакет: "LOGE" + 4 байта события (номер - младшие 16 бит, уровень - следующие 8 бит, число аргументов -
+# старшие 8 бит) + аргументы по 4 байта + CRC32, числа little-endian
+log_word = b"LOGE"
+log_max_arguments = 4
+# Начало пакета и слово события: размер пакета можно определить, когда они приняты
+log_event_header_size = 8
+
+# Уровни журнала (log_level_t): загрузчик передает события с уровнем не больше текущего
+log_level_error = 1
+log_level_warning = 2
+log_level_info = 3
+log_level_debug = 4
+log_levels = {
+    "error": log_level_error,
+    "warning": log_level_warning,
+    "info": log_level_info,
+    "debug": log_level_debug,
+}
+
+# События журнала по номеру: (уровень, формат printf без перевода строки). Номера не меняются,
+# новые события добавляются в конец - как в log_event_t загрузчика
+log_events = {
+    # Запуск загрузчика и переход в приложение
+    1: (log_level_info, "Загрузчик версии: (%d.%d)"),
+    2: (log_level_info, "Приложение запросило режим загрузчика, переходим в режим загрузчика"),
+    3: (log_level_info,
+         "Нажмите кнопку User или передайте пакет \"boot\" в течение %lu мс чтобы перейти в режим загрузчика"),
+    4: (log_level_info, "Кнопка User была нажата, переходим в режим загрузчика"),
+    5: (log_level_info, "Получен пакет \"boot\", переходим в режим загрузчика"),
+    6: (log_level_info, "Кнопка User не нажата, переходим к исполнению пользовательского приложения"),
+    7: (log_level_warning, "Прошивка активного слота 0x%08lX повреждена"),
+    8: (log_level_warning, "Возвращаемся к прошивке слота 0x%08lX"),
+    9: (log_level_warning, "Нет исправной прошивки пользовательского приложения, переходим в режим загрузчика"),
+    10: (log_level_info, "Переходим в User application (слот 0x%08lX)"),
+    11: (log_level_debug, "Значение MSP: %#lx"),
+    12: (log_level_debug, "Адрес обработчика сброса User application: %#lx"),
+    13: (log_level_error, "Ошибка получения ключей шифрования при запуске"),
+    14: (log_level_warning, "Происходит сброс до заводских настроек"),
+    15: (log_level_error, "Ошибка установки настроек по умолчанию!"),
+
+    # Цикл приема команд
+    16: (log_level_error, "Ошибка при получении пакета \"command\""),
+    17: (log_level_error, "Ошибка выполнения команды!"),
+    18: (log_level_info, "Ожидаю следующую команду"),
+    19: (log_level_info, "Перезагрузка микроконтроллера через 3 секунды"),
+    20: (log_level_info, "Перезагрузка МК!"),
+
+    # Выбор команды
+    21: (log_level_info, "Выбрана команда для обновления прошивки, выполняю..."),
+    22: (log_level_info, "Выбрана команда для задания пароля, выполняю..."),
+    23: (log_level_info, "Выбрана команда для проверки защиты flash памяти, выполняю..."),
+    24: (log_level_info, "Выбрана команда для установки защиты flash памяти, выполняю..."),
+    25: (log_level_info, "Выбрана команда для снятия защиты flash памяти, выполняю..."),
+    26: (log_level_info, "Выбрана команда для получения UID, выполняю..."),
+    27: (log_level_info, "Выбрана команда для проверки соответствия ключей шифрования, выполняю..."),
+    28: (log_level_info, "Выбрана команда для стирания пользовательской прошивки из flash памяти, выполняю..."),
+    29: (log_level_info, "Выбрана команда для смены скорости UART, выполняю..."),
+    30: (log_level_info, "Выбрана команда для разностного обновления прошивки, выполняю..."),
+    31: (log_level_info, "Выбрана команда для начала сессии команд, выполняю..."),
+    32: (log_level_info, "Выбрана команда для завершения сессии команд, выполняю..."),
+    33: (log_level_info, "Выбрана команда для проверки записанной прошивки, выполняю..."),
+    34: (log_level_info, "Выбрана команда для отката к предыдущей прошивке, выполняю..."),
+    35: (log_level_error, "Неизвестная команда"),
+
+    # Обновление прошивки
+    36: (log_level_error, "Ошибка при получении header"),
+    37: (log_level_error, "Размер прошивки равен нулю"),
+    38: (log_level_error, "Размер прошивки больше %lu байт"),
+    39: (log_level_error, "Прошивка собрана для адреса 0x%08lX, слот приложения начинается с 0x%08lX"),
+    40: (log_level_error, "Размер блока должен быть степенью двойки от %u до %u байт"),
+    41: (log_level_error, "Размер окна передачи должен быть от 1 до %u блоков и не больше %u байт"),
+    42: (log_level_error, "Формат передачи блоков %lu не поддерживается"),
+    43: (log_level_error, "Участки прошивки не упорядочены, не выровнены по блокам или выходят за прошивку"),
+    44: (log_level_error, "Ошибка при получении блока данных с прошивкой"),
+    45: (log_level_error, "Ошибка при стирании flash памяти"),
+    46: (log_level_error, "Ошибка распаковки блока данных"),
+    47: (log_level_error, "Ошибка при записи блока flash памяти"),
+    48: (log_level_info, "[%lu / %lu]"),
+    49: (log_level_error, "Ошибка при обновлении прошивки"),
+    50: (log_level_info, "Прошивка запрограммирована успешно!"),
+    51: (log_level_error, "CRC32 записанной прошивки не совпадает с CRC32 из header"),
+    52: (log_level_error, "Ошибка при записи журнала загрузки"),
+    53: (log_level_info, "Слот 0x%08lX активен"),
+
+    # Разностное обновление прошивки
+    54: (log_level_error, "Ошибка при получении пакета \"dmap\""),
+    55: (log_level_info, "Прошивка не изменилась, запись не требуется"),
+    56: (log_level_error, "Сектор %lu больше буфера CCMRAM и должен передаваться целиком"),
+    57: (log_level_error, "Ошибка при записи сектора %lu flash памяти"),
+    58: (log_level_info, "Изменено блоков: %lu из %lu, стерто секторов: %lu"),
+
+    # Проверка прошивки, откат, ключи шифрования, защита flash памяти, скорость UART
+    59: (log_level_info, "CRC32 прошивки: %#lx, вычислен за %lu мкс"),
+    60: (log_level_error, "В журнале загрузки нет прошивки для отката"),
+    61: (log_level_error, "Прошивка слота 0x%08lX перезаписана или повреждена, откат невозможен"),
+    62: (log_level_error, "Ошибка при получении пакета \"key\""),
+    63: (log_level_error, "Ошибка установки настроек!"),
+    64: (log_level_info, "Ключи шифрования соответствуют!"),
+    65: (log_level_warning, "Ключи шифрования НЕ соответствуют!"),
+    66: (log_level_info, "Защита flash памяти выключена"),
+    67: (log_level_info, "Защита flash памяти включена (отключение приведет к полному стиранию flash памяти!)"),
+    68: (log_level_info, "Провожу проверку на наличие защиты flash памяти"),
+    69: (log_level_info, "Защита flash памяти успешно включена"),
+    70: (log_level_warning, "Защита flash памяти уже включена, отмена команды"),
+    71: (log_level_info, "Отключаю защиту flash памяти"),
+    72: (log_level_warning, "Защита flash памяти уже выключена, отмена команды"),
+    73: (log_level_error, "Ошибка при получении пакета \"baud\""),
+    74: (log_level_error, "Скорость UART %lu бод не поддерживается"),
+    75: (log_level_info, "Скорость UART изменена на %lu бод"),
+    76: (log_level_warning, "Проверка скорости UART не пройдена, скорость %lu бод"),
+
+    # Работа с flash памятью
+    77: (log_level_error, "Ошибка разблокировки памяти"),
+    78: (log_level_error, "Ошибка стирания памяти"),
+    79: (log_level_error, "Ошибка блокировки памяти"),
+    80: (log_level_info, "Стирание памяти - успешно!"),
+    81: (log_level_error, "Ошибка при записи слова в память"),
+    82: (log_level_error, "Ошибка проверки CRC32 записанного блока"),
+    83: (log_level_error, "Ошибка при записи слова настроек в память"),
+    84: (log_level_error, "Ошибка при записи журнала загрузки в память"),
+    85: (log_level_info, "Начинаю запись настроек по умолчанию во flash"),
+    86: (log_level_info, "Запись настроек в память - успешно!"),
+    87: (log_level_info, "Журнал загрузки заполнен, переписываю сектор настроек"),
+
+    # Прием пакетов
+    88: (log_level_error, "Пустой указатель"),
+    89: (log_level_error, "При использовании HAL функции для получения данных по UART возникла ошибка"),
+    90: (log_level_error, "Ошибка CRC, полученная и вычисленная сумма отличаются"),
+    91: (log_level_error, "Переданные данные не соответствуют пакету типа \"command\""),
+    92: (log_level_error, "Переданные данные не соответствуют пакету типа \"header\""),
+    93: (log_level_error, "Переданные данные не соответствуют пакету типа \"key\""),
+    94: (log_level_error, "Переданные данные не соответствуют пакету типа \"baud\""),
+    95: (log_level_error, "Переданные данные не соответствуют пакету типа \"dmap\""),
+    96: (log_level_error, "four_uint8t_to_one_uint32t - Пустой указатель"),
+}
+
+
+def get_log_frame_size(buffer):
+    # Размер пакета "loge" в начале buffer или None, если слово события еще не пришло. Пакет с числом аргументов
+    # больше допустимого - случайное совпадение начала пакета: размер без CRC32 не пройдет проверку CRC
+    if len(buffer) < log_event_header_size:
+        return None
+    number_of_arguments = buffer[7]
+    if number_of_arguments > log_max_arguments:
+        return log_event_header_size
+    return log_event_header_size + number_of_arguments * 4 + 4
+
+
+def parse_log_event(frame_data):
+    # Данные пакета "loge" без начала и CRC32: (номер события, уровень, аргументы)
+    event_data, = struct.unpack_from("<I", frame_data)
+    number_of_arguments = event_data >> 24
+    arguments = struct.unpack_from(f"<{number_of_arguments}I", frame_data, 4)
+    return event_data & 0xFFFF, (event_data >> 16) & 0xFF, arguments
+
+
+def format_log_event(frame_data):
+    # Строка журнала пакета "loge". Событие, которого нет в log_events (загрузчик новее Host приложения),
+    # выводится номером и аргументами
+    event, level, arguments = parse_log_event(frame_data)
+    if event in log_events:
+        try:
+            return log_events[event][1] % arguments
+        except TypeError:
+            pass
+    return f"Событие журнала {event} (уровень {level}): {', '.join(hex(argument) for argument in arguments)}"
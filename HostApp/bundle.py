@@ -0,0 +1,89 @@
+import hashlib
+import mmap
+import struct
+
+# Формат файла скомпилированной прошивки (.fwb), все числа big-endian:
+# заголовок  - начало файла "FWBN", версия формата, размер прошивки, размер блока, число блоков,
+#              формат передачи блоков, адрес записи, CRC32 образа (как в команде проверки прошивки), SHA-256 образа
+# таблица    - на каждый блок: смещение и размер готового пакета "data" или "zdat" и CRC32 данных блока
+# образ      - прошивка, дополненная 0xFF до целого числа блоков
+# пакеты     - пакеты блоков с порядковыми номерами полной прошивки, готовые к передаче без изменений
+bundle_magic = b"FWBN"
+bundle_version = 1
+bundle_header_format = ">4sIIIIIII32s"
+bundle_block_format = ">III"
+bundle_extension = ".fwb"
+
+
+def is_bundle(path):
+    with open(path, 'rb') as bundle_file:
+        return bundle_file.read(len(bundle_magic)) == bundle_magic
+
+
+def read_header(path):
+    with open(path, 'rb') as bundle_file:
+        return struct.unpack(bundle_header_format, bundle_file.read(struct.calcsize(bundle_header_format)))
+
+
+def read_block_size(path):
+    return read_header(path)[3]
+
+
+def read_target_address(path):
+    # Адрес слота, для которого собрана прошивка
+    return read_header(path)[6]
+
+
+def write_bundle(bundle_path, firmware_size, block_size, block_format, target_address, image, block_crcs,
+                 image_crc, packets):
+    # image - образ, дополненный до целых блоков, packets - пакеты блоков в порядке номеров
+    number_of_blocks = len(block_crcs)
+    header_size = struct.calcsize(bundle_header_format)
+    table_size = struct.calcsize(bundle_block_format) * number_of_blocks
+    packet_offset = header_size + table_size + len(image)
+
+    with open(bundle_path, 'wb') as bundle_file:
+        bundle_file.write(struct.pack(bundle_header_format, bundle_magic, bundle_version, firmware_size, block_size,
+                                      number_of_blocks, block_format, target_address, image_crc,
+                                      hashlib.sha256(image).digest()))
+        for packet, block_crc in zip(packets, block_crcs):
+            bundle_file.write(struct.pack(bundle_block_format, packet_offset, len(packet), block_crc))
+            packet_offset += len(packet)
+        bundle_file.write(image)
+        for packet in packets:
+            bundle_file.write(packet)
+
+
+class FirmwareBundle:
+    # Скомпилированная прошивка, отображенная в память: пакеты и образ - срезы memoryview без копирования
+
+    def __init__(self, bundle_path):
+        with open(bundle_path, 'rb') as bundle_file:
+            self.mapping = mmap.mmap(bundle_file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.mapping)
+
+        header_size = struct.calcsize(bundle_header_format)
+        (magic, version, self.firmware_size, self.block_size, number_of_blocks, self.block_format,
+         self.target_address, self.image_crc, self.digest) = struct.unpack_from(bundle_header_format, self.mapping)
+        if magic != bundle_magic:
+            raise ValueError(f"Файл '{bundle_path}' не является скомпилированной прошивкой")
+        if version != bundle_version:
+            raise ValueError(f"Версия формата {version} не поддерживается (ожидается {bundle_version})")
+
+        block_entry_size = struct.calcsize(bundle_block_format)
+        image_offset = header_size + block_entry_size * number_of_blocks
+        self.image = self.view[image_offset:image_offset + number_of_blocks * self.block_size]
+
+        self.packets = []
+        self.block_crcs = []
+        for block in range(number_of_blocks):
+            packet_offset, packet_size, block_crc = struct.unpack_from(bundle_block_format, self.mapping,
+                                                                       header_size + block * block_entry_size)
+            self.packets.append(self.view[packet_offset:packet_offset + packet_size])
+            self.block_crcs.append(block_crc)
+
+    def block_data(self, block):
+        return self.image[block * self.block_size:(block + 1) * self.block_size]
+
+    def check_digest(self):
+        return hashlib.sha256(self.image).digest() == self.digest
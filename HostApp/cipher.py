@@ -0,0 +1,44 @@
+try:
+    import numpy
+except ImportError:
+    # NumPy не обязателен: без него буфер обрабатывается целиком через int.from_bytes
+    numpy = None
+
+# Размер части файла при потоковом шифровании, байт. Должен быть кратен 4, иначе ключ сдвинется между частями
+stream_chunk_size = 1024 * 1024
+
+
+def key_stream(key, size):
+    # Ключ накладывается на каждое 4 байтное слово в порядке little-endian, как в загрузчике
+    key_bytes = key.to_bytes(4, byteorder="little")
+    return (key_bytes * (size // 4 + 1))[:size]
+
+
+def xor_buffer(data, key):
+    # Шифрование и расшифровка совпадают: XOR каждого 4 байтного слова данных с ключом
+    data_size = len(data)
+    if numpy is not None and data_size >= 4:
+        result = bytearray(data)
+        words_size = data_size - data_size % 4
+        words = numpy.frombuffer(result, dtype="<u4", count=words_size // 4)
+        numpy.bitwise_xor(words, numpy.uint32(key), out=words)
+        tail_stream = key_stream(key, data_size - words_size)
+        for i, key_byte in enumerate(tail_stream):
+            result[words_size + i] ^= key_byte
+        return bytes(result)
+
+    result = int.from_bytes(data, byteorder="little") ^ int.from_bytes(key_stream(key, data_size), byteorder="little")
+    return result.to_bytes(data_size, byteorder="little")
+
+
+def xor_file(source_path, destination_path, key, chunk_size=stream_chunk_size):
+    # Потоковый режим: файл обрабатывается частями, поэтому размер файла не ограничен памятью
+    if chunk_size <= 0 or chunk_size % 4 != 0:
+        raise ValueError(f"Размер части {chunk_size} байт не кратен 4")
+
+    with open(source_path, 'rb') as source_file, open(destination_path, 'wb') as destination_file:
+        while True:
+            chunk = source_file.read(chunk_size)
+            if not chunk:
+                break
+            destination_file.write(xor_buffer(chunk, key))
@@ -0,0 +1,299 @@
+import argparse
+import sys
+import time
+
+import bootloader_log
+import firmware_file
+import fleet
+import metrics
+import uart_functions
+from uart_functions import *
+
+# Коды возврата пакетного режима (2 возвращает argparse при ошибке в аргументах)
+exit_success = 0
+exit_error = 1
+exit_interrupted = 130
+
+# Подкоманды работы с загрузчиком и номера команд загрузчика (host_developer_bootloader_commands)
+device_commands = {
+    "flash": 1,
+    "set-key": 2,
+    "ob-check": 3,
+    "lock": 4,
+    "unlock": 5,
+    "get-uid": 6,
+    "check-key": 7,
+    "erase": 8,
+    "delta-flash": 10,
+    "verify": 13,
+    "rollback": 14,
+}
+
+# Справка для путей до прошивок: прошивка исполняется из слота, для которого собрана
+firmware_paths_help = ("пути до зашифрованных прошивок .bin (первая собрана для слота A, вторая - для слота B), "
+                       ".fwb или прошивок .hex и .elf; используется прошивка для слота, который выбрал загрузчик")
+firmware_key_help = "4 байтный ключ шифрования загрузчика для прошивок .hex и .elf, например 01020304"
+# Подробное описание команд (cli.py <команда> -h)
+command_descriptions = {
+    "delta-flash": "Передаются только блоки, которые отличаются от прошивки неактивного слота. Обновление "
+                   "записывается в неактивный слот, а слоты чередуются, поэтому в нем прошивка на две версии старше "
+                   "текущей (или прерванная передача): передаются изменения двух последних версий, а если слот пуст - "
+                   "вся прошивка.",
+}
+quiet_help = "тихий режим: во время передачи блоков загрузчик присылает только сообщения об ошибках"
+
+
+def parse_key_argument(key_string):
+    try:
+        return parse_key(key_string)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def parse_block_size_argument(block_size_string):
+    # "auto" - размер блока выбирается по качеству линии
+    if block_size_string == "auto":
+        return None
+    if not block_size_string.isdigit() or int(block_size_string) not in data_block_sizes:
+        raise argparse.ArgumentTypeError(f"размер блока должен быть auto или одним из: "
+                                         f"{', '.join(str(size) for size in data_block_sizes)}")
+    return int(block_size_string)
+
+
+def add_block_size_argument(subparser, help_text):
+    subparser.add_argument("--block-size", type=parse_block_size_argument, default=data_block_size, help=help_text)
+
+
+def add_firmware_key_argument(subparser):
+    subparser.add_argument("--firmware-key", type=parse_key_argument, help=firmware_key_help)
+
+
+def add_quiet_argument(subparser):
+    subparser.add_argument("-q", "--quiet", action="store_true", help=quiet_help)
+
+
+# Подкоманды, которым нужна прошивка или ключ шифрования
+firmware_commands = ("flash", "delta-flash", "verify")
+key_commands = ("set-key", "check-key")
+# Подкоманды передачи прошивки, которые можно продолжить после потери связи
+resumable_commands = ("flash", "delta-flash")
+
+
+def get_device_handlers(arguments):
+    return {
+        "flash": lambda uart_serial: update_firmware_command(uart_serial, arguments.firmware),
+        "set-key": lambda uart_serial: set_key_command(uart_serial, arguments.key),
+        "ob-check": flash_ob_check_command,
+        "lock": flash_lock_command,
+        "unlock": flash_unlock_command,
+        "get-uid": get_uid_command,
+        "check-key": lambda uart_serial: check_key_command(uart_serial, arguments.key),
+        "erase": erase_program_command,
+        "rollback": rollback_firmware_command,
+        "delta-flash": lambda uart_serial: delta_update_firmware_command(uart_serial, arguments.firmware),
+        "verify": lambda uart_serial: verify_firmware_command(uart_serial, arguments.firmware),
+    }
+
+
+def run_device_command(arguments):
+    uart_functions.pacing_profile = arguments.pacing
+    if hasattr(arguments, "format"):
+        uart_functions.transfer_format = arguments.format
+    if hasattr(arguments, "block_size"):
+        uart_functions.data_block_size = arguments.block_size
+    command = arguments.command
+    attempts = getattr(arguments, "resume", 0)
+
+    with metrics.phase(arguments.port, "session", command=command):
+        for attempt in range(attempts + 1):
+            # Порт открывается заново: после сбоя USB-UART адаптера старый дескриптор может быть уже недействителен
+            ser, baudrate = start_uart_connection(arguments.port, arguments.baudrate)
+            try:
+                # Ждем перехода прошивки в режим загрузчика
+                wait_bootloader_mode(ser, resume_wait_timeout if attempt else None)
+
+                # Согласуем с загрузчиком выбранную скорость UART
+                negotiate_baudrate(ser, baudrate)
+
+                # Ждем ответа о принятии команды (статуса)
+                send_command_with_status(ser, device_commands[command])
+
+                time.sleep(1)
+                get_device_handlers(arguments)[command](ser)
+                return
+            except TransferInterruptedError as e:
+                if attempt == attempts:
+                    raise
+                # Разностное обновление передает только блоки, которые еще не записаны
+                print(f"{e}. Продолжаю передачу после повторного подключения ({attempt + 1} из {attempts})")
+                metrics.resume(arguments.port, attempt + 1)
+                command = "delta-flash"
+            finally:
+                ser.close()
+
+
+def run_session_commands(arguments):
+    # Все команды выполняются за одно подключение: загрузчик перезагружается только после последней
+    uart_functions.pacing_profile = arguments.pacing
+    uart_functions.transfer_format = arguments.format
+    uart_functions.data_block_size = arguments.block_size
+    device_handlers = get_device_handlers(arguments)
+    with metrics.phase(arguments.port, "session", command=" ".join(arguments.commands)):
+        ser, baudrate = start_uart_connection(arguments.port, arguments.baudrate)
+        try:
+            wait_bootloader_mode(ser)
+            negotiate_baudrate(ser, baudrate)
+            start_command_session(ser)
+
+            for command in arguments.commands:
+                print(f"Выполняю команду {command}")
+                run_session_command(ser, device_commands[command], device_handlers[command])
+
+            end_command_session(ser)
+        finally:
+            ser.close()
+
+
+def run_fleet_command(arguments):
+    uart_functions.pacing_profile = arguments.pacing
+    uart_functions.transfer_format = arguments.format
+    uart_functions.data_block_size = arguments.block_size
+    ports = list(arguments.port)
+    if arguments.match is not None:
+        ports += [port for port in fleet.discover_ports(arguments.match) if port not in ports]
+    if not fleet.run_fleet(ports, arguments.baudrate, arguments.firmware, arguments.jobs):
+        raise BootloaderError("Прошить удалось не все устройства")
+
+
+def run_file_command(arguments):
+    if arguments.command == "encrypt":
+        encrypt_firmware_file(arguments.key, arguments.firmware)
+    else:
+        decrypt_firmware_file(arguments.key, arguments.firmware)
+
+
+def run_bundle_command(arguments):
+    compile_firmware_bundle(arguments.firmware, arguments.output, arguments.format, arguments.block_size,
+                            app_slot_addresses[arguments.slot])
+
+
+def build_parser():
+    parser = argparse.ArgumentParser(description="Host приложение загрузчика STM32F407 (пакетный режим)")
+    parser.add_argument("--metrics-jsonl", metavar="PATH",
+                        help="дописывать в файл время каждой фазы сессии и события передачи (JSON lines)")
+    parser.add_argument("--metrics-prom", metavar="PATH",
+                        help="записывать в файл счетчики фаз, повторов и NACK в текстовом формате Prometheus")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+
+    for command, bootloader_command in device_commands.items():
+        subparser = subparsers.add_parser(command, help=host_developer_bootloader_commands[bootloader_command],
+                                          description=command_descriptions.get(command))
+        subparser.add_argument("-p", "--port", required=True, help="COM-порт устройства, например COM1 или /dev/ttyUSB0")
+        subparser.add_argument("-b", "--baudrate", type=int, default=default_baudrate, choices=supported_baudrates,
+                               help="скорость UART после входа в режим загрузчика")
+        subparser.add_argument("--pacing", default=pacing_profile, choices=list(pacing_profiles),
+                               help="профиль темпа передачи прошивки")
+        if command in ("flash", "delta-flash"):
+            subparser.add_argument("--format", default=transfer_format, choices=list(transfer_formats),
+                                   help="формат передачи блоков прошивки (lz4 - со сжатием)")
+            add_quiet_argument(subparser)
+        if command in resumable_commands:
+            subparser.add_argument("--resume", type=int, default=resume_attempts,
+                                   help="число попыток продолжить передачу после потери связи (0 - не продолжать)")
+        if command in firmware_commands:
+            add_block_size_argument(subparser, "размер блока прошивки в байтах или auto - по качеству линии")
+            subparser.add_argument("firmware", nargs="+", help=firmware_paths_help)
+            add_firmware_key_argument(subparser)
+        if command in key_commands:
+            subparser.add_argument("-k", "--key", type=parse_key_argument, required=True,
+                                   help="4 байтный ключ шифрования, например 01020304")
+        subparser.set_defaults(function=run_device_command)
+
+    subparser = subparsers.add_parser("session", help="Выполнить несколько команд загрузчика за одно подключение")
+    subparser.add_argument("-p", "--port", required=True, help="COM-порт устройства, например COM1 или /dev/ttyUSB0")
+    subparser.add_argument("-b", "--baudrate", type=int, default=default_baudrate, choices=supported_baudrates,
+                           help="скорость UART после входа в режим загрузчика")
+    subparser.add_argument("--pacing", default=pacing_profile, choices=list(pacing_profiles),
+                           help="профиль темпа передачи прошивки")
+    subparser.add_argument("--format", default=transfer_format, choices=list(transfer_formats),
+                           help="формат передачи блоков прошивки (lz4 - со сжатием)")
+    add_block_size_argument(subparser, "размер блока прошивки в байтах или auto - по качеству линии")
+    subparser.add_argument("-k", "--key", type=parse_key_argument,
+                           help="4 байтный ключ шифрования для команд set-key и check-key")
+    subparser.add_argument("-f", "--firmware", action="append",
+                           help=f"{firmware_paths_help}; для команд flash, delta-flash и verify "
+                                f"(можно указать несколько раз)")
+    add_firmware_key_argument(subparser)
+    add_quiet_argument(subparser)
+    subparser.add_argument("commands", nargs="+", choices=list(device_commands),
+                           help="команды в порядке выполнения, например get-uid check-key flash")
+    subparser.set_defaults(function=run_session_commands)
+
+    subparser = subparsers.add_parser("fleet", help="Загрузить прошивку одновременно в несколько микроконтроллеров")
+    subparser.add_argument("-p", "--port", action="append", default=[],
+                           help="COM-порт устройства, можно указать несколько раз")
+    subparser.add_argument("-m", "--match", help="регулярное выражение для поиска портов по имени, описанию или hwid")
+    subparser.add_argument("-j", "--jobs", type=int, default=None, help="число одновременно прошиваемых устройств")
+    subparser.add_argument("-b", "--baudrate", type=int, default=default_baudrate, choices=supported_baudrates,
+                           help="скорость UART после входа в режим загрузчика")
+    subparser.add_argument("--pacing", default=pacing_profile, choices=list(pacing_profiles),
+                           help="профиль темпа передачи прошивки")
+    subparser.add_argument("--format", default=transfer_format, choices=list(transfer_formats),
+                           help="формат передачи блоков прошивки (lz4 - со сжатием)")
+    add_block_size_argument(subparser, "размер блока прошивки в байтах или auto - по качеству линии каждого порта")
+    subparser.add_argument("firmware", nargs="+", help=firmware_paths_help)
+    add_firmware_key_argument(subparser)
+    add_quiet_argument(subparser)
+    subparser.set_defaults(function=run_fleet_command)
+
+    subparser = subparsers.add_parser("bundle", help="Скомпилировать прошивку: подготовить пакеты для передачи заранее")
+    subparser.add_argument("--format", default=transfer_format, choices=list(transfer_formats),
+                           help="формат передачи блоков, для которого готовятся пакеты")
+    subparser.add_argument("--block-size", type=int, default=default_data_block_size, choices=data_block_sizes,
+                           help="размер блока прошивки в байтах, для которого готовятся пакеты")
+    subparser.add_argument("--slot", default="A", choices=list(app_slot_addresses),
+                           help="слот приложения, для которого собрана прошивка")
+    subparser.add_argument("-o", "--output", help="путь до файла .fwb (по умолчанию рядом с прошивкой)")
+    subparser.add_argument("firmware", help="путь до зашифрованной прошивки формата .bin")
+    subparser.set_defaults(function=run_bundle_command)
+
+    for command, help_text in (("encrypt", "Зашифровать прошивку"), ("decrypt", "Расшифровать прошивку")):
+        subparser = subparsers.add_parser(command, help=help_text)
+        subparser.add_argument("-k", "--key", type=parse_key_argument, required=True,
+                               help="4 байтный ключ шифрования, например 01020304")
+        subparser.add_argument("firmware", help="путь до прошивки формата .bin")
+        subparser.set_defaults(function=run_file_command)
+
+    return parser
+
+
+def main(argv=None):
+    parser = build_parser()
+    arguments = parser.parse_args(argv)
+    if arguments.command == "session":
+        if arguments.firmware is None and any(command in firmware_commands for command in arguments.commands):
+            parser.error("для команд flash, delta-flash и verify нужен путь до прошивки (--firmware)")
+        if arguments.key is None and any(command in key_commands for command in arguments.commands):
+            parser.error("для команд set-key и check-key нужен ключ шифрования (--key)")
+    # Прошивки .hex и .elf шифруются перед передачей, в пакетном режиме ключ не запрашивается
+    firmware_paths = getattr(arguments, "firmware", None)
+    if isinstance(firmware_paths, list) and getattr(arguments, "firmware_key", None) is None \
+            and any(firmware_file.is_segmented_firmware(path) for path in firmware_paths):
+        parser.error("для прошивок .hex и .elf нужен ключ шифрования загрузчика (--firmware-key)")
+    uart_functions.firmware_encryption_key = getattr(arguments, "firmware_key", None)
+    uart_functions.transfer_log_level = bootloader_log.log_level_error if getattr(arguments, "quiet", False) else None
+    metrics.jsonl_path = arguments.metrics_jsonl
+    metrics.prometheus_path = arguments.metrics_prom
+    try:
+        arguments.function(arguments)
+    except KeyboardInterrupt:
+        print("Прервано пользователем", file=sys.stderr)
+        return exit_interrupted
+    except Exception as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        return exit_error
+    return exit_success
+
+
+if __name__ == "__main__":
+    sys.exit(main())
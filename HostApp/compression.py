@@ -0,0 +1,113 @@
+try:
+    import lz4.block
+except ImportError:
+    # Пакет lz4 не обязателен: без него блоки сжимаются встроенным кодером того же формата
+    lz4 = None
+
+# Формат LZ4 block: последовательности "токен, литералы, смещение совпадения, длина совпадения".
+# Минимальная длина совпадения
+min_match_size = 4
+# Последние 5 байт блока всегда литералы, а последнее совпадение начинается не позже чем за 12 байт до конца
+last_literals_size = 5
+match_find_limit = 12
+# Максимальное смещение совпадения (2 байта)
+max_match_offset = 65535
+
+
+def write_length(output, length):
+    # Продолжение длины: байты 255, пока остаток не станет меньше 255
+    while length >= 255:
+        output.append(255)
+        length -= 255
+    output.append(length)
+
+
+def write_sequence(output, literals, match_offset=0, match_size=0):
+    literals_size = len(literals)
+    token_literals = min(literals_size, 15)
+    token_match = min(match_size - min_match_size, 15) if match_size else 0
+    output.append((token_literals << 4) | token_match)
+    if literals_size >= 15:
+        write_length(output, literals_size - 15)
+    output += literals
+    if match_size:
+        output += match_offset.to_bytes(2, byteorder="little")
+        if match_size - min_match_size >= 15:
+            write_length(output, match_size - min_match_size - 15)
+
+
+def lz4_compress_block(data):
+    # Жадный кодер: для каждой позиции ищем последнее вхождение тех же 4 байт
+    if lz4 is not None:
+        return lz4.block.compress(bytes(data), store_size=False)
+
+    data_size = len(data)
+    output = bytearray()
+    last_positions = {}
+    anchor = 0
+    position = 0
+
+    while position < data_size - match_find_limit:
+        sequence = data[position:position + min_match_size]
+        candidate = last_positions.get(sequence)
+        last_positions[sequence] = position
+
+        if candidate is None or position - candidate > max_match_offset:
+            position += 1
+            continue
+
+        match_size = min_match_size
+        max_match_size = data_size - last_literals_size - position
+        while match_size < max_match_size and data[candidate + match_size] == data[position + match_size]:
+            match_size += 1
+
+        write_sequence(output, data[anchor:position], position - candidate, match_size)
+        position += match_size
+        anchor = position
+
+    write_sequence(output, data[anchor:])
+    return bytes(output)
+
+
+def lz4_decompress_block(data, decompressed_size):
+    # Повторяет lz4_decompress_block загрузчика, используется для проверки сжатых блоков
+    output = bytearray()
+    index = 0
+
+    while index < len(data):
+        token = data[index]
+        index += 1
+
+        literals_size = token >> 4
+        if literals_size == 15:
+            while True:
+                length_byte = data[index]
+                index += 1
+                literals_size += length_byte
+                if length_byte != 255:
+                    break
+        output += data[index:index + literals_size]
+        index += literals_size
+
+        if index == len(data):
+            break
+
+        match_offset = int.from_bytes(data[index:index + 2], byteorder="little")
+        index += 2
+        if match_offset == 0 or match_offset > len(output):
+            raise ValueError("Неверное смещение совпадения LZ4")
+
+        match_size = (token & 0x0F) + min_match_size
+        if token & 0x0F == 15:
+            while True:
+                length_byte = data[index]
+                index += 1
+                match_size += length_byte
+                if length_byte != 255:
+                    break
+        for i in range(match_size):
+            output.append(output[-match_offset])
+
+    if len(output) != decompressed_size:
+        raise ValueError(f"Размер распакованного блока {len(output)} байт вместо {decompressed_size}")
+    return bytes(output)
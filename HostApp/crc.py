@@ -0,0 +1,122 @@
+import importlib.util
+import sys
+import time
+import zlib
+
+try:
+    import crcmod
+except ImportError:
+    crcmod = None
+# Пакет crcmod не обязателен, а без C расширения он считает CRC на Python медленнее таблиц ниже
+if crcmod is not None and importlib.util.find_spec("crcmod._crcfunext") is None:
+    crcmod = None
+
+# CRC32 MPEG-2, как в аппаратном блоке CRC STM32F407: полином 0x04C11DB7, начальное значение 0xFFFFFFFF,
+# без отражения битов и без финального XOR
+crc32mpeg2_polynomial = 0x04C11DB7
+crc32mpeg2_init = 0xFFFFFFFF
+
+# Размер данных и число повторов для встроенного измерения скорости
+benchmark_size = 1024 * 1024
+benchmark_repeats = 3
+
+
+def make_slicing_tables(polynomial, number_of_tables=8):
+    # Таблица 0 - CRC одного байта, таблица k - CRC байта, за которым следуют k нулевых байт
+    tables = [[0] * 256 for i in range(number_of_tables)]
+    for byte in range(256):
+        crc = byte << 24
+        for bit in range(8):
+            crc = ((crc << 1) ^ polynomial if crc & 0x80000000 else crc << 1) & 0xFFFFFFFF
+        tables[0][byte] = crc
+    for table in range(1, number_of_tables):
+        for byte in range(256):
+            previous = tables[table - 1][byte]
+            tables[table][byte] = ((previous << 8) & 0xFFFFFFFF) ^ tables[0][previous >> 24]
+    return tables
+
+
+crc32mpeg2_tables = make_slicing_tables(crc32mpeg2_polynomial)
+
+# Перестановка битов в каждом байте: CRC32 MPEG-2 - это CRC32 zlib без отражения битов,
+# поэтому zlib считает ее по данным с отраженными байтами
+reflected_bytes = bytes(int(f"{byte:08b}"[::-1], 2) for byte in range(256))
+
+
+def reflect32(value):
+    # Отражение 32 битного слова: байты в обратном порядке, биты каждого байта - по таблице
+    return int.from_bytes(value.to_bytes(4, byteorder="little").translate(reflected_bytes), byteorder="big")
+
+
+def crc32mpeg2_table(data, crc=crc32mpeg2_init):
+    # Slicing-by-8: за итерацию обрабатывается 8 байт, по одному обращению к каждой из 8 таблиц
+    t0, t1, t2, t3, t4, t5, t6, t7 = crc32mpeg2_tables
+    data = bytes(data)
+    words_size = len(data) - len(data) % 8
+    for index in range(0, words_size, 8):
+        crc ^= int.from_bytes(data[index:index + 4], byteorder="big")
+        crc = (t7[crc >> 24] ^ t6[(crc >> 16) & 0xFF] ^ t5[(crc >> 8) & 0xFF] ^ t4[crc & 0xFF]
+               ^ t3[data[index + 4]] ^ t2[data[index + 5]] ^ t1[data[index + 6]] ^ t0[data[index + 7]])
+    for byte in data[words_size:]:
+        crc = ((crc << 8) & 0xFFFFFFFF) ^ t0[(crc >> 24) ^ byte]
+    return crc
+
+
+def crc32mpeg2_zlib(data, crc=crc32mpeg2_init):
+    # zlib.crc32 хранит регистр отраженным и инвертированным, поэтому состояние переводится туда и обратно
+    zlib_crc = zlib.crc32(bytes(data).translate(reflected_bytes), reflect32(crc) ^ 0xFFFFFFFF)
+    return reflect32(zlib_crc ^ 0xFFFFFFFF)
+
+
+# Реализации в порядке предпочтения: при импорте выбирается первая доступная. zlib есть всегда и на блоках
+# от 1 Кбайт быстрее C расширения crcmod в 2-4 раза (python crc.py); crcmod быстрее только на коротких пакетах
+crc32mpeg2_backends = {"zlib": crc32mpeg2_zlib}
+if crcmod is not None:
+    crc32mpeg2_backends["crcmod"] = crcmod.mkCrcFun(0x100000000 | crc32mpeg2_polynomial, initCrc=crc32mpeg2_init,
+                                                    xorOut=0x0, rev=False)
+crc32mpeg2_backends["table"] = crc32mpeg2_table
+
+crc32mpeg2_backend = next(iter(crc32mpeg2_backends))
+crc32mpeg2_function = crc32mpeg2_backends[crc32mpeg2_backend]
+
+
+def set_backend(name):
+    global crc32mpeg2_backend, crc32mpeg2_function
+    if name not in crc32mpeg2_backends:
+        raise ValueError(f"Реализация CRC32 '{name}' недоступна, доступны: {', '.join(crc32mpeg2_backends)}")
+    crc32mpeg2_backend = name
+    crc32mpeg2_function = crc32mpeg2_backends[name]
+
+
+def crc32mpeg2(data, crc=crc32mpeg2_init):
+    # crc - значение после предыдущей части данных, чтобы считать CRC по частям
+    return crc32mpeg2_function(data, crc)
+
+
+def benchmark(size=benchmark_size, repeats=benchmark_repeats):
+    # Скорость каждой доступной реализации, байт/с (лучшее из repeats измерений)
+    data = bytes(index * 7 & 0xFF for index in range(size))
+    expected_crc = crc32mpeg2_table(data)
+    results = {}
+    for name, function in crc32mpeg2_backends.items():
+        if function(data) != expected_crc:
+            raise ValueError(f"Реализация CRC32 '{name}' вычисляет неверный результат")
+        best_time = None
+        for repeat in range(repeats):
+            started = time.perf_counter()
+            function(data)
+            elapsed = time.perf_counter() - started
+            best_time = elapsed if best_time is None else min(best_time, elapsed)
+        results[name] = size / best_time
+    return results
+
+
+def main():
+    print(f"Выбрана реализация CRC32 MPEG-2: {crc32mpeg2_backend}")
+    for name, speed in benchmark().items():
+        print(f"{name}: {speed / 1024 / 1024:.1f} МБ/с")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,116 @@
+import os
+import struct
+
+# Прошивки с адресами данных: Intel HEX и ELF (результат сборки без objcopy -O binary). Файл читается в список
+# участков [(адрес, данные)] по возрастанию адреса, соседние участки объединяются. Участки не зашифрованы:
+# Host приложение шифрует их перед передачей, как encrypt_firmware_file - прошивку .bin
+hex_extensions = (".hex", ".ihex")
+elf_extensions = (".elf", ".axf", ".out")
+
+# Типы записей Intel HEX
+hex_data_record = 0x00
+hex_end_of_file_record = 0x01
+hex_extended_segment_address_record = 0x02
+hex_start_segment_address_record = 0x03
+hex_extended_linear_address_record = 0x04
+hex_start_linear_address_record = 0x05
+
+# ELF: начало файла, 32 битный класс, порядок байт, тип сегмента программы с данными для загрузки
+elf_magic = b"\x7fELF"
+elf_class_32 = 1
+elf_byte_orders = {1: "<", 2: ">"}
+elf_program_load = 1
+
+
+def is_segmented_firmware(path):
+    return os.path.splitext(path)[1].lower() in hex_extensions + elf_extensions
+
+
+def merge_segments(segments):
+    # Участки по возрастанию адреса, перекрывающиеся участки - ошибка сборки прошивки
+    merged_segments = []
+    for address, data in sorted(segments, key=lambda segment: segment[0]):
+        if not data:
+            continue
+        if merged_segments:
+            last_address, last_data = merged_segments[-1]
+            last_end = last_address + len(last_data)
+            if address < last_end:
+                raise ValueError(f"участки 0x{last_address:08X} и 0x{address:08X} перекрываются")
+            if address == last_end:
+                last_data += data
+                continue
+        merged_segments.append((address, bytearray(data)))
+    return [(address, bytes(data)) for address, data in merged_segments]
+
+
+def read_hex_segments(path):
+    segments = []
+    base_address = 0
+    with open(path, "r", encoding="ascii") as hex_file:
+        for line_number, line in enumerate(hex_file, 1):
+            line = line.strip()
+            if not line:
+                continue
+            if not line.startswith(":"):
+                raise ValueError(f"строка {line_number}: запись должна начинаться с ':'")
+            try:
+                record = bytes.fromhex(line[1:])
+            except ValueError:
+                raise ValueError(f"строка {line_number}: запись содержит не шестнадцатеричные символы")
+            if len(record) < 5 or len(record) != record[0] + 5:
+                raise ValueError(f"строка {line_number}: длина записи не совпадает с числом байт данных")
+            if sum(record) & 0xFF:
+                raise ValueError(f"строка {line_number}: неверная контрольная сумма")
+
+            record_address, record_type = struct.unpack_from(">HB", record, 1)
+            record_data = record[4:-1]
+            if record_type == hex_data_record:
+                segments.append((base_address + record_address, record_data))
+            elif record_type == hex_end_of_file_record:
+                break
+            elif record_type == hex_extended_segment_address_record:
+                base_address = int.from_bytes(record_data, byteorder="big") << 4
+            elif record_type == hex_extended_linear_address_record:
+                base_address = int.from_bytes(record_data, byteorder="big") << 16
+            elif record_type not in (hex_start_segment_address_record, hex_start_linear_address_record):
+                raise ValueError(f"строка {line_number}: тип записи {record_type} не поддерживается")
+    return merge_segments(segments)
+
+
+def read_elf_segments(path):
+    # Загружаемые сегменты программы по физическому адресу (LMA): начальные значения .data лежат во flash
+    # после кода, хотя выполняются из RAM. Сегменты без данных в файле (.bss) пропускаются
+    with open(path, "rb") as elf_file:
+        elf_data = elf_file.read()
+    if elf_data[:4] != elf_magic:
+        raise ValueError("файл не является ELF")
+    if elf_data[4] != elf_class_32:
+        raise ValueError("поддерживаются только 32 битные ELF")
+    byte_order = elf_byte_orders.get(elf_data[5])
+    if byte_order is None:
+        raise ValueError(f"порядок байт ELF {elf_data[5]} не поддерживается")
+
+    program_header_offset, = struct.unpack_from(byte_order + "I", elf_data, 28)
+    program_header_size, number_of_program_headers = struct.unpack_from(byte_order + "HH", elf_data, 42)
+    segments = []
+    for program_header in range(number_of_program_headers):
+        (segment_type, file_offset, virtual_address, physical_address,
+         file_size) = struct.unpack_from(byte_order + "IIIII", elf_data,
+                                         program_header_offset + program_header * program_header_size)
+        if segment_type != elf_program_load or file_size == 0:
+            continue
+        if file_offset + file_size > len(elf_data):
+            raise ValueError(f"сегмент 0x{physical_address:08X} выходит за конец файла")
+        segments.append((physical_address, elf_data[file_offset:file_offset + file_size]))
+    return merge_segments(segments)
+
+
+def read_segments(path):
+    if os.path.splitext(path)[1].lower() in hex_extensions:
+        segments = read_hex_segments(path)
+    else:
+        segments = read_elf_segments(path)
+    if not segments:
+        raise ValueError("файл не содержит данных прошивки")
+    return segments
@@ -0,0 +1,176 @@
+import concurrent.futures
+import sys
+import threading
+import time
+
+import serial.tools.list_ports
+
+import metrics
+from uart_functions import *
+
+# Интервал вывода общего прогресса прошивки, с
+progress_interval = 2.0
+
+# Состояния сессии прошивки одного устройства
+state_queued = "в очереди"
+state_connecting = "подключение"
+state_waiting_bootloader = "ожидание загрузчика"
+state_negotiating = "согласование скорости"
+state_sending_command = "передача команды"
+state_transferring = "передача прошивки"
+state_resuming = "повторное подключение"
+state_done = "готово"
+state_failed = "ошибка"
+
+
+class ThreadPrefixWriter:
+    # Подменяет sys.stdout на время прошивки: перед каждой строкой потока устройства ставит имя его порта,
+    # чтобы вывод разных устройств не перемешивался внутри строки
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.lock = threading.Lock()
+        self.local = threading.local()
+
+    def set_prefix(self, prefix):
+        self.local.prefix = prefix
+        self.local.buffer = ""
+
+    def write(self, text):
+        prefix = getattr(self.local, "prefix", None)
+        with self.lock:
+            if prefix is None:
+                return self.stream.write(text)
+            self.local.buffer += text
+            while "\n" in self.local.buffer:
+                line, self.local.buffer = self.local.buffer.split("\n", 1)
+                self.stream.write(f"[{prefix}] {line}\n")
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+
+class DeviceSession:
+    # Прошивка одного устройства: те же шаги, что и в интерактивном режиме, с отметкой текущего состояния
+
+    def __init__(self, port, baudrate, firmware_paths):
+        self.port = port
+        self.baudrate = baudrate
+        self.firmware_paths = firmware_paths
+        self.state = state_queued
+        self.acknowledged_blocks = 0
+        self.number_of_blocks = 0
+        self.error = None
+        self.started = None
+        self.finished = None
+
+    def progress(self, acknowledged_blocks, number_of_blocks):
+        self.acknowledged_blocks = acknowledged_blocks
+        self.number_of_blocks = number_of_blocks
+
+    def transfer(self, resumed):
+        # После потери связи передаются только незаписанные блоки (разностное обновление)
+        ser = None
+        try:
+            self.state = state_connecting
+            ser, baudrate = start_uart_connection(self.port, self.baudrate)
+
+            self.state = state_waiting_bootloader
+            wait_bootloader_mode(ser, resume_wait_timeout if resumed else None)
+
+            self.state = state_negotiating
+            negotiate_baudrate(ser, baudrate)
+
+            self.state = state_sending_command
+            command = "Обновить прошивку (передать только измененные блоки)" if resumed \
+                else "Загрузить прошивку в микроконтроллер"
+            send_command_with_status(ser, get_key(command, host_developer_bootloader_commands))
+            time.sleep(1)
+
+            self.state = state_transferring
+            if resumed:
+                delta_update_firmware_command(ser, self.firmware_paths, self.progress)
+            else:
+                update_firmware_command(ser, self.firmware_paths, self.progress)
+        finally:
+            if ser is not None:
+                ser.close()
+
+    def run(self):
+        self.started = time.monotonic()
+        try:
+            with metrics.phase(self.port, "session", command="fleet"):
+                for attempt in range(resume_attempts + 1):
+                    try:
+                        self.transfer(attempt > 0)
+                        break
+                    except TransferInterruptedError:
+                        if attempt == resume_attempts:
+                            raise
+                        self.state = state_resuming
+                        metrics.resume(self.port, attempt + 1)
+            self.state = state_done
+        except Exception as e:
+            self.error = str(e)
+            self.state = state_failed
+        finally:
+            self.finished = time.monotonic()
+        return self.state == state_done
+
+
+def discover_ports(pattern):
+    # Порты, у которых имя, описание или hwid совпадают с регулярным выражением pattern
+    return [port.device for port in serial.tools.list_ports.grep(pattern)]
+
+
+def run_session(writer, session):
+    writer.set_prefix(session.port)
+    return session.run()
+
+
+def print_fleet_progress(sessions):
+    acknowledged_blocks = sum(session.acknowledged_blocks for session in sessions)
+    number_of_blocks = sum(session.number_of_blocks for session in sessions)
+    done = sum(session.state == state_done for session in sessions)
+    failed = sum(session.state == state_failed for session in sessions)
+    print(f"Прогресс: готово {done} из {len(sessions)}, ошибок {failed}, "
+          f"передано блоков {acknowledged_blocks} из {number_of_blocks}")
+
+
+def print_fleet_report(sessions, elapsed):
+    print("Результат прошивки устройств:")
+    for session in sessions:
+        session_time = session.finished - session.started if session.finished is not None else 0.0
+        line = f"{session.port}: {session.state}, {session_time:.1f} с"
+        if session.error is not None:
+            line += f" ({session.error})"
+        print(line)
+    done = sum(session.state == state_done for session in sessions)
+    print(f"Прошито {done} из {len(sessions)} устройств за {elapsed:.1f} с")
+
+
+def run_fleet(ports, baudrate, firmware_paths, max_workers=None):
+    # Прошивает все устройства одновременно, по одному потоку на порт. Возвращает True, если прошиты все
+    if not ports:
+        raise BootloaderError("Ошибка run_fleet: не найдено ни одного порта")
+
+    sessions = [DeviceSession(port, baudrate, firmware_paths) for port in ports]
+    started = time.monotonic()
+
+    original_stdout = sys.stdout
+    writer = ThreadPrefixWriter(original_stdout)
+    sys.stdout = writer
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers or len(sessions)) as executor:
+            futures = [executor.submit(run_session, writer, session) for session in sessions]
+            while True:
+                done, not_done = concurrent.futures.wait(futures, timeout=progress_interval)
+                print_fleet_progress(sessions)
+                if not not_done:
+                    break
+    finally:
+        sys.stdout = original_stdout
+
+    print_fleet_report(sessions, time.monotonic() - started)
+    return all(session.state == state_done for session in sessions)
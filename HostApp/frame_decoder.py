@@ -0,0 +1,109 @@
+import collections
+
+
+class FrameDecoder:
+    # Потоковый разбор байт, приходящих по UART.
+    # Пакеты ищутся по 4 байтным началам (COMD, HEAD, DATA, RESP, ACKW, ...), проверяются по CRC32
+    # и складываются в очередь. Все остальные байты - это текст printf, он собирается в строки
+    # и передается в отдельный канал журнала (log_handler), а также ставится в ту же очередь,
+    # чтобы сохранить порядок строк и пакетов. Пакеты журнала (log_formatters) превращаются в такие же строки.
+
+    def __init__(self, frame_sizes, crc_func, crc_byteorder, log_handler=None, log_formatters=None):
+        # frame_sizes: словарь {начало пакета: полный размер пакета с CRC или функция, которая возвращает
+        # размер по началу буфера (None - размер еще неизвестен)}
+        # crc_byteorder: порядок байт CRC в пакете ("little" у загрузчика, "big" у Host приложения)
+        # log_formatters: словарь {начало пакета журнала: функция, которая возвращает строку по данным пакета}
+        self.frame_sizes = frame_sizes
+        self.crc_func = crc_func
+        self.crc_byteorder = crc_byteorder
+        self.log_handler = log_handler
+        self.log_formatters = log_formatters or {}
+        self.buffer = bytearray()
+        self.text = bytearray()
+        # Очередь принятых событий: ("frame", (начало пакета, данные пакета)) или ("log", строка).
+        # Размер не ограничен: при ограничении пакеты, которые не успели прочитать (например, сотни "resp"
+        # с CRC32 блоков), молча отбрасывались бы. Очередь освобождают pop_frame и pop_log_line
+        self.events = collections.deque()
+
+    def feed(self, data):
+        self.buffer += data
+        self._parse_frames()
+        self._parse_text()
+
+    def _find_frame_start(self):
+        indexes = [index for index in (self.buffer.find(word) for word in self.frame_sizes) if index != -1]
+        return min(indexes) if indexes else -1
+
+    def _partial_word_size(self):
+        # Длина окончания буфера, совпадающего с началом одного из пакетов, который еще не пришел целиком
+        for size in range(min(len(self.buffer), 3), 0, -1):
+            suffix = bytes(self.buffer[-size:])
+            if any(word.startswith(suffix) for word in self.frame_sizes):
+                return size
+        return 0
+
+    def _parse_frames(self):
+        while True:
+            index = self._find_frame_start()
+            if index == -1:
+                # Остальные байты - текст: иначе строка, после которой загрузчик замолкает, не завершится
+                keep = self._partial_word_size()
+                self.text += self.buffer[:len(self.buffer) - keep]
+                del self.buffer[:len(self.buffer) - keep]
+                return
+
+            self.text += self.buffer[:index]
+            del self.buffer[:index]
+            self._parse_text()
+
+            word = bytes(self.buffer[:4])
+            frame_size = self.frame_sizes[word]
+            if callable(frame_size):
+                frame_size = frame_size(self.buffer)
+            if frame_size is None or len(self.buffer) < frame_size:
+                return
+
+            frame = bytes(self.buffer[:frame_size])
+            frame_crc = int.from_bytes(frame[-4:], byteorder=self.crc_byteorder)
+            if self.crc_func(frame[:-4]) == frame_crc:
+                if word in self.log_formatters:
+                    self._add_log_line(self.log_formatters[word](frame[4:-4]))
+                else:
+                    self.events.append(("frame", (word, frame[4:-4])))
+                del self.buffer[:frame_size]
+            else:
+                # Совпадение начала пакета случайное (например, внутри текста): сдвигаемся на один байт
+                self.text += self.buffer[:1]
+                del self.buffer[:1]
+
+    def _parse_text(self):
+        while True:
+            index = self.text.find(b"\n")
+            if index == -1:
+                return
+            line = self.text[:index].decode("utf-8", errors="replace").strip("\r\x00 ")
+            del self.text[:index + 1]
+            if line:
+                self._add_log_line(line)
+
+    def _add_log_line(self, line):
+        self.events.append(("log", line))
+        if self.log_handler is not None:
+            self.log_handler(line)
+
+    def pop_frame(self, words):
+        # Возвращает первый пакет с одним из начал words. Строки журнала и пакеты других типов,
+        # пришедшие раньше него, отбрасываются
+        while self.events:
+            event_type, event = self.events.popleft()
+            if event_type == "frame" and event[0] in words:
+                return event
+        return None
+
+    def pop_log_line(self):
+        # Возвращает первую строку журнала, пакеты до нее отбрасываются
+        while self.events:
+            event_type, event = self.events.popleft()
+            if event_type == "log":
+                return event
+        return None
@@ -1,9 +1,15 @@
+import functools
 import time
 
 import serial
 from serial import *
 
 from uart_functions import *
+import cli
+
+# С аргументами командной строки работаем в пакетном режиме, без вопросов пользователю (python main.py --help)
+if len(sys.argv) > 1:
+    sys.exit(cli.main())
 
 try:
     # Ждем выбор режима пользователь\разработчик
@@ -21,34 +27,27 @@ try:
         elif developer_command == get_key("Работа с загрузчиком", host_developer_commands):
 
             # Устанавливаем uart соединение
-            ser = start_uart_connection()
+            ser, baudrate = start_uart_connection()
 
             # Ждем перехода прошивки в режим загрузчика
             wait_bootloader_mode(ser)
 
-            # Разработчик вводит команду для загрузчика
-            command = input_developer_bootloader_command()
+            # Согласуем с загрузчиком выбранную скорость UART
+            negotiate_baudrate(ser, baudrate)
 
-            # Ждем ответа о принятии команды (статуса)
-            status_result = 0
-            number_of_try_connection = 0
+            # Команды выполняются в одной сессии, пока разработчик не выберет выход
+            start_command_session(ser)
 
-            while number_of_try_connection < max_usart_connection_try:
-                send_command(ser, command)
-                status_result = wait_status(ser)
-                if status_result == 1:
-                    print("Команда передана успешно")
+            while True:
+                # Разработчик вводит команду для загрузчика
+                command = input_developer_bootloader_command()
+                if command == 0:
+                    end_command_session(ser)
                     break
-                else:
-                    number_of_try_connection += 1
-
-            if status_result == 0:
-                raise Exception("Загрузчик не отвечает пакетом \"статус\"")
 
-            number_of_try_connection = 0
-
-            time.sleep(1)
-            execute_develop_bootloader_command(ser, command)
+                # Ждем ответа о принятии команды (статуса), выполняем команду и ждем готовности к следующей
+                run_session_command(ser, command,
+                                    functools.partial(execute_develop_bootloader_command, command=command))
 
         else:
             raise Exception("Ошибка при выборе команды хост программы")
@@ -56,11 +55,14 @@ try:
         # Режим пользователя
 
         # Устанавливаем uart соединение
-        ser = start_uart_connection()
+        ser, baudrate = start_uart_connection()
 
         # Ждем перехода прошивки в режим загрузчика
         wait_bootloader_mode(ser)
 
+        # Согласуем с загрузчиком выбранную скорость UART
+        negotiate_baudrate(ser, baudrate)
+
         # Пользователь вводит команду для загрузчика
         command = input_user_bootloader_command()
 
@@ -70,24 +72,11 @@ try:
             command_to_bootloader = 1
         if command == 2:
             command_to_bootloader = 6
+        if command == 3:
+            command_to_bootloader = 10
 
         # Ждем ответа о принятии команды (статуса)
-        status_result = 0
-        number_of_try_connection = 0
-
-        while number_of_try_connection < max_usart_connection_try:
-            send_command(ser, command_to_bootloader)
-            status_result = wait_status(ser)
-            if status_result == 1:
-                print("Команда передана успешно")
-                break
-            else:
-                number_of_try_connection += 1
-
-        if status_result == 0:
-            raise Exception("Загрузчик не отвечает пакетом \"статус\"")
-
-        number_of_try_connection = 0
+        send_command_with_status(ser, command_to_bootloader)
 
         time.sleep(1)
         execute_user_bootloader_command(ser, command)
@@ -98,7 +87,7 @@ try:
 
 except Exception as e:
     print(f"Ошибка main: {e}")
-    exit(0)
+    exit(1)
 
 # for i in range(100):
 #     response = ser.readline().decode("utf-8").strip()
@@ -0,0 +1,113 @@
+import contextlib
+import json
+import os
+import threading
+import time
+
+# Файл, в который дописывается каждое событие сессии загрузчика одной строкой JSON (None - не записывать)
+jsonl_path = None
+# Файл счетчиков в текстовом формате Prometheus (None - не записывать). Файл перезаписывается целиком после каждой
+# фазы, поэтому его можно отдавать через textfile collector node_exporter во время прошивки
+prometheus_path = None
+
+# Описания счетчиков для # HELP. Метка port - COM-порт устройства, phase - фаза сессии
+counter_descriptions = {
+    "bootloader_phase_seconds_total": "Время, проведенное в фазе сессии загрузчика, с",
+    "bootloader_phase_total": "Число завершенных фаз сессии загрузчика по результату",
+    "bootloader_retries_total": "Число повторных передач пакета в фазе",
+    "bootloader_nacks_total": "Число пакетов NACK при передаче прошивки",
+    "bootloader_status_timeouts_total": "Число окон, подтверждение которых не пришло вовремя",
+    "bootloader_windows_total": "Число подтвержденных окон блоков прошивки",
+    "bootloader_window_latency_seconds_total": "Суммарная задержка подтверждения окон, с",
+    "bootloader_program_seconds_total": "Суммарное время записи окон во flash по отчетам загрузчика, с",
+    "bootloader_data_blocks_total": "Число подтвержденных блоков прошивки",
+    "bootloader_data_bytes_total": "Число переданных байт пакетов блоков прошивки, включая повторные передачи",
+    "bootloader_resumes_total": "Число продолжений передачи после потери связи",
+}
+
+# (имя счетчика, метки) -> значение. Метки - кортеж пар (имя, значение), отсортированный по имени
+counters = {}
+metrics_lock = threading.Lock()
+# Фазы устройств при прошивке нескольких устройств заканчиваются в разных потоках
+prometheus_lock = threading.Lock()
+
+
+def port_name(uart_serial):
+    # События можно записывать и по открытому порту, и по его имени (до открытия порта)
+    return getattr(uart_serial, "port", uart_serial)
+
+
+def add(name, value=1, **labels):
+    key = (name, tuple(sorted(labels.items())))
+    with metrics_lock:
+        counters[key] = counters.get(key, 0) + value
+
+
+def event(uart_serial, name, **fields):
+    if jsonl_path is None:
+        return
+    record = {"time": round(time.time(), 6), "port": port_name(uart_serial), "event": name}
+    record.update(fields)
+    line = json.dumps(record, ensure_ascii=False) + "\n"
+    with metrics_lock:
+        with open(jsonl_path, "a", encoding="utf-8") as jsonl_file:
+            jsonl_file.write(line)
+
+
+def retry(uart_serial, phase_name, attempt):
+    add("bootloader_retries_total", port=port_name(uart_serial), phase=phase_name)
+    event(uart_serial, "retry", phase=phase_name, attempt=attempt)
+
+
+def resume(uart_serial, attempt):
+    add("bootloader_resumes_total", port=port_name(uart_serial))
+    event(uart_serial, "resume", attempt=attempt)
+
+
+@contextlib.contextmanager
+def phase(uart_serial, name, **fields):
+    # Засекает время фазы. Через возвращаемый словарь фаза дополняет событие своими полями, а ключом "result"
+    # сообщает о неудаче, о которой не сигнализирует исключение. При исключении результат фазы - "error"
+    started = time.monotonic()
+    details = dict(fields)
+    result = "error"
+    try:
+        yield details
+        result = details.pop("result", "ok")
+    finally:
+        duration = time.monotonic() - started
+        port = port_name(uart_serial)
+        add("bootloader_phase_seconds_total", duration, port=port, phase=name)
+        add("bootloader_phase_total", port=port, phase=name, result=result)
+        event(uart_serial, "phase", phase=name, result=result, duration=round(duration, 6), **details)
+        write_prometheus()
+
+
+def escape_label(value):
+    return str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+
+
+def format_prometheus():
+    with metrics_lock:
+        items = sorted(counters.items())
+    lines = []
+    last_name = None
+    for (name, labels), value in items:
+        if name != last_name:
+            lines.append(f"# HELP {name} {counter_descriptions.get(name, name)}")
+            lines.append(f"# TYPE {name} counter")
+            last_name = name
+        label_text = ",".join(f"{label}=\"{escape_label(label_value)}\"" for label, label_value in labels)
+        lines.append(f"{name}{{{label_text}}} {value}" if label_text else f"{name} {value}")
+    return "\n".join(lines) + "\n"
+
+
+def write_prometheus():
+    if prometheus_path is None:
+        return
+    # Запись через временный файл: читатель не увидит файл, записанный наполовину
+    temporary_path = prometheus_path + ".tmp"
+    with prometheus_lock:
+        with open(temporary_path, "w", encoding="utf-8") as prometheus_file:
+            prometheus_file.write(format_prometheus())
+        os.replace(temporary_path, prometheus_path)
@@ -0,0 +1,45 @@
+import re
+import struct
+
+import pytest
+
+import bootloader_log
+
+# Строки журнала из пакетов "loge": каждое событие log_events форматируется без ошибок
+
+
+def make_event_data(event, level, arguments):
+    return struct.pack("<I", event | level << 16 | len(arguments) << 24) + struct.pack(f"<{len(arguments)}I",
+                                                                                      *arguments)
+
+
+def count_arguments(log_format):
+    # Число спецификаторов printf в формате (%% - не спецификатор)
+    return len(re.findall(r"%[^%]*?[diouxXsc]", log_format.replace("%%", "")))
+
+
+@pytest.mark.parametrize("event", sorted(bootloader_log.log_events))
+def test_every_event_is_formatted(event):
+    level, log_format = bootloader_log.log_events[event]
+    arguments = tuple(range(1, count_arguments(log_format) + 1))
+    assert len(arguments) <= bootloader_log.log_max_arguments
+    line = bootloader_log.format_log_event(make_event_data(event, level, arguments))
+    assert line == log_format % arguments
+
+
+def test_unknown_event_is_formatted_by_number():
+    line = bootloader_log.format_log_event(make_event_data(0xFFFF, bootloader_log.log_level_error, (0x10, 0x20)))
+    assert line == "Событие журнала 65535 (уровень 1): 0x10, 0x20"
+
+
+def test_wrong_number_of_arguments_is_formatted_by_number():
+    line = bootloader_log.format_log_event(make_event_data(10, bootloader_log.log_level_info, ()))
+    assert line.startswith("Событие журнала 10 ")
+
+
+@pytest.mark.parametrize("number_of_arguments", range(bootloader_log.log_max_arguments + 1))
+def test_log_frame_size(number_of_arguments):
+    header = bootloader_log.log_word + make_event_data(1, bootloader_log.log_level_info,
+                                                       (0,) * number_of_arguments)[:4]
+    assert bootloader_log.get_log_frame_size(header[:7]) is None
+    assert bootloader_log.get_log_frame_size(header) == 8 + 4 * number_of_arguments + 4
@@ -0,0 +1,66 @@
+import struct
+
+import pytest
+
+import bundle
+
+# Скомпилированная прошивка .fwb: запись и чтение без изменения пакетов, CRC32 блоков и образа
+
+block_size = 256
+number_of_blocks = 3
+target_address = 0x08020000
+
+
+def write_test_bundle(path):
+    image = bytes(index & 0xFF for index in range(block_size * number_of_blocks))
+    packets = [b"DATA" + bytes([block]) * (10 + block) for block in range(number_of_blocks)]
+    block_crcs = [0x11111111 * (block + 1) for block in range(number_of_blocks)]
+    bundle.write_bundle(path, len(image) - 100, block_size, 1, target_address, image, block_crcs, 0xCAFEBABE,
+                        packets)
+    return image, packets, block_crcs
+
+
+def test_write_then_load(tmp_path):
+    path = str(tmp_path / ("firmware" + bundle.bundle_extension))
+    image, packets, block_crcs = write_test_bundle(path)
+
+    assert bundle.is_bundle(path)
+    assert bundle.read_block_size(path) == block_size
+    assert bundle.read_target_address(path) == target_address
+
+    firmware_bundle = bundle.FirmwareBundle(path)
+    assert firmware_bundle.firmware_size == len(image) - 100
+    assert firmware_bundle.block_size == block_size
+    assert firmware_bundle.block_format == 1
+    assert firmware_bundle.target_address == target_address
+    assert firmware_bundle.image_crc == 0xCAFEBABE
+    assert [bytes(packet) for packet in firmware_bundle.packets] == packets
+    assert firmware_bundle.block_crcs == block_crcs
+    assert bytes(firmware_bundle.block_data(1)) == image[block_size:2 * block_size]
+    assert firmware_bundle.check_digest()
+
+
+def test_bin_file_is_not_bundle(tmp_path):
+    path = tmp_path / "firmware.bin"
+    path.write_bytes(b"\xFF" * 64)
+    assert not bundle.is_bundle(str(path))
+
+
+def test_load_rejects_other_version(tmp_path):
+    path = tmp_path / ("firmware" + bundle.bundle_extension)
+    write_test_bundle(str(path))
+    data = bytearray(path.read_bytes())
+    struct.pack_into(">I", data, len(bundle.bundle_magic), bundle.bundle_version + 1)
+    path.write_bytes(data)
+    with pytest.raises(ValueError):
+        bundle.FirmwareBundle(str(path))
+
+
+def test_damaged_image_fails_digest_check(tmp_path):
+    path = tmp_path / ("firmware" + bundle.bundle_extension)
+    write_test_bundle(str(path))
+    data = bytearray(path.read_bytes())
+    header_size = struct.calcsize(bundle.bundle_header_format)
+    data[header_size + struct.calcsize(bundle.bundle_block_format) * number_of_blocks] ^= 0xFF
+    path.write_bytes(data)
+    assert not bundle.FirmwareBundle(str(path)).check_digest()
@@ -0,0 +1,52 @@
+import random
+
+import pytest
+
+import cipher
+
+# XOR шифр прошивки: результат не зависит от реализации (numpy или int) и от деления файла на части
+
+test_key = 0x13121411
+
+
+def make_data(size, seed=1):
+    generator = random.Random(seed)
+    return bytes(generator.randrange(256) for i in range(size))
+
+
+def xor_reference(data, key):
+    # Побайтный XOR с ключом little-endian, как в загрузчике
+    key_bytes = key.to_bytes(4, byteorder="little")
+    return bytes(byte ^ key_bytes[index % 4] for index, byte in enumerate(data))
+
+
+@pytest.mark.parametrize("size", [0, 1, 3, 4, 5, 1023, 1024])
+def test_xor_buffer_matches_reference(size):
+    data = make_data(size)
+    assert cipher.xor_buffer(data, test_key) == xor_reference(data, test_key)
+    assert cipher.xor_buffer(cipher.xor_buffer(data, test_key), test_key) == data
+
+
+@pytest.mark.parametrize("size", [4, 7, 4096, 4099])
+def test_numpy_path_matches_int_path(size, monkeypatch):
+    pytest.importorskip("numpy")
+    data = make_data(size)
+    numpy_result = cipher.xor_buffer(data, test_key)
+    monkeypatch.setattr(cipher, "numpy", None)
+    assert cipher.xor_buffer(data, test_key) == numpy_result
+
+
+@pytest.mark.parametrize("chunk_size", [4, 12, 1024, cipher.stream_chunk_size])
+def test_xor_file_does_not_depend_on_chunk_size(tmp_path, chunk_size):
+    data = make_data(4099)
+    source_path = tmp_path / "source.bin"
+    destination_path = tmp_path / "destination.bin"
+    source_path.write_bytes(data)
+    cipher.xor_file(source_path, destination_path, test_key, chunk_size)
+    assert destination_path.read_bytes() == xor_reference(data, test_key)
+
+
+@pytest.mark.parametrize("chunk_size", [0, 6])
+def test_xor_file_rejects_chunk_size_not_multiple_of_4(tmp_path, chunk_size):
+    with pytest.raises(ValueError):
+        cipher.xor_file(tmp_path / "source.bin", tmp_path / "destination.bin", test_key, chunk_size)
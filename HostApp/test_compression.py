@@ -0,0 +1,60 @@
+import os
+import random
+
+import pytest
+
+import compression
+
+# Сжатие блоков LZ4: распаковка в модели загрузчика (как lz4_decompress_block на устройстве) возвращает исходный
+# блок при сжатии и пакетом lz4, и встроенным кодером
+
+block_size = 1024
+
+
+def make_compressible_block(size=block_size, seed=1):
+    generator = random.Random(seed)
+    block = bytearray()
+    while len(block) < size:
+        block += bytes([generator.randrange(256)]) * generator.randrange(1, 300)
+        block += bytes(generator.randrange(256) for i in range(generator.randrange(0, 20)))
+    return bytes(block[:size])
+
+
+blocks = {
+    "compressible": make_compressible_block(),
+    "long_runs": b"\x00" * 300 + b"\xFF" * 700 + b"\x01" * 24,
+    "incompressible": os.urandom(block_size),
+    "short": b"abc",
+    "empty": b"",
+}
+
+
+@pytest.fixture(params=["builtin", "lz4"])
+def encoder(request, monkeypatch):
+    if request.param == "lz4":
+        pytest.importorskip("lz4.block")
+    else:
+        monkeypatch.setattr(compression, "lz4", None)
+    return compression.lz4_compress_block
+
+
+@pytest.mark.parametrize("name", list(blocks))
+def test_round_trip(encoder, name):
+    block = blocks[name]
+    assert compression.lz4_decompress_block(encoder(block), len(block)) == block
+
+
+def test_compressible_block_gets_smaller(encoder):
+    assert len(encoder(blocks["compressible"])) < block_size
+
+
+def test_decompress_rejects_wrong_size():
+    compressed = compression.lz4_compress_block(blocks["compressible"])
+    with pytest.raises(ValueError):
+        compression.lz4_decompress_block(compressed, block_size + 1)
+
+
+def test_decompress_rejects_offset_before_start():
+    # Токен: 1 литерал и совпадение со смещением 2, которое выходит за начало распакованных данных
+    with pytest.raises(ValueError):
+        compression.lz4_decompress_block(b"\x10a\x02\x00", 5)
@@ -0,0 +1,40 @@
+import pytest
+
+import crc
+
+# CRC32 MPEG-2 (как в аппаратном блоке CRC STM32F407): все доступные реализации дают одинаковый результат
+
+# Контрольные значения CRC-32/MPEG-2
+known_vectors = [
+    (b"", 0xFFFFFFFF),
+    (b"123456789", 0x0376E6E7),
+    (b"\x00", 0x4E08BFB4),
+    (b"\xFF\xFF\xFF\xFF", 0x00000000),
+]
+
+
+@pytest.fixture(params=list(crc.crc32mpeg2_backends))
+def backend(request):
+    return crc.crc32mpeg2_backends[request.param]
+
+
+@pytest.mark.parametrize("data, expected_crc", known_vectors)
+def test_known_vectors(backend, data, expected_crc):
+    assert backend(data) == expected_crc
+
+
+def test_crc_by_parts_matches_whole_buffer(backend):
+    data = bytes(index * 7 & 0xFF for index in range(1000))
+    assert backend(data[400:], backend(data[:400])) == backend(data)
+
+
+def test_backends_match_table_on_every_tail_size(backend):
+    # Slicing-by-8 обрабатывает хвост короче 8 байт отдельно
+    data = bytes(range(256)) * 2
+    for size in range(0, 17):
+        assert backend(data[:size]) == crc.crc32mpeg2_table(data[:size])
+
+
+def test_set_backend_rejects_unknown_name():
+    with pytest.raises(ValueError):
+        crc.set_backend("unknown")
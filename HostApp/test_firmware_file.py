@@ -0,0 +1,112 @@
+import struct
+
+import pytest
+
+import firmware_file
+
+# Чтение прошивок Intel HEX и ELF в участки [(адрес, данные)]
+
+
+def hex_record(record_type, address=0, data=b""):
+    record = struct.pack(">BHB", len(data), address, record_type) + data
+    return ":" + (record + bytes([-sum(record) & 0xFF])).hex().upper() + "\n"
+
+
+def write_hex(tmp_path, records):
+    path = tmp_path / "firmware.hex"
+    path.write_text("".join(records), encoding="ascii")
+    return str(path)
+
+
+def write_elf(tmp_path, segments, byte_order="<"):
+    # 32 битный ELF с сегментами программы [(тип, виртуальный адрес, физический адрес, данные)]
+    header_size = 52
+    program_header_size = 32
+    data_offset = header_size + program_header_size * len(segments)
+    program_headers = b""
+    segments_data = b""
+    for segment_type, virtual_address, physical_address, data in segments:
+        program_headers += struct.pack(byte_order + "IIIIIIII", segment_type, data_offset + len(segments_data),
+                                       virtual_address, physical_address, len(data), len(data), 5, 4)
+        segments_data += data
+    identification = firmware_file.elf_magic + bytes([firmware_file.elf_class_32,
+                                                      1 if byte_order == "<" else 2, 1]) + bytes(9)
+    header = identification + struct.pack(byte_order + "HHIIIIIHHHHHH", 2, 40, 1, 0, header_size, 0, 0,
+                                          header_size, program_header_size, len(segments), 0, 0, 0)
+    path = tmp_path / "firmware.elf"
+    path.write_bytes(header + program_headers + segments_data)
+    return str(path)
+
+
+def test_hex_all_record_types(tmp_path):
+    path = write_hex(tmp_path, [
+        hex_record(firmware_file.hex_extended_linear_address_record, data=b"\x08\x02"),
+        hex_record(firmware_file.hex_data_record, 0x0000, b"\x01\x02\x03\x04"),
+        hex_record(firmware_file.hex_data_record, 0x0004, b"\x05\x06"),
+        hex_record(firmware_file.hex_extended_segment_address_record, data=b"\x10\x00"),
+        hex_record(firmware_file.hex_data_record, 0x0010, b"\xAA\xBB"),
+        hex_record(firmware_file.hex_start_segment_address_record, data=b"\x00\x00\x01\x00"),
+        hex_record(firmware_file.hex_start_linear_address_record, data=b"\x08\x02\x01\xC1"),
+        hex_record(firmware_file.hex_end_of_file_record),
+        hex_record(firmware_file.hex_data_record, 0x0100, b"\xEE"),
+    ])
+    # Соседние записи объединяются, записи после конца файла не читаются
+    assert firmware_file.read_segments(path) == [
+        (0x00010010, b"\xAA\xBB"),
+        (0x08020000, b"\x01\x02\x03\x04\x05\x06"),
+    ]
+
+
+@pytest.mark.parametrize("line", [
+    "0400000001020304F2\n",
+    ":0400000001020304F3\n",
+    ":0500000001020304F2\n",
+    ":0400000001020304ZZ\n",
+    ":00000006FA\n",
+])
+def test_hex_rejects_invalid_records(tmp_path, line):
+    with pytest.raises(ValueError):
+        firmware_file.read_segments(write_hex(tmp_path, [line]))
+
+
+def test_hex_without_data_is_rejected(tmp_path):
+    with pytest.raises(ValueError):
+        firmware_file.read_segments(write_hex(tmp_path, [hex_record(firmware_file.hex_end_of_file_record)]))
+
+
+@pytest.mark.parametrize("byte_order", ["<", ">"])
+def test_elf_load_segments_by_physical_address(tmp_path, byte_order):
+    path = write_elf(tmp_path, [
+        (firmware_file.elf_program_load, 0x08020000, 0x08020000, b"\x11" * 8),
+        # .data выполняется из RAM, но начальные значения лежат во flash сразу после кода
+        (firmware_file.elf_program_load, 0x20000000, 0x08020008, b"\x22" * 4),
+        # Не загружаемый сегмент и сегмент без данных в файле (.bss) пропускаются
+        (4, 0x08030000, 0x08030000, b"\x33" * 4),
+        (firmware_file.elf_program_load, 0x20000100, 0x20000100, b""),
+    ], byte_order)
+    assert firmware_file.read_segments(path) == [(0x08020000, b"\x11" * 8 + b"\x22" * 4)]
+
+
+def test_elf_rejects_64_bit_class(tmp_path):
+    path = tmp_path / "firmware.elf"
+    path.write_bytes(firmware_file.elf_magic + bytes([2, 1, 1]) + bytes(45))
+    with pytest.raises(ValueError):
+        firmware_file.read_segments(str(path))
+
+
+def test_merge_segments_sorts_and_joins_adjacent():
+    assert firmware_file.merge_segments([(0x20, b"\x03"), (0x10, b"\x01"), (0x11, b"\x02"), (0x30, b"")]) == [
+        (0x10, b"\x01\x02"),
+        (0x20, b"\x03"),
+    ]
+
+
+def test_merge_segments_rejects_overlap():
+    with pytest.raises(ValueError):
+        firmware_file.merge_segments([(0x10, b"\x01\x02"), (0x11, b"\x03")])
+
+
+@pytest.mark.parametrize("path, expected", [("app.hex", True), ("APP.ELF", True), ("app.axf", True),
+                                            ("app.bin", False), ("app.fwb", False)])
+def test_is_segmented_firmware(path, expected):
+    assert firmware_file.is_segmented_firmware(path) == expected
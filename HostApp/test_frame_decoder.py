@@ -0,0 +1,114 @@
+import bootloader_log
+import crc
+from frame_decoder import FrameDecoder
+
+# Разбор потока байт загрузчика без порта: пакеты статуса, журнала "loge" и текст printf вперемешку
+
+ack_word = b"ACKW"
+response_word = b"RESP"
+frame_sizes = {
+    ack_word: 12,
+    response_word: 12,
+    bootloader_log.log_word: bootloader_log.get_log_frame_size,
+}
+log_formatters = {bootloader_log.log_word: bootloader_log.format_log_event}
+
+
+def make_frame(word, data):
+    # Пакет загрузчика: CRC32 MPEG-2 начала и данных в порядке little-endian
+    return word + data + crc.crc32mpeg2(word + data).to_bytes(4, byteorder="little")
+
+
+def make_status_frame(word, value):
+    return make_frame(word, value.to_bytes(4, byteorder="little"))
+
+
+def make_log_frame(event, *arguments):
+    level = bootloader_log.log_events[event][0]
+    event_data = event | level << 16 | len(arguments) << 24
+    data = event_data.to_bytes(4, byteorder="little") + b"".join(
+        argument.to_bytes(4, byteorder="little") for argument in arguments)
+    return make_frame(bootloader_log.log_word, data)
+
+
+def make_decoder(log_lines=None):
+    log_handler = None if log_lines is None else log_lines.append
+    return FrameDecoder(frame_sizes, crc.crc32mpeg2, "little", log_handler, log_formatters)
+
+
+def decode(data, chunk_size=None):
+    decoder = make_decoder()
+    chunk_size = chunk_size or len(data)
+    for index in range(0, len(data), chunk_size):
+        decoder.feed(data[index:index + chunk_size])
+    return list(decoder.events)
+
+
+def test_text_and_frames_keep_order():
+    stream = b"first line\r\n" + make_status_frame(ack_word, 3) + b"second line\n"
+    assert decode(stream) == [
+        ("log", "first line"),
+        ("frame", (ack_word, (3).to_bytes(4, byteorder="little"))),
+        ("log", "second line"),
+    ]
+
+
+def test_byte_by_byte_feed_matches_whole_feed():
+    # Начало пакета, разорванное между чтениями порта, не попадает в текст
+    stream = (b"text\n" + make_status_frame(response_word, 0x12345678) + make_log_frame(1, 0, 2)
+              + b"tail\n" + make_status_frame(ack_word, 8))
+    assert decode(stream, 1) == decode(stream)
+    assert len(decode(stream, 1)) == 5
+
+
+def test_corrupted_crc_is_rejected():
+    frame = bytearray(make_status_frame(ack_word, 1))
+    frame[-1] ^= 0x01
+    decoder = make_decoder()
+    decoder.feed(bytes(frame))
+    assert decoder.pop_frame((ack_word,)) is None
+
+
+def test_resync_after_corrupted_byte():
+    # Поврежденный пакет пропускается побайтно, следующий за ним пакет принимается
+    damaged_frame = bytearray(make_status_frame(response_word, 5))
+    damaged_frame[5] ^= 0x40
+    stream = b"\x00\x13" + bytes(damaged_frame) + make_status_frame(response_word, 6) + b"\n"
+    frames = [event for event_type, event in decode(stream) if event_type == "frame"]
+    assert frames == [(response_word, (6).to_bytes(4, byteorder="little"))]
+
+
+def test_resync_after_false_start_word():
+    # Начало пакета без пакета: размер захватывает начало следующего пакета, и CRC32 не совпадает
+    stream = ack_word + b"\xff" * 3 + make_status_frame(ack_word, 7)
+    frames = [event for event_type, event in decode(stream) if event_type == "frame"]
+    assert frames == [(ack_word, (7).to_bytes(4, byteorder="little"))]
+
+
+def test_log_frames_interleave_with_text_and_frames():
+    log_lines = []
+    decoder = make_decoder(log_lines)
+    decoder.feed(b"text before\n" + make_log_frame(10, 0x08020000) + make_status_frame(ack_word, 1)
+                 + make_log_frame(4) + b"text after\n")
+    assert log_lines == [
+        "text before",
+        "Переходим в User application (слот 0x08020000)",
+        "Кнопка User была нажата, переходим в режим загрузчика",
+        "text after",
+    ]
+    assert [event_type for event_type, event in decoder.events] == ["log", "log", "frame", "log", "log"]
+
+
+def test_pop_frame_skips_earlier_log_lines():
+    decoder = make_decoder()
+    decoder.feed(b"line\n" + make_status_frame(response_word, 1) + make_status_frame(ack_word, 2) + b"last\n")
+    assert decoder.pop_frame((ack_word,)) == (ack_word, (2).to_bytes(4, byteorder="little"))
+    assert decoder.pop_log_line() == "last"
+    assert decoder.pop_log_line() is None
+
+
+def test_log_frame_with_too_many_arguments_is_not_a_frame():
+    data = (1 | bootloader_log.log_level_info << 16 | (bootloader_log.log_max_arguments + 1) << 24)
+    decoder = make_decoder()
+    decoder.feed(bootloader_log.log_word + data.to_bytes(4, byteorder="little") + b"\n")
+    assert all(event_type == "log" for event_type, event in decoder.events)
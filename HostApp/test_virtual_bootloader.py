@@ -0,0 +1,124 @@
+import contextlib
+import os
+
+import pytest
+
+import bootloader_log
+import cipher
+import cli
+import metrics
+import uart_functions
+import virtual_bootloader
+
+# Проверка протокола на модели загрузчика (virtual_bootloader.py) без устройства: python -m pytest HostApp.
+# Линия без ограничения скоростью UART и почти мгновенное стирание flash, чтобы тесты шли секунды
+
+firmware_size = 64 * 1024
+test_baudrate = "921600"
+# Вероятность ошибки бита и seed модели, при которых ошибки каждого направления линии попадают в одни и те же биты:
+# прошивка проходит с двумя NACK и пятью окнами без подтверждения вовремя, без продолжения после потери связи
+test_bit_error_rate = 0.00003
+test_seed = 1
+expected_nacks = 2
+expected_retries = 7
+# Номера событий журнала о неверном начале пакета (LOG_EVENT_NOT_*_PACKET) по началу пакета
+not_packet_events = {
+    uart_functions.command_word: 91,
+    uart_functions.header_word: 92,
+    uart_functions.key_word: 93,
+    uart_functions.baud_word: 94,
+    uart_functions.delta_map_word: 95,
+}
+
+
+@pytest.fixture
+def firmware_paths(tmp_path):
+    # Зашифрованные прошивки .bin для слотов A и B, как принимает cli.py
+    paths = []
+    for slot_name, slot_address in uart_functions.app_slot_addresses.items():
+        path = tmp_path / f"firmware_{slot_name}.bin"
+        path.write_bytes(virtual_bootloader.make_encrypted_firmware(firmware_size, slot_address))
+        paths.append(str(path))
+    return paths
+
+
+def start_bootloader(bit_error_rate=0.0, seed=1):
+    bootloader = virtual_bootloader.VirtualBootloader(erase_time=0.01, restart_delay=0.0, emulate_line_rate=False,
+                                                      bit_error_rate=bit_error_rate, seed=seed)
+    return bootloader, bootloader.start()
+
+
+def run_cli(command, port, firmware_paths):
+    with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+        return cli.main([command, "-p", port, "-b", test_baudrate] + firmware_paths)
+
+
+def read_slot(bootloader, slot_address, size):
+    # Модель хранит во flash расшифрованную прошивку, как настоящий загрузчик
+    offset = slot_address - virtual_bootloader.app_flash_start_address
+    return bytes(bootloader.flash[offset:offset + size])
+
+
+def expected_slot_data(firmware_paths, slot_address):
+    slot_name = uart_functions.get_slot_name(slot_address)
+    with open(firmware_paths["AB".index(slot_name)], "rb") as firmware:
+        return cipher.xor_buffer(firmware.read(), virtual_bootloader.default_encryption_key)
+
+
+def test_flash_then_delta_flash(firmware_paths):
+    bootloader, port = start_bootloader()
+    try:
+        assert run_cli("flash", port, firmware_paths) == cli.exit_success
+        flashed_slot = bootloader.get_active_app_slot()
+        assert read_slot(bootloader, flashed_slot, firmware_size) == expected_slot_data(firmware_paths, flashed_slot)
+
+        # Неактивный слот пуст: разностное обновление передает все блоки и переключает слот
+        assert run_cli("delta-flash", port, firmware_paths) == cli.exit_success
+        updated_slot = bootloader.get_active_app_slot()
+        assert updated_slot != flashed_slot
+        assert read_slot(bootloader, updated_slot, firmware_size) == expected_slot_data(firmware_paths, updated_slot)
+
+        # Неактивный слот уже содержит ту же прошивку: блоки не передаются и не записываются
+        written_blocks = bootloader.statistics["written_blocks"]
+        assert run_cli("delta-flash", port, firmware_paths) == cli.exit_success
+        assert bootloader.statistics["written_blocks"] == written_blocks
+        assert bootloader.get_active_app_slot() == flashed_slot
+
+        assert run_cli("verify", port, firmware_paths) == cli.exit_success
+    finally:
+        bootloader.stop()
+
+
+def get_counter(name, port):
+    return sum(value for (counter_name, labels), value in metrics.counters.items()
+               if counter_name == name and ("port", port) in labels)
+
+
+def test_flash_retransmits_after_bit_errors(firmware_paths):
+    bootloader, port = start_bootloader(test_bit_error_rate, test_seed)
+    # Имя псевдотерминала может совпасть с именем из предыдущего теста, поэтому считаем приращение счетчиков
+    counter_names = ("bootloader_nacks_total", "bootloader_retries_total", "bootloader_resumes_total")
+    counters = {name: get_counter(name, port) for name in counter_names}
+    try:
+        assert run_cli("flash", port, firmware_paths) == cli.exit_success
+        counters = {name: get_counter(name, port) - value for name, value in counters.items()}
+        assert bootloader.statistics["bit_errors"] > 0
+        assert bootloader.statistics["nack"] == expected_nacks
+        assert counters == {"bootloader_nacks_total": expected_nacks, "bootloader_retries_total": expected_retries,
+                            "bootloader_resumes_total": 0}
+        flashed_slot = bootloader.get_active_app_slot()
+        assert read_slot(bootloader, flashed_slot, firmware_size) == expected_slot_data(firmware_paths, flashed_slot)
+    finally:
+        bootloader.stop()
+
+
+@pytest.mark.parametrize("word", list(not_packet_events))
+def test_packet_with_wrong_start_word_is_logged(word):
+    # Пакет с поврежденным началом: модель сообщает о нем событием журнала загрузчика и ждет следующий пакет
+    bootloader = virtual_bootloader.VirtualBootloader(bit_error_rate=0.0)
+    sent = []
+    bootloader.read_bytes = lambda size, timeout=None: b"XXXX" + bytes(size - 4)
+    bootloader.write_bytes = sent.append
+    assert bootloader.get_packet(word, 12) is None
+    assert len(sent) == 1 and sent[0].startswith(bootloader_log.log_word)
+    assert bootloader_log.parse_log_event(sent[0][4:-4])[0] == not_packet_events[word]
@@ -5,9 +5,19 @@ import sys
 import struct
 from serial import *
 import serial.tools.list_ports
-import crcmod
 import time
 import math
+import os
+import threading
+
+import bootloader_log
+import bundle
+import cipher
+import compression
+import crc
+import firmware_file
+import metrics
+from frame_decoder import FrameDecoder
 
 command_word = b"COMD"
 header_word = b"HEAD"
@@ -17,6 +27,11 @@ response_word = b"RESP"
 test_word = b"TEST"
 ack_word = b"ACKW"
 nack_word = b"NACK"
+baud_word = b"BAUD"
+delta_map_word = b"DMAP"
+compressed_data_word = b"ZDAT"
+program_time_word = b"PTIM"
+boot_word = b"BOOT"
 
 bootloader_responses = {"ok": 0xFFFFFFFF,
                         "fail": 0x33333333, }
@@ -29,7 +44,8 @@ persons = {
 host_user_commands = {
     0: "Выход из программы",
     1: "Загрузить прошивку в микроконтроллер",
-    2: "Узнать ID устройства"
+    2: "Узнать ID устройства",
+    3: "Обновить прошивку (передать только измененные блоки)",
 }
 
 host_developer_commands = {
@@ -50,12 +66,175 @@ host_developer_bootloader_commands = {
     6: "Узнать UID микроконтроллера",
     7: "Проверить соответствие ключей шифрования",
     8: "Очистить flash память с прошивкой",
+    10: "Обновить прошивку (передать только измененные блоки)",
+    13: "Проверить записанную прошивку по CRC32",
+    14: "Вернуться к предыдущей прошивке",
 }
 
 max_usart_connection_try = 10
 
+# Команда загрузчика для согласования скорости UART (CMD_SET_BAUDRATE в enum cmd_t).
+# В меню не выводится: выполняется автоматически перед основной командой
+set_baudrate_command = 9
+
+# Команды сессии (CMD_START_SESSION и CMD_RESET). После начала сессии загрузчик не перезагружается после
+# каждой команды, а ждет следующую, пока не получит команду завершения сессии
+start_session_command = 11
+reset_command = 12
+
+# Строки журнала, которыми загрузчик заканчивает команду: перезагрузка или ожидание следующей команды сессии
+restart_line = "Перезагрузка МК!"
+session_ready_line = "Ожидаю следующую команду"
+
+# Скорость, на которой загрузчик работает после сброса
+default_baudrate = 115200
+
+# Скорости, на которые можно перейти после входа в режим загрузчика (должны совпадать с supported_baudrates загрузчика)
+supported_baudrates = [115200, 230400, 460800, 921600, 1000000, 2000000]
+
+# Время, за которое загрузчик ждет пакет проверки новой скорости (BAUDRATE_PROBE_TIMEOUT_MS), с
+baudrate_probe_timeout = 1.0
+
+# Данные пакета "boot" (BOOTLOADER_ENTRY_MAGIC). Пакет принимают загрузчик в первые BOOTLOADER_ENTRY_WINDOW_MS
+# после сброса и пользовательское приложение с поддержкой входа в режим загрузчика
+bootloader_entry_magic = 0xB007B007
+# Интервал повтора пакета "boot", с. Должен быть меньше BOOTLOADER_ENTRY_QUIET_MS загрузчика
+boot_request_interval = 0.05
+# Время тишины после входа в режим загрузчика (BOOTLOADER_ENTRY_QUIET_MS), с. Пока оно не истекло, загрузчик
+# пропускает все, что не является пакетом "boot", поэтому первую команду передаем позже
+bootloader_entry_quiet = 0.1
+# Строки, которыми загрузчик сообщает о входе в режим загрузчика
+bootloader_entry_lines = (
+    "Кнопка User была нажата, переходим в режим загрузчика",
+    "Получен пакет \"boot\", переходим в режим загрузчика",
+    "Приложение запросило режим загрузчика, переходим в режим загрузчика",
+)
+
+# Размер пакетов "status" и "response": начало пакета + 4 байта данных + CRC32
+status_packet_size = 12
+
+# Число блоков "data", которые передаются подряд без ожидания подтверждения (не больше MAX_WINDOW_SIZE загрузчика)
+data_window_size = 8
+
+# Профили темпа передачи прошивки:
+# ready  - следующее окно передается сразу после сигнала готовности загрузчика (ACKW после записи окна во flash)
+# rtscts - порт открывается с аппаратным управлением потоком RTS/CTS (UART_HW_FLOW_CONTROL в загрузчике),
+#          следующее окно передается, не дожидаясь записи предыдущего
+# stream - для загрузчиков с приемом через DMA (UART_RX_DMA): следующее окно передается, пока предыдущее
+#          пишется во flash, без управления потоком (окно целиком помещается в кольцевой буфер загрузчика)
+# fixed  - запасной профиль для старых загрузчиков и адаптеров: фиксированная пауза перед каждым окном
+pacing_profiles = {
+    "ready": {"delay": 0.0, "rtscts": False, "windows_in_flight": 1},
+    "rtscts": {"delay": 0.0, "rtscts": True, "windows_in_flight": 2},
+    "stream": {"delay": 0.0, "rtscts": False, "windows_in_flight": 2},
+    "fixed": {"delay": 0.6, "rtscts": False, "windows_in_flight": 1},
+}
+pacing_profile = "ready"
+
+# Форматы передачи блоков прошивки (transfer_format_t загрузчика):
+# raw - блоки передаются пакетами "data" без сжатия (поддерживается всеми загрузчиками)
+# lz4 - каждый блок сжимается отдельно в формате LZ4 block и передается пакетом "zdat"
+transfer_formats = {"raw": 0, "lz4": 1}
+transfer_format = "raw"
+
+# Слоты пользовательского приложения загрузчика: адреса начала (APP_SLOT_A_ADDRESS и APP_SLOT_B_ADDRESS) и размеры
+# их секторов (в STM32F407 слот A - сектор 4 на 64 Кбайт и сектора 5 - 7, слот B - сектора 8 - 11 по 128 Кбайт).
+# Прошивка исполняется из flash памяти, поэтому для каждого слота она собирается отдельно (test_app, APP_SLOT).
+# Загрузчик записывает новую прошивку в неактивный слот и сообщает его адрес перед пакетом "header",
+# адрес прошивки передается в пакете "header", прошивку для другого слота загрузчик не примет
+app_slot_addresses = {"A": 0x08010000, "B": 0x08080000}
+app_slot_sector_sizes = {
+    0x08010000: [64 * 1024] + [128 * 1024] * 3,
+    0x08080000: [128 * 1024] * 4,
+}
+# Размер буфера CCMRAM загрузчика (DELTA_STAGING_SIZE). При разностном обновлении сектора больше буфера
+# перезаписываются целиком, поэтому передаются все их блоки
+delta_staging_size = 64 * 1024
+
+# Размеры блока "data", которые принимает загрузчик: степени двойки от MIN_NUMBER_OF_BYTES_DATA_DATA
+# до MAX_NUMBER_OF_BYTES_DATA_DATA. Размер блока передается в пакете "header"
+data_block_sizes = [256, 512, 1024, 2048, 4096, 8192, 16384]
+# Число байт прошивки в блоке "data" (None - размер выбирается по качеству линии, см. select_block_size)
+data_block_size = None
+# Размер блока для прошивки, которая готовится без подключения к устройству (compile_firmware_bundle)
+default_data_block_size = 1024
+# Размер буфера окна загрузчика (WINDOW_BUFFER_SIZE): блоки окна вместе не должны превышать его
+window_buffer_size = 16 * 1024
+# Число блоков в большем слоте пользовательского приложения при минимальном размере блока (MAX_NUMBER_OF_DATA_BLOCKS
+# загрузчика), по одному биту на блок в пакете "dmap"
+max_number_of_data_blocks = max(sum(sector_sizes) for sector_sizes in app_slot_sector_sizes.values()) \
+    // data_block_sizes[0]
+
+# Прошивки .hex и .elf (firmware_file.py) передаются участками: блоки, которые до шифрования состоят только из 0xFF,
+# не передаются, так как загрузчик стирает сектора слота перед записью. Адреса и размеры участков передаются
+# в пакете "header", их не больше MAX_NUMBER_OF_SEGMENTS: близкие участки объединяются вместе с промежутком
+max_number_of_segments = 16
+# Ключ, которым шифруются прошивки .hex и .elf (ключ загрузчика). None - ключ запрашивается у пользователя
+firmware_encryption_key = None
+
+# Уровень журнала загрузчика во время передачи блоков (bootloader_log.log_levels), передается в пакете "header".
+# None - загрузчик не меняет уровень. Тихий режим (log_level_error) убирает строки о ходе передачи из UART
+transfer_log_level = None
+
+# Оценка качества линии для выбора размера блока: по каждому порту считаются переданные биты пакетов блоков
+# и поврежденные блоки (повторенные после NACK или без подтверждения). Пока передач не было, считается,
+# что на link_prior_bits бит приходится одна ошибка
+link_prior_bits = 1000000
+link_statistics = {}
+# Накладные расходы на блок, байт: начало пакета, номер блока и CRC32, а также подтверждение окна,
+# выраженное в байтах, которые можно было бы передать за время его ожидания
+data_packet_overhead = 12
+window_round_trip_bytes = 512
+
+# Минимальное время ожидания пакета "status" при адаптивном подборе, с
+min_status_timeout = 0.05
+
+# Число попыток продолжить прерванную передачу прошивки: после повторного подключения передаются только
+# незаписанные блоки (разностным обновлением), уже записанные сектора не стираются
+resume_attempts = 3
+# Время ожидания загрузчика после потери связи, с: загрузчик перезагружается только после того,
+# как исчерпает попытки приема блоков (MAX_USART_CONNECTION_TRY * DATA_PACKET_TIMEOUT_MS)
+resume_wait_timeout = 30
+
 # Аппаратный блок вычисления CRC в STM32F407 нельзя настроить, он всегда будет вычислять CRC32 по алгоритму MPEG-2
-crc32mpeg2_func = crcmod.mkCrcFun(0x104c11db7, initCrc=0xFFFFFFFF, xorOut=0x0, rev=False)
+# (реализация выбирается при импорте модуля crc, скорость реализаций: python crc.py)
+crc32mpeg2_func = crc.crc32mpeg2
+
+
+class BootloaderError(Exception):
+    # Ошибка работы с загрузчиком или файлом прошивки. Интерактивный режим выводит ее сообщение,
+    # пакетный режим (cli.py) завершается с ненулевым кодом возврата
+    pass
+
+
+class TransferInterruptedError(BootloaderError):
+    # Передача блоков прошивки прервалась (нет подтверждений или пропал порт): часть блоков уже записана,
+    # передачу можно продолжить после повторного подключения
+    pass
+
+# Пакеты, которые присылает загрузчик, и их полный размер
+bootloader_frame_sizes = {
+    response_word: status_packet_size,
+    ack_word: status_packet_size,
+    nack_word: status_packet_size,
+    program_time_word: status_packet_size,
+    bootloader_log.log_word: bootloader_log.get_log_frame_size,
+}
+# Пакеты журнала загрузчика, которые декодер превращает в строки журнала
+bootloader_log_formatters = {
+    bootloader_log.log_word: bootloader_log.format_log_event,
+}
+
+# Декодеры принятого потока байт, по одному на открытый порт
+frame_decoders = {}
+
+# Порты, загрузчик которых уже сообщил о готовности к следующей команде сессии (session_ready_line)
+ready_sessions = set()
+
+# Открытые прошивки по пути, времени изменения и размеру файла: при прошивке нескольких устройств (fleet)
+# или нескольких команд подряд файл разбирается и пакеты строятся один раз
+firmware_images = {}
+firmware_images_lock = threading.Lock()
 
 
 def get_key(val, dictionary):
@@ -143,27 +322,31 @@ def input_developer_bootloader_command():
             continue
         break
 
-    if command_number == 0:
-        exit(1)
-
+    # 0 - завершение работы с загрузчиком, его обрабатывает вызывающий код (завершает сессию команд)
     return command_number
 
 
-def start_uart_connection():
-    com_port_finded = False
+def start_uart_connection(com_port=None, input_baudrate=None):
+    # Порт и скорость запрашиваются у пользователя, если не переданы в параметрах (пакетный режим cli.py)
+    com_port_finded = com_port is not None
     baudrate_finded = False
-    supported_baudrates = [115200]
 
     try:
-        # Получаем список всех доступных портов в системе
-        ports = serial.tools.list_ports.comports()
+        if input_baudrate is not None:
+            if int(input_baudrate) not in supported_baudrates:
+                raise Exception(f'Скорость не поддерживается: {input_baudrate}')
+            baudrate_finded = True
 
-        if len(ports) == 0:
-            raise Exception('На компьютере не найден ни один COM-порт')
-        else:
-            print("Список доступных COM портов в системе:")
-            for port in ports:
-                print("Устройство: " + port.device + ". Название: " + port.name + ". Описание: " + port.description)
+        if not com_port_finded:
+            # Получаем список всех доступных портов в системе
+            ports = serial.tools.list_ports.comports()
+
+            if len(ports) == 0:
+                raise Exception('На компьютере не найден ни один COM-порт')
+            else:
+                print("Список доступных COM портов в системе:")
+                for port in ports:
+                    print("Устройство: " + port.device + ". Название: " + port.name + ". Описание: " + port.description)
 
         while not com_port_finded:
             com_port = input(
@@ -191,7 +374,7 @@ def start_uart_connection():
             for baudrate in supported_baudrates:
                 if int(input_baudrate) == baudrate:
                     baudrate_finded = True
-                    print('Установлена скорость:', input_baudrate)
+                    print('Выбрана скорость:', input_baudrate)
 
             if not baudrate_finded:
                 print('Скорость не поддерживается:', input_baudrate)
@@ -199,165 +382,628 @@ def start_uart_connection():
         print(
             'Убедитесь, что UART устройства установлены со следующими настройками: World Length = 8 Bits; Parity = None; Stop Bits = 1;')
 
-        serial_com = serial.Serial(com_port, input_baudrate, EIGHTBITS, PARITY_NONE, STOPBITS_ONE, timeout=1)
+        # Порт открывается на скорости по умолчанию, выбранная скорость согласуется после входа в режим загрузчика
+        with metrics.phase(com_port, "connect"):
+            serial_com = serial.Serial(com_port, default_baudrate, EIGHTBITS, PARITY_NONE, STOPBITS_ONE, timeout=1,
+                                       rtscts=pacing_profiles[pacing_profile]["rtscts"])
+            serial_com.write_timeout = get_write_timeout(
+                serial_com, data_window_size * (data_block_sizes[-1] + data_packet_overhead))
 
         if serial_com.is_open:
             print(f"UART соединение с {serial_com.name} успешно установлено!")
             print(f"Перезагрузите устройство, чтобы начать работать с загрузчиком")
         else:
             raise Exception(f"Ошибка установки UART соединения!")
-        return serial_com
+        return serial_com, int(input_baudrate)
 
     except Exception as e:
-        print("Произошла ошибка:", e)
-        exit(0)
+        raise BootloaderError(f"Ошибка start_uart_connection: {e}")
+
+
+def print_bootloader_log(line):
+    print('Ответ загрузчика: {}'.format(line))
+
 
+def get_frame_decoder(uart_serial):
+    if uart_serial not in frame_decoders:
+        frame_decoders[uart_serial] = FrameDecoder(bootloader_frame_sizes, crc32mpeg2_func, "little",
+                                                   print_bootloader_log, log_formatters=bootloader_log_formatters)
+    return frame_decoders[uart_serial]
 
-def wait_status(uart_serial):
+
+def reset_input(uart_serial):
+    # После смены скорости принятые байты не имеют смысла: сбрасываем и порт, и декодер
+    uart_serial.reset_input_buffer()
+    frame_decoders.pop(uart_serial, None)
+
+
+def read_decoded(uart_serial, pop_function, timeout):
+    # Читает порт, пока pop_function не вернет пакет или строку журнала, но не дольше timeout секунд.
+    # Чтение возвращается сразу, как только придут нужные байты, а не по таймауту порта
+    decoder = get_frame_decoder(uart_serial)
+    deadline = time.monotonic() + timeout
+    default_timeout = uart_serial.timeout
+    try:
+        while True:
+            result = pop_function(decoder)
+            if result is not None:
+                return result
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return None
+            uart_serial.timeout = remaining
+            decoder.feed(uart_serial.read(max(1, uart_serial.in_waiting)))
+    finally:
+        uart_serial.timeout = default_timeout
+
+
+def read_frame(uart_serial, words, timeout=None):
+    # Возвращает (начало пакета, данные пакета) первого пакета с началом из words или None
+    if timeout is None:
+        timeout = uart_serial.timeout * max_usart_connection_try
+    return read_decoded(uart_serial, lambda decoder: decoder.pop_frame(words), timeout)
+
+
+def read_log_line(uart_serial, timeout=None):
+    # Возвращает следующую строку журнала загрузчика или None, если за timeout секунд строк не было
+    if timeout is None:
+        timeout = uart_serial.timeout
+    return read_decoded(uart_serial, lambda decoder: decoder.pop_log_line(), timeout)
+
+
+def wait_log_lines(uart_serial, number_of_lines):
+    # Строки журнала выводит декодер, здесь только ждем, пока загрузчик их пришлет (или закончит команду)
+    for i in range(number_of_lines):
+        response = read_log_line(uart_serial, uart_serial.timeout * max_usart_connection_try)
+        if response is None or is_command_end(uart_serial, response):
+            break
+
+
+def wait_status_data(uart_serial, timeout=None, program_time_handler=None):
+    # Возвращает результат пакета "status" (1 - ACKW, 0 - NACK) и 4 байта его данных.
+    # Время записи окна во flash (пакет "ptim" перед ACKW) передается в program_time_handler в секундах.
+    # Если ответа нет до конца timeout, результат такой же, как у NACK; ошибки порта - исключение
     try:
-        number_of_try = 0
-        while number_of_try < max_usart_connection_try:
-            response = uart_serial.readline().decode("utf-8").strip()
-            index_ackw = response.find("ACKW")
-            index_nack = response.find("NACK")
-            if index_ackw != -1:
-                return 1
-            if index_nack != -1:
-                return 0
-            number_of_try = number_of_try + 1
-        return 0
+        if timeout is None:
+            timeout = uart_serial.timeout * max_usart_connection_try
+        deadline = time.monotonic() + timeout
+        while True:
+            frame = read_frame(uart_serial, (ack_word, nack_word, program_time_word),
+                               max(0.0, deadline - time.monotonic()))
+            if frame is None:
+                return 0, 0
+            frame_word, frame_data = frame
+            frame_value = int.from_bytes(frame_data, byteorder="little")
+            if frame_word != program_time_word:
+                return int(frame_word == ack_word), frame_value
+            if program_time_handler is not None:
+                program_time_handler(frame_value / 1000000)
+    except SerialException as e:
+        # Пропал порт: ответа уже не будет, повторять передачу бессмысленно
+        raise TransferInterruptedError(f"Ошибка wait_status: {e}")
     except Exception as e:
-        print(f"Ошибка wait_status: {e}")
-        # TODO: нужно ли выходить из программы?
+        raise BootloaderError(f"Ошибка wait_status: {e}")
 
 
-def send_header(uart_serial, firmware_size):
+def wait_status(uart_serial, timeout=None):
+    status_result, status_data = wait_status_data(uart_serial, timeout)
+    return status_result
+
+
+def send_header(uart_serial, firmware_image, window_size, block_format, block_size, segments=()):
     try:
-        header_data = firmware_size.to_bytes(4, "big")
+        # CRC32 образа загрузчик сверяет с записанным слотом перед тем, как сделать слот активным.
+        # segments - участки [(адрес, размер)], блоки которых передаются; без участков передается вся прошивка
+        header_data = struct.pack(">IIIIIIII", firmware_image.firmware_size, window_size, block_format,
+                                  firmware_image.target_address, block_size, firmware_image.image_crc,
+                                  transfer_log_level or 0, len(segments))
+        for segment in list(segments) + [(0, 0)] * (max_number_of_segments - len(segments)):
+            header_data += struct.pack(">II", *segment)
         header_crc = struct.pack('>I', crc32mpeg2_func(header_word + header_data))
         header_packet = header_word + header_data + header_crc
         uart_serial.write(header_packet)
     except Exception as e:
-        print(f"Ошибка send_header: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка send_header: {e}")
 
 
 def wait_response(uart_serial):
-    number_of_try = 0
     try:
-        while number_of_try < max_usart_connection_try:
-            number_of_try = number_of_try + 1
-
-            response_packet = uart_serial.readline()
-            index = response_packet.find(response_word, 0)
-            if index != -1:
-                response_data = int.from_bytes(response_packet[4:8], byteorder="little")
-                if response_data == bootloader_responses["ok"]:
-                    print("Ответ - успех")
-                    break
-                elif response_data == bootloader_responses["fail"]:
-                    raise Exception("Ответ - неудача")
-                else:
-                    return hex(response_data)
-            if number_of_try + 1 == max_usart_connection_try:
-                raise ValueError("За все попытки подключения получаем неизвестный ответ")
-            number_of_try = number_of_try + 1
+        frame = read_frame(uart_serial, (response_word,))
+        if frame is None:
+            raise ValueError("Загрузчик не прислал пакет \"response\"")
+        response_data = int.from_bytes(frame[1], byteorder="little")
+        if response_data == bootloader_responses["ok"]:
+            print("Ответ - успех")
+        elif response_data == bootloader_responses["fail"]:
+            raise Exception("Ответ - неудача")
+        else:
+            return hex(response_data)
     except ValueError as e:
-        print(f"Ошибка wait_response: {e}")
-        exit(0)
-
-
-def send_data(uart_serial, data_blocks):
+        raise BootloaderError(f"Ошибка wait_response: {e}")
+
+
+class TransferPacer:
+    # Измеряет реальную задержку подтверждения блоков и по ней подбирает время ожидания пакета "status"
+    # (по аналогии с оценкой RTT в TCP: сглаженное среднее + 4 отклонения)
+
+    def __init__(self, profile):
+        self.delay = pacing_profiles[profile]["delay"]
+        self.windows_in_flight = pacing_profiles[profile]["windows_in_flight"]
+        self.smoothed_latency = None
+        self.latency_deviation = 0.0
+        self.block_latencies = []
+        self.window_program_times = []
+        self.started = time.monotonic()
+
+    def wait_before_window(self):
+        # Фиксированная пауза нужна, чтобы загрузчик успел записать окно. Если он сообщает время записи,
+        # пауза сокращается до него
+        delay = self.delay
+        if self.window_program_times:
+            delay = min(delay, self.window_program_times[-1])
+        if delay > 0:
+            time.sleep(delay)
+
+    def program_time_reported(self, program_time):
+        self.window_program_times.append(program_time)
+
+    def window_acknowledged(self, sent_time, number_of_blocks):
+        latency = time.monotonic() - sent_time
+        self.block_latencies.append(latency / number_of_blocks)
+        if self.smoothed_latency is None:
+            self.smoothed_latency = latency
+            self.latency_deviation = latency / 2
+        else:
+            self.latency_deviation = 0.75 * self.latency_deviation + 0.25 * abs(self.smoothed_latency - latency)
+            self.smoothed_latency = 0.875 * self.smoothed_latency + 0.125 * latency
+
+    def status_timeout(self, default_timeout):
+        # Пока нет ни одного измерения (первое окно включает стирание flash), ждем стандартное время
+        if self.smoothed_latency is None:
+            return default_timeout
+        timeout = max(min_status_timeout, self.smoothed_latency + 4 * self.latency_deviation)
+        # Запись во flash может замедлиться независимо от линии: ждем не меньше двойного времени записи окна
+        if self.window_program_times:
+            timeout = max(timeout, 2 * self.window_program_times[-1])
+        return timeout
+
+    def print_statistics(self, number_of_bytes):
+        if not self.block_latencies:
+            return
+        elapsed = time.monotonic() - self.started
+        average_latency = sum(self.block_latencies) / len(self.block_latencies)
+        print(f"Задержка подтверждения блока: средняя {average_latency * 1000:.1f} мс, "
+              f"мин {min(self.block_latencies) * 1000:.1f} мс, макс {max(self.block_latencies) * 1000:.1f} мс")
+        if self.window_program_times:
+            average_program_time = sum(self.window_program_times) / len(self.window_program_times)
+            print(f"Время записи окна во flash: среднее {average_program_time * 1000:.1f} мс, "
+                  f"макс {max(self.window_program_times) * 1000:.1f} мс")
+        print(f"Прошивка передана за {elapsed:.1f} с ({number_of_bytes / elapsed:.0f} байт/с)")
+
+
+def build_data_packet(sequence, block):
+    data_data = struct.pack(">I", sequence) + block
+    data_crc = struct.pack('>I', crc32mpeg2_func(data_word + data_data))
+    return data_word + data_data + data_crc
+
+
+def build_compressed_data_packet(sequence, compressed_block):
+    # Сжатые данные дополняются нулями до кратного 4 размера: загрузчик проверяет CRC32 по 4 байтным словам
+    compressed_size = len(compressed_block)
+    compressed_data = struct.pack(">II", sequence, compressed_size) + compressed_block + bytes(-compressed_size % 4)
+    compressed_crc = struct.pack('>I', crc32mpeg2_func(compressed_data_word + compressed_data))
+    return compressed_data_word + compressed_data + compressed_crc
+
+
+def build_block_packet(sequence, data_block):
+    if data_block[0] == compressed_data_word:
+        return build_compressed_data_packet(sequence, data_block[1])
+    return build_data_packet(sequence, data_block[1])
+
+
+def build_block_packets(data_blocks):
+    # Пакеты строятся один раз до передачи: при повторе окна передаются те же байты
+    return [build_block_packet(sequence, data_block) for sequence, data_block in enumerate(data_blocks)]
+
+
+def compress_data_blocks(data_blocks):
+    # Блок, который не удалось сжать, передается как есть: размер, равный размеру блока, означает "без сжатия".
+    # Блоки "zdat" - [начало пакета, сжатые данные] без CRC32: CRC32 пакета вычисляет build_compressed_data_packet
+    compressed_blocks = []
+    for _, block_data, _ in data_blocks:
+        compressed_block = compression.lz4_compress_block(block_data)
+        if len(compressed_block) >= len(block_data):
+            compressed_block = block_data
+        compressed_blocks.append([compressed_data_word, compressed_block])
+
+    source_size = sum(len(block[1]) for block in data_blocks)
+    compressed_size = sum(len(block[1]) for block in compressed_blocks)
+    print(f"Блоки сжаты: {source_size} байт -> {compressed_size} байт ({compressed_size / source_size:.0%})")
+    return compressed_blocks
+
+
+def prepare_data_blocks(data_blocks, block_format=None):
+    if (block_format or transfer_format) == "lz4":
+        return compress_data_blocks(data_blocks)
+    return data_blocks
+
+
+class FirmwareImage:
+    # Прошивка, разделенная на блоки [начало пакета, данные блока, CRC32 данных блока], с CRC32 всего образа
+    # и готовыми пакетами полной прошивки для каждого формата передачи. Пакеты строятся при первой передаче
+    # в этом формате или берутся из скомпилированной прошивки (bundle.py).
+    # block_ranges - диапазоны номеров передаваемых блоков [первый, следующий за последним) для прошивки,
+    # переданной участками (open_segmented_firmware), None - передаются все блоки
+
+    def __init__(self, firmware_size, block_size, target_address, data_blocks, image_crc=None, packets=None,
+                 block_ranges=None):
+        self.firmware_size = firmware_size
+        self.block_size = block_size
+        self.target_address = target_address
+        self.data_blocks = data_blocks
+        if image_crc is None:
+            image_crc = crc32mpeg2_func(b"".join(block_data for word, block_data, crc in data_blocks))
+        self.image_crc = image_crc
+        self.packets = dict(packets or {})
+        self.block_ranges = block_ranges
+
+    def transfer_blocks(self):
+        # Номера передаваемых блоков по порядку: порядковый номер пакета - индекс в этом списке
+        if self.block_ranges is None:
+            return list(range(len(self.data_blocks)))
+        return [block for first_block, last_block in self.block_ranges for block in range(first_block, last_block)]
+
+    def segments(self):
+        # Участки для пакета "header": адрес первого блока и размер до конца последнего блока (или до конца прошивки)
+        if self.block_ranges is None:
+            return []
+        return [(self.target_address + first_block * self.block_size,
+                 min(last_block * self.block_size, self.firmware_size) - first_block * self.block_size)
+                for first_block, last_block in self.block_ranges]
+
+    def transfer_packets(self, block_format=None):
+        block_format = block_format or transfer_format
+        if block_format not in self.packets:
+            data_blocks = [self.data_blocks[block] for block in self.transfer_blocks()]
+            self.packets[block_format] = build_block_packets(prepare_data_blocks(data_blocks, block_format))
+        return self.packets[block_format]
+
+
+def print_progress(acknowledged_blocks, number_of_blocks):
+    print(f"[{acknowledged_blocks} / {number_of_blocks}]")
+
+
+def get_sector_blocks(number_of_blocks, block_size, slot_address):
+    # Диапазоны номеров блоков прошивки [первый, следующий за последним) по секторам слота приложения
+    sector_blocks = []
+    first_block = 0
+    for sector_size in app_slot_sector_sizes[slot_address]:
+        if first_block >= number_of_blocks:
+            break
+        last_block = min(first_block + sector_size // block_size, number_of_blocks)
+        sector_blocks.append((first_block, last_block, sector_size))
+        first_block = last_block
+    return sector_blocks
+
+
+def get_window_size(block_size):
+    # Окно не больше MAX_WINDOW_SIZE блоков и не больше буфера окна загрузчика
+    return max(1, min(data_window_size, window_buffer_size // block_size))
+
+
+def get_bundle_block_size(firmware_path):
+    # Размер блока, для которого скомпилированы пакеты прошивки .fwb, или None для прошивки .bin
+    if not os.path.isfile(firmware_path) or not bundle.is_bundle(firmware_path):
+        return None
+    return bundle.read_block_size(firmware_path)
+
+
+def estimate_bit_error_rate(port):
+    sent_bits, damaged_blocks = link_statistics.get(port, (0, 0))
+    return (damaged_blocks + 1) / (sent_bits + link_prior_bits)
+
+
+def get_block_transfer_cost(block_size, bit_error_rate):
+    # Байт линии на байт прошивки: блок с накладными расходами повторяется, пока не дойдет без ошибок
+    packet_bits = 8 * (block_size + data_packet_overhead)
+    block_cost = block_size + data_packet_overhead + window_round_trip_bytes / get_window_size(block_size)
+    return block_cost / (block_size * (1 - bit_error_rate) ** packet_bits)
+
+
+def select_block_size(uart_serial, firmware_path):
+    # Явно заданный размер, размер скомпилированной прошивки (ее пакеты готовы заранее) или размер, при котором
+    # на линии с оценкой вероятности ошибки бита по прошлым передачам тратится меньше всего байт: на чистой
+    # линии - большие блоки, на зашумленной - маленькие, так как поврежденный блок передается заново целиком
+    if data_block_size is not None:
+        return data_block_size
+    bundle_block_size = get_bundle_block_size(firmware_path)
+    if bundle_block_size is not None:
+        return bundle_block_size
+    bit_error_rate = estimate_bit_error_rate(uart_serial.port)
+    block_size = min(data_block_sizes, key=lambda size: get_block_transfer_cost(size, bit_error_rate))
+    print(f"Выбран размер блока {block_size} байт (оценка вероятности ошибки бита {bit_error_rate:.1e})")
+    return block_size
+
+
+def report_blocks_sent(uart_serial, sent_bytes, damaged_blocks):
+    # damaged_blocks - блоки, которые передаются повторно: они дошли с ошибкой или не дошли вовсе
+    metrics.add("bootloader_data_bytes_total", sent_bytes, port=metrics.port_name(uart_serial))
+    sent_bits, total_damaged_blocks = link_statistics.get(uart_serial.port, (0, 0))
+    link_statistics[uart_serial.port] = (sent_bits + 8 * sent_bytes, total_damaged_blocks + damaged_blocks)
+
+
+def report_program_time(uart_serial, pacer, program_time):
+    pacer.program_time_reported(program_time)
+    metrics.add("bootloader_program_seconds_total", program_time, port=metrics.port_name(uart_serial))
+
+
+def report_window_acknowledged(uart_serial, pacer, sent_time, first_block, last_block):
+    latency = time.monotonic() - sent_time
+    pacer.window_acknowledged(sent_time, last_block - first_block)
+    port = metrics.port_name(uart_serial)
+    metrics.add("bootloader_windows_total", port=port)
+    metrics.add("bootloader_window_latency_seconds_total", latency, port=port)
+    metrics.add("bootloader_data_blocks_total", last_block - first_block, port=port)
+    metrics.event(uart_serial, "data_window", first_block=first_block, blocks=last_block - first_block,
+                  latency=round(latency, 6), block_latency=round(latency / (last_block - first_block), 6))
+
+
+def report_window_failed(uart_serial, first_block, status_result, timed_out, number_of_missing_blocks, attempt):
+    # Окно без подтверждения: NACK с маской принятых блоков или отсутствие ответа за время ожидания
+    port = metrics.port_name(uart_serial)
+    metrics.retry(uart_serial, "data", attempt)
+    if timed_out:
+        metrics.add("bootloader_status_timeouts_total", port=port)
+        metrics.event(uart_serial, "status_timeout", first_block=first_block)
+    else:
+        metrics.add("bootloader_nacks_total", port=port)
+        metrics.event(uart_serial, "nack", first_block=first_block, ack=bool(status_result),
+                      missing_blocks=number_of_missing_blocks)
+
+
+def get_write_timeout(uart_serial, number_of_bytes):
+    # Время записи в порт, после которого загрузчик считается не принимающим данные (перезагрузился во время окна
+    # или держит CTS снятым), с: передача number_of_bytes на текущей скорости и стандартное время ожидания ответа,
+    # за которое загрузчик успевает стереть сектор и записать окно во flash
+    return 10 * number_of_bytes / uart_serial.baudrate + uart_serial.timeout * max_usart_connection_try
+
+
+def send_data(uart_serial, packets, window_size, progress=print_progress, erase_blocks=()):
+    # Блоки передаются окнами: все блоки окна отправляются подряд, затем загрузчик отвечает
+    # ACKW с числом записанных во flash блоков (сигнал готовности к следующему окну)
+    # или NACK с битовой маской принятых блоков текущего окна. packets - готовые пакеты блоков (build_block_packets).
+    # erase_blocks - номера блоков, перед записью которых загрузчик стирает сектор: подтверждение окна с таким
+    # блоком ждем стандартное время, так как стирание сектора 128 Кбайт занимает до нескольких секунд
+    default_timeout = uart_serial.timeout * max_usart_connection_try
+    number_of_bytes = sum(len(packet) for packet in packets)
     try:
-        number_of_try = 0
-        for data_block in data_blocks:
-            number_of_block = 0
-            while number_of_try < max_usart_connection_try:
-                time.sleep(0.6)
-                data_crc = struct.pack('>I', crc32mpeg2_func(data_word + data_block[1]))
-                data_packet = data_word + data_block[1] + data_crc
-                uart_serial.write(data_packet)
-                status_result = wait_status(uart_serial)
-
-                if status_result == 1:
-                    print(f"[{number_of_block + 1} / {len(data_blocks)}]")
+        with metrics.phase(uart_serial, "data", blocks=len(packets), bytes=number_of_bytes) as details:
+            pacer = TransferPacer(pacing_profile)
+            number_of_blocks = len(packets)
+            windows = [(first_block, min(first_block + window_size, number_of_blocks))
+                       for first_block in range(0, number_of_blocks, window_size)]
+            # Без ограничения времени записи write() ждет бесконечно, если загрузчик перестал принимать данные
+            window_bytes = max((sum(map(len, packets[first_block:last_block])) for first_block, last_block in windows),
+                               default=0)
+            uart_serial.write_timeout = get_write_timeout(uart_serial, window_bytes)
+            # Окна, переданные загрузчику, но еще не подтвержденные: [номер окна, время отправки]
+            windows_in_flight = []
+            next_window = 0
+            number_of_try = 0
+
+            while next_window < len(windows) or windows_in_flight:
+                while next_window < len(windows) and len(windows_in_flight) < pacer.windows_in_flight:
+                    first_block, last_block = windows[next_window]
+                    pacer.wait_before_window()
+                    for sequence in range(first_block, last_block):
+                        uart_serial.write(packets[sequence])
+                    report_blocks_sent(uart_serial, sum(map(len, packets[first_block:last_block])), 0)
+                    windows_in_flight.append([next_window, time.monotonic()])
+                    next_window += 1
+
+                first_block, last_block = windows[windows_in_flight[0][0]]
+                status_timeout = pacer.status_timeout(default_timeout)
+                if any(first_block <= block < last_block for block in erase_blocks):
+                    status_timeout = default_timeout
+
+                wait_started = time.monotonic()
+                status_result, status_data = wait_status_data(
+                    uart_serial, status_timeout,
+                    lambda program_time: report_program_time(uart_serial, pacer, program_time))
+
+                if status_result == 1 and status_data >= last_block:
+                    # Подтверждение накопительное: снимаем все окна, блоки которых уже записаны
+                    while windows_in_flight and windows[windows_in_flight[0][0]][1] <= status_data:
+                        window_number, sent_time = windows_in_flight.pop(0)
+                        window_first_block, window_last_block = windows[window_number]
+                        report_window_acknowledged(uart_serial, pacer, sent_time, window_first_block,
+                                                   window_last_block)
+                        progress(window_last_block, number_of_blocks)
                     number_of_try = 0
-                    break
-                elif number_of_try + 1 == max_usart_connection_try:
-                    return 0
+                    continue
 
                 number_of_try = number_of_try + 1
-        return 1
+                # wait_status_data возвращает 0 и при NACK, и когда ответа нет до конца времени ожидания
+                timed_out = status_result == 0 and time.monotonic() - wait_started >= status_timeout
+                if number_of_try == max_usart_connection_try:
+                    report_window_failed(uart_serial, first_block, status_result, timed_out, 0, number_of_try)
+                    details["result"] = "failed"
+                    return 0
+
+                # Загрузчик отбрасывает блоки следующих окон, пока не запишет текущее, поэтому их передаем заново
+                next_window = windows_in_flight[0][0] + 1
+                del windows_in_flight[1:]
+
+                if status_result == 0:
+                    # Повторяем только те блоки, которых нет в маске принятых
+                    missing_blocks = [sequence for sequence in range(first_block, last_block)
+                                      if not (status_data >> (sequence - first_block)) & 1]
+                else:
+                    missing_blocks = list(range(first_block, last_block))
+                report_window_failed(uart_serial, first_block, status_result, timed_out, len(missing_blocks),
+                                     number_of_try)
+
+                pacer.wait_before_window()
+                for sequence in missing_blocks:
+                    uart_serial.write(packets[sequence])
+                report_blocks_sent(uart_serial, sum(len(packets[sequence]) for sequence in missing_blocks),
+                                   len(missing_blocks))
+                windows_in_flight[0][1] = time.monotonic()
+
+            pacer.print_statistics(number_of_bytes)
+            return 1
+    except TransferInterruptedError:
+        raise
+    except SerialTimeoutException:
+        raise TransferInterruptedError("Ошибка send_data: загрузчик не принимает данные")
+    except SerialException as e:
+        raise TransferInterruptedError(f"Ошибка send_data: {e}")
     except Exception as e:
-        print(f"Ошибка send_data: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка send_data: {e}")
+
 
+def send_boot_request(uart_serial):
+    boot_data = struct.pack(">I", bootloader_entry_magic)
+    boot_crc = struct.pack('>I', crc32mpeg2_func(boot_word + boot_data))
+    uart_serial.write(boot_word + boot_data + boot_crc)
 
-def wait_bootloader_mode(uart_serial):
-    # Ждем нажатия пользовательской кнопки
-    number_of_try = 0
+
+def wait_bootloader_mode(uart_serial, timeout=None):
+    # Пока загрузчик не сообщит о входе в режим загрузчика, повторяем пакет "boot": кнопку User нажимать не нужно,
+    # достаточно перезагрузить устройство (или приложение само перезагрузится в режим загрузчика по этому пакету)
+    if timeout is None:
+        timeout = uart_serial.timeout * max_usart_connection_try
+    deadline = time.monotonic() + timeout
+    next_request = time.monotonic()
+    application_started = False
     try:
-        while number_of_try < max_usart_connection_try:
-            response = uart_serial.readline().decode('utf-8').strip()
-            if response != "":
-                print('Ответ загрузчика: {}'.format(response))
-            if response == 'Кнопка User была нажата, переходим в режим загрузчика':
-                print("Кнопка User была нажата, входим в режим загрузчика")
-                break
-            elif response == 'Кнопка User не нажата, переходим к исполнению пользовательского приложения':
-                for i in range(10):
-                    response = uart_serial.readline().decode("utf-8").strip()
-                    if response != "":
-                        print('Ответ загрузчика: {}'.format(response))
-                raise Exception("Кнопка User не была нажата")
-            elif number_of_try + 1 == max_usart_connection_try:
-                raise Exception("Загрузчик не отвечает")
-            number_of_try = number_of_try + 1
+        with metrics.phase(uart_serial, "bootloader_entry") as details:
+            boot_requests = 0
+            while time.monotonic() < deadline:
+                if time.monotonic() >= next_request:
+                    send_boot_request(uart_serial)
+                    boot_requests += 1
+                    details["boot_requests"] = boot_requests
+                    next_request = time.monotonic() + boot_request_interval
+                response = read_log_line(uart_serial, max(0.0, next_request - time.monotonic()))
+                if response in bootloader_entry_lines:
+                    print("Входим в режим загрузчика")
+                    time.sleep(bootloader_entry_quiet + 2 * boot_request_interval)
+                    return
+                if response == 'Кнопка User не нажата, переходим к исполнению пользовательского приложения':
+                    application_started = True
+            if application_started:
+                raise Exception("Кнопка User не была нажата, приложение не перешло в режим загрузчика")
+            raise Exception("Загрузчик не отвечает")
     except Exception as e:
-        print("Ошибка wait_bootloader_mode:", e)
-        exit(0)
+        raise BootloaderError(f"Ошибка wait_bootloader_mode: {e}")
 
 
-def encrypt_firmware_file(encrypt_key):
+def send_baudrate(uart_serial, baudrate):
     try:
-        filepath = input("Введите путь до прошивки формата .bin: ").strip()
-        with open(filepath, 'rb') as firmware_file:
-            firmware_data = firmware_file.read()
-            encrypted_data = bytearray(firmware_data)
-            for i in range(0, len(firmware_data), 4):
-                encrypted_data[i:i + 4] = bytes(
-                    [b ^ (encrypt_key >> (8 * (j % 4))) & 0xFF for j, b in enumerate(firmware_data[i:i + 4])])
-            encrypted_filename = os.path.splitext(filepath)[0] + '_encrypted.bin'
-            with open(encrypted_filename, 'wb') as encrypted_file:
-                encrypted_file.write(encrypted_data)
-            print(f"Файл {filepath} успешно зашифрован в файл {encrypted_filename}")
+        baud_data = struct.pack(">I", baudrate)
+        baud_crc = struct.pack('>I', crc32mpeg2_func(baud_word + baud_data))
+        uart_serial.write(baud_word + baud_data + baud_crc)
+    except Exception as e:
+        raise BootloaderError(f"Ошибка send_baudrate: {e}")
+
+
+def send_baudrate_probe(uart_serial, baudrate):
+    probe_data = struct.pack(">I", baudrate)
+    probe_crc = struct.pack('>I', crc32mpeg2_func(test_word + probe_data))
+    uart_serial.write(test_word + probe_data + probe_crc)
+
+
+def wait_baudrate_probe_response(uart_serial, deadline):
+    # Ждем пакет "response" с успехом на новой скорости
+    frame = read_frame(uart_serial, (response_word,), max(0.0, deadline - time.monotonic()))
+    if frame is None:
+        return False
+    return int.from_bytes(frame[1], byteorder="little") == bootloader_responses["ok"]
+
+
+def negotiate_baudrate(uart_serial, baudrate):
+    # Переводит загрузчик и порт на скорость baudrate. При неудаче обе стороны остаются на default_baudrate
+    if baudrate == uart_serial.baudrate:
+        return uart_serial.baudrate
+
+    with metrics.phase(uart_serial, "baudrate", baudrate=baudrate) as details:
+        send_command_with_status(uart_serial, set_baudrate_command)
+
+        time.sleep(1)
+
+        status_result = 0
+        number_of_try_connection = 0
+
+        while number_of_try_connection < max_usart_connection_try:
+            send_baudrate(uart_serial, baudrate)
+            status_result = wait_status(uart_serial)
+            if status_result == 1:
+                break
+            number_of_try_connection += 1
+            metrics.retry(uart_serial, "baudrate", number_of_try_connection)
+
+        if status_result == 0:
+            raise Exception("Ошибка при передаче скорости UART")
+
+        try:
+            wait_response(uart_serial)
+        except Exception:
+            print(f"Загрузчик не поддерживает скорость {baudrate} бод, остаюсь на {uart_serial.baudrate} бод")
+            details["result"] = "unsupported"
+            return uart_serial.baudrate
+
+        # Переключаемся и присылаем пакет проверки, пока загрузчик его ждет
+        uart_serial.baudrate = baudrate
+        reset_input(uart_serial)
+        deadline = time.monotonic() + baudrate_probe_timeout
+        probe_passed = False
+
+        while not probe_passed and time.monotonic() < deadline:
+            send_baudrate_probe(uart_serial, baudrate)
+            probe_passed = wait_baudrate_probe_response(uart_serial, min(deadline, time.monotonic() + 0.2))
+
+        if probe_passed:
+            print(f"Скорость UART изменена на {baudrate} бод")
+        else:
+            # Загрузчик сам вернется на скорость по умолчанию, когда истечет время ожидания пакета проверки
+            uart_serial.baudrate = default_baudrate
+            time.sleep(max(0.0, deadline - time.monotonic()) + 0.1)
+            reset_input(uart_serial)
+            print(f"Проверка скорости {baudrate} бод не пройдена, остаюсь на {default_baudrate} бод")
+            details["result"] = "probe_failed"
+
+        return uart_serial.baudrate
+
+
+def encrypt_firmware_file(encrypt_key, filepath=None):
+    try:
+        if filepath is None:
+            filepath = input("Введите путь до прошивки формата .bin: ").strip()
+        encrypted_filename = os.path.splitext(filepath)[0] + '_encrypted.bin'
+        cipher.xor_file(filepath, encrypted_filename, encrypt_key)
+        print(f"Файл {filepath} успешно зашифрован в файл {encrypted_filename}")
     except FileNotFoundError:
-        print(f"Ошибка encrypt_firmware_file: файл '{filepath}' не найден")
+        raise BootloaderError(f"Ошибка encrypt_firmware_file: файл '{filepath}' не найден")
     except PermissionError:
-        print(f"Ошибка encrypt_firmware_file: доступ к файлу '{filepath}' запрещен")
+        raise BootloaderError(f"Ошибка encrypt_firmware_file: доступ к файлу '{filepath}' запрещен")
     except Exception as e:
-        print(f"Ошибка encrypt_firmware_file: {e}")
+        raise BootloaderError(f"Ошибка encrypt_firmware_file: {e}")
 
 
-def decrypt_firmware_file(encrypt_key):
+def decrypt_firmware_file(encrypt_key, filepath=None):
     try:
-        filepath = input("Введите путь до зашифрованной прошивки формата .bin: ").strip()
-        with open(filepath, 'rb') as encrypted_file:
-            encrypted_data = encrypted_file.read()
-            decrypted_data = bytearray(encrypted_data)
-            for i in range(0, len(encrypted_data), 4):
-                decrypted_data[i:i + 4] = bytes(
-                    [b ^ (encrypt_key >> (8 * (j % 4))) & 0xFF for j, b in enumerate(encrypted_data[i:i + 4])])
-            decrypted_filename = os.path.splitext(filepath)[0] + '_decrypted.bin'
-            with open(decrypted_filename, 'wb') as decrypted_file:
-                decrypted_file.write(decrypted_data)
-            print(f"Файл {filepath} успешно расшифрован в файл {decrypted_filename}")
+        if filepath is None:
+            filepath = input("Введите путь до зашифрованной прошивки формата .bin: ").strip()
+        decrypted_filename = os.path.splitext(filepath)[0] + '_decrypted.bin'
+        cipher.xor_file(filepath, decrypted_filename, encrypt_key)
+        print(f"Файл {filepath} успешно расшифрован в файл {decrypted_filename}")
     except FileNotFoundError:
-        print(f"Ошибка decrypt_firmware_file: файл '{filepath}' не найден")
+        raise BootloaderError(f"Ошибка decrypt_firmware_file: файл '{filepath}' не найден")
     except PermissionError:
-        print(f"Ошибка decrypt_firmware_file: доступ к файлу '{filepath}' запрещен")
+        raise BootloaderError(f"Ошибка decrypt_firmware_file: доступ к файлу '{filepath}' запрещен")
     except Exception as e:
-        print(f"Ошибка decrypt_firmware_file: {e}")
+        raise BootloaderError(f"Ошибка decrypt_firmware_file: {e}")
 
 
 def send_command(uart_serial, command):
@@ -367,64 +1013,340 @@ def send_command(uart_serial, command):
         cmd_packet = command_word + cmd_cmd + cmd_crc
         uart_serial.write(cmd_packet)
     except Exception as e:
-        print(f"Ошибка send_command: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка send_command: {e}")
+
+
+def send_command_with_status(uart_serial, command):
+    # Передает пакет "command", пока загрузчик не ответит ACKW
+    status_result = 0
+    number_of_try_connection = 0
+
+    with metrics.phase(uart_serial, "command_ack", command=command):
+        while number_of_try_connection < max_usart_connection_try:
+            send_command(uart_serial, command)
+            status_result = wait_status(uart_serial)
+            if status_result == 1:
+                print("Команда передана успешно")
+                break
+            # При ошибке приема команды на повышенной скорости загрузчик возвращается на скорость по умолчанию
+            if uart_serial.baudrate != default_baudrate:
+                uart_serial.baudrate = default_baudrate
+                reset_input(uart_serial)
+            number_of_try_connection += 1
+            metrics.retry(uart_serial, "command_ack", number_of_try_connection)
+
+        if status_result == 0:
+            raise Exception("Загрузчик не отвечает пакетом \"статус\"")
+
+
+def start_command_session(uart_serial):
+    # После начала сессии загрузчик выполняет команды по одной, пока не получит reset_command
+    send_command_with_status(uart_serial, start_session_command)
+    wait_session_ready(uart_serial)
+    print("Сессия команд начата")
+
+
+def is_command_end(uart_serial, response):
+    # Строку готовности запоминаем: ее может прочитать обработчик команды раньше wait_session_ready
+    if response == session_ready_line:
+        ready_sessions.add(uart_serial)
+    return response in (restart_line, session_ready_line)
+
+
+def wait_session_ready(uart_serial):
+    # Ждем, пока загрузчик допишет журнал команды: передача во время вывода журнала может потеряться
+    for i in range(max_usart_connection_try):
+        if uart_serial not in ready_sessions:
+            response = read_log_line(uart_serial, uart_serial.timeout * max_usart_connection_try)
+            if response is None or response == restart_line:
+                break
+            is_command_end(uart_serial, response)
+        if uart_serial in ready_sessions:
+            ready_sessions.discard(uart_serial)
+            return
+    raise BootloaderError("Ошибка wait_session_ready: загрузчик не ждет следующую команду")
+
+
+def run_session_command(uart_serial, command, handler):
+    # Выполняет одну команду сессии и ждет, пока загрузчик будет готов к следующей
+    send_command_with_status(uart_serial, command)
+    time.sleep(1)
+    handler(uart_serial)
+    wait_session_ready(uart_serial)
+
+
+def end_command_session(uart_serial):
+    send_command_with_status(uart_serial, reset_command)
+    wait_log_lines(uart_serial, max_usart_connection_try)
+    print("Сессия команд завершена, микроконтроллер перезагружается")
+
+
+def parse_key(key_string):
+    # Проверить, что введенные данные состоят из 8 шестнадцатеричных символов
+    if len(key_string) != 8 or not all(c in "0123456789abcdefABCDEF" for c in key_string):
+        raise ValueError("введите 4 байта в виде 8 шестнадцатеричных символов (например, '01020304').")
+    # Преобразовать введенные данные в беззнаковое 32-битное целое число
+    return int(key_string, 16)
 
 
 def input_key():
     while True:
         user_input = input("Введите 4 байтный ключ шифрования (например, '01020304'): ")
-        # Проверить, что введенные данные состоят из 8 шестнадцатеричных символов
-        if len(user_input) != 8 or not all(c in "0123456789abcdefABCDEF" for c in user_input):
-            print("Ошибка: введите 4 байта в виде 8 шестнадцатеричных символов (например, '01020304').")
-        else:
-            # Преобразовать введенные данные в беззнаковое 32-битное целое число
-            return int(user_input, 16)
+        try:
+            return parse_key(user_input)
+        except ValueError as e:
+            print(f"Ошибка: {e}")
+
 
+def split_firmware(firmware_data, block_size):
+    # Блоки [начало пакета, данные блока, CRC32 данных блока]. Последний блок дополняется байтами 0xFF,
+    # что является обозначением "чистой" памяти в STM32
+    data_blocks = []
+    for i in range(0, len(firmware_data), block_size):
+        block_data = firmware_data[i:i + block_size].ljust(block_size, b'\xFF')
+        # По CRC32 данных блока разностное обновление сравнивает его с установленной прошивкой
+        data_blocks.append([data_word, block_data, crc32mpeg2_func(block_data)])
+    return data_blocks
 
-def open_encrypted_firmware():
-    # Число байт прошивки в блоке "данные"
-    number_of_bytes_in_data_data = 1024
-    result_data_blocks_to_send = []
+
+def open_encrypted_firmware(path_to_bin_file=None, block_size=default_data_block_size):
     try:
-        path_to_bin_file = input("Введите путь до прошивки формата .bin: ").strip()
+        if path_to_bin_file is None:
+            path_to_bin_file = input("Введите путь до прошивки формата .bin: ").strip()
         # path_to_bin_file = "test_app_red_11_04.bin"
         with open(path_to_bin_file, 'rb') as firmware_file:
             print("Файл прошивки успешно открыт, делим ее на блоки")
             firmware_data = firmware_file.read()
             firmware_size = len(firmware_data)
             print("Размер прошивки: " + str(firmware_size) + " байт")
-            print("Количество блоков по " + str(number_of_bytes_in_data_data) + " байт: " + str(
-                math.ceil(firmware_size / number_of_bytes_in_data_data)))
-
-            for i in range(0, firmware_size, number_of_bytes_in_data_data):
-                block_data = firmware_data[i:i + number_of_bytes_in_data_data]
-                # Если файл нельзя разделить на блоки нацело, то заполняем оставшиеся в последнем блоке байты
-                # числом 0xFF, что является обозначением "чистой" памяти в STM32
-                if len(block_data) < number_of_bytes_in_data_data:
-                    block_data = block_data.ljust(number_of_bytes_in_data_data, b'\xFF')
-                crc = crc32mpeg2_func(data_word + block_data)
-                result_data_blocks_to_send.append([data_word, block_data, crc])
-        return result_data_blocks_to_send, firmware_size
+            print("Количество блоков по " + str(block_size) + " байт: " + str(math.ceil(firmware_size / block_size)))
+        return split_firmware(firmware_data, block_size), firmware_size
     except FileNotFoundError:
-        print(f"Ошибка open_and_encrypt_firmware: файл '{path_to_bin_file}' не найден")
-        exit(0)
+        raise BootloaderError(f"Ошибка open_and_encrypt_firmware: файл '{path_to_bin_file}' не найден")
     except PermissionError:
-        print(f"Ошибка open_and_encrypt_firmware: доступ к файлу '{path_to_bin_file}' запрещен")
-        exit(0)
+        raise BootloaderError(f"Ошибка open_and_encrypt_firmware: доступ к файлу '{path_to_bin_file}' запрещен")
     except Exception as e:
-        print(f"Ошибка open_and_encrypt_firmware: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка open_and_encrypt_firmware: {e}")
+
 
+def get_segments_slot(segments):
+    # Слот, в который попадает первый участок прошивки: прошивка собрана для адреса этого слота
+    first_address = segments[0][0]
+    for slot_address, sector_sizes in app_slot_sector_sizes.items():
+        if slot_address <= first_address < slot_address + sum(sector_sizes):
+            return slot_address
+    raise BootloaderError(f"Прошивка начинается с адреса 0x{first_address:08X}, который не входит ни в один слот")
 
-def update_firmware_command(uart_serial):
+
+def read_firmware_segments(firmware_path):
     try:
-        number_of_try_connection = 0
+        return firmware_file.read_segments(firmware_path)
+    except FileNotFoundError:
+        raise BootloaderError(f"Ошибка read_firmware_segments: файл '{firmware_path}' не найден")
+    except PermissionError:
+        raise BootloaderError(f"Ошибка read_firmware_segments: доступ к файлу '{firmware_path}' запрещен")
+    except (OSError, ValueError, struct.error) as e:
+        raise BootloaderError(f"Ошибка read_firmware_segments: '{firmware_path}': {e}")
+
+
+def get_block_ranges(transfer_blocks):
+    # Подряд идущие передаваемые блоки объединяются в диапазоны. Если диапазонов больше max_number_of_segments,
+    # объединяются диапазоны с самым коротким промежутком: его блоки тоже передаются
+    block_ranges = []
+    for block in transfer_blocks:
+        if block_ranges and block_ranges[-1][1] == block:
+            block_ranges[-1][1] = block + 1
+        else:
+            block_ranges.append([block, block + 1])
+    while len(block_ranges) > max_number_of_segments:
+        gap = min(range(len(block_ranges) - 1), key=lambda i: block_ranges[i + 1][0] - block_ranges[i][1])
+        block_ranges[gap][1] = block_ranges.pop(gap + 1)[1]
+    return [tuple(block_range) for block_range in block_ranges]
+
+
+def open_segmented_firmware(firmware_path, block_size, encryption_key):
+    # Прошивка .hex или .elf: участки собираются в образ от начала слота, промежутки заполняются 0xFF, образ
+    # шифруется ключом загрузчика. Блоки только из 0xFF не передаются: после стирания сектора они уже такие
+    segments = read_firmware_segments(firmware_path)
+    slot_address = get_segments_slot(segments)
+    # Участки вне слота (например, option bytes по адресу 0x1FFFC000) проверяются до того, как выделяется образ:
+    # иначе размер образа от начала слота до такого участка - сотни Мбайт
+    slot_end = slot_address + sum(app_slot_sector_sizes[slot_address])
+    for address, data in segments:
+        if address + len(data) > slot_end:
+            raise BootloaderError(f"Ошибка open_segmented_firmware: участок 0x{address:08X} ({len(data)} байт) "
+                                  f"выходит за слот {get_slot_name(slot_address)} (0x{slot_address:08X} - "
+                                  f"0x{slot_end - 1:08X})")
+    last_address, last_data = segments[-1]
+    firmware_data = bytearray(b"\xFF") * (last_address + len(last_data) - slot_address)
+    for address, data in segments:
+        firmware_data[address - slot_address:address - slot_address + len(data)] = data
+    firmware_size = len(firmware_data)
+    # Последний блок дополняется 0xFF до шифрования: загрузчик записывает в конец блока 0xFF, как в стертой памяти,
+    # поэтому CRC32 слота не зависит от размера блока (verify_firmware_command)
+    firmware_data += b"\xFF" * (-firmware_size % block_size)
+
+    empty_block = b"\xFF" * block_size
+    transfer_blocks = [block for block in range(len(firmware_data) // block_size)
+                       if firmware_data[block * block_size:(block + 1) * block_size] != empty_block]
+    data_blocks = split_firmware(cipher.xor_buffer(bytes(firmware_data), encryption_key), block_size)
+    block_ranges = get_block_ranges(transfer_blocks)
+    number_of_transfer_blocks = sum(last_block - first_block for first_block, last_block in block_ranges)
+
+    print(f"Прошивка '{firmware_path}': {len(segments)} участков, {firmware_size} байт от адреса 0x{slot_address:08X}")
+    print(f"Блоков по {block_size} байт: с данными {len(transfer_blocks)}, передается {number_of_transfer_blocks} "
+          f"из {len(data_blocks)} ({len(block_ranges)} участков в пакете \"header\")")
+    return FirmwareImage(firmware_size, block_size, slot_address, data_blocks, block_ranges=block_ranges)
+
+
+def load_firmware_bundle(bundle_path, block_size):
+    firmware_bundle = bundle.FirmwareBundle(bundle_path)
+    if firmware_bundle.target_address not in app_slot_sector_sizes:
+        raise BootloaderError(f"Ошибка load_firmware_bundle: прошивка собрана для адреса "
+                              f"0x{firmware_bundle.target_address:08X}, который не является началом слота")
+    if not firmware_bundle.check_digest():
+        raise BootloaderError(f"Ошибка load_firmware_bundle: SHA-256 образа в '{bundle_path}' не совпадает")
+
+    block_format = get_key(firmware_bundle.block_format, transfer_formats)
+    if block_format is None:
+        raise BootloaderError(f"Ошибка load_firmware_bundle: формат передачи блоков {firmware_bundle.block_format} "
+                              f"не поддерживается")
+
+    print(f"Скомпилированная прошивка: {firmware_bundle.firmware_size} байт, "
+          f"{len(firmware_bundle.packets)} блоков, формат {block_format}, SHA-256 {firmware_bundle.digest.hex()}")
+    if firmware_bundle.block_size != block_size:
+        # Готовые пакеты не подходят: образ делится на блоки заново, пакеты строятся перед передачей
+        print(f"Прошивка скомпилирована для блоков по {firmware_bundle.block_size} байт, передается блоками "
+              f"по {block_size} байт")
+        firmware_data = bytes(firmware_bundle.image[:firmware_bundle.firmware_size])
+        return FirmwareImage(firmware_bundle.firmware_size, block_size, firmware_bundle.target_address,
+                             split_firmware(firmware_data, block_size))
+
+    # Данные блоков копируются (нужны только для разностного обновления и сжатия), пакеты передаются из файла
+    data_blocks = [[data_word, bytes(firmware_bundle.block_data(block)), block_crc]
+                   for block, block_crc in enumerate(firmware_bundle.block_crcs)]
+    return FirmwareImage(firmware_bundle.firmware_size, block_size, firmware_bundle.target_address, data_blocks,
+                         firmware_bundle.image_crc, {block_format: firmware_bundle.packets})
+
+
+def get_slot_name(slot_address):
+    return get_key(slot_address, app_slot_addresses) or f"0x{slot_address:08X}"
+
+
+def read_app_slot(uart_serial):
+    # Перед пакетом "header" загрузчик присылает пакетом "response" адрес слота, с которым работает команда
+    frame = read_frame(uart_serial, (response_word,))
+    if frame is None:
+        raise BootloaderError("Загрузчик не сообщил адрес слота приложения")
+    slot_address = int.from_bytes(frame[1], byteorder="little")
+    if slot_address not in app_slot_sector_sizes:
+        raise BootloaderError(f"Загрузчик сообщил неизвестный адрес слота 0x{slot_address:08X}")
+    print(f"Слот приложения {get_slot_name(slot_address)} (0x{slot_address:08X})")
+    return slot_address
+
+
+def get_firmware_address(firmware_path, position):
+    # Адрес скомпилированной прошивки записан в ее заголовке, прошивка .hex и .elf собрана для слота, в который
+    # попадают ее данные, прошивка .bin - для слота по порядку в списке: первая - для слота A, вторая - для слота B
+    if os.path.isfile(firmware_path) and bundle.is_bundle(firmware_path):
+        return bundle.read_target_address(firmware_path)
+    if firmware_file.is_segmented_firmware(firmware_path):
+        return get_segments_slot(read_firmware_segments(firmware_path))
+    slot_addresses = list(app_slot_addresses.values())
+    return slot_addresses[position] if position < len(slot_addresses) else None
+
+
+def input_firmware_path(firmware_paths=None, slot_address=None):
+    # Путь до прошивки, собранной для слота slot_address, из списка путей (или одного пути).
+    # Без списка путь запрашивается у пользователя
+    if firmware_paths is None:
+        slot_text = f" для слота {get_slot_name(slot_address)}" if slot_address is not None else ""
+        return (input(f"Введите путь до прошивки{slot_text} формата .bin, .fwb, .hex или .elf: ").strip(),
+                slot_address)
+    if isinstance(firmware_paths, str):
+        firmware_paths = [firmware_paths]
+    for position, firmware_path in enumerate(firmware_paths):
+        firmware_address = get_firmware_address(firmware_path, position)
+        if slot_address is None or firmware_address == slot_address:
+            return firmware_path, firmware_address
+    raise BootloaderError(f"Нужна прошивка, собранная для слота {get_slot_name(slot_address)} "
+                          f"(0x{slot_address:08X}): .bin вторым путем или .fwb с этим адресом")
+
+
+def open_firmware(firmware_path, block_size, target_address):
+    # Зашифрованная прошивка .bin, скомпилированная прошивка .fwb (compile_firmware_bundle) или прошивка .hex и .elf,
+    # которая шифруется ключом firmware_encryption_key, разделенная на блоки по block_size байт.
+    # Адрес прошивки .bin задает target_address
+    try:
+        file_stat = os.stat(firmware_path)
+    except OSError as e:
+        raise BootloaderError(f"Ошибка open_firmware: файл '{firmware_path}' недоступен ({e.strerror})")
+
+    encryption_key = None
+    if firmware_file.is_segmented_firmware(firmware_path):
+        encryption_key = firmware_encryption_key if firmware_encryption_key is not None else input_key()
+    image_key = (os.path.abspath(firmware_path), file_stat.st_mtime_ns, file_stat.st_size, block_size, target_address,
+                 encryption_key)
+    with firmware_images_lock:
+        if image_key not in firmware_images:
+            if encryption_key is not None:
+                firmware_images[image_key] = open_segmented_firmware(firmware_path, block_size, encryption_key)
+            elif bundle.is_bundle(firmware_path):
+                firmware_images[image_key] = load_firmware_bundle(firmware_path, block_size)
+            else:
+                data_blocks, firmware_size = open_encrypted_firmware(firmware_path, block_size)
+                firmware_images[image_key] = FirmwareImage(firmware_size, block_size, target_address, data_blocks)
+        return firmware_images[image_key]
+
+
+def open_slot_firmware(uart_serial, firmware_paths, block_size=None):
+    # Читает слот, о котором сообщил загрузчик, и открывает прошивку, собранную для этого слота.
+    # Без block_size размер блока выбирается по линии (select_block_size)
+    slot_address = read_app_slot(uart_serial)
+    firmware_path, target_address = input_firmware_path(firmware_paths, slot_address)
+    if block_size is None:
+        block_size = select_block_size(uart_serial, firmware_path)
+    firmware_image = open_firmware(firmware_path, block_size, target_address)
+    if firmware_image.target_address != slot_address:
+        raise BootloaderError(f"Прошивка '{firmware_path}' собрана для адреса 0x{firmware_image.target_address:08X}, "
+                              f"загрузчик ожидает прошивку для слота {get_slot_name(slot_address)}")
+    if firmware_image.firmware_size > sum(app_slot_sector_sizes[slot_address]):
+        raise BootloaderError(f"Прошивка '{firmware_path}' не помещается в слот {get_slot_name(slot_address)}")
+    return firmware_image, slot_address
+
+
+def compile_firmware_bundle(firmware_path, bundle_path=None, block_format=None, block_size=None,
+                            target_address=app_slot_addresses["A"]):
+    # Один раз строит пакеты зашифрованной прошивки, собранной для слота target_address,
+    # и сохраняет их вместе с CRC32 блоков и образа
+    block_format = block_format or transfer_format
+    block_size = block_size or data_block_size or default_data_block_size
+    if bundle_path is None:
+        bundle_path = os.path.splitext(firmware_path)[0] + bundle.bundle_extension
+    try:
+        data_blocks, firmware_size = open_encrypted_firmware(firmware_path, block_size)
+        image = FirmwareImage(firmware_size, block_size, target_address, data_blocks)
+        bundle.write_bundle(bundle_path, firmware_size, block_size, transfer_formats[block_format],
+                            target_address, b"".join(block_data for word, block_data, crc in data_blocks),
+                            [crc for word, block_data, crc in data_blocks], image.image_crc,
+                            image.transfer_packets(block_format))
+        print(f"Скомпилированная прошивка сохранена в '{bundle_path}'")
+        return bundle_path
+    except BootloaderError:
+        raise
+    except Exception as e:
+        raise BootloaderError(f"Ошибка compile_firmware_bundle: {e}")
+
 
-        result_data_blocks_to_send, firmware_size = open_encrypted_firmware()
-        print("Отправляю заголовок с размером прошивки")
+def send_header_with_status(uart_serial, firmware_image, window_size, block_size, segments=()):
+    number_of_try_connection = 0
+
+    print("Отправляю заголовок с размером прошивки")
+    with metrics.phase(uart_serial, "header", firmware_size=firmware_image.firmware_size, window_size=window_size,
+                       block_size=block_size):
         while number_of_try_connection < max_usart_connection_try:
-            send_header(uart_serial, firmware_size)
+            send_header(uart_serial, firmware_image, window_size, transfer_formats[transfer_format], block_size,
+                        segments)
             status_of_send_header = wait_status(uart_serial)
             if status_of_send_header == 1:
                 print("Заголовок передан успешно")
@@ -433,26 +1355,204 @@ def update_firmware_command(uart_serial):
                 raise Exception("Ошибка при передачи заголовка")
             else:
                 number_of_try_connection += 1
+                metrics.retry(uart_serial, "header", number_of_try_connection)
 
-        print("Ожидаю ответа о наличии свободного места во flash памяти")
+    print("Ожидаю ответа о наличии свободного места во flash памяти")
+    with metrics.phase(uart_serial, "space_response"):
         wait_response(uart_serial)
 
-        print("Начинаю передачу прошивки")
-        send_data_result = send_data(uart_serial, result_data_blocks_to_send)
 
+def wait_activation_result(uart_serial):
+    # После последнего окна загрузчик сверяет CRC32 слота с CRC32 образа из заголовка и записывает слот в журнал
+    # загрузки. Пока слот не активирован, запускается прежняя прошивка
+    print("Ожидаю проверки записанной прошивки и активации слота")
+    with metrics.phase(uart_serial, "activation"):
+        frame = read_frame(uart_serial, (response_word,), uart_serial.timeout * max_usart_connection_try)
+        if frame is None:
+            raise Exception("Загрузчик не сообщил результат активации слота")
+        if int.from_bytes(frame[1], byteorder="little") != bootloader_responses["ok"]:
+            raise Exception("Записанная прошивка не совпадает с файлом, слот не активирован")
+        print("Слот с новой прошивкой активирован")
+
+
+def wait_update_result(uart_serial):
+    # После последнего окна загрузчик может стирать и записывать сектор несколько секунд, поэтому ждем дольше обычного
+    with metrics.phase(uart_serial, "confirmation") as details:
+        details["result"] = "no_confirmation"
         for i in range(10):
-            response = uart_serial.readline().decode("utf-8").strip()
+            response = read_log_line(uart_serial, uart_serial.timeout * max_usart_connection_try)
+            if response is None:
+                break
             if response == "Прошивка запрограммирована успешно!":
                 print("Прошивка успешно запрограммирована!")
-            if response == "Перезагрузка МК!":
+                details["result"] = "ok"
+            if response == restart_line:
                 print("Перезагрузка микроконтроллера")
+            if is_command_end(uart_serial, response):
+                break
+
+
+def update_firmware_command(uart_serial, firmware_paths=None, progress=print_progress):
+    try:
+        firmware_image, slot_address = open_slot_firmware(uart_serial, firmware_paths)
+        block_size = firmware_image.block_size
+        window_size = get_window_size(block_size)
+        packets = firmware_image.transfer_packets()
+        send_header_with_status(uart_serial, firmware_image, window_size, block_size, firmware_image.segments())
+
+        print("Начинаю передачу прошивки")
+        # Загрузчик стирает сектора перед первым переданным блоком, который в них попадает (сектора без переданных
+        # блоков - вместе со следующим за ними)
+        transfer_blocks = firmware_image.transfer_blocks()
+        erase_blocks = []
+        for first_block, last_block, sector_size in get_sector_blocks(len(firmware_image.data_blocks), block_size,
+                                                                      slot_address):
+            sequence = next((sequence for sequence, block in enumerate(transfer_blocks) if block >= first_block),
+                            None)
+            if sequence is not None and sequence not in erase_blocks:
+                erase_blocks.append(sequence)
+        send_data_result = send_data(uart_serial, packets, window_size, progress, erase_blocks)
+
+        if send_data_result == 1:
+            wait_activation_result(uart_serial)
+
+        wait_update_result(uart_serial)
 
         if send_data_result != 1:
-            raise Exception("Ошибка при передаче прошивки")
+            raise TransferInterruptedError("Ошибка update_firmware_command: ошибка при передаче прошивки")
 
+    except TransferInterruptedError:
+        raise
     except Exception as e:
-        print(f"Ошибка update_firmware_command: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка update_firmware_command: {e}")
+
+
+def read_block_crcs(uart_serial, number_of_blocks):
+    # CRC32 блоков установленной прошивки приходят пакетами "response" (данные пакета - CRC32, а не код ответа)
+    block_crcs = []
+    for block in range(number_of_blocks):
+        frame = read_frame(uart_serial, (response_word,))
+        if frame is None:
+            raise Exception(f"Загрузчик не прислал CRC32 блока {block}")
+        block_crcs.append(int.from_bytes(frame[1], byteorder="little"))
+    return block_crcs
+
+
+def read_erased_blocks(uart_serial, number_of_blocks):
+    # Маска стертых блоков приходит пакетами "response" по 32 блока: бит i слова - блок 32 * номер слова + i
+    erased_blocks = set()
+    for first_block in range(0, number_of_blocks, 32):
+        frame = read_frame(uart_serial, (response_word,))
+        if frame is None:
+            raise Exception(f"Загрузчик не прислал маску стертых блоков {first_block} - {first_block + 31}")
+        erased_mask = int.from_bytes(frame[1], byteorder="little")
+        erased_blocks.update(first_block + bit for bit in range(32) if (erased_mask >> bit) & 1)
+    return erased_blocks
+
+
+def send_delta_map(uart_serial, changed_blocks):
+    # Бит i маски (байт i // 8, бит i % 8) означает, что блок i изменился и будет передан
+    delta_map = bytearray(max_number_of_data_blocks // 8)
+    for block in changed_blocks:
+        delta_map[block // 8] |= 1 << (block % 8)
+    delta_map_crc = struct.pack('>I', crc32mpeg2_func(delta_map_word + delta_map))
+    uart_serial.write(delta_map_word + delta_map + delta_map_crc)
+
+
+def delta_update_firmware_command(uart_serial, firmware_paths=None, progress=print_progress):
+    # Разностное обновление: загрузчик присылает CRC32 блоков прошивки неактивного слота (вычисленные по зашифрованным
+    # текущим ключом данным), и передаются только блоки, CRC32 которых отличается. В неактивном слоте прошивка
+    # на две версии старше текущей (слоты чередуются), поэтому передаются изменения двух последних версий
+    try:
+        firmware_image, slot_address = open_slot_firmware(uart_serial, firmware_paths)
+        block_size = firmware_image.block_size
+        window_size = get_window_size(block_size)
+        result_data_blocks_to_send = firmware_image.data_blocks
+        send_header_with_status(uart_serial, firmware_image, window_size, block_size)
+
+        print("Получаю CRC32 блоков прошивки слота")
+        with metrics.phase(uart_serial, "block_crcs", blocks=len(result_data_blocks_to_send)):
+            device_block_crcs = read_block_crcs(uart_serial, len(result_data_blocks_to_send))
+            erased_blocks = read_erased_blocks(uart_serial, len(result_data_blocks_to_send))
+        changed_blocks = [block for block, (word, block_data, crc) in enumerate(result_data_blocks_to_send)
+                          if crc != device_block_crcs[block]]
+        print(f"Изменено блоков: {len(changed_blocks)} из {len(result_data_blocks_to_send)}")
+
+        # Сектор больше буфера загрузчика стирается, если хоть один его измененный блок уже записан, поэтому тогда
+        # передаем все блоки сектора. Стертые блоки (после прерванной передачи) дописываются без стирания.
+        # С первого блока каждого затронутого сектора загрузчик начинает его запись и может стирать сектор
+        erase_blocks = []
+        number_of_changed_blocks = len(changed_blocks)
+        for first_block, last_block, sector_size in get_sector_blocks(len(result_data_blocks_to_send), block_size,
+                                                                      slot_address):
+            sector_changed_blocks = [block for block in changed_blocks if first_block <= block < last_block]
+            if not sector_changed_blocks:
+                continue
+            if sector_size > delta_staging_size and not erased_blocks.issuperset(sector_changed_blocks):
+                changed_blocks = sorted(set(changed_blocks) | set(range(first_block, last_block)))
+            erase_blocks.append(min(block for block in changed_blocks if first_block <= block < last_block))
+        if len(changed_blocks) != number_of_changed_blocks:
+            print(f"С учетом секторов, которые перезаписываются целиком, передается блоков: {len(changed_blocks)}")
+
+        status_result = 0
+        number_of_try_connection = 0
+        while number_of_try_connection < max_usart_connection_try:
+            send_delta_map(uart_serial, changed_blocks)
+            status_result = wait_status(uart_serial)
+            if status_result == 1:
+                break
+            number_of_try_connection += 1
+
+        if status_result == 0:
+            raise Exception("Ошибка при передаче маски измененных блоков")
+
+        send_data_result = 1
+        if changed_blocks:
+            print("Начинаю передачу измененных блоков прошивки")
+            # Порядковый номер пакета "data" - номер блока в списке измененных блоков
+            changed_data_blocks = [result_data_blocks_to_send[block] for block in changed_blocks]
+            send_data_result = send_data(uart_serial, build_block_packets(prepare_data_blocks(changed_data_blocks)),
+                                         window_size, progress,
+                                         [changed_blocks.index(block) for block in erase_blocks])
+
+        if send_data_result == 1:
+            wait_activation_result(uart_serial)
+
+        wait_update_result(uart_serial)
+
+        if send_data_result != 1:
+            raise TransferInterruptedError("Ошибка delta_update_firmware_command: ошибка при передаче прошивки")
+
+    except TransferInterruptedError:
+        raise
+    except Exception as e:
+        raise BootloaderError(f"Ошибка delta_update_firmware_command: {e}")
+
+
+def verify_firmware_command(uart_serial, firmware_paths=None):
+    # Загрузчик присылает CRC32 активного слота, зашифрованного текущим ключом (как при разностном
+    # обновлении), поэтому он сравнивается с CRC32 зашифрованного файла прошивки, дополненного до целых блоков
+    try:
+        # CRC32 не зависит от размера блока, кроме дополнения образа до целых блоков, поэтому размер выбирается
+        # так, чтобы не делить прошивку на блоки заново
+        slot_address = read_app_slot(uart_serial)
+        firmware_path, target_address = input_firmware_path(firmware_paths, slot_address)
+        block_size = data_block_size or get_bundle_block_size(firmware_path) or default_data_block_size
+        firmware_image = open_firmware(firmware_path, block_size, target_address)
+        send_header_with_status(uart_serial, firmware_image, get_window_size(block_size), block_size)
+
+        frame = read_frame(uart_serial, (response_word,))
+        if frame is None:
+            raise Exception("Загрузчик не прислал CRC32 прошивки")
+        device_crc = int.from_bytes(frame[1], byteorder="little")
+        firmware_crc = firmware_image.image_crc
+
+        if device_crc != firmware_crc:
+            raise Exception(f"CRC32 прошивки во flash памяти {device_crc:#010x}, в файле {firmware_crc:#010x}")
+        print(f"Прошивка во flash памяти совпадает с файлом (CRC32 {firmware_crc:#010x})")
+
+    except Exception as e:
+        raise BootloaderError(f"Ошибка verify_firmware_command: {e}")
 
 
 def send_key(uart_serial, key):
@@ -461,24 +1561,23 @@ def send_key(uart_serial, key):
         key_packet = key_word + key + key_crc
         uart_serial.write(key_packet)
     except Exception as e:
-        print(f"Ошибка при отправке пакета \"key\": {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка при отправке пакета \"key\": {e}")
 
 
-def set_key_command(uart_serial):
+def set_key_command(uart_serial, developer_input_key=None):
     try:
         number_of_try_connection = 0
 
         uid = get_uid_command(uart_serial)
         secret_encryption_key = bytes.fromhex(uid[1][2:]) # убираем первые 2 символа "0x"
         secret_encryption_key = int.from_bytes(secret_encryption_key, byteorder="big")
-        developer_input_key = input_key()
+        if developer_input_key is None:
+            developer_input_key = input_key()
 
         developer_input_key = developer_input_key.to_bytes(4, "big")
 
         # Шифруем ключ при помощи secret_encryption_key
-        encrypted_developer_key = bytes(
-            [(b ^ (secret_encryption_key >> (8 * (j % 4))) & 0xFF) for j, b in enumerate(developer_input_key)])
+        encrypted_developer_key = cipher.xor_buffer(developer_input_key, secret_encryption_key)
 
 
         status_result = 0
@@ -502,19 +1601,18 @@ def set_key_command(uart_serial):
         print(f"Ключ шифрования - {print_developer_input_key} для МК с UID - {uid[0]}-{uid[1]}-{uid[2]} установлен")
 
     except Exception as e:
-        print(f"Ошибка set_key_command: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка set_key_command: {e}")
 
 
-def check_key_command(uart_serial):
+def check_key_command(uart_serial, develiper_input_key=None):
     try:
         number_of_try_connection = 0
 
-        develiper_input_key = input_key()
+        if develiper_input_key is None:
+            develiper_input_key = input_key()
 
         # Шифруем тестовое слово полученным ключом шифрования
-        encrypted_test_word = bytes(
-            [(b ^ (develiper_input_key >> (8 * (j % 4))) & 0xFF) for j, b in enumerate(test_word)])
+        encrypted_test_word = cipher.xor_buffer(test_word, develiper_input_key)
 
         status_result = 0
 
@@ -534,42 +1632,26 @@ def check_key_command(uart_serial):
         wait_response(uart_serial)
 
     except Exception as e:
-        print(f"Ошибка check_key_command: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка check_key_command: {e}")
 
 
 def flash_ob_check_command(uart_serial):
     try:
-        number_of_try = 0
-        while number_of_try < 5:
-            response = uart_serial.readline().decode("utf-8").strip()
-            if response != "":
-                print('Ответ загрузчика: {}'.format(response))
-                number_of_try += 1
+        wait_log_lines(uart_serial, 5)
     except Exception as e:
         print(f"Ошибка flash_ob_check_command: {e}")
 
 
 def flash_lock_command(uart_serial):
     try:
-        number_of_try = 0
-        while number_of_try < 5:
-            response = uart_serial.readline().decode("utf-8").strip()
-            if response != "":
-                print('Ответ загрузчика: {}'.format(response))
-                number_of_try += 1
+        wait_log_lines(uart_serial, 5)
     except Exception as e:
         print(f"Ошибка flash_lock_command: {e}")
 
 
 def flash_unlock_command(uart_serial):
     try:
-        number_of_try = 0
-        while number_of_try < 5:
-            response = uart_serial.readline().decode("utf-8").strip()
-            if response != "":
-                print('Ответ загрузчика: {}'.format(response))
-                number_of_try += 1
+        wait_log_lines(uart_serial, 5)
     except Exception as e:
         print(f"Ошибка flash_unlock_command: {e}")
 
@@ -589,22 +1671,29 @@ def get_uid_command(uart_serial):
             raise ValueError("UID не может быть пустым")
 
     except Exception as e:
-        print(f"Ошибка uart_serial: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка uart_serial: {e}")
 
 
 def erase_program_command(uart_serial):
     try:
-        number_of_try = 0
-        while number_of_try < 5:
-            response = uart_serial.readline().decode("utf-8").strip()
-            if response != "":
-                print('Ответ загрузчика: {}'.format(response))
-                number_of_try += 1
+        wait_log_lines(uart_serial, 5)
     except Exception as e:
         print(f"Ошибка erase_program_command: {e}")
 
 
+def rollback_firmware_command(uart_serial):
+    # Загрузчик делает активным слот, который был активен до последнего обновления, если его прошивка цела
+    try:
+        frame = read_frame(uart_serial, (response_word,))
+        if frame is None:
+            raise Exception("Загрузчик не прислал результат отката")
+        if int.from_bytes(frame[1], byteorder="little") != bootloader_responses["ok"]:
+            raise Exception("Прошивки для отката нет или она перезаписана")
+        print("Активна предыдущая прошивка, она запустится после перезагрузки")
+    except Exception as e:
+        raise BootloaderError(f"Ошибка rollback_firmware_command: {e}")
+
+
 def execute_develop_bootloader_command(uart_serial, command):
     # Должен соответствовать host_developer_bootloader_commands
     handlers = {
@@ -616,6 +1705,9 @@ def execute_develop_bootloader_command(uart_serial, command):
         6: get_uid_command,
         7: check_key_command,
         8: erase_program_command,
+        10: delta_update_firmware_command,
+        13: verify_firmware_command,
+        14: rollback_firmware_command,
     }
 
     try:
@@ -625,14 +1717,14 @@ def execute_develop_bootloader_command(uart_serial, command):
 
         handler(uart_serial)
     except Exception as e:
-        print(f"Ошибка execute_develop_bootloader_command: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка execute_develop_bootloader_command: {e}")
 
 
 def execute_user_bootloader_command(uart_serial, command):
     handlers = {
         1: update_firmware_command,
         2: get_uid_command,
+        3: delta_update_firmware_command,
     }
 
     try:
@@ -642,5 +1734,4 @@ def execute_user_bootloader_command(uart_serial, command):
 
         handler(uart_serial)
     except Exception as e:
-        print(f"Ошибка execute_user_bootloader_command: {e}")
-        exit(0)
+        raise BootloaderError(f"Ошибка execute_user_bootloader_command: {e}")
@@ -0,0 +1,1080 @@
+import argparse
+import fcntl
+import math
+import os
+import random
+import select
+import struct
+import sys
+import termios
+import threading
+import time
+import tty
+
+import bootloader_log
+import cipher
+import compression
+from uart_functions import *
+
+# Программная модель загрузчика для проверки Host приложения и измерения скорости передачи без платы.
+# Повторяет обработку пакетов bootloader_uart.c и bootloader_execution.c: те же пакеты, CRC32 MPEG-2, ACKW/NACK/RESP,
+# окна передачи и сектора flash памяти пользовательского приложения. Host приложение подключается к псевдотерминалу,
+# имя которого возвращает VirtualBootloader.start(), так же, как к настоящему COM-порту.
+
+# Версия загрузчика (MAJOR, MINOR в main.c)
+bootloader_version = (0, 2)
+
+# Размеры и ограничения загрузчика (bootloader_settings.h)
+# Сектора слотов пользовательского приложения подряд (смещение от APP_FLASH_START_ADDRESS, размер)
+app_flash_start_address = min(app_slot_sector_sizes)
+app_flash_sectors = [(slot_address - app_flash_start_address + sum(sector_sizes[:sector]), sector_size)
+                     for slot_address, sector_sizes in sorted(app_slot_sector_sizes.items())
+                     for sector, sector_size in enumerate(sector_sizes)]
+app_flash_size = sum(sector_size for sector_offset, sector_size in app_flash_sectors)
+# Допустимые значения указателя стека в таблице векторов прошивки: RAM (SRAM1 + SRAM2) и CCMRAM (is_app_slot_valid)
+app_stack_ranges = [(0x20000000, 0x20020000), (0x10000000, 0x10010000)]
+max_window_size = 8
+# Размеры блока "data" (MIN_/MAX_NUMBER_OF_BYTES_DATA_DATA) и буфера окна (WINDOW_BUFFER_SIZE), байт
+min_data_block_size = data_block_sizes[0]
+max_data_block_size = data_block_sizes[-1]
+window_buffer_size = 16 * 1024
+data_packet_timeout = 1.0
+# Окно входа в режим загрузчика после сброса и время тишины после входа
+# (BOOTLOADER_ENTRY_WINDOW_MS, BOOTLOADER_ENTRY_QUIET_MS), с
+bootloader_entry_window = 0.5
+bootloader_entry_quiet = 0.1
+default_encryption_key = 0x13121411
+# UID модели: второе слово - секретный ключ для передачи нового ключа шифрования (DEFAULT_SECRET_ENCRYPTION_KEY)
+default_uid = (0x00470036, 0x3137510A, 0x33383835)
+
+# Полные размеры пакетов Host приложения
+command_packet_size = 12
+header_packet_size = 4 + 8 * 4 + max_number_of_segments * 8 + 4
+key_packet_size = 12
+baud_packet_size = 12
+test_packet_size = 12
+boot_packet_size = 12
+delta_map_packet_size = 4 + max_number_of_data_blocks // 8 + 4
+# Пакет "data" без данных блока: начало пакета, номер блока и CRC32
+data_packet_overhead_size = 4 + 4 + 4
+compressed_header_size = 12
+
+# Номера событий журнала (log_event_t) по формату сообщения: модель выводит сообщения в формате printf загрузчика
+log_event_numbers = {log_format: event for event, (level, log_format) in bootloader_log.log_events.items()}
+# Тип пакета в сообщении о неверном начале пакета (LOG_EVENT_NOT_*_PACKET в bootloader_uart.c) по началу пакета
+packet_type_names = {command_word: "command", header_word: "header", key_word: "key", baud_word: "baud",
+                     delta_map_word: "dmap"}
+
+# Время работы flash памяти STM32F407 по умолчанию, с: стирание сектора 64 Кбайт (сектор 128 Кбайт стирается вдвое
+# дольше) и запись 1024 байт словами
+default_erase_time = 1.0
+erase_time_sector_size = 64 * 1024
+default_block_write_time = 0.004
+block_write_time_size = 1024
+# Пауза перед программной перезагрузкой (restart в bootloader_utilities.c), с
+default_restart_delay = 3.0
+
+# Бит TIOCPKT_FLUSHREAD: Host приложение сбросило входной буфер порта (pyserial делает это при открытии порта)
+pty_flush_read = getattr(termios, "TIOCPKT_FLUSHREAD", 1)
+
+# Скорости UART по значениям termios, чтобы узнать, на какой скорости Host приложение открыло порт
+termios_baudrates = {getattr(termios, f"B{baudrate}"): baudrate for baudrate in supported_baudrates
+                     if hasattr(termios, f"B{baudrate}")}
+
+
+class VirtualReset(Exception):
+    # Host приложение открыло порт: модель перезагружается, как после нажатия кнопки Reset
+    pass
+
+
+class VirtualBootloaderStopped(Exception):
+    pass
+
+
+class VirtualBootloader:
+
+    def __init__(self, latency=0.0, block_write_time=default_block_write_time, erase_time=default_erase_time,
+                 bit_error_rate=0.0, emulate_line_rate=True, restart_delay=default_restart_delay,
+                 button_pressed=True, seed=None, rx_dma=True, binary_log=True):
+        # latency - задержка перед каждой передачей загрузчика, с
+        # bit_error_rate - вероятность искажения каждого бита на линии (в обе стороны)
+        # emulate_line_rate - ограничивать передачу скоростью UART (10 бит на байт), как на настоящей линии
+        # rx_dma - прием через DMA (UART_RX_DMA): байты, пришедшие во время стирания и записи flash, не теряются
+        # binary_log - журнал пакетами "loge" (LOG_BINARY_FRAMES), иначе текстом printf
+        self.latency = latency
+        self.block_write_time = block_write_time
+        self.erase_time = erase_time
+        self.bit_error_rate = bit_error_rate
+        self.emulate_line_rate = emulate_line_rate
+        self.restart_delay = restart_delay
+        self.button_pressed = button_pressed
+        self.rx_dma = rx_dma
+        self.binary_log = binary_log
+        self.random = random.Random(seed)
+        # Ошибки бит в каждом направлении линии ("rx" - к загрузчику, "tx" - к Host приложению) считаются своим
+        # генератором: при одном seed ошибки попадают в те же биты каждого потока, как бы ни чередовались прием
+        # и передача
+        self.error_randoms = {direction: random.Random(None if seed is None else f"{seed}:{direction}")
+                              for direction in ("rx", "tx")}
+        self.bits_to_error = {direction: self.next_error_distance(direction) for direction in self.error_randoms}
+
+        self.flash = bytearray(b"\xFF" * app_flash_size)
+        # Журнал загрузки (BOOT_JOURNAL_ADDRESS): записи (адрес слота, размер образа, CRC32 образа без шифрования)
+        # в порядке добавления. Хранится в секторе настроек и переживает сброс
+        self.boot_records = []
+        # Слот, с которым работает текущая команда
+        self.slot_address = app_flash_start_address
+        self.encryption_key = default_encryption_key
+        self.uid = default_uid
+        self.flash_locked = False
+        self.baudrate = default_baudrate
+        # Размер блока "data" из последнего принятого пакета "header" (header_t.block_size)
+        self.block_size = min_data_block_size
+        # Участки прошивки из последнего принятого пакета "header" [(адрес, размер)], которые передаются блоками
+        self.segments = []
+        # Флаг входа в режим загрузчика в backup регистре (BOOTLOADER_ENTRY_FLAG): переживает программный сброс
+        self.entry_flag = False
+        # Текущий уровень журнала (LOG_LEVEL после сброса) и уровень на время передачи блоков из пакета "header"
+        self.log_level = bootloader_log.log_level_info
+        self.transfer_log_level = 0
+
+        self.statistics = {"received_bytes": 0, "sent_bytes": 0, "bit_errors": 0, "nack": 0,
+                           "erased_sectors": 0, "written_blocks": 0, "resets": 0, "lost_bytes": 0}
+
+        self.master_fd = None
+        self.slave_fd = None
+        self.port = None
+        self.input_buffer = bytearray()
+        self.reset_allowed = False
+        self.running = False
+        self.thread = None
+
+    # ---------- Линия UART ----------
+
+    def open(self):
+        # Загрузчик работает на стороне master псевдотерминала, Host приложение открывает slave как обычный порт
+        self.master_fd, self.slave_fd = os.openpty()
+        # Без raw режима терминал вернет загрузчику эхо его же передачи
+        tty.setraw(self.slave_fd)
+        # Пакетный режим: чтение master сообщает о сбросе буфера, по нему модель узнает об открытии порта
+        fcntl.ioctl(self.master_fd, termios.TIOCPKT, struct.pack("i", 1))
+        self.port = os.ttyname(self.slave_fd)
+        return self.port
+
+    def close(self):
+        for fd in (self.master_fd, self.slave_fd):
+            if fd is not None:
+                os.close(fd)
+        self.master_fd = self.slave_fd = None
+
+    def host_baudrate(self):
+        # Скорость, которую Host приложение установило для порта. Если она неизвестна, считаем ее совпадающей
+        speed = termios.tcgetattr(self.slave_fd)[5]
+        return termios_baudrates.get(speed, self.baudrate)
+
+    def next_error_distance(self, direction):
+        # Число бит до следующей ошибки (геометрическое распределение)
+        if self.bit_error_rate <= 0:
+            return math.inf
+        if self.bit_error_rate >= 1:
+            return 0
+        return int(math.log(1.0 - self.error_randoms[direction].random()) / math.log(1.0 - self.bit_error_rate))
+
+    def line_transfer(self, data, direction):
+        # Искажения на линии: ошибки отдельных бит и мусор вместо байт при несовпадении скоростей сторон
+        if self.host_baudrate() != self.baudrate:
+            return bytes(self.random.randrange(256) for i in range(len(data)))
+
+        number_of_bits = len(data) * 8
+        if self.bits_to_error[direction] >= number_of_bits:
+            self.bits_to_error[direction] -= number_of_bits
+            return data
+
+        data = bytearray(data)
+        bit = self.bits_to_error[direction]
+        while bit < number_of_bits:
+            data[bit // 8] ^= 1 << (bit % 8)
+            self.statistics["bit_errors"] += 1
+            bit += self.next_error_distance(direction) + 1
+        self.bits_to_error[direction] = bit - number_of_bits
+        return bytes(data)
+
+    def wait_line(self, number_of_bytes):
+        if self.emulate_line_rate:
+            time.sleep(number_of_bytes * 10 / self.baudrate)
+
+    def read_bytes(self, size, timeout=None):
+        # Аналог HAL_UART_Receive: None, если за timeout секунд не пришло size байт (None - HAL_MAX_DELAY)
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while len(self.input_buffer) < size:
+            if not self.running:
+                raise VirtualBootloaderStopped()
+            wait = 0.1 if deadline is None else min(0.1, deadline - time.monotonic())
+            if wait <= 0:
+                return None
+            ready, _, _ = select.select([self.master_fd], [], [], wait)
+            if not ready:
+                continue
+            packet = os.read(self.master_fd, 4096)
+            if packet[0] != 0:
+                if packet[0] & pty_flush_read and self.reset_allowed:
+                    raise VirtualReset()
+                continue
+            self.input_buffer += self.line_transfer(packet[1:], "rx")
+
+        data = bytes(self.input_buffer[:size])
+        del self.input_buffer[:size]
+        self.statistics["received_bytes"] += size
+        self.wait_line(size)
+        return data
+
+    def drop_received_bytes(self):
+        # Прием опросом: пока процессор занят flash памятью, приходящие байты теряются
+        if self.rx_dma:
+            return
+        lost_bytes = len(self.input_buffer)
+        self.input_buffer.clear()
+        while select.select([self.master_fd], [], [], 0)[0]:
+            packet = os.read(self.master_fd, 4096)
+            if packet[0] == 0:
+                lost_bytes += len(packet) - 1
+        self.statistics["lost_bytes"] += lost_bytes
+
+    def write_bytes(self, data):
+        if self.latency > 0:
+            time.sleep(self.latency)
+        self.wait_line(len(data))
+        data = self.line_transfer(data, "tx")
+        self.statistics["sent_bytes"] += len(data)
+        while data:
+            written = os.write(self.master_fd, data)
+            data = data[written:]
+
+    def print(self, text):
+        self.write_bytes((text + "\n").encode("utf-8"))
+
+    def log(self, log_format, *arguments):
+        # LOG_ERROR, LOG_INFO и т.п.: событие журнала с форматом log_format, если его уровень не больше текущего
+        event = log_event_numbers[log_format]
+        level = bootloader_log.log_events[event][0]
+        if level > self.log_level:
+            return
+        if not self.binary_log:
+            self.print(log_format % arguments)
+            return
+        # usart_send_log_event
+        data = (bootloader_log.log_word + struct.pack("<I", event | level << 16 | len(arguments) << 24)
+                + struct.pack(f"<{len(arguments)}I", *arguments))
+        self.write_bytes(data + crc32mpeg2_func(data).to_bytes(4, byteorder="little"))
+
+    # ---------- Пакеты (bootloader_uart.c) ----------
+
+    def send_packet(self, word, packet_data):
+        data = word + packet_data.to_bytes(4, byteorder="little")
+        self.write_bytes(data + crc32mpeg2_func(data).to_bytes(4, byteorder="little"))
+
+    def send_response(self, response_data):
+        self.send_packet(response_word, response_data)
+
+    def send_status(self, ack, status_data=0):
+        if not ack:
+            self.statistics["nack"] += 1
+        self.send_packet(ack_word if ack else nack_word, status_data)
+
+    @staticmethod
+    def check_packet(packet, word):
+        return (packet[:4] == word
+                and crc32mpeg2_func(packet[:-4]) == int.from_bytes(packet[-4:], byteorder="big"))
+
+    def get_packet(self, word, packet_size):
+        # Пакет фиксированного размера без поиска начала (usart_get_cmd, usart_get_header, ...):
+        # данные пакета или None, если пакет поврежден
+        packet = self.read_bytes(packet_size)
+        if packet[:4] != word:
+            self.log(f"Переданные данные не соответствуют пакету типа \"{packet_type_names[word]}\"")
+            return None
+        if not self.check_packet(packet, word):
+            self.log("Ошибка CRC, полученная и вычисленная сумма отличаются")
+            return None
+        return packet[4:-4]
+
+    def get_packet_with_status(self, word, packet_size):
+        # Повторяет прием пакета с ответом NACK, пока он не будет принят (не больше max_usart_connection_try раз)
+        for connection_try in range(max_usart_connection_try):
+            packet_data = self.get_packet(word, packet_size)
+            if packet_data is not None:
+                self.send_status(True)
+                return packet_data
+            self.send_status(False)
+        return None
+
+    def receive_packet(self, word, packet_size, timeout):
+        # usart_receive_packet: начало пакета ищется побайтно. None - линия свободна timeout секунд
+        packet = self.read_bytes(4, timeout)
+        while packet is not None and packet != word:
+            next_byte = self.read_bytes(1, timeout)
+            packet = None if next_byte is None else packet[1:] + next_byte
+        if packet is None:
+            return None
+        rest = self.read_bytes(packet_size - 4, timeout)
+        return None if rest is None else packet + rest
+
+    def get_data(self):
+        # Возвращает (статус, номер блока, данные): статус "ok", "crc" или "timeout"
+        packet = self.receive_packet(data_word, data_packet_overhead_size + self.block_size, data_packet_timeout)
+        if packet is None:
+            return "timeout", 0, None
+        if not self.check_packet(packet, data_word):
+            return "crc", 0, None
+        return "ok", int.from_bytes(packet[4:8], byteorder="big"), packet[8:-4]
+
+    def get_compressed_data(self):
+        packet = self.receive_packet(compressed_data_word, compressed_header_size, data_packet_timeout)
+        if packet is None:
+            return "timeout", 0, None
+        data_size = int.from_bytes(packet[8:12], byteorder="big")
+        if data_size == 0 or data_size > self.block_size:
+            return "crc", 0, None
+        rest = self.read_bytes(data_size + (-data_size % 4) + 4, data_packet_timeout)
+        if rest is None:
+            return "timeout", 0, None
+        packet += rest
+        if not self.check_packet(packet, compressed_data_word):
+            return "crc", 0, None
+        return "ok", int.from_bytes(packet[4:8], byteorder="big"), packet[12:12 + data_size]
+
+    # ---------- Flash память ----------
+
+    def erase_sector(self, sector):
+        # sector - номер сектора в области приложения (0 - APP_FIRST_SECTOR)
+        sector_offset, sector_size = app_flash_sectors[sector]
+        time.sleep(self.erase_time * sector_size / erase_time_sector_size)
+        self.flash[sector_offset:sector_offset + sector_size] = b"\xFF" * sector_size
+        self.statistics["erased_sectors"] += 1
+        self.drop_received_bytes()
+
+    def erase_flash(self):
+        # erase_app_flash: стирание всей области приложения
+        for sector in range(len(app_flash_sectors)):
+            self.erase_sector(sector)
+
+    @staticmethod
+    def get_sector(offset):
+        for sector, (sector_offset, sector_size) in enumerate(app_flash_sectors):
+            if sector_offset <= offset < sector_offset + sector_size:
+                return sector
+        return None
+
+    def get_slot_offset(self):
+        return self.slot_address - app_flash_start_address
+
+    def get_sector_blocks(self, sector, number_of_data_blocks):
+        # Блоки нумеруются от начала слота текущей команды
+        sector_offset, sector_size = app_flash_sectors[sector]
+        first_block = (sector_offset - self.get_slot_offset()) // self.block_size
+        return first_block, min(first_block + sector_size // self.block_size, number_of_data_blocks)
+
+    def write_flash(self, offset, data):
+        # Программирование flash памяти может только сбрасывать биты из 1 в 0
+        time.sleep(self.block_write_time * len(data) / block_write_time_size)
+        for i, data_byte in enumerate(data):
+            self.flash[offset + i] &= data_byte
+        self.statistics["written_blocks"] += len(data) // self.block_size
+        self.drop_received_bytes()
+
+    # ---------- Слоты и журнал загрузки (bootloader_flash.c) ----------
+
+    def get_image_crc(self, slot_address, image_size, key):
+        # calculate_encrypted_flash_crc: с нулевым ключом - CRC32 данных слота без шифрования
+        offset = slot_address - app_flash_start_address
+        return crc32mpeg2_func(cipher.xor_buffer(self.flash[offset:offset + image_size], key))
+
+    def is_app_slot_valid(self, slot_address, image_size=0, image_crc=0):
+        offset = slot_address - app_flash_start_address
+        slot_size = sum(app_slot_sector_sizes[slot_address])
+        stack_pointer, reset_handler = struct.unpack_from("<II", self.flash, offset)
+        if not any(start < stack_pointer <= end for start, end in app_stack_ranges):
+            return False
+        if not slot_address <= reset_handler < slot_address + slot_size:
+            return False
+        if image_size == 0:
+            return True
+        return image_size <= slot_size and self.get_image_crc(slot_address, image_size, 0) == image_crc
+
+    def get_boot_records(self):
+        # get_boot_records: [запись слота для отката, запись активного слота] или меньше записей
+        records = []
+        for record in self.boot_records:
+            if records and record[0] != records[-1][0]:
+                records = records[-1:]
+            else:
+                records = records[:-1]
+            records.append(record)
+        return records
+
+    def get_active_app_slot(self):
+        records = self.get_boot_records()
+        return records[-1][0] if records else app_flash_start_address
+
+    def get_inactive_app_slot(self):
+        active_slot = self.get_active_app_slot()
+        return next(slot_address for slot_address in app_slot_sector_sizes if slot_address != active_slot)
+
+    def select_app_slot(self):
+        # select_app_slot: активный слот, откат к предыдущему или 0, если исправной прошивки нет
+        records = self.get_boot_records()
+        if not records:
+            return app_flash_start_address if self.is_app_slot_valid(app_flash_start_address) else 0
+        if self.is_app_slot_valid(*records[-1]):
+            return records[-1][0]
+        self.log("Прошивка активного слота 0x%08lX повреждена", records[-1][0])
+        if len(records) < 2 or not self.is_app_slot_valid(*records[0]):
+            return 0
+        self.log("Возвращаемся к прошивке слота 0x%08lX", records[0][0])
+        self.boot_records.append(records[0])
+        return records[0][0]
+
+    def activate_app_slot(self, firmware_size, image_crc):
+        # activate_app_slot: CRC32 слота сверяется с CRC32 из header, затем слот записывается в журнал
+        image_size = math.ceil(firmware_size / self.block_size) * self.block_size
+        activated = self.get_image_crc(self.slot_address, image_size, self.encryption_key) == image_crc
+        if activated:
+            self.boot_records.append((self.slot_address, image_size, self.get_image_crc(self.slot_address,
+                                                                                        image_size, 0)))
+            self.log("Слот 0x%08lX активен", self.slot_address)
+        else:
+            self.log("CRC32 записанной прошивки не совпадает с CRC32 из header")
+        self.send_response(bootloader_responses["ok" if activated else "fail"])
+        return activated
+
+    # ---------- Команды (bootloader_execution.c) ----------
+
+    def receive_header(self):
+        for connection_try in range(max_usart_connection_try):
+            header_data = self.get_packet(header_word, header_packet_size)
+            if header_data is None:
+                self.send_status(False)
+                continue
+
+            (firmware_size, window_size, block_format, target_address, block_size, image_crc, transfer_log_level,
+             number_of_segments) = struct.unpack_from(">IIIIIIII", header_data)
+            segments = [struct.unpack_from(">II", header_data, 32 + segment * 8)
+                        for segment in range(min(number_of_segments, max_number_of_segments))]
+            slot_size = sum(app_slot_sector_sizes[self.slot_address])
+            # Ошибка: формат сообщения журнала и его аргументы
+            error = None
+            if firmware_size == 0:
+                error = ("Размер прошивки равен нулю",)
+            elif firmware_size > slot_size:
+                error = ("Размер прошивки больше %lu байт", slot_size)
+            elif target_address != self.slot_address:
+                error = ("Прошивка собрана для адреса 0x%08lX, слот приложения начинается с 0x%08lX",
+                         target_address, self.slot_address)
+            elif (block_size < min_data_block_size or block_size > max_data_block_size
+                  or block_size & (block_size - 1)):
+                error = ("Размер блока должен быть степенью двойки от %u до %u байт", min_data_block_size,
+                         max_data_block_size)
+            elif window_size == 0 or window_size > max_window_size or window_size * block_size > window_buffer_size:
+                error = ("Размер окна передачи должен быть от 1 до %u блоков и не больше %u байт", max_window_size,
+                         window_buffer_size)
+            elif block_format not in transfer_formats.values():
+                error = ("Формат передачи блоков %lu не поддерживается", block_format)
+            elif not self.is_segment_list_valid(number_of_segments, segments, firmware_size, block_size):
+                error = ("Участки прошивки не упорядочены, не выровнены по блокам или выходят за прошивку",)
+
+            self.send_status(True)
+            if error is not None:
+                self.log(*error)
+                self.send_response(bootloader_responses["fail"])
+                return None
+            self.send_response(bootloader_responses["ok"])
+            self.block_size = block_size
+            self.transfer_log_level = transfer_log_level
+            # Без участков передается вся прошивка
+            self.segments = segments or [(self.slot_address, firmware_size)]
+            return firmware_size, window_size, block_format, image_crc
+        return None
+
+    def is_segment_list_valid(self, number_of_segments, segments, firmware_size, block_size):
+        # is_segment_list_valid: участки по возрастанию адреса, начинаются с начала блока и заканчиваются концом блока
+        # или концом прошивки
+        if number_of_segments > max_number_of_segments:
+            return False
+        previous_end = self.slot_address
+        firmware_end = self.slot_address + firmware_size
+        for address, size in segments:
+            end = address + size
+            if size == 0 or address < previous_end or end > firmware_end:
+                return False
+            if (address - self.slot_address) % block_size or ((end - self.slot_address) % block_size
+                                                               and end != firmware_end):
+                return False
+            previous_end = end
+        return True
+
+    def get_transfer_offsets(self):
+        # Смещения блоков участков от начала области приложения в порядке передачи: порядковый номер пакета "data" -
+        # индекс в этом списке
+        return [address - app_flash_start_address + offset for address, size in self.segments
+                for offset in range(0, size, self.block_size)]
+
+    def receive_data_window(self, first_block, blocks_in_window, block_format):
+        # receive_data_window: пока окно принимается, загрузчик молчит, NACK с маской - когда линия освободилась
+        window = {}
+        previous_window_repeated = False
+        connection_try = 0
+
+        while len(window) < blocks_in_window and connection_try < max_usart_connection_try:
+            if block_format == transfer_formats["lz4"]:
+                status, sequence, block = self.get_compressed_data()
+            else:
+                status, sequence, block = self.get_data()
+
+            if status == "ok":
+                if first_block <= sequence < first_block + blocks_in_window:
+                    window.setdefault(sequence - first_block, block)
+                elif sequence < first_block:
+                    previous_window_repeated = True
+                continue
+            if status != "timeout":
+                continue
+
+            if previous_window_repeated and not window:
+                self.send_status(True, first_block)
+            else:
+                self.send_status(False, sum(1 << slot for slot in window))
+            previous_window_repeated = False
+            connection_try += 1
+
+        if len(window) < blocks_in_window:
+            return None
+        return [window[slot] for slot in range(blocks_in_window)]
+
+    def set_transfer_log_level(self):
+        # На время передачи блоков действует уровень журнала из header (0 - не меняется). Возвращает прежний уровень
+        saved_log_level = self.log_level
+        if self.transfer_log_level:
+            self.log_level = self.transfer_log_level
+        return saved_log_level
+
+    def decode_block(self, block, block_format):
+        if block_format == transfer_formats["lz4"] and len(block) != self.block_size:
+            try:
+                block = compression.lz4_decompress_block(block, self.block_size)
+            except (ValueError, IndexError):
+                return None
+        return cipher.xor_buffer(block, self.encryption_key)
+
+    def update_firmware(self):
+        # Прошивка записывается в неактивный слот, его адрес загрузчик сообщает перед пакетом "header"
+        self.slot_address = self.get_inactive_app_slot()
+        self.send_response(self.slot_address)
+        header = self.receive_header()
+        if header is None:
+            self.log("Ошибка при получении header")
+            return False
+        firmware_size, window_size, block_format, image_crc = header
+        block_offsets = self.get_transfer_offsets()
+        number_of_data_blocks = len(block_offsets)
+        next_sector = self.get_sector(self.get_slot_offset())
+
+        saved_log_level = self.set_transfer_log_level()
+        try:
+            for first_block in range(0, number_of_data_blocks, window_size):
+                blocks_in_window = min(window_size, number_of_data_blocks - first_block)
+                window = self.receive_data_window(first_block, blocks_in_window, block_format)
+                if window is None:
+                    self.log("Ошибка при получении блока данных с прошивкой")
+                    self.log("Ошибка при обновлении прошивки")
+                    return False
+
+                # Сектора стираются, когда в них попадает окно, вместе с пропущенными секторами без переданных блоков
+                window_end = block_offsets[first_block + blocks_in_window - 1] + self.block_size
+                while next_sector < len(app_flash_sectors) and app_flash_sectors[next_sector][0] < window_end:
+                    self.erase_sector(next_sector)
+                    next_sector += 1
+
+                program_start = time.monotonic()
+                for slot, block in enumerate(window):
+                    decoded_block = self.decode_block(block, block_format)
+                    if decoded_block is None:
+                        self.log("Ошибка распаковки блока данных")
+                        self.log("Ошибка при записи блока flash памяти")
+                        self.log("Ошибка при обновлении прошивки")
+                        return False
+                    self.write_flash(block_offsets[first_block + slot], decoded_block)
+                program_time = time.monotonic() - program_start
+
+                self.log("[%lu / %lu]", first_block + blocks_in_window, number_of_data_blocks)
+                self.send_packet(program_time_word, int(program_time * 1000000))
+                self.send_status(True, first_block + blocks_in_window)
+        finally:
+            self.log_level = saved_log_level
+
+        if not self.activate_app_slot(firmware_size, image_crc):
+            self.log("Ошибка при обновлении прошивки")
+            return False
+        self.log("Прошивка запрограммирована успешно!")
+        return True
+
+    def flash_block_crc(self, block):
+        # calculate_encrypted_flash_crc: CRC32 блока, зашифрованного текущим ключом, как в файле прошивки
+        offset = self.get_slot_offset() + block * self.block_size
+        return crc32mpeg2_func(cipher.xor_buffer(self.flash[offset:offset + self.block_size], self.encryption_key))
+
+    def is_block_erased(self, block):
+        offset = self.get_slot_offset() + block * self.block_size
+        return self.flash[offset:offset + self.block_size] == b"\xFF" * self.block_size
+
+    def verify_firmware(self):
+        self.slot_address = self.get_active_app_slot()
+        self.send_response(self.slot_address)
+        header = self.receive_header()
+        if header is None:
+            self.log("Ошибка при получении header")
+            return False
+        number_of_data_blocks = math.ceil(header[0] / self.block_size)
+        started = time.monotonic()
+        firmware_crc = self.get_image_crc(self.slot_address, number_of_data_blocks * self.block_size,
+                                          self.encryption_key)
+        crc_time_us = int((time.monotonic() - started) * 1000000)
+        self.send_response(firmware_crc)
+        self.log("CRC32 прошивки: %#lx, вычислен за %lu мкс", firmware_crc, crc_time_us)
+        return True
+
+    def delta_update_firmware(self):
+        self.slot_address = self.get_inactive_app_slot()
+        self.send_response(self.slot_address)
+        header = self.receive_header()
+        if header is None:
+            self.log("Ошибка при получении header")
+            return False
+        firmware_size, window_size, block_format, image_crc = header
+        slot_offset = self.get_slot_offset()
+        number_of_data_blocks = math.ceil(firmware_size / self.block_size)
+
+        for block in range(number_of_data_blocks):
+            self.send_response(self.flash_block_crc(block))
+        erased_blocks = [self.is_block_erased(block) for block in range(number_of_data_blocks)]
+        for first_block in range(0, number_of_data_blocks, 32):
+            self.send_response(sum(1 << bit for bit, erased in enumerate(erased_blocks[first_block:first_block + 32])
+                                   if erased))
+
+        delta_map = self.get_packet_with_status(delta_map_word, delta_map_packet_size)
+        if delta_map is None:
+            self.log("Ошибка при получении пакета \"dmap\"")
+            return False
+
+        changed_blocks = [block for block in range(number_of_data_blocks) if delta_map[block // 8] & (1 << (block % 8))]
+        if not changed_blocks:
+            # Слот уже содержит новую прошивку, его остается только активировать
+            self.log("Прошивка не изменилась, запись не требуется")
+
+        # Сектор не больше CCMRAM собирается в буфере и записывается после приема всех его блоков,
+        # блоки сектора больше буфера записываются по мере приема: если все измененные блоки стерты - без стирания,
+        # иначе сектор стирается (все его блоки должны быть в маске)
+        current_sector = None
+        staging_image = None
+        erased_sectors = 0
+        saved_log_level = self.set_transfer_log_level()
+        try:
+            for first_block in range(0, len(changed_blocks), window_size):
+                blocks_in_window = min(window_size, len(changed_blocks) - first_block)
+                window = self.receive_data_window(first_block, blocks_in_window, block_format)
+                if window is None:
+                    self.log("Ошибка при получении блока данных с прошивкой")
+                    self.log("Ошибка при обновлении прошивки")
+                    return False
+
+                for slot, block in enumerate(window):
+                    decoded_block = self.decode_block(block, block_format)
+                    if decoded_block is None:
+                        self.log("Ошибка распаковки блока данных")
+                        return False
+                    offset = slot_offset + changed_blocks[first_block + slot] * self.block_size
+                    sector = self.get_sector(offset)
+
+                    if sector != current_sector:
+                        if staging_image is not None:
+                            erased_sectors += self.write_staged_sector(current_sector, staging_image, delta_map,
+                                                                       number_of_data_blocks)
+                        current_sector = sector
+                        sector_offset, sector_size = app_flash_sectors[sector]
+                        staging_image = None
+                        if sector_size <= delta_staging_size:
+                            staging_image = bytearray(self.flash[sector_offset:sector_offset + sector_size])
+                        else:
+                            sector_first_block, sector_last_block = self.get_sector_blocks(sector,
+                                                                                           number_of_data_blocks)
+                            sector_changed_blocks = [block for block in range(sector_first_block, sector_last_block)
+                                                     if delta_map[block // 8] & (1 << (block % 8))]
+                            if not all(erased_blocks[block] for block in sector_changed_blocks):
+                                if len(sector_changed_blocks) != sector_last_block - sector_first_block:
+                                    self.log("Сектор %lu больше буфера CCMRAM и должен передаваться целиком", sector)
+                                    return False
+                                self.erase_sector(sector)
+                                erased_sectors += 1
+
+                    if staging_image is not None:
+                        sector_offset = app_flash_sectors[sector][0]
+                        staging_image[offset - sector_offset:offset - sector_offset + self.block_size] = decoded_block
+                    else:
+                        self.write_flash(offset, decoded_block)
+
+                self.log("[%lu / %lu]", first_block + blocks_in_window, len(changed_blocks))
+                self.send_status(True, first_block + blocks_in_window)
+        finally:
+            self.log_level = saved_log_level
+
+        if staging_image is not None:
+            erased_sectors += self.write_staged_sector(current_sector, staging_image, delta_map, number_of_data_blocks)
+
+        self.log("Изменено блоков: %lu из %lu, стерто секторов: %lu", len(changed_blocks), number_of_data_blocks,
+                 erased_sectors)
+        if not self.activate_app_slot(firmware_size, image_crc):
+            self.log("Ошибка при обновлении прошивки")
+            return False
+        self.log("Прошивка запрограммирована успешно!")
+        return True
+
+    def write_staged_sector(self, sector, staging_image, delta_map, number_of_data_blocks):
+        # write_staged_sector: если измененные блоки можно записать без стирания, пишутся только они.
+        # Возвращает 1, если сектор пришлось стереть
+        sector_offset = app_flash_sectors[sector][0]
+        first_block, last_block = self.get_sector_blocks(sector, number_of_data_blocks)
+        changed_offsets = [self.get_slot_offset() + block * self.block_size - sector_offset
+                           for block in range(first_block, last_block)
+                           if delta_map[block // 8] & (1 << (block % 8))]
+        erase_required = any(flash_byte & new_byte != new_byte
+                             for offset in changed_offsets
+                             for flash_byte, new_byte in zip(
+                                 self.flash[sector_offset + offset:sector_offset + offset + self.block_size],
+                                 staging_image[offset:offset + self.block_size]))
+        if erase_required:
+            self.erase_sector(sector)
+            self.write_flash(sector_offset, staging_image[:(last_block - first_block) * self.block_size])
+            return 1
+        for offset in changed_offsets:
+            self.write_flash(sector_offset + offset, staging_image[offset:offset + self.block_size])
+        return 0
+
+    def rollback_firmware(self):
+        records = self.get_boot_records()
+        rolled_back = False
+        if len(records) < 2:
+            self.log("В журнале загрузки нет прошивки для отката")
+        elif not self.is_app_slot_valid(*records[0]):
+            self.log("Прошивка слота 0x%08lX перезаписана или повреждена, откат невозможен", records[0][0])
+        else:
+            self.boot_records.append(records[0])
+            self.log("Слот 0x%08lX активен", records[0][0])
+            rolled_back = True
+        self.send_response(bootloader_responses["ok" if rolled_back else "fail"])
+        return rolled_back
+
+    def erase_program(self):
+        # erase_program: стираются оба слота и журнал загрузки
+        self.erase_flash()
+        self.boot_records.clear()
+        return True
+
+    def send_uid(self):
+        for uid_word in self.uid:
+            self.send_response(uid_word)
+
+    def set_key(self):
+        self.send_uid()
+        coded_key = self.get_packet_with_status(key_word, key_packet_size)
+        if coded_key is None:
+            self.log("Ошибка при получении пакета \"key\"")
+            return False
+        self.encryption_key = int.from_bytes(cipher.xor_buffer(coded_key, self.uid[1]), byteorder="big")
+        self.send_response(bootloader_responses["ok"])
+        return True
+
+    def check_key(self):
+        encrypted_test_word = self.get_packet_with_status(key_word, key_packet_size)
+        if encrypted_test_word is None:
+            self.log("Ошибка при получении пакета \"key\"")
+            return False
+        if cipher.xor_buffer(encrypted_test_word, self.encryption_key) == test_word:
+            self.send_response(bootloader_responses["ok"])
+            self.log("Ключи шифрования соответствуют!")
+            return True
+        self.send_response(bootloader_responses["fail"])
+        self.log("Ключи шифрования НЕ соответствуют!")
+        return False
+
+    def flash_ob_check(self):
+        if self.flash_locked:
+            self.log("Защита flash памяти включена (отключение приведет к полному стиранию flash памяти!)")
+        else:
+            self.log("Защита flash памяти выключена")
+        return self.flash_locked
+
+    def flash_lock(self):
+        self.log("Провожу проверку на наличие защиты flash памяти")
+        if not self.flash_ob_check():
+            self.flash_locked = True
+            self.log("Защита flash памяти успешно включена")
+        else:
+            self.log("Защита flash памяти уже включена, отмена команды")
+        return True
+
+    def flash_unlock(self):
+        self.log("Провожу проверку на наличие защиты flash памяти")
+        if self.flash_ob_check():
+            self.log("Отключаю защиту flash памяти")
+            # Снятие защиты аппаратно стирает flash память
+            self.flash_locked = False
+            self.erase_flash()
+        else:
+            self.log("Защита flash памяти уже выключена, отмена команды")
+        return True
+
+    def set_baudrate(self):
+        baud_data = self.get_packet_with_status(baud_word, baud_packet_size)
+        if baud_data is None:
+            self.log("Ошибка при получении пакета \"baud\"")
+            return False
+
+        baudrate = int.from_bytes(baud_data, byteorder="big")
+        if baudrate not in supported_baudrates:
+            self.log("Скорость UART %lu бод не поддерживается", baudrate)
+            self.send_response(bootloader_responses["fail"])
+            return True
+
+        self.send_response(bootloader_responses["ok"])
+        self.baudrate = baudrate
+
+        # usart_get_probe: пакеты, принятые с ошибкой, пропускаются до истечения времени ожидания
+        deadline = time.monotonic() + baudrate_probe_timeout
+        while time.monotonic() < deadline:
+            packet = self.receive_packet(test_word, test_packet_size, deadline - time.monotonic())
+            if packet is not None and self.check_packet(packet, test_word) \
+                    and int.from_bytes(packet[4:8], byteorder="big") == baudrate:
+                self.log("Скорость UART изменена на %lu бод", baudrate)
+                self.send_response(bootloader_responses["ok"])
+                return True
+
+        self.baudrate = default_baudrate
+        self.log("Проверка скорости UART не пройдена, скорость %lu бод", self.baudrate)
+        return True
+
+    def execute_command(self, command):
+        commands = {
+            1: ("обновления прошивки", self.update_firmware),
+            2: ("задания пароля", self.set_key),
+            3: ("проверки защиты flash памяти", lambda: self.flash_ob_check() or True),
+            4: ("установки защиты flash памяти", self.flash_lock),
+            5: ("снятия защиты flash памяти", self.flash_unlock),
+            6: ("получения UID", lambda: self.send_uid() or True),
+            7: ("проверки соответствия ключей шифрования", self.check_key),
+            8: ("стирания пользовательской прошивки из flash памяти", self.erase_program),
+            9: ("смены скорости UART", self.set_baudrate),
+            10: ("разностного обновления прошивки", self.delta_update_firmware),
+            11: ("начала сессии команд", lambda: True),
+            12: ("завершения сессии команд", lambda: True),
+            13: ("проверки записанной прошивки", self.verify_firmware),
+            14: ("отката к предыдущей прошивке", self.rollback_firmware),
+        }
+        description, handler = commands[command]
+        self.log(f"Выбрана команда для {description}, выполняю...")
+        return handler()
+
+    def get_command(self):
+        # Пакет "command" ждем без ограничения времени: в это время открытие порта Host приложением - сброс МК
+        self.reset_allowed = True
+        try:
+            command_data = self.get_packet(command_word, command_packet_size)
+        finally:
+            self.reset_allowed = False
+        if command_data is None:
+            return None
+        return int.from_bytes(command_data, byteorder="big")
+
+    def bootloader_mode(self):
+        session_started = False
+        wait_next_command = True
+        while wait_next_command:
+            command = None
+            for connection_try in range(max_usart_connection_try):
+                command = self.get_command()
+                if command is None:
+                    self.baudrate = default_baudrate
+                    self.send_status(False)
+                elif not 1 <= command <= 14:
+                    command = None
+                    self.send_status(False)
+                else:
+                    self.send_status(True)
+                    break
+
+            if command is None:
+                self.log("Ошибка при получении пакета \"command\"")
+                return
+
+            if not self.execute_command(command):
+                self.log("Ошибка выполнения команды!")
+                if not session_started:
+                    return
+
+            session_started = session_started or command == 11
+            if command == 12:
+                return
+
+            if session_started:
+                self.log("Ожидаю следующую команду")
+            wait_next_command = session_started or command == 9
+
+    def get_boot_request(self, timeout):
+        # usart_get_boot_request: пакеты, принятые с ошибкой, пропускаются до истечения времени ожидания
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while deadline is None or time.monotonic() < deadline:
+            packet = self.receive_packet(boot_word, boot_packet_size,
+                                         None if deadline is None else deadline - time.monotonic())
+            if packet is not None and self.check_packet(packet, boot_word) \
+                    and int.from_bytes(packet[4:8], byteorder="big") == bootloader_entry_magic:
+                return True
+        return False
+
+    def run_application(self):
+        # Пользовательское приложение модели (как test_app) по пакету "boot" ставит флаг входа и перезагружается
+        self.reset_allowed = True
+        try:
+            self.get_boot_request(None)
+        finally:
+            self.reset_allowed = False
+        self.print("Bootloader requested, restarting")
+        self.entry_flag = True
+
+    def boot(self):
+        self.baudrate = default_baudrate
+        self.input_buffer.clear()
+        self.log_level = bootloader_log.log_level_info
+        # Открытие порта Host приложением до входа в режим загрузчика - тоже сброс МК: pyserial при открытии
+        # сбрасывает входной буфер, и строки о входе, переданные до этого, Host приложение уже не получит
+        self.reset_allowed = True
+        try:
+            self.log("Загрузчик версии: (%d.%d)", bootloader_version[0], bootloader_version[1])
+            if self.entry_flag:
+                self.entry_flag = False
+                self.log("Приложение запросило режим загрузчика, переходим в режим загрузчика")
+            else:
+                self.log("Нажмите кнопку User или передайте пакет \"boot\" в течение %lu мс "
+                         "чтобы перейти в режим загрузчика", int(bootloader_entry_window * 1000))
+                if self.button_pressed:
+                    self.log("Кнопка User была нажата, переходим в режим загрузчика")
+                elif self.get_boot_request(bootloader_entry_window):
+                    self.log("Получен пакет \"boot\", переходим в режим загрузчика")
+                else:
+                    self.log("Кнопка User не нажата, переходим к исполнению пользовательского приложения")
+                    app_address = self.select_app_slot()
+                    if app_address:
+                        self.log("Переходим в User application (слот 0x%08lX)", app_address)
+                        self.run_application()
+                        return
+                    self.log("Нет исправной прошивки пользовательского приложения, переходим в режим загрузчика")
+
+            # Пропускаем повторные пакеты "boot", переданные до строки о входе в режим загрузчика
+            while self.get_boot_request(bootloader_entry_quiet):
+                pass
+        finally:
+            self.reset_allowed = False
+        self.bootloader_mode()
+        self.log("Перезагрузка микроконтроллера через 3 секунды")
+        time.sleep(self.restart_delay)
+        self.log("Перезагрузка МК!")
+
+    def run(self):
+        while self.running:
+            try:
+                self.boot()
+            except VirtualReset:
+                self.statistics["resets"] += 1
+            except VirtualBootloaderStopped:
+                break
+
+    def start(self):
+        # Запускает модель в отдельном потоке и возвращает имя порта для Host приложения
+        if self.master_fd is None:
+            self.open()
+        self.running = True
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+        return self.port
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.close()
+
+    def print_statistics(self):
+        print("Статистика модели загрузчика:")
+        for name, value in self.statistics.items():
+            print(f"  {name}: {value}")
+
+
+def make_firmware(size, seed=1):
+    # Похожие на прошивку данные: участки случайных байт (код) чередуются с повторами (таблицы и заполнение),
+    # поэтому сжатие LZ4 работает, но не вырождается
+    generator = random.Random(seed)
+    firmware = bytearray()
+    while len(firmware) < size:
+        if generator.random() < 0.6:
+            firmware += bytes(generator.randrange(256) for i in range(generator.randrange(16, 256)))
+        else:
+            firmware += bytes([generator.randrange(256)]) * generator.randrange(16, 512)
+    return bytes(firmware[:size])
+
+
+def make_encrypted_firmware(size, slot_address):
+    # Зашифрованная прошивка для слота: таблица векторов с вершиной стека в SRAM и Reset_Handler в слоте,
+    # чтобы модель загрузчика запустила записанное приложение
+    vector_table = struct.pack("<II", app_stack_ranges[0][1], slot_address + 0x1C1)
+    firmware = vector_table + make_firmware(size - len(vector_table))
+    return cipher.xor_buffer(firmware, default_encryption_key)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Программная модель загрузчика STM32F407 на псевдотерминале")
+    parser.add_argument("--latency", type=float, default=0.0, help="задержка перед каждой передачей загрузчика, с")
+    parser.add_argument("--block-write-time", type=float, default=default_block_write_time,
+                        help="время записи блока 1024 байт во flash, с")
+    parser.add_argument("--erase-time", type=float, default=default_erase_time, help="время стирания сектора, с")
+    parser.add_argument("--restart-delay", type=float, default=default_restart_delay,
+                        help="пауза перед программной перезагрузкой, с")
+    parser.add_argument("--bit-error-rate", type=float, default=0.0, help="вероятность искажения бита на линии")
+    parser.add_argument("--no-line-rate", action="store_true",
+                        help="не ограничивать передачу скоростью UART")
+    parser.add_argument("--no-button", action="store_true",
+                        help="кнопка User не нажата: вход в режим загрузчика только по пакету \"boot\"")
+    parser.add_argument("--no-rx-dma", action="store_true",
+                        help="прием опросом: байты, пришедшие во время записи flash, теряются")
+    parser.add_argument("--key", type=parse_key, default=default_encryption_key,
+                        help="ключ шифрования прошивки, например 13121411")
+    parser.add_argument("--seed", type=int, default=None, help="начальное значение генератора ошибок")
+    parser.add_argument("--text-log", action="store_true",
+                        help="журнал текстом printf вместо пакетов \"loge\" (LOG_BINARY_FRAMES FALSE)")
+    arguments = parser.parse_args(argv)
+
+    bootloader = VirtualBootloader(arguments.latency, arguments.block_write_time, arguments.erase_time,
+                                   arguments.bit_error_rate, not arguments.no_line_rate, arguments.restart_delay,
+                                   not arguments.no_button, arguments.seed, not arguments.no_rx_dma,
+                                   not arguments.text_log)
+    bootloader.encryption_key = arguments.key
+    print(f"Модель загрузчика запущена на порту {bootloader.start()}, Ctrl+C для остановки")
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        bootloader.stop()
+        bootloader.print_statistics()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
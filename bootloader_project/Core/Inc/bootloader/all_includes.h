@@ -40,8 +40,8 @@
 #include "stm32f4xx.h"
 #include "stm32f4xx_hal_rcc.h"
 
+#include "bootloader_settings.h" /* До bootloader_types.h: размеры массивов в структурах пакетов */
 #include "bootloader_types.h"
-#include "bootloader_settings.h"
 #include "bootloader_words.h"
 
 #include "bootloader_utilities.h"
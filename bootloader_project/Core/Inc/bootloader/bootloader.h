@@ -41,6 +41,7 @@ extern "C" {
 #include "all_includes.h"
 
 extern uint8_t check_bootloader_mode(void);
+extern uint32_t select_app_slot(void);
 extern void bootloader_mode(void);
 
 #ifdef __cplusplus
@@ -42,9 +42,13 @@ extern "C" {
 
 extern uint8_t set_key(void);
 extern uint8_t update_firmware(void);
+extern uint8_t delta_update_firmware(void);
+extern uint8_t verify_firmware(void);
+extern uint8_t rollback_firmware(void);
 extern uint8_t flash_ob_check(void);
 extern uint8_t flash_lock(void);
 extern void flash_unlock(void);
+extern uint8_t set_baudrate(void);
 extern uint8_t execute_command(cmd_t command);
 
 #ifdef __cplusplus
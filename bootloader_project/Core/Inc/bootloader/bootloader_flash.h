@@ -40,10 +40,26 @@ extern "C" {
 
 #include "all_includes.h"
 
+/* Номер сектора для адреса вне flash памяти */
+#define FLASH_SECTOR_INVALID 0xFFFFFFFFU
+
+extern uint32_t get_flash_sector(uint32_t flash_address);
+extern uint32_t get_flash_sector_address(uint32_t number_of_sector);
+extern uint32_t get_flash_sector_size(uint32_t number_of_sector);
+extern uint8_t is_flash_erased(uint32_t flash_address, uint32_t size);
 extern uint8_t erase_flash(uint32_t number_of_sector);
+extern uint8_t erase_app_flash(void);
+extern uint8_t erase_app_slot(uint32_t slot_address);
 extern uint8_t write_data_block_to_flash(uint8_t* data, uint32_t data_len, uint32_t flash_address);
 extern uint8_t check_settings(void);
 extern uint8_t set_settings(uint32_t key);
+extern uint32_t get_app_slot_size(uint32_t slot_address);
+extern uint32_t get_other_app_slot(uint32_t slot_address);
+extern uint8_t is_app_slot_valid(uint32_t slot_address, uint32_t image_size, uint32_t image_crc);
+extern uint32_t get_boot_records(boot_record_t* records);
+extern uint32_t get_active_app_slot(boot_record_t* record);
+extern uint8_t add_boot_record(uint32_t slot_address, uint32_t image_size, uint32_t image_crc);
+extern uint8_t clear_boot_records(void);
 
 #ifdef __cplusplus
 }
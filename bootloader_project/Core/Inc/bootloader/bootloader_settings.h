@@ -39,6 +39,7 @@ extern "C" {
 #endif /* __cplusplus */
 
 extern UART_HandleTypeDef huart3;
+extern DMA_HandleTypeDef hdma_usart3_rx;
 extern CRC_HandleTypeDef hcrc;
 
 extern uint32_t encryption_key; /*Ключ шифрования прошивки, использующийся в программе */
@@ -54,41 +55,162 @@ extern uint32_t secret_encryption_key; /* Ключ шифрования, нео
 #define NUMBER_OF_BYTES_DATA_WORD     4
 #define NUMBER_OF_BYTES_KEY_WORD      4
 #define NUMBER_OF_BYTES_TEST_WORD     4
+#define NUMBER_OF_BYTES_BAUD_WORD     4
+#define NUMBER_OF_BYTES_DMAP_WORD     4
+#define NUMBER_OF_BYTES_ZDAT_WORD     4
+#define NUMBER_OF_BYTES_PTIM_WORD     4
+#define NUMBER_OF_BYTES_BOOT_WORD     4
+#define NUMBER_OF_BYTES_LOGE_WORD     4
 #define NUMBER_OF_BYTES_ACK           4
 #define NUMBER_OF_BYTES_NACK          4
 
 /* Количество байт, которые определяют данные в пакете */
 #define NUMBER_OF_BYTES_COMMAND_DATA  4
-#define NUMBER_OF_BYTES_HEADER_DATA   4
+/* Размер прошивки + размер окна передачи + формат передачи блоков + адрес записи + размер блока + CRC32 образа
+ * + уровень журнала во время передачи блоков + число участков + MAX_NUMBER_OF_SEGMENTS пар (адрес, размер) */
+#define NUMBER_OF_BYTES_HEADER_DATA   (32 + MAX_NUMBER_OF_SEGMENTS * 8)
 #define NUMBER_OF_BYTES_RESPONSE_DATA 4
-#define NUMBER_OF_BYTES_DATA_DATA     1024
+#define NUMBER_OF_BYTES_STATUS_DATA   4 /* Число записанных блоков или битовая маска принятых блоков окна */
+#define NUMBER_OF_BYTES_DATA_SEQUENCE 4 /* Порядковый номер блока прошивки в пакете "data" */
+/* Размер данных пакета "data" выбирает Host приложение в пакете "header": степень двойки от MIN до MAX байт.
+ * Большие блоки уменьшают накладные расходы на чистой линии, маленькие - объем повторной передачи на зашумленной */
+#define MIN_NUMBER_OF_BYTES_DATA_DATA 256U
+#define MAX_NUMBER_OF_BYTES_DATA_DATA 16384U
 #define NUMBER_OF_BYTES_KEY_DATA      4
+#define NUMBER_OF_BYTES_BAUD_DATA     4 /* Скорость UART в бод */
+#define NUMBER_OF_BYTES_TEST_DATA     4 /* Скорость UART, на которой передан пакет проверки */
+#define NUMBER_OF_BYTES_DMAP_DATA     (MAX_NUMBER_OF_DATA_BLOCKS / 8) /* Битовая маска измененных блоков прошивки */
+#define NUMBER_OF_BYTES_BOOT_DATA     4 /* Значение \ref BOOTLOADER_ENTRY_MAGIC */
+#define NUMBER_OF_BYTES_ZDAT_SIZE     4 /* Размер сжатого блока в пакете "zdat" (данные дополняются до кратного 4) */
+#define NUMBER_OF_BYTES_LOGE_EVENT    4 /* Номер события, уровень журнала и число аргументов пакета "loge" */
 #define NUMBER_OF_BYTES_CRC           4
 
 /* Полный размер пакета */
 #define CMD_SIZE                      (NUMBER_OF_BYTES_COMMAND_WORD + NUMBER_OF_BYTES_COMMAND_DATA + NUMBER_OF_BYTES_CRC)
 #define HEADER_SIZE                   (NUMBER_OF_BYTES_HEADER_WORD + NUMBER_OF_BYTES_HEADER_DATA + NUMBER_OF_BYTES_CRC)
 #define RESPONSE_SIZE                 (NUMBER_OF_BYTES_RESPONSE_WORD + NUMBER_OF_BYTES_RESPONSE_DATA + NUMBER_OF_BYTES_CRC)
-#define DATA_SIZE                     (NUMBER_OF_BYTES_DATA_WORD + NUMBER_OF_BYTES_DATA_DATA + NUMBER_OF_BYTES_CRC)
+#define STATUS_SIZE                   (NUMBER_OF_BYTES_ACK + NUMBER_OF_BYTES_STATUS_DATA + NUMBER_OF_BYTES_CRC)
+#define DATA_MAX_SIZE                                                                                                  \
+    (NUMBER_OF_BYTES_DATA_WORD + NUMBER_OF_BYTES_DATA_SEQUENCE + MAX_NUMBER_OF_BYTES_DATA_DATA + NUMBER_OF_BYTES_CRC)
 #define KEY_SIZE                      (NUMBER_OF_BYTES_KEY_WORD + NUMBER_OF_BYTES_KEY_DATA + NUMBER_OF_BYTES_CRC)
+#define BAUD_SIZE                     (NUMBER_OF_BYTES_BAUD_WORD + NUMBER_OF_BYTES_BAUD_DATA + NUMBER_OF_BYTES_CRC)
+#define TEST_SIZE                     (NUMBER_OF_BYTES_TEST_WORD + NUMBER_OF_BYTES_TEST_DATA + NUMBER_OF_BYTES_CRC)
+#define DMAP_SIZE                     (NUMBER_OF_BYTES_DMAP_WORD + NUMBER_OF_BYTES_DMAP_DATA + NUMBER_OF_BYTES_CRC)
+#define BOOT_SIZE                     (NUMBER_OF_BYTES_BOOT_WORD + NUMBER_OF_BYTES_BOOT_DATA + NUMBER_OF_BYTES_CRC)
+/* Пакет "zdat" переменной длины: сначала принимается его начало с размером сжатых данных, затем остальное */
+#define ZDAT_HEADER_SIZE              (NUMBER_OF_BYTES_ZDAT_WORD + NUMBER_OF_BYTES_DATA_SEQUENCE + NUMBER_OF_BYTES_ZDAT_SIZE)
+#define ZDAT_MAX_SIZE                 (ZDAT_HEADER_SIZE + MAX_NUMBER_OF_BYTES_DATA_DATA + NUMBER_OF_BYTES_CRC)
+/* Пакет "loge" переменной длины: событие журнала и до LOG_MAX_ARGUMENTS аргументов по 4 байта */
+#define LOGE_MAX_SIZE                                                                                                  \
+    (NUMBER_OF_BYTES_LOGE_WORD + NUMBER_OF_BYTES_LOGE_EVENT + LOG_MAX_ARGUMENTS * 4 + NUMBER_OF_BYTES_CRC)
+
+/* Максимальное число участков прошивки в пакете "header". Host приложение передает блоками только участки,
+ * в которых есть данные (прошивки .hex и .elf с промежутками), остальные блоки слота остаются стертыми */
+#define MAX_NUMBER_OF_SEGMENTS        16U
 
 /* Максимальная попытка получить от Host приложения пакет, если он получен с ошибкой*/
 #define MAX_USART_CONNECTION_TRY      10U
 
+/* Максимальное число блоков "data", которые Host приложение передает подряд без ожидания подтверждения.
+ * Блоки окна накапливаются в RAM и записываются во flash после приема всего окна.
+ * Не более 32, так как принятые блоки окна передаются битовой маской в пакете NACK */
+#define MAX_WINDOW_SIZE               8U
+/* Размер буфера окна, байт: блоки окна вместе (header_t.window_size * header_t.block_size) не должны превышать его,
+ * поэтому окно из блоков максимального размера состоит из одного блока */
+#define WINDOW_BUFFER_SIZE            16384U
+/* Время ожидания очередного пакета "data" внутри окна, мс */
+#define DATA_PACKET_TIMEOUT_MS        1000U
+
+/* Время после сброса, в течение которого загрузчик ждет нажатия кнопки User или пакета "boot", мс.
+ * Если за это время ничего не пришло, сразу запускается пользовательское приложение */
+#define BOOTLOADER_ENTRY_WINDOW_MS    500U
+/* Время тишины на линии после входа в режим загрузчика, мс. Host приложение передает пакеты "boot" повторно,
+ * пока не увидит строку о входе в режим загрузчика, поэтому оставшиеся пакеты пропускаются до начала приема команд */
+#define BOOTLOADER_ENTRY_QUIET_MS     100U
+/* Значение данных пакета "boot" и флага входа в режим загрузчика */
+#define BOOTLOADER_ENTRY_MAGIC        0xB007B007U
+/* Регистр флага входа в режим загрузчика. Backup регистры RTC сохраняются при программной перезагрузке, поэтому
+ * пользовательское приложение может запросить вход без кнопки и без пакета "boot":
+ *     __HAL_RCC_PWR_CLK_ENABLE();
+ *     HAL_PWR_EnableBkUpAccess();
+ *     RTC->BKP0R = BOOTLOADER_ENTRY_MAGIC;
+ *     NVIC_SystemReset();
+ * Загрузчик сбрасывает флаг, поэтому следующая перезагрузка снова запускает приложение */
+#define BOOTLOADER_ENTRY_FLAG         (RTC->BKP0R)
+
+/* Скорость UART после сброса. На ней загрузчик принимает команды до согласования более высокой скорости */
+#define DEFAULT_UART_BAUDRATE         115200U
+/* Время, за которое Host приложение должно прислать пакет проверки на новой скорости, мс.
+ * Если проверка не пройдена, загрузчик возвращается на \ref DEFAULT_UART_BAUDRATE */
+#define BAUDRATE_PROBE_TIMEOUT_MS     1000U
+
+/* Аппаратное управление потоком RTS/CTS на USART3 (PB13 - CTS, PB14 - RTS).
+ * Пока загрузчик пишет flash и не читает UART, RTS снимается и Host приложение
+ * приостанавливает передачу, поэтому следующее окно можно передавать, не дожидаясь записи предыдущего.
+ * Включать только вместе с профилем "rtscts" Host приложения и подключенными линиями RTS/CTS */
+#define UART_HW_FLOW_CONTROL          FALSE
+
+/* Прием по UART через DMA (DMA1 Stream1 Channel4) в кольцевой буфер. Пока загрузчик пишет окно во flash,
+ * DMA принимает следующее окно, поэтому Host приложение может передавать его, не дожидаясь записи (профиль "stream").
+ * Если FALSE, прием ведется опросом HAL_UART_Receive, и байты, пришедшие во время записи flash, теряются */
+#define UART_RX_DMA                   TRUE
+/* Размер кольцевого буфера приема, байт. Должен вмещать два окна пакетов "data" (2 * (16384 + 8 * 12) байт) */
+#define UART_RX_BUFFER_SIZE           34816U
+
+/* Журнал загрузчика передается по тому же USART3, что и пакеты протокола. Если TRUE, каждое сообщение
+ * передается пакетом "loge" (\ref log_event_t + целые аргументы, 12 - 28 байт), а текст сообщения восстанавливает
+ * Host приложение (bootloader_log.py). Если FALSE, сообщения выводятся текстом printf, как в терминал */
+#define LOG_BINARY_FRAMES             TRUE
+/* Уровень журнала после сброса: сообщения с уровнем больше него не передаются (\ref log_level_t).
+ * Во время передачи блоков прошивки действует уровень из пакета "header", если он не равен нулю */
+#define LOG_LEVEL                     LOG_LEVEL_INFO
+/* Максимальное число целых аргументов сообщения журнала */
+#define LOG_MAX_ARGUMENTS             4U
+
 #define MEMORY_ADDRESS_WITH_SETTINGS                                                                                   \
     0x0800C000U /* Адрес в памяти, где хранятся настройки загрузчика (должен совпадать с номером сектора) */
 #define MEMORY_SECTOR_WITH_SETTINGS   3U /* Номер сектора памяти, где хранятся настройки */
 #define NUMBER_OF_SETTINGS_WORDS      3U          /* Количество слов uint32_t настроек */
+/* Журнал загрузки - записи \ref boot_record_t в секторе настроек после слов настроек. Запись добавляется
+ * при каждой смене активного слота и записывается последним словом CRC32, поэтому действует последняя запись
+ * с верной CRC32: если запись прервалась, активным остается прежний слот. Заполненный журнал стирается вместе
+ * с настройками, в нем остаются записи активного слота и слота для отката */
+#define BOOT_JOURNAL_ADDRESS          (MEMORY_ADDRESS_WITH_SETTINGS + 0x100U)
+#define BOOT_JOURNAL_END_ADDRESS      (MEMORY_ADDRESS_WITH_SETTINGS + 0x4000U) /* Конец сектора с настройками (16 КБ) */
+#define BOOT_RECORD_MAGIC             0xB0075107U /* Первое слово записи журнала загрузки */
 #define DEFAULT_ENCRYPTION_KEY        0x13121411U /* Ключ шифрования прошивки по умолчанию */
 #define DEFAULT_SECRET_ENCRYPTION_KEY (*(uint32_t *)0x1FFF7A14) /* Ключ шифрования для смены encryption_key (Это вторые 32 бита UID) */
 
-#define NUMBER_OF_BYTES_OF_FLASH_MEMORY_SECTOR                                                                         \
-    65536U /* Максимальный размер сектора, в котором располагается загрузчик */
+/* Область пользовательского приложения - сектора flash памяти с APP_FIRST_SECTOR по APP_LAST_SECTOR
+ * (в STM32F407 сектор 4 - 64 КБ, сектора 5 - 11 - по 128 КБ). Область разделена на два слота: A - сектора 4 - 7
+ * (448 КБ), B - сектора 8 - 11 (512 КБ). Новая прошивка записывается в неактивный слот, а после проверки CRC32
+ * становится активной одной записью журнала загрузки, поэтому прерванная передача не затрагивает прошивку
+ * активного слота. Приложение выполняется из своего слота, поэтому собирается отдельно для каждого из них
+ * (адрес FLASH в скрипте компоновщика). Адреса слотов должны совпадать с границами секторов. Сектора слота
+ * стираются по мере записи прошивки, поэтому стираются только сектора, которые она занимает */
+#define APP_FIRST_SECTOR        4U
+#define APP_LAST_SECTOR         11U
+#define APP_FLASH_START_ADDRESS 0x08010000U /* Адрес начала области приложения (начало APP_FIRST_SECTOR) */
+#define APP_FLASH_END_ADDRESS   0x08100000U /* Адрес конца области приложения (конец APP_LAST_SECTOR) */
+#define APP_SLOT_A_ADDRESS      APP_FLASH_START_ADDRESS /* Адрес начала слота A, слот A заканчивается началом слота B */
+#define APP_SLOT_B_ADDRESS      0x08080000U /* Адрес начала слота B (начало сектора 8), слот B - до конца области */
+#define APP_SLOT_MAX_SIZE       (APP_FLASH_END_ADDRESS - APP_SLOT_B_ADDRESS) /* Размер большего слота */
+#define FLASH_BLOCK_OFFSET      4U /* Количество байт данных типа слово, которое занято в памяти */
+
+/* Диапазон напряжения питания для стирания и записи flash памяти, от него зависит ширина записи:
+ * FLASH_VOLTAGE_RANGE_3 (2.7 - 3.6 В) - словами по 32 бита,
+ * FLASH_VOLTAGE_RANGE_4 (2.7 - 3.6 В и внешнее напряжение Vpp 8 - 9 В) - двойными словами по 64 бита */
+#define FLASH_PROGRAM_VOLTAGE_RANGE FLASH_VOLTAGE_RANGE_3
+
+/* Максимальное число блоков "data" в слоте пользовательского приложения (при минимальном размере блока) */
+#define MAX_NUMBER_OF_DATA_BLOCKS (APP_SLOT_MAX_SIZE / MIN_NUMBER_OF_BYTES_DATA_DATA)
 
-#define APP_FLASH_START_ADDRESS                                                                                        \
-    0x08010000U /* Адрес начала пользовательского приложения (должен совпадать с номером сектора) */
-#define FLASH_SECTOR_NUMBER 4U /* Номер сектора flash памяти, где находится пользовательское приложение */
-#define FLASH_BLOCK_OFFSET  4U /* Количество байт данных типа слово, которое занято в памяти */
+/* Адрес буфера, в котором при разностном обновлении собирается новый образ сектора пользовательского приложения.
+ * Это начало CCMRAM (64 КБ). Массив в секции .ccmram не используется, так как
+ * секция инициализируется из flash и увеличила бы размер загрузчика на весь буфер.
+ * Сектора больше буфера разностное обновление перезаписывает целиком: Host приложение передает все их блоки */
+#define DELTA_STAGING_ADDRESS     0x10000000U
+#define DELTA_STAGING_SIZE        65536U
 
 #ifdef __cplusplus
 }
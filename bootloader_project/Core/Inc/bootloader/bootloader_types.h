@@ -51,6 +51,12 @@ typedef enum {
     CMD_GET_ID = 6, /* Команда на получение уникального ID микроконтроллера */
     CMD_CHECK_KEY = 7, /* Команда на проверку соответствия ключей шифрования */
     CMD_ERASE_PROGRAM = 8, /* Команда на стирание пользовательской прошивки */
+    CMD_SET_BAUDRATE = 9, /* Команда на согласование скорости UART, после нее загрузчик ждет следующую команду */
+    CMD_DELTA_UPDATE = 10, /* Команда на разностное обновление прошивки: передаются только измененные блоки */
+    CMD_START_SESSION = 11, /* Команда на начало сессии: загрузчик выполняет команды, пока не получит CMD_RESET */
+    CMD_RESET = 12, /* Команда на завершение сессии и программную перезагрузку микроконтроллера */
+    CMD_VERIFY = 13, /* Команда на проверку записанной прошивки по CRC32 */
+    CMD_ROLLBACK = 14, /* Команда на возврат к прошивке предыдущего слота приложения */
 } cmd_t;
 
 /**
@@ -73,6 +79,181 @@ typedef enum {
     STATUS_ACK = 1,  /* Пакет передался загрузчику успешно */
 } status_t;
 
+/**
+ * \brief     Структура участка прошивки из пакета "header"
+ */
+typedef struct {
+    uint32_t address; /* Адрес начала участка, совпадает с началом блока "data" */
+    uint32_t size; /* Размер участка в байтах, кратен размеру блока, кроме участка, который заканчивается с прошивкой */
+} header_segment_t;
+
+/**
+ * \brief     Структура с данными пакета "header"
+ */
+typedef struct {
+    uint32_t firmware_size; /* Размер прошивки в байтах */
+    uint32_t window_size;   /* Число блоков "data", передаваемых Host приложением без ожидания подтверждения */
+    uint32_t transfer_format; /* Формат передачи блоков прошивки, одно из значений \ref transfer_format_t */
+    uint32_t target_address;  /* Адрес flash памяти, для которого собрана прошивка */
+    uint32_t block_size;      /* Число байт прошивки в пакете "data" */
+    uint32_t image_crc; /* CRC32 зашифрованной прошивки, дополненной до целого числа блоков (как в \ref CMD_VERIFY) */
+    uint32_t transfer_log_level; /* Уровень журнала во время передачи блоков (\ref log_level_t, 0 - не меняется) */
+    uint32_t number_of_segments; /* Число участков, блоки которых передаются (0 - передается вся прошивка) */
+    header_segment_t segments[MAX_NUMBER_OF_SEGMENTS]; /* Участки по возрастанию адреса */
+} header_t;
+
+/**
+ * \brief     Структура записи журнала загрузки (\ref BOOT_JOURNAL_ADDRESS)
+ * \note      Размер записи кратен 8 байтам, чтобы ее можно было записать двойными словами
+ */
+typedef struct {
+    uint32_t magic;        /* \ref BOOT_RECORD_MAGIC */
+    uint32_t sequence;     /* Номер записи, увеличивается с каждой записью */
+    uint32_t slot_address; /* Адрес начала активного слота приложения */
+    uint32_t image_size;   /* Размер прошивки в слоте, дополненной до целого числа блоков */
+    uint32_t image_crc;    /* CRC32 прошивки в слоте (расшифрованной, как она записана во flash) */
+    uint32_t crc;          /* CRC32 предыдущих слов записи */
+} boot_record_t;
+
+/**
+ * \brief     Перечисление, отвечающее за формат передачи блоков прошивки
+ */
+typedef enum {
+    TRANSFER_FORMAT_RAW = 0, /* Блоки передаются пакетами "data" без сжатия */
+    TRANSFER_FORMAT_LZ4 = 1, /* Блоки передаются пакетами "zdat", каждый блок сжат отдельно (формат LZ4 block) */
+} transfer_format_t;
+
+/**
+ * \brief     Перечисление уровней журнала загрузчика
+ * \note      Сообщение передается, если его уровень не больше текущего уровня журнала (\ref LOG_LEVEL)
+ */
+typedef enum {
+    LOG_LEVEL_NONE = 0,    /* Журнал выключен */
+    LOG_LEVEL_ERROR = 1,   /* Ошибки, после которых команда завершается неудачей */
+    LOG_LEVEL_WARNING = 2, /* Нештатные ситуации, которые загрузчик обходит (откат на другой слот, отмена команды) */
+    LOG_LEVEL_INFO = 3,    /* Ход выполнения команд */
+    LOG_LEVEL_DEBUG = 4,   /* Подробности для отладки */
+} log_level_t;
+
+/**
+ * \brief     Перечисление событий журнала загрузчика, которые передаются пакетом "loge"
+ * \note      Тексты событий хранит Host приложение (log_events в bootloader_log.py) по номеру события,
+ *            поэтому номера существующих событий не меняются, новые события добавляются в конец
+ */
+typedef enum {
+    /* Запуск загрузчика и переход в приложение */
+    LOG_EVENT_BOOTLOADER_VERSION = 1,
+    LOG_EVENT_ENTRY_REQUESTED_BY_APP = 2,
+    LOG_EVENT_ENTRY_WINDOW = 3,
+    LOG_EVENT_ENTRY_BUTTON = 4,
+    LOG_EVENT_ENTRY_BOOT_PACKET = 5,
+    LOG_EVENT_ENTRY_SKIPPED = 6,
+    LOG_EVENT_ACTIVE_SLOT_CORRUPTED = 7,
+    LOG_EVENT_FALLBACK_SLOT = 8,
+    LOG_EVENT_NO_VALID_APP = 9,
+    LOG_EVENT_JUMP_TO_APP = 10,
+    LOG_EVENT_APP_MSP = 11,
+    LOG_EVENT_APP_RESET_HANDLER = 12,
+    LOG_EVENT_KEYS_READ_ERROR = 13,
+    LOG_EVENT_FACTORY_RESET = 14,
+    LOG_EVENT_DEFAULT_SETTINGS_ERROR = 15,
+
+    /* Цикл приема команд */
+    LOG_EVENT_COMMAND_RECEIVE_ERROR = 16,
+    LOG_EVENT_COMMAND_ERROR = 17,
+    LOG_EVENT_SESSION_READY = 18,
+    LOG_EVENT_RESTART_SCHEDULED = 19,
+    LOG_EVENT_RESTART = 20,
+
+    /* Выбор команды */
+    LOG_EVENT_CMD_UPDATE = 21,
+    LOG_EVENT_CMD_SET_KEY = 22,
+    LOG_EVENT_CMD_FLASH_CHECK = 23,
+    LOG_EVENT_CMD_FLASH_LOCK = 24,
+    LOG_EVENT_CMD_FLASH_UNLOCK = 25,
+    LOG_EVENT_CMD_GET_UID = 26,
+    LOG_EVENT_CMD_CHECK_KEY = 27,
+    LOG_EVENT_CMD_ERASE = 28,
+    LOG_EVENT_CMD_SET_BAUDRATE = 29,
+    LOG_EVENT_CMD_DELTA_UPDATE = 30,
+    LOG_EVENT_CMD_START_SESSION = 31,
+    LOG_EVENT_CMD_END_SESSION = 32,
+    LOG_EVENT_CMD_VERIFY = 33,
+    LOG_EVENT_CMD_ROLLBACK = 34,
+    LOG_EVENT_CMD_UNKNOWN = 35,
+
+    /* Обновление прошивки */
+    LOG_EVENT_HEADER_RECEIVE_ERROR = 36,
+    LOG_EVENT_FIRMWARE_SIZE_ZERO = 37,
+    LOG_EVENT_FIRMWARE_TOO_LARGE = 38,
+    LOG_EVENT_TARGET_ADDRESS_MISMATCH = 39,
+    LOG_EVENT_INVALID_BLOCK_SIZE = 40,
+    LOG_EVENT_INVALID_WINDOW_SIZE = 41,
+    LOG_EVENT_INVALID_TRANSFER_FORMAT = 42,
+    LOG_EVENT_INVALID_SEGMENTS = 43,
+    LOG_EVENT_DATA_RECEIVE_ERROR = 44,
+    LOG_EVENT_FLASH_ERASE_ERROR = 45,
+    LOG_EVENT_DECOMPRESS_ERROR = 46,
+    LOG_EVENT_BLOCK_WRITE_ERROR = 47,
+    LOG_EVENT_PROGRESS = 48,
+    LOG_EVENT_UPDATE_ERROR = 49,
+    LOG_EVENT_UPDATE_SUCCESS = 50,
+    LOG_EVENT_IMAGE_CRC_MISMATCH = 51,
+    LOG_EVENT_JOURNAL_ERROR = 52,
+    LOG_EVENT_SLOT_ACTIVE = 53,
+
+    /* Разностное обновление прошивки */
+    LOG_EVENT_DMAP_RECEIVE_ERROR = 54,
+    LOG_EVENT_DELTA_UNCHANGED = 55,
+    LOG_EVENT_DELTA_SECTOR_TOO_LARGE = 56,
+    LOG_EVENT_SECTOR_WRITE_ERROR = 57,
+    LOG_EVENT_DELTA_SUMMARY = 58,
+
+    /* Проверка прошивки, откат, ключи шифрования, защита flash памяти, скорость UART */
+    LOG_EVENT_FIRMWARE_CRC = 59,
+    LOG_EVENT_ROLLBACK_NO_RECORD = 60,
+    LOG_EVENT_ROLLBACK_SLOT_CORRUPTED = 61,
+    LOG_EVENT_KEY_RECEIVE_ERROR = 62,
+    LOG_EVENT_SETTINGS_ERROR = 63,
+    LOG_EVENT_KEYS_MATCH = 64,
+    LOG_EVENT_KEYS_MISMATCH = 65,
+    LOG_EVENT_FLASH_UNLOCKED = 66,
+    LOG_EVENT_FLASH_LOCKED = 67,
+    LOG_EVENT_FLASH_CHECK = 68,
+    LOG_EVENT_FLASH_LOCK_DONE = 69,
+    LOG_EVENT_FLASH_ALREADY_LOCKED = 70,
+    LOG_EVENT_FLASH_UNLOCK_STARTED = 71,
+    LOG_EVENT_FLASH_ALREADY_UNLOCKED = 72,
+    LOG_EVENT_BAUD_RECEIVE_ERROR = 73,
+    LOG_EVENT_BAUDRATE_UNSUPPORTED = 74,
+    LOG_EVENT_BAUDRATE_CHANGED = 75,
+    LOG_EVENT_BAUDRATE_PROBE_FAILED = 76,
+
+    /* Работа с flash памятью */
+    LOG_EVENT_FLASH_UNLOCK_ERROR = 77,
+    LOG_EVENT_FLASH_ERASE_SECTOR_ERROR = 78,
+    LOG_EVENT_FLASH_LOCK_ERROR = 79,
+    LOG_EVENT_FLASH_ERASE_DONE = 80,
+    LOG_EVENT_FLASH_WORD_WRITE_ERROR = 81,
+    LOG_EVENT_FLASH_BLOCK_CRC_ERROR = 82,
+    LOG_EVENT_SETTINGS_WRITE_ERROR = 83,
+    LOG_EVENT_JOURNAL_WRITE_ERROR = 84,
+    LOG_EVENT_DEFAULT_SETTINGS_WRITE = 85,
+    LOG_EVENT_SETTINGS_WRITE_DONE = 86,
+    LOG_EVENT_JOURNAL_FULL = 87,
+
+    /* Прием пакетов */
+    LOG_EVENT_NULL_POINTER = 88,
+    LOG_EVENT_UART_RECEIVE_ERROR = 89,
+    LOG_EVENT_PACKET_CRC_ERROR = 90,
+    LOG_EVENT_NOT_COMMAND_PACKET = 91,
+    LOG_EVENT_NOT_HEADER_PACKET = 92,
+    LOG_EVENT_NOT_KEY_PACKET = 93,
+    LOG_EVENT_NOT_BAUD_PACKET = 94,
+    LOG_EVENT_NOT_DMAP_PACKET = 95,
+    LOG_EVENT_CONVERT_NULL_POINTER = 96,
+} log_event_t;
+
 /**
  * \brief     Перечисление, в котором указан статус выполнения функции usart_get_cmd
  */
@@ -104,6 +285,7 @@ typedef enum {
     GET_DATA_ERROR_NOT_DATA = 2,         /* Ошибка при определении типа пакета */
     GET_DATA_ERROR_CRC = 3,              /* Ошибка проверки CRC32 */
     GET_DATA_ERROR_EMPTY_POINTER = 4,    /* Указатель на входные данные == NULL */
+    GET_DATA_ERROR_TIMEOUT = 5,          /* Пакет не получен за \ref DATA_PACKET_TIMEOUT_MS */
 } get_data_status_t;
 
 /**
@@ -117,6 +299,28 @@ typedef enum {
     GET_KEY_ERROR_EMPTY_POINTER = 4,    /* Указатель на входные данные == NULL */
 } get_key_status_t;
 
+/**
+ * \brief     Перечисление, в котором указан статус выполнения функции usart_get_baudrate
+ */
+typedef enum {
+    GET_BAUD_OK = 0,                     /* Выполнение функции успешно */
+    GET_BAUD_ERROR_RECEIVING_STATUS = 1, /* Ошибка при использовании HAL_UART_Receive */
+    GET_BAUD_ERROR_NOT_BAUD = 2,         /* Ошибка при определении типа пакета */
+    GET_BAUD_ERROR_CRC = 3,              /* Ошибка проверки CRC32 */
+    GET_BAUD_ERROR_EMPTY_POINTER = 4,    /* Указатель на входные данные == NULL */
+} get_baud_status_t;
+
+/**
+ * \brief     Перечисление, в котором указан статус выполнения функции usart_get_delta_map
+ */
+typedef enum {
+    GET_DMAP_OK = 0,                     /* Выполнение функции успешно */
+    GET_DMAP_ERROR_RECEIVING_STATUS = 1, /* Ошибка при использовании HAL_UART_Receive */
+    GET_DMAP_ERROR_NOT_DMAP = 2,         /* Ошибка при определении типа пакета */
+    GET_DMAP_ERROR_CRC = 3,              /* Ошибка проверки CRC32 */
+    GET_DMAP_ERROR_EMPTY_POINTER = 4,    /* Указатель на входные данные == NULL */
+} get_dmap_status_t;
+
 #ifdef __cplusplus
 }
 #endif /* __cplusplus */
@@ -40,12 +40,24 @@ extern "C" {
 
 #include "all_includes.h"
 
+extern void usart_start_reception(void);
+extern void usart_stop_reception(void);
 extern void usart_send_response(uint32_t response_data);
-extern void usart_send_status(status_t status);
+extern void usart_send_status(status_t status, uint32_t status_data);
+extern void usart_send_program_time(uint32_t program_time_us);
+extern void usart_send_log_event(log_level_t level, log_event_t event, uint32_t number_of_arguments,
+                                 const uint32_t* arguments);
 extern get_cmd_status_t usart_get_cmd(cmd_t* received_command);
-extern get_header_status_t usart_get_header(uint32_t* firmware_size);
-extern get_data_status_t usart_get_data(uint8_t* data_buffer);
+extern get_header_status_t usart_get_header(header_t* header);
+extern get_data_status_t usart_get_data(uint32_t* sequence, uint8_t* data_buffer, uint32_t block_size);
+extern get_data_status_t usart_get_compressed_data(uint32_t* sequence, uint8_t* data_buffer, uint32_t* data_size,
+                                                   uint32_t block_size);
 extern get_key_status_t usart_get_key(uint32_t* coded_key);
+extern get_baud_status_t usart_get_baudrate(uint32_t* baudrate);
+extern get_dmap_status_t usart_get_delta_map(uint8_t* delta_map);
+extern uint8_t usart_get_probe(uint32_t baudrate, uint32_t timeout);
+extern uint8_t usart_get_boot_request(uint32_t timeout);
+extern uint8_t usart_set_baudrate(uint32_t baudrate);
 
 #ifdef __cplusplus
 }
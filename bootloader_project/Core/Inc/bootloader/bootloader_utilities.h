@@ -44,8 +44,41 @@ extern uint32_t four_uint8t_to_one_uint32t(uint8_t* p_bytes);
 extern void decrypt_data(uint32_t key, uint8_t* data, size_t size);
 extern uint8_t find_word(uint8_t* source, const char* destination);
 extern uint8_t check_crc(uint8_t* data, size_t data_size, uint32_t input_crc);
+extern uint32_t calculate_encrypted_flash_crc(uint32_t flash_address, size_t size, uint32_t key);
+extern uint32_t lz4_decompress_block(const uint8_t* source, uint32_t source_size, uint8_t* destination,
+                                     uint32_t destination_size);
 extern cmd_t check_cmd_type(uint32_t cmd_type_bytes);
+extern uint32_t start_time_measurement(void);
+extern uint32_t get_elapsed_time_us(uint32_t start_cycles);
 extern void restart(void);
+extern log_level_t get_log_level(void);
+extern void set_log_level(log_level_t level);
+extern void log_event(log_level_t level, log_event_t event, uint32_t number_of_arguments, const uint32_t* arguments);
+
+/* Аргументы сообщения журнала массивом uint32_t: первый элемент - заполнитель, чтобы массив без аргументов
+ * не был пустым */
+#define LOG_ARGUMENTS(...)            ((const uint32_t[]){0U, __VA_ARGS__})
+#define LOG_NUMBER_OF_ARGUMENTS(...)  (sizeof(LOG_ARGUMENTS(__VA_ARGS__)) / sizeof(uint32_t) - 1U)
+
+/* Сообщение журнала: событие \ref log_event_t, формат printf и до \ref LOG_MAX_ARGUMENTS целых аргументов.
+ * Если \ref LOG_BINARY_FRAMES, формат в прошивку не попадает: передаются только номер события и аргументы,
+ * а Host приложение выводит по номеру тот же текст */
+#if LOG_BINARY_FRAMES
+#define LOG(level, event, format, ...)                                                                                 \
+    log_event((level), (event), LOG_NUMBER_OF_ARGUMENTS(__VA_ARGS__), &LOG_ARGUMENTS(__VA_ARGS__)[1])
+#else
+#define LOG(level, event, format, ...)                                                                                 \
+    do {                                                                                                               \
+        if ((level) <= get_log_level()) {                                                                              \
+            printf(format, ##__VA_ARGS__);                                                                             \
+        }                                                                                                              \
+    } while (0)
+#endif
+
+#define LOG_ERROR(event, format, ...)   LOG(LOG_LEVEL_ERROR, event, format, ##__VA_ARGS__)
+#define LOG_WARNING(event, format, ...) LOG(LOG_LEVEL_WARNING, event, format, ##__VA_ARGS__)
+#define LOG_INFO(event, format, ...)    LOG(LOG_LEVEL_INFO, event, format, ##__VA_ARGS__)
+#define LOG_DEBUG(event, format, ...)   LOG(LOG_LEVEL_DEBUG, event, format, ##__VA_ARGS__)
 
 #ifdef __cplusplus
 }
@@ -47,7 +47,13 @@ extern const char header_word[NUMBER_OF_BYTES_HEADER_WORD + 2];     /* Нача
 extern const char response_word[NUMBER_OF_BYTES_RESPONSE_WORD + 2]; /* Начало пакета типа "response" */
 extern const char data_word[NUMBER_OF_BYTES_DATA_WORD + 2];         /* Начало пакета типа "data" */
 extern const char key_word[NUMBER_OF_BYTES_KEY_WORD + 2];           /* Начало пакета типа "key" */
-extern const char test_word[NUMBER_OF_BYTES_TEST_WORD + 2];           /* Слово для проверки ключей шифрования */
+extern const char test_word[NUMBER_OF_BYTES_TEST_WORD + 2];           /* Слово для проверки ключей шифрования и скорости UART */
+extern const char baud_word[NUMBER_OF_BYTES_BAUD_WORD + 2];         /* Начало пакета типа "baud" */
+extern const char dmap_word[NUMBER_OF_BYTES_DMAP_WORD + 2];         /* Начало пакета типа "dmap" */
+extern const char zdat_word[NUMBER_OF_BYTES_ZDAT_WORD + 2];         /* Начало пакета типа "zdat" */
+extern const char ptim_word[NUMBER_OF_BYTES_PTIM_WORD + 2];         /* Начало пакета типа "ptim" */
+extern const char boot_word[NUMBER_OF_BYTES_BOOT_WORD + 2];         /* Начало пакета типа "boot" */
+extern const char loge_word[NUMBER_OF_BYTES_LOGE_WORD + 2];         /* Начало пакета типа "loge" */
 
 /* Условный пакет типа "status" */
 /* + 2 байта нужно, чтобы учитывать нуль-терминатор */
@@ -39,54 +39,140 @@ const char response_word[] = "RESP\0";
 const char data_word[] = "DATA\0";
 const char key_word[] = "PASS\0";
 const char test_word[] = "TEST\0";
+const char baud_word[] = "BAUD\0";
+const char dmap_word[] = "DMAP\0";
+const char zdat_word[] = "ZDAT\0";
+const char ptim_word[] = "PTIM\0";
+const char boot_word[] = "BOOT\0";
+const char loge_word[] = "LOGE\0";
 const char ack_word[] = "ACKW\0";
 const char nack_word[] = "NACK\0";
 
 /* После обновления проекта через CubeMX, необходимо удалять данные структуры
  * из функции main.c, чтобы избежать ошибки множественного определения */
 UART_HandleTypeDef huart3; /* Структура, необходимая для передачи данных по UART */
+DMA_HandleTypeDef hdma_usart3_rx; /* Структура канала DMA для приема данных по UART (\ref UART_RX_DMA) */
 CRC_HandleTypeDef hcrc; /* Структура, необходимая для аппаратного вычисления CRC32 */
 
 uint32_t encryption_key = 0; /* Ключ шифрования прошивки */
 uint32_t secret_encryption_key = 0; /* Ключ шифрования, использующийся для передачи пакета типа "key" */
 
 /**
- * \brief       Функция, которая проверяет нажатие пользовательской клавиши в течение 10 секунд.
- * \return      flag: Результат: TRUE (кнопка нажата), FALSE (кнопка не нажата).
+ * \brief       Функция, которая проверяет, нужно ли перейти в режим загрузчика.
+ * \note        В режим загрузчика переходим, если пользовательское приложение установило флаг
+ *              \ref BOOTLOADER_ENTRY_FLAG, либо в течение \ref BOOTLOADER_ENTRY_WINDOW_MS нажата кнопка User
+ *              или получен пакет "boot". Иначе приложение запускается без ожидания.
+ * \return      flag: Результат: TRUE (переходим в режим загрузчика), FALSE (запускаем пользовательское приложение).
  */
 uint8_t
 check_bootloader_mode(void) {
     uint8_t flag = FALSE;
-    GPIO_PinState user_btn_pin_state;
-    uint32_t end_tick = HAL_GetTick() + 10000;
 
-    printf("Нажмите кнопку User в течение 10 секунд чтобы перейти в режим загрузчика\n");
-    do {
-        user_btn_pin_state = HAL_GPIO_ReadPin(GPIOA, GPIO_PIN_0);
-        uint32_t current_tick = HAL_GetTick();
+    /* Доступ к backup регистрам RTC, в которых хранится флаг входа в режим загрузчика */
+    __HAL_RCC_PWR_CLK_ENABLE();
+    HAL_PWR_EnableBkUpAccess();
+
+    /* Принимаем пакеты "boot" в фоне (если прием через DMA отключен, функция ничего не делает) */
+    usart_start_reception();
 
-        /* Проверяем нажатие кнопки User в течение 10 секунд */
-        if (user_btn_pin_state == GPIO_PIN_SET) {
-            printf("Кнопка User была нажата, переходим в режим загрузчика\n");
+    do {
+        if (BOOTLOADER_ENTRY_FLAG == BOOTLOADER_ENTRY_MAGIC) {
+            BOOTLOADER_ENTRY_FLAG = 0;
+            LOG_INFO(LOG_EVENT_ENTRY_REQUESTED_BY_APP,
+                     "Приложение запросило режим загрузчика, переходим в режим загрузчика\n");
             flag = TRUE;
             break;
         }
-        if (current_tick > end_tick) {
-            printf("Кнопка User не нажата, переходим к исполнению пользовательского приложения\n");
-            break;
+
+        LOG_INFO(LOG_EVENT_ENTRY_WINDOW,
+                 "Нажмите кнопку User или передайте пакет \"boot\" в течение %lu мс чтобы перейти в режим загрузчика\n",
+                 (uint32_t) BOOTLOADER_ENTRY_WINDOW_MS);
+
+        uint32_t start_tick = HAL_GetTick();
+
+        while (HAL_GetTick() - start_tick < BOOTLOADER_ENTRY_WINDOW_MS) {
+            if (HAL_GPIO_ReadPin(GPIOA, GPIO_PIN_0) == GPIO_PIN_SET) {
+                LOG_INFO(LOG_EVENT_ENTRY_BUTTON, "Кнопка User была нажата, переходим в режим загрузчика\n");
+                flag = TRUE;
+                break;
+            }
+
+            /* Кнопку проверяем между короткими ожиданиями пакета */
+            if (usart_get_boot_request(10)) {
+                LOG_INFO(LOG_EVENT_ENTRY_BOOT_PACKET, "Получен пакет \"boot\", переходим в режим загрузчика\n");
+                flag = TRUE;
+                break;
+            }
         }
 
-    } while (1);
+        if (!flag) {
+            LOG_INFO(LOG_EVENT_ENTRY_SKIPPED,
+                     "Кнопка User не нажата, переходим к исполнению пользовательского приложения\n");
+        }
+    } while (0);
+
+    if (flag) {
+        /* Пропускаем пакеты "boot", которые Host приложение успело передать до строки о входе в режим загрузчика */
+        while (usart_get_boot_request(BOOTLOADER_ENTRY_QUIET_MS)) {}
+    } else {
+        /* Пользовательское приложение не должно получить работающий DMA загрузчика */
+        usart_stop_reception();
+    }
 
     return flag;
 }
 
+/**
+ * \brief       Функция, которая выбирает слот пользовательского приложения для запуска.
+ * \note        Запускается прошивка активного слота из журнала загрузки, если она совпадает с CRC32 из журнала.
+ *              Иначе загрузчик возвращается к прошивке слота, который был активен до последнего обновления,
+ *              и записывает откат в журнал. Если журнал пуст (загрузчик обновлен с версии без слотов),
+ *              запускается слот A, у которого проверяется только таблица векторов.
+ * \return      slot_address: Адрес начала слота для запуска или 0, если исправной прошивки нет.
+ */
+uint32_t
+select_app_slot(void) {
+    boot_record_t records[2];
+    uint32_t number_of_records = get_boot_records(records);
+
+    if (number_of_records == 0) {
+        return is_app_slot_valid(APP_SLOT_A_ADDRESS, 0, 0) ? APP_SLOT_A_ADDRESS : 0;
+    }
+
+    const boot_record_t* active_record = &records[number_of_records - 1];
+
+    if (is_app_slot_valid(active_record->slot_address, active_record->image_size, active_record->image_crc)) {
+        return active_record->slot_address;
+    }
+
+    LOG_WARNING(LOG_EVENT_ACTIVE_SLOT_CORRUPTED, "Прошивка активного слота 0x%08lX повреждена\n",
+                active_record->slot_address);
+
+    if (number_of_records < 2 || !is_app_slot_valid(records[0].slot_address, records[0].image_size,
+                                                    records[0].image_crc)) {
+        return 0;
+    }
+
+    LOG_WARNING(LOG_EVENT_FALLBACK_SLOT, "Возвращаемся к прошивке слота 0x%08lX\n", records[0].slot_address);
+
+    /* Если запись в журнал не удалась, откат повторится при следующем запуске */
+    add_boot_record(records[0].slot_address, records[0].image_size, records[0].image_crc);
+
+    return records[0].slot_address;
+}
+
 /**
  * \brief     Эта основная функция загрузчика
+ * \note      Без сессии загрузчик выполняет одну команду и перезагружается. После команды \ref CMD_START_SESSION
+ *            он ждет следующие команды (в том числе после неудачной команды) до команды \ref CMD_RESET.
  */
 void
 bootloader_mode(void) {
     uint32_t connection_try = 0;
+    uint8_t session_started = FALSE;
+
+    /* Начинаем прием по UART в фоне (если прием через DMA отключен, функция ничего не делает) */
+    usart_start_reception();
 
     do {
         /* Получаем настройки шифрования загрузчика */
@@ -95,54 +181,87 @@ bootloader_mode(void) {
         get_settings_successfully = check_settings();
 
         if (!get_settings_successfully) {
-            printf("Ошибка получения ключей шифрования при запуске\n");
-            printf("Происходит сброс до заводских настроек\n");
+            LOG_ERROR(LOG_EVENT_KEYS_READ_ERROR, "Ошибка получения ключей шифрования при запуске\n");
+            LOG_WARNING(LOG_EVENT_FACTORY_RESET, "Происходит сброс до заводских настроек\n");
 
-            erase_flash(FLASH_SECTOR_NUMBER);
+            erase_app_flash();
             /* Устанавливаем настройки шифрования по умолчанию */
             set_settings_by_default = set_settings(DEFAULT_ENCRYPTION_KEY);
 
             if (!set_settings_by_default) {
-                printf("Ошибка установки настроек по умолчанию!");
+                LOG_ERROR(LOG_EVENT_DEFAULT_SETTINGS_ERROR, "Ошибка установки настроек по умолчанию!");
                 break;
             }
         }
 
-        cmd_t command = CMD_UNKNOWN;
-        get_cmd_status_t get_cmd_result;
-        uint8_t cmd_received_successfully = FALSE;
-
-        /* Получаем пакет типа "command" */
-        while (connection_try < MAX_USART_CONNECTION_TRY) {
-            get_cmd_result = usart_get_cmd(&command);
-
-            if (get_cmd_result != GET_CMD_OK) {
-                usart_send_status(STATUS_NACK);
-            } else if (command == CMD_UNKNOWN) {
-                usart_send_status(STATUS_NACK);
-            } else {
-                usart_send_status(STATUS_ACK);
-                cmd_received_successfully = TRUE;
+        uint8_t wait_next_command = TRUE;
+
+        while (wait_next_command) {
+            wait_next_command = FALSE;
+
+            cmd_t command = CMD_UNKNOWN;
+            get_cmd_status_t get_cmd_result;
+            uint8_t cmd_received_successfully = FALSE;
+
+            /* Получаем пакет типа "command" */
+            while (connection_try < MAX_USART_CONNECTION_TRY) {
+                get_cmd_result = usart_get_cmd(&command);
+
+                if (get_cmd_result != GET_CMD_OK) {
+                    /* Host приложение могло не получить подтверждение новой скорости и вернуться на скорость
+                     * по умолчанию, поэтому при ошибке приема на повышенной скорости возвращаемся на нее же */
+                    if (huart3.Init.BaudRate != DEFAULT_UART_BAUDRATE) {
+                        usart_set_baudrate(DEFAULT_UART_BAUDRATE);
+                    }
+                    usart_send_status(STATUS_NACK, 0);
+                } else if (command == CMD_UNKNOWN) {
+                    usart_send_status(STATUS_NACK, 0);
+                } else {
+                    usart_send_status(STATUS_ACK, 0);
+                    cmd_received_successfully = TRUE;
+                    break;
+                }
+
+                connection_try++;
+            }
+
+            connection_try = 0;
+
+            if (!cmd_received_successfully) {
+                LOG_ERROR(LOG_EVENT_COMMAND_RECEIVE_ERROR, "Ошибка при получении пакета \"command\"\n");
                 break;
             }
 
-            connection_try++;
-        }
+            /* Выполняем полученную команду */
+            uint8_t execution_result = FALSE;
+            execution_result = execute_command(command);
 
-        connection_try = 0;
+            if (!execution_result) {
+                LOG_ERROR(LOG_EVENT_COMMAND_ERROR, "Ошибка выполнения команды!\n");
+                /* Результат команды Host приложение уже получило, в сессии оно само решает, продолжать ли работу */
+                if (!session_started) {
+                    break;
+                }
+            }
 
-        if (!cmd_received_successfully) {
-            printf("Ошибка при получении пакета \"command\"\n");
-            break;
-        }
+            if (command == CMD_START_SESSION) {
+                session_started = TRUE;
+            }
 
-        /* Выполняем полученную команду */
-        uint8_t execution_result = FALSE;
-        execution_result = execute_command(command);
+            if (command == CMD_RESET) {
+                break;
+            }
 
-        if (!execution_result) {
-            printf("Ошибка выполнения команды!\n");
-            break;
+            if (session_started) {
+                /* Host приложение передает следующую команду только после этой строки */
+                LOG_INFO(LOG_EVENT_SESSION_READY, "Ожидаю следующую команду\n");
+                wait_next_command = TRUE;
+            }
+
+            /* Смена скорости UART выполняется перед основной командой, поэтому ждем ее */
+            if (command == CMD_SET_BAUDRATE) {
+                wait_next_command = TRUE;
+            }
         }
 
     } while (0);
@@ -66,9 +66,9 @@ set_key(void) {
             get_key_result = usart_get_key(&coded_key);
 
             if (get_key_result != GET_KEY_OK) {
-                usart_send_status(STATUS_NACK);
+                usart_send_status(STATUS_NACK, 0);
             } else {
-                usart_send_status(STATUS_ACK);
+                usart_send_status(STATUS_ACK, 0);
                 key_received_successfully = TRUE;
                 break;
             }
@@ -79,7 +79,7 @@ set_key(void) {
         connection_try = 0;
 
         if (!key_received_successfully) {
-            printf("Ошибка при получении пакета \"key\"\n");
+            LOG_ERROR(LOG_EVENT_KEY_RECEIVE_ERROR, "Ошибка при получении пакета \"key\"\n");
             break;
         }
 
@@ -99,7 +99,7 @@ set_key(void) {
         set_settings_successfully = set_settings(encryption_key);
 
         if (!set_settings_successfully) {
-            printf("Ошибка установки настроек!");
+            LOG_ERROR(LOG_EVENT_SETTINGS_ERROR, "Ошибка установки настроек!");
             usart_send_response(RESPONSE_FAIL);
             break;
         }
@@ -111,141 +111,885 @@ set_key(void) {
     return result;
 }
 
+/* Буфер окна передачи: блоки прошивки накапливаются здесь, пока Host приложение передает окно целиком.
+ * Блок окна с номером slot начинается со смещения slot * header_t.block_size.
+ * Буферы выровнены по 4 байтам: записанный блок проверяется аппаратным CRC32 по словам */
+static __ALIGNED(4) uint8_t window_buffer[WINDOW_BUFFER_SIZE];
+/* Размер данных каждого блока окна (при передаче со сжатием блоки имеют разный размер) */
+static uint32_t window_data_size[MAX_WINDOW_SIZE];
+/* Буфер блока: при приеме окна в него принимается пакет до копирования в окно, после приема окна
+ * в него распаковывается сжатый блок перед расшифровкой и записью во flash */
+static __ALIGNED(4) uint8_t block_buffer[MAX_NUMBER_OF_BYTES_DATA_DATA];
+
+/**
+ * \brief       Функция, которая принимает одно окно пакетов "data".
+ * \note        Host приложение передает блоки окна подряд, не дожидаясь подтверждения каждого из них.
+ *              Пока окно принимается, загрузчик ничего не передает: при приеме опросом любая передача
+ *              приводит к потере входящих байт. При \ref UART_RX_DMA следующее окно принимается в фоне,
+ *              пока текущее пишется во flash, а его блоки остаются в кольцевом буфере до следующего вызова.
+ *              Когда линия освобождается, а окно принято не полностью, Host приложению отправляется
+ *              пакет NACK с битовой маской принятых блоков, и оно повторяет только недостающие блоки.
+ * \param[in]   first_block: Порядковый номер первого блока окна.
+ * \param[in]   blocks_in_window: Количество блоков в окне.
+ * \param[in]   transfer_format: Формат передачи блоков, одно из значений \ref transfer_format_t.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \return      result: Результат: TRUE (все блоки окна приняты), FALSE (превышено число попыток).
+ */
+static uint8_t
+receive_data_window(uint32_t first_block, uint32_t blocks_in_window, uint32_t transfer_format, uint32_t block_size) {
+    uint32_t connection_try = 0;
+    uint32_t full_mask = (1U << blocks_in_window) - 1U;
+    uint32_t received_mask = 0;
+    uint32_t sequence = 0;
+    uint32_t data_size = block_size;
+    uint8_t previous_window_repeated = FALSE;
+
+    while (received_mask != full_mask && connection_try < MAX_USART_CONNECTION_TRY) {
+        get_data_status_t get_data_status;
+
+        if (transfer_format == TRANSFER_FORMAT_LZ4) {
+            get_data_status = usart_get_compressed_data(&sequence, block_buffer, &data_size, block_size);
+        } else {
+            get_data_status = usart_get_data(&sequence, block_buffer, block_size);
+        }
+
+        if (get_data_status == GET_DATA_OK) {
+            if (sequence >= first_block && sequence < first_block + blocks_in_window) {
+                uint32_t slot = sequence - first_block;
+
+                /* Повторно принятый блок просто пропускаем */
+                if ((received_mask & (1U << slot)) == 0) {
+                    memcpy(&window_buffer[slot * block_size], block_buffer, data_size);
+                    window_data_size[slot] = data_size;
+                    received_mask |= (1U << slot);
+                }
+            } else if (sequence < first_block) {
+                /* Host приложение не получило подтверждение записи предыдущего окна */
+                previous_window_repeated = TRUE;
+            }
+            continue;
+        }
+
+        /* Поврежденный пакет пропускаем и продолжаем принимать окно до освобождения линии */
+        if (get_data_status != GET_DATA_ERROR_TIMEOUT) {
+            continue;
+        }
+
+        if (previous_window_repeated && received_mask == 0) {
+            /* Повторяем подтверждение: все блоки до first_block уже записаны во flash */
+            usart_send_status(STATUS_ACK, first_block);
+        } else {
+            usart_send_status(STATUS_NACK, received_mask);
+        }
+
+        previous_window_repeated = FALSE;
+        connection_try++;
+    }
+
+    return (received_mask == full_mask) ? TRUE : FALSE;
+}
+
+/**
+ * \brief       Функция, которая распаковывает (если нужно) и расшифровывает принятый блок окна.
+ * \param[in]   slot: Номер блока в окне.
+ * \param[in]   transfer_format: Формат передачи блоков, одно из значений \ref transfer_format_t.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \return      block: Указатель на расшифрованный блок из block_size байт,
+ *              или NULL, если сжатый блок поврежден.
+ */
+static uint8_t*
+decode_window_block(uint32_t slot, uint32_t transfer_format, uint32_t block_size) {
+    uint8_t* block = &window_buffer[slot * block_size];
+
+    /* Блок, который не удалось сжать, передается как есть */
+    if (transfer_format == TRANSFER_FORMAT_LZ4 && window_data_size[slot] != block_size) {
+        uint32_t decoded_size = lz4_decompress_block(block, window_data_size[slot], block_buffer, block_size);
+
+        if (decoded_size != block_size) {
+            return NULL;
+        }
+
+        block = block_buffer;
+    }
+
+    /* Расшифровываем данные прямо в буфере */
+    decrypt_data(encryption_key, block, block_size);
+
+    return block;
+}
+
+/**
+ * \brief       Функция, которая проверяет размер блока "data" из пакета "header".
+ * \note        Размер - степень двойки, поэтому блоки не пересекают границы секторов flash памяти.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \return      result: TRUE (размер поддерживается), FALSE (размер не поддерживается).
+ */
+static uint8_t
+is_block_size_supported(uint32_t block_size) {
+    if (block_size < MIN_NUMBER_OF_BYTES_DATA_DATA || block_size > MAX_NUMBER_OF_BYTES_DATA_DATA) {
+        return FALSE;
+    }
+
+    return ((block_size & (block_size - 1U)) == 0) ? TRUE : FALSE;
+}
+
+/**
+ * \brief       Функция, которая проверяет участки прошивки из пакета "header".
+ * \note        Участки идут по возрастанию адреса и не перекрываются, начинаются с начала блока "data"
+ *              и заканчиваются концом блока или концом прошивки, поэтому блоки участков не пересекаются.
+ * \param[in]   *header: Указатель на данные пакета "header".
+ * \param[in]   slot_address: Адрес слота пользовательского приложения, с которым работает команда.
+ * \return      result: TRUE (участки корректны), FALSE (участки не поддерживаются).
+ */
+static uint8_t
+is_segment_list_valid(const header_t* header, uint32_t slot_address) {
+    uint32_t previous_end = slot_address;
+    uint32_t firmware_end = slot_address + header->firmware_size;
+
+    if (header->number_of_segments > MAX_NUMBER_OF_SEGMENTS) {
+        return FALSE;
+    }
+
+    for (uint32_t segment = 0; segment < header->number_of_segments; segment++) {
+        uint32_t address = header->segments[segment].address;
+        uint32_t size = header->segments[segment].size;
+
+        if (size == 0 || address < previous_end || address > firmware_end || size > firmware_end - address) {
+            return FALSE;
+        }
+
+        if ((address - slot_address) % header->block_size != 0
+            || ((address + size - slot_address) % header->block_size != 0 && address + size != firmware_end)) {
+            return FALSE;
+        }
+
+        previous_end = address + size;
+    }
+
+    return TRUE;
+}
+
+/**
+ * \brief       Функция, которая принимает пакет "header" и проверяет его данные.
+ * \note        На корректный пакет загрузчик отвечает ACK, затем RESPONSE_OK или RESPONSE_FAIL,
+ *              если размер прошивки, блока или окна передачи не поддерживается или прошивка собрана для другого слота.
+ *              Если участков нет, вся прошивка считается одним участком.
+ * \param[out]  *header: Указатель на структуру с полученными данными пакета.
+ * \param[in]   slot_address: Адрес слота пользовательского приложения, с которым работает команда.
+ * \return      result: Результат: TRUE (header принят и корректен), FALSE (ошибка приема или неверные данные).
+ */
+static uint8_t
+receive_header(header_t* header, uint32_t slot_address) {
+    uint32_t connection_try = 0;
+    uint32_t max_flash_size_b = get_app_slot_size(slot_address);
+    get_header_status_t get_header_status;
+    uint8_t get_header_successfull = FALSE;
+
+    while (connection_try < MAX_USART_CONNECTION_TRY) {
+        get_header_status = usart_get_header(header);
+
+        if (get_header_status != GET_HEADER_OK) {
+            usart_send_status(STATUS_NACK, 0);
+        } else if (header->firmware_size == 0) {
+            LOG_ERROR(LOG_EVENT_FIRMWARE_SIZE_ZERO, "Размер прошивки равен нулю\n");
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else if (header->firmware_size > max_flash_size_b) {
+            LOG_ERROR(LOG_EVENT_FIRMWARE_TOO_LARGE, "Размер прошивки больше %lu байт\n", max_flash_size_b);
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else if (header->target_address != slot_address) {
+            LOG_ERROR(LOG_EVENT_TARGET_ADDRESS_MISMATCH,
+                      "Прошивка собрана для адреса 0x%08lX, слот приложения начинается с 0x%08lX\n",
+                      header->target_address, slot_address);
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else if (!is_block_size_supported(header->block_size)) {
+            LOG_ERROR(LOG_EVENT_INVALID_BLOCK_SIZE, "Размер блока должен быть степенью двойки от %u до %u байт\n",
+                      MIN_NUMBER_OF_BYTES_DATA_DATA, MAX_NUMBER_OF_BYTES_DATA_DATA);
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else if (header->window_size == 0 || header->window_size > MAX_WINDOW_SIZE
+                   || header->window_size * header->block_size > WINDOW_BUFFER_SIZE) {
+            LOG_ERROR(LOG_EVENT_INVALID_WINDOW_SIZE,
+                      "Размер окна передачи должен быть от 1 до %u блоков и не больше %u байт\n", MAX_WINDOW_SIZE,
+                      WINDOW_BUFFER_SIZE);
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else if (header->transfer_format != TRANSFER_FORMAT_RAW && header->transfer_format != TRANSFER_FORMAT_LZ4) {
+            LOG_ERROR(LOG_EVENT_INVALID_TRANSFER_FORMAT, "Формат передачи блоков %lu не поддерживается\n",
+                      header->transfer_format);
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else if (!is_segment_list_valid(header, slot_address)) {
+            LOG_ERROR(LOG_EVENT_INVALID_SEGMENTS,
+                      "Участки прошивки не упорядочены, не выровнены по блокам или выходят за прошивку\n");
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        } else {
+            if (header->number_of_segments == 0) {
+                header->segments[0].address = slot_address;
+                header->segments[0].size = header->firmware_size;
+                header->number_of_segments = 1;
+            }
+
+            usart_send_status(STATUS_ACK, 0);
+            usart_send_response(RESPONSE_OK);
+            get_header_successfull = TRUE;
+            break;
+        }
+
+        connection_try++;
+    }
+
+    return get_header_successfull;
+}
+
+/**
+ * \brief       Функция, которая вычисляет число блоков "data" в прошивке.
+ * \param[in]   firmware_size: Размер прошивки в байтах.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \return      number_of_data_blocks: Число блоков, последний блок может быть неполным.
+ */
+static uint32_t
+get_number_of_data_blocks(uint32_t firmware_size, uint32_t block_size) {
+    uint32_t number_of_data_blocks = firmware_size / block_size;
+
+    if (firmware_size % block_size != 0) {
+        number_of_data_blocks++;
+    }
+
+    return number_of_data_blocks;
+}
+
+/**
+ * \brief       Функция, которая вычисляет число блоков "data", передаваемых для участков прошивки.
+ * \param[in]   *header: Указатель на данные пакета "header".
+ * \return      number_of_data_blocks: Число блоков всех участков.
+ */
+static uint32_t
+get_number_of_transfer_blocks(const header_t* header) {
+    uint32_t number_of_data_blocks = 0;
+
+    for (uint32_t segment = 0; segment < header->number_of_segments; segment++) {
+        number_of_data_blocks += get_number_of_data_blocks(header->segments[segment].size, header->block_size);
+    }
+
+    return number_of_data_blocks;
+}
+
+/**
+ * \brief       Функция, которая находит адрес flash памяти блока "data" по его порядковому номеру.
+ * \note        Блоки нумеруются подряд по всем участкам прошивки.
+ * \param[in]   *header: Указатель на данные пакета "header".
+ * \param[in]   sequence: Порядковый номер блока.
+ * \return      address: Адрес, по которому записывается блок.
+ */
+static uint32_t
+get_transfer_block_address(const header_t* header, uint32_t sequence) {
+    uint32_t segment = 0;
+
+    for (; segment < header->number_of_segments - 1U; segment++) {
+        uint32_t segment_blocks = get_number_of_data_blocks(header->segments[segment].size, header->block_size);
+
+        if (sequence < segment_blocks) {
+            break;
+        }
+
+        sequence -= segment_blocks;
+    }
+
+    return header->segments[segment].address + sequence * header->block_size;
+}
+
+/**
+ * \brief       Функция, которая сбрасывает кэш данных flash памяти.
+ * \note        Кэш может хранить значения, прочитанные до записи прошивки.
+ */
+static void
+reset_flash_data_cache(void) {
+    if (FLASH->ACR & FLASH_ACR_DCEN) {
+        __HAL_FLASH_DATA_CACHE_DISABLE();
+        __HAL_FLASH_DATA_CACHE_RESET();
+        __HAL_FLASH_DATA_CACHE_ENABLE();
+    }
+}
+
+/**
+ * \brief       Функция, которая проверяет записанную в слот прошивку и делает слот активным.
+ * \note        CRC32 слота, вычисленный по данным, зашифрованным текущим ключом, сравнивается с header_t.image_crc,
+ *              затем в журнал загрузки добавляется запись с CRC32 прошивки без шифрования, по которому прошивка
+ *              проверяется при запуске. Результат загрузчик отправляет пакетом "response": RESPONSE_OK или
+ *              RESPONSE_FAIL. Если слот не активирован, запускаться будет прежняя прошивка.
+ * \param[in]   *header: Указатель на данные пакета "header" записанной прошивки.
+ * \param[in]   slot_address: Адрес слота, в который записана прошивка.
+ * \return      result: Результат: TRUE (слот активен), FALSE (прошивка повреждена или ошибка записи журнала).
+ */
+static uint8_t
+activate_app_slot(const header_t* header, uint32_t slot_address) {
+    uint8_t result = FALSE;
+
+    do {
+        uint32_t image_size = get_number_of_data_blocks(header->firmware_size, header->block_size) * header->block_size;
+
+        reset_flash_data_cache();
+
+        if (calculate_encrypted_flash_crc(slot_address, image_size, encryption_key) != header->image_crc) {
+            LOG_ERROR(LOG_EVENT_IMAGE_CRC_MISMATCH, "CRC32 записанной прошивки не совпадает с CRC32 из header\n");
+            break;
+        }
+
+        if (!add_boot_record(slot_address, image_size, calculate_encrypted_flash_crc(slot_address, image_size, 0))) {
+            LOG_ERROR(LOG_EVENT_JOURNAL_ERROR, "Ошибка при записи журнала загрузки\n");
+            break;
+        }
+
+        LOG_INFO(LOG_EVENT_SLOT_ACTIVE, "Слот 0x%08lX активен\n", slot_address);
+        result = TRUE;
+    } while (0);
+
+    usart_send_response(result ? RESPONSE_OK : RESPONSE_FAIL);
+
+    return result;
+}
+
+/**
+ * \brief       Функция, которая стирает сектора области пользовательского приложения перед записью в них данных.
+ * \note        Сектора стираются по мере записи прошивки, когда адрес записи доходит до начала сектора,
+ *              поэтому стираются только сектора, которые займет прошивка.
+ * \param[in,out] *next_sector_address: Адрес начала первого нестертого сектора, сдвигается за стертые сектора.
+ * \param[in]   end_address: Адрес конца данных, которые будут записаны.
+ * \return      result: Результат: TRUE (сектора стерты), FALSE (ошибка стирания flash памяти).
+ */
+static uint8_t
+erase_sectors_before_write(uint32_t* next_sector_address, uint32_t end_address) {
+    while (*next_sector_address < end_address) {
+        uint32_t sector = get_flash_sector(*next_sector_address);
+
+        if (!erase_flash(sector)) {
+            return FALSE;
+        }
+
+        *next_sector_address += get_flash_sector_size(sector);
+    }
+
+    return TRUE;
+}
+
 /**
  * \brief       Функция которая производит обновление прошивки.
+ * \note        Прошивка записывается в неактивный слот, запущенная прошивка не изменяется. Перед пакетом "header"
+ *              загрузчик отправляет пакет "response" с адресом слота, для которого должна быть собрана прошивка.
+ *              Прошивка передается окнами по header_t.window_size блоков. После записи окна во flash
+ *              загрузчик отправляет пакет "ptim" со временем записи и пакет ACK с числом записанных блоков,
+ *              это сигнал Host приложению передавать следующее окно. Передаются только блоки участков
+ *              из пакета "header", остальные блоки слота остаются стертыми. Сектор стирается перед записью
+ *              первого окна, которое в него попадает, сектора без переданных блоков - вместе с ним.
+ *              После последнего окна слот становится активным (см. \ref activate_app_slot).
  * \return     update_successfull: Результат обновления: TRUE (обновление прошло успешно), FALSE (произошла ошибка обновления)
  */
 uint8_t
 update_firmware(void) {
-    uint32_t connection_try = 0;
-
     uint8_t update_successfull = FALSE;
 
     do {
+        /* Сообщаем Host приложению слот, в который будет записана прошивка */
+        uint32_t slot_address = get_other_app_slot(get_active_app_slot(NULL));
+        usart_send_response(slot_address);
+
         /* Получаем header с размером прошивки */
-        uint32_t firmware_size = 0;
-        uint32_t max_flash_size_b = NUMBER_OF_BYTES_OF_FLASH_MEMORY_SECTOR;
-        get_header_status_t get_header_status;
-        uint8_t get_header_successfull = FALSE;
+        header_t header = {0};
 
-        while (connection_try < MAX_USART_CONNECTION_TRY) {
-            get_header_status = usart_get_header(&firmware_size);
-
-            if (get_header_status != GET_HEADER_OK) {
-                usart_send_status(STATUS_NACK);
-            } else if (firmware_size == 0) {
-                printf("Размер прошивки равен нулю\n");
-                usart_send_status(STATUS_ACK);
-                usart_send_response(RESPONSE_FAIL);
+        if (!receive_header(&header, slot_address)) {
+            LOG_ERROR(LOG_EVENT_HEADER_RECEIVE_ERROR, "Ошибка при получении header\n");
+            break;
+        }
+
+        /*TODO: Сделать проверку на соответствие ключей шифрования */
+
+        /* Получаем блоки участков прошивки */
+        uint32_t number_of_data_blocks = get_number_of_transfer_blocks(&header);
+
+        uint8_t all_data_blocks_received = FALSE;
+        uint32_t next_sector_address = slot_address;
+
+        /* На время передачи блоков действует уровень журнала из header, например только ошибки */
+        log_level_t saved_log_level = get_log_level();
+
+        if (header.transfer_log_level != LOG_LEVEL_NONE) {
+            set_log_level((log_level_t) header.transfer_log_level);
+        }
+
+        for (uint32_t first_block = 0; first_block < number_of_data_blocks; first_block += header.window_size) {
+            uint32_t blocks_in_window = number_of_data_blocks - first_block;
+
+            if (blocks_in_window > header.window_size) {
+                blocks_in_window = header.window_size;
+            }
+
+            if (!receive_data_window(first_block, blocks_in_window, header.transfer_format, header.block_size)) {
+                LOG_ERROR(LOG_EVENT_DATA_RECEIVE_ERROR, "Ошибка при получении блока данных с прошивкой\n");
                 break;
-            } else if (firmware_size > max_flash_size_b) {
-                printf("Размер прошивки больше %lu байт\n", max_flash_size_b);
-                usart_send_status(STATUS_ACK);
-                usart_send_response(RESPONSE_FAIL);
+            }
+
+            /* Стираем сектора, в которые попадает окно, только после того, как его получили */
+            uint32_t window_end_address =
+                get_transfer_block_address(&header, first_block + blocks_in_window - 1U) + header.block_size;
+            uint8_t erase_successfull = erase_sectors_before_write(&next_sector_address, window_end_address);
+
+            if (!erase_successfull) {
+                LOG_ERROR(LOG_EVENT_FLASH_ERASE_ERROR, "Ошибка при стирании flash памяти\n");
                 break;
-            } else {
-                usart_send_status(STATUS_ACK);
-                usart_send_response(RESPONSE_OK);
-                get_header_successfull = TRUE;
+            }
+
+            uint8_t write_status = TRUE;
+            uint32_t program_start = start_time_measurement();
+
+            for (uint32_t slot = 0; slot < blocks_in_window && write_status; slot++) {
+                /* Распаковываем и расшифровываем блок */
+                uint8_t* decoded_block = decode_window_block(slot, header.transfer_format, header.block_size);
+
+                if (decoded_block == NULL) {
+                    LOG_ERROR(LOG_EVENT_DECOMPRESS_ERROR, "Ошибка распаковки блока данных\n");
+                    write_status = FALSE;
+                    break;
+                }
+
+                /* Записываем блок данных во flash */
+                write_status = write_data_block_to_flash(decoded_block, header.block_size,
+                                                         get_transfer_block_address(&header, first_block + slot));
+            }
+
+            if (!write_status) {
+                LOG_ERROR(LOG_EVENT_BLOCK_WRITE_ERROR, "Ошибка при записи блока flash памяти\n");
                 break;
             }
 
-            connection_try++;
+            uint32_t program_time_us = get_elapsed_time_us(program_start);
+
+            LOG_INFO(LOG_EVENT_PROGRESS, "[%lu / %lu]\n", first_block + blocks_in_window, number_of_data_blocks);
+
+            /* Окно записано, Host приложение может передавать следующее */
+            usart_send_program_time(program_time_us);
+            usart_send_status(STATUS_ACK, first_block + blocks_in_window);
+
+            /* Последний блок передан успешно */
+            if (first_block + blocks_in_window == number_of_data_blocks) {
+                all_data_blocks_received = TRUE;
+            }
         }
 
-        connection_try = 0;
+        set_log_level(saved_log_level);
 
-        if (!get_header_successfull) {
-            printf("Ошибка при получении header\n");
+        if (!all_data_blocks_received) {
+            LOG_ERROR(LOG_EVENT_UPDATE_ERROR, "Ошибка при обновлении прошивки\n");
             break;
         }
 
-        /*TODO: Сделать проверку на соответствие ключей шифрования */
+        if (!activate_app_slot(&header, slot_address)) {
+            LOG_ERROR(LOG_EVENT_UPDATE_ERROR, "Ошибка при обновлении прошивки\n");
+            break;
+        }
 
-        /* Получаем прошивку */
-        get_data_status_t get_data_status;
-        uint32_t number_of_data_blocks = 0;
+        LOG_INFO(LOG_EVENT_UPDATE_SUCCESS, "Прошивка запрограммирована успешно!\n");
+        update_successfull = TRUE;
+    } while (0);
 
-        uint8_t coded_data[NUMBER_OF_BYTES_DATA_DATA];
-        uint8_t decoded_data[NUMBER_OF_BYTES_DATA_DATA];
+    return update_successfull;
+}
 
-        if (firmware_size % NUMBER_OF_BYTES_DATA_DATA == 0) {
-            number_of_data_blocks = firmware_size / NUMBER_OF_BYTES_DATA_DATA;
-        } else {
-            number_of_data_blocks = firmware_size / NUMBER_OF_BYTES_DATA_DATA;
-            number_of_data_blocks++;
+/**
+ * \brief       Функция, которая проверяет, можно ли записать данные поверх flash памяти без стирания сектора.
+ * \note        Программирование flash памяти может только сбрасывать биты из 1 в 0.
+ * \param[in]   *data: Указатель на новые данные.
+ * \param[in]   flash_address: Адрес flash памяти, в который будут записаны данные.
+ * \param[in]   size: Размер данных в байтах.
+ * \return      result: TRUE (запись возможна без стирания), FALSE (нужно стирание сектора).
+ */
+static uint8_t
+can_program_without_erase(const uint8_t* data, uint32_t flash_address, uint32_t size) {
+    const uint8_t* flash_data = (const uint8_t*)flash_address;
+
+    for (uint32_t i = 0; i < size; i++) {
+        if ((flash_data[i] & data[i]) != data[i]) {
+            return FALSE;
         }
+    }
 
-        uint8_t all_data_blocks_received = FALSE;
-        uint32_t address_write_to_memory = APP_FLASH_START_ADDRESS;
+    return TRUE;
+}
 
-        for (uint32_t i = 0; i < number_of_data_blocks; i++) {
+/**
+ * \brief       Функция, которая проверяет, отмечен ли блок прошивки в маске измененных блоков.
+ * \param[in]   *delta_map: Указатель на маску измененных блоков из пакета "dmap".
+ * \param[in]   block: Номер блока прошивки.
+ * \return      result: TRUE (блок изменен), FALSE (блок не изменен).
+ */
+static uint8_t
+is_block_changed(const uint8_t* delta_map, uint32_t block) {
+    return (delta_map[block / 8] & (1U << (block % 8))) ? TRUE : FALSE;
+}
 
-            uint8_t one_data_block_received = FALSE;
+/**
+ * \brief       Функция, которая вычисляет диапазон блоков прошивки, попадающих в сектор.
+ * \note        Блоки нумеруются от начала слота, в котором находится сектор.
+ * \param[in]   sector: Номер сектора flash памяти.
+ * \param[in]   number_of_data_blocks: Число блоков прошивки.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \param[out]  *first_block: Номер первого блока прошивки в секторе.
+ * \param[out]  *last_block: Номер блока, следующего за последним блоком прошивки в секторе.
+ */
+static void
+get_sector_blocks(uint32_t sector, uint32_t number_of_data_blocks, uint32_t block_size, uint32_t* first_block,
+                  uint32_t* last_block) {
+    uint32_t sector_address = get_flash_sector_address(sector);
+    uint32_t slot_address = (sector_address < APP_SLOT_B_ADDRESS) ? APP_SLOT_A_ADDRESS : APP_SLOT_B_ADDRESS;
 
-            while (connection_try < MAX_USART_CONNECTION_TRY) {
-                /* Получаем блок с прошивкой */
-                get_data_status = usart_get_data(coded_data);
+    *first_block = (sector_address - slot_address) / block_size;
+    *last_block = *first_block + get_flash_sector_size(sector) / block_size;
 
-                if (get_data_status != GET_DATA_OK) {
-                    printf("Ошибка при выполнении usart_get_data\n");
-                    usart_send_status(STATUS_NACK);
-                } else {
-                    printf("[%lu / %lu]\n", i + 1, number_of_data_blocks);
-                    usart_send_status(STATUS_ACK);
-                    one_data_block_received = TRUE;
-                    break;
+    if (*last_block > number_of_data_blocks) {
+        *last_block = number_of_data_blocks;
+    }
+}
+
+/**
+ * \brief       Функция, которая готовит сектор к приему измененных блоков при разностном обновлении.
+ * \note        Сектор, который помещается в CCMRAM, копируется в буфер \ref DELTA_STAGING_ADDRESS и записывается
+ *              после приема всех его измененных блоков. Блоки сектора больше буфера записываются по мере приема:
+ *              если все измененные блоки стерты (например, передача прошивки прервалась), они дописываются
+ *              без стирания, иначе сектор стирается, и в маске должны быть отмечены все блоки прошивки этого сектора.
+ * \param[in]   sector: Номер сектора flash памяти.
+ * \param[in]   *delta_map: Указатель на маску измененных блоков.
+ * \param[in]   number_of_data_blocks: Число блоков прошивки.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \param[out]  *sector_staged: TRUE, если сектор собирается в CCMRAM.
+ * \param[out]  *sector_erased: TRUE, если сектор стерт.
+ * \return      result: Результат: TRUE (сектор готов), FALSE (сектор изменен не целиком или ошибка стирания).
+ */
+static uint8_t
+start_delta_sector(uint32_t sector, const uint8_t* delta_map, uint32_t number_of_data_blocks, uint32_t block_size,
+                   uint8_t* sector_staged, uint8_t* sector_erased) {
+    uint32_t sector_size = get_flash_sector_size(sector);
+
+    *sector_staged = FALSE;
+    *sector_erased = FALSE;
+
+    if (sector_size <= DELTA_STAGING_SIZE) {
+        /* Неизмененные блоки берем из flash памяти, измененные - из принятых пакетов */
+        memcpy((uint8_t*)DELTA_STAGING_ADDRESS, (const uint8_t*)get_flash_sector_address(sector), sector_size);
+        *sector_staged = TRUE;
+        return TRUE;
+    }
+
+    uint32_t first_block;
+    uint32_t last_block;
+    get_sector_blocks(sector, number_of_data_blocks, block_size, &first_block, &last_block);
+
+    uint8_t changed_blocks_erased = TRUE;
+    uint8_t all_blocks_changed = TRUE;
+
+    for (uint32_t block = first_block; block < last_block; block++) {
+        if (!is_block_changed(delta_map, block)) {
+            all_blocks_changed = FALSE;
+        } else if (!is_flash_erased(get_flash_sector_address(sector) + (block - first_block) * block_size,
+                                    block_size)) {
+            changed_blocks_erased = FALSE;
+        }
+    }
+
+    if (changed_blocks_erased) {
+        return TRUE;
+    }
+
+    if (!all_blocks_changed) {
+        LOG_ERROR(LOG_EVENT_DELTA_SECTOR_TOO_LARGE, "Сектор %lu больше буфера CCMRAM и должен передаваться целиком\n",
+                  sector);
+        return FALSE;
+    }
+
+    *sector_erased = TRUE;
+    return erase_flash(sector);
+}
+
+/**
+ * \brief       Функция, которая записывает во flash память сектор, собранный в CCMRAM.
+ * \note        Если измененные блоки сектора можно записать без стирания, перезаписываются только они,
+ *              иначе сектор стирается и записывается из собранного образа до конца прошивки.
+ * \param[in]   sector: Номер сектора flash памяти.
+ * \param[in]   *delta_map: Указатель на маску измененных блоков.
+ * \param[in]   number_of_data_blocks: Число блоков прошивки.
+ * \param[in]   block_size: Число байт прошивки в блоке.
+ * \param[out]  *sector_erased: TRUE, если сектор пришлось стереть.
+ * \return      result: Результат записи: TRUE (сектор записан), FALSE (ошибка стирания или записи).
+ */
+static uint8_t
+write_staged_sector(uint32_t sector, const uint8_t* delta_map, uint32_t number_of_data_blocks, uint32_t block_size,
+                    uint8_t* sector_erased) {
+    uint8_t* staging_image = (uint8_t*)DELTA_STAGING_ADDRESS;
+    uint32_t sector_address = get_flash_sector_address(sector);
+    uint32_t first_block;
+    uint32_t last_block;
+    get_sector_blocks(sector, number_of_data_blocks, block_size, &first_block, &last_block);
+
+    /* Стирание нужно, если хотя бы в одном измененном блоке бит меняется из 0 в 1 */
+    uint8_t erase_required = FALSE;
+
+    for (uint32_t block = first_block; block < last_block && !erase_required; block++) {
+        uint32_t offset = (block - first_block) * block_size;
+
+        if (is_block_changed(delta_map, block)
+            && !can_program_without_erase(&staging_image[offset], sector_address + offset, block_size)) {
+            erase_required = TRUE;
+        }
+    }
+
+    *sector_erased = erase_required;
+
+    if (erase_required) {
+        if (!erase_flash(sector)) {
+            return FALSE;
+        }
+
+        return write_data_block_to_flash(staging_image, (last_block - first_block) * block_size, sector_address);
+    }
+
+    uint8_t write_status = TRUE;
+
+    for (uint32_t block = first_block; block < last_block && write_status; block++) {
+        uint32_t offset = (block - first_block) * block_size;
+
+        if (is_block_changed(delta_map, block)) {
+            write_status = write_data_block_to_flash(&staging_image[offset], block_size, sector_address + offset);
+        }
+    }
+
+    return write_status;
+}
+
+/**
+ * \brief       Функция которая производит разностное обновление прошивки.
+ * \note        Как и при полном обновлении, прошивка записывается в неактивный слот, адрес которого загрузчик
+ *              отправляет пакетом "response" перед пакетом "header". Разность вычисляется с прошивкой этого слота,
+ *              а не активного: слоты чередуются, поэтому в неактивном слоте прошивка на две версии старше текущей
+ *              (или прерванная передача), и передаются изменения двух последних версий. Если неактивный слот пуст
+ *              (первое обновление после прошивки слота A), передаются все блоки, как при полном обновлении.
+ *              После пакета "header" загрузчик отправляет пакеты "response" с CRC32 каждого блока
+ *              прошивки слота (см. \ref calculate_encrypted_flash_crc). Host приложение сравнивает их
+ *              с блоками новой прошивки, затем маску стертых блоков (по 32 блока в пакете "response").
+ *              Host приложение присылает пакет "dmap" с маской измененных блоков, затем передает
+ *              окнами только измененные блоки. Порядковый номер в пакете "data" - это номер блока в списке
+ *              измененных блоков, а не в прошивке.
+ *              Измененные блоки записываются по секторам (см. \ref start_delta_sector и \ref write_staged_sector):
+ *              новый образ сектора, который помещается в CCMRAM, собирается в ней, сектор больше буфера
+ *              перезаписывается целиком.
+ * \return     update_successfull: Результат обновления: TRUE (обновление прошло успешно), FALSE (произошла ошибка обновления)
+ */
+uint8_t
+delta_update_firmware(void) {
+    uint32_t connection_try = 0;
+
+    uint8_t update_successfull = FALSE;
+
+    do {
+        /* Сообщаем Host приложению слот, в который будет записана прошивка */
+        uint32_t slot_address = get_other_app_slot(get_active_app_slot(NULL));
+        usart_send_response(slot_address);
+
+        /* Получаем header с размером новой прошивки */
+        header_t header = {0};
+
+        if (!receive_header(&header, slot_address)) {
+            LOG_ERROR(LOG_EVENT_HEADER_RECEIVE_ERROR, "Ошибка при получении header\n");
+            break;
+        }
+
+        uint32_t number_of_data_blocks = get_number_of_data_blocks(header.firmware_size, header.block_size);
+
+        /* Передаем CRC32 блоков прошивки слота */
+        for (uint32_t block = 0; block < number_of_data_blocks; block++) {
+            usart_send_response(calculate_encrypted_flash_crc(slot_address + block * header.block_size,
+                                                              header.block_size, encryption_key));
+        }
+
+        /* Передаем маску стертых блоков словами по 32 блока (бит i слова - блок 32 * номер слова + i).
+         * По ней Host приложение определяет, в каких секторах блоки можно дописать без стирания,
+         * поэтому прерванная передача прошивки продолжается с первого незаписанного блока */
+        for (uint32_t first_block = 0; first_block < number_of_data_blocks; first_block += 32) {
+            uint32_t erased_blocks_mask = 0;
+
+            for (uint32_t bit = 0; bit < 32 && first_block + bit < number_of_data_blocks; bit++) {
+                if (is_flash_erased(slot_address + (first_block + bit) * header.block_size, header.block_size)) {
+                    erased_blocks_mask |= 1U << bit;
                 }
+            }
+
+            usart_send_response(erased_blocks_mask);
+        }
+
+        /* Получаем маску измененных блоков */
+        uint8_t delta_map[NUMBER_OF_BYTES_DMAP_DATA];
+        get_dmap_status_t get_dmap_result;
+        uint8_t dmap_received_successfully = FALSE;
+
+        while (connection_try < MAX_USART_CONNECTION_TRY) {
+            get_dmap_result = usart_get_delta_map(delta_map);
+
+            if (get_dmap_result != GET_DMAP_OK) {
+                usart_send_status(STATUS_NACK, 0);
+            } else {
+                usart_send_status(STATUS_ACK, 0);
+                dmap_received_successfully = TRUE;
+                break;
+            }
+
+            connection_try++;
+        }
+
+        connection_try = 0;
+
+        if (!dmap_received_successfully) {
+            LOG_ERROR(LOG_EVENT_DMAP_RECEIVE_ERROR, "Ошибка при получении пакета \"dmap\"\n");
+            break;
+        }
+
+        /* Список не помещается в стек загрузчика, если слот приложения занимает всю свою область flash памяти */
+        static uint32_t changed_blocks[MAX_NUMBER_OF_DATA_BLOCKS];
+        uint32_t number_of_changed_blocks = 0;
 
-                connection_try++;
+        for (uint32_t block = 0; block < number_of_data_blocks; block++) {
+            if (is_block_changed(delta_map, block)) {
+                changed_blocks[number_of_changed_blocks++] = block;
             }
+        }
+
+        /* Слот уже содержит новую прошивку (например, после отката), его остается только активировать */
+        if (number_of_changed_blocks == 0) {
+            LOG_INFO(LOG_EVENT_DELTA_UNCHANGED, "Прошивка не изменилась, запись не требуется\n");
+        }
 
-            if (!one_data_block_received) {
-                printf("Ошибка при получении блока данных с прошивкой\n");
-                all_data_blocks_received = FALSE;
+        uint8_t all_data_blocks_received = (number_of_changed_blocks == 0) ? TRUE : FALSE;
+        uint32_t current_sector = FLASH_SECTOR_INVALID;
+        uint8_t sector_staged = FALSE;
+        uint8_t sector_erased = FALSE;
+        uint32_t number_of_erased_sectors = 0;
+
+        /* На время передачи блоков действует уровень журнала из header, например только ошибки */
+        log_level_t saved_log_level = get_log_level();
+
+        if (header.transfer_log_level != LOG_LEVEL_NONE) {
+            set_log_level((log_level_t) header.transfer_log_level);
+        }
+
+        for (uint32_t first_block = 0; first_block < number_of_changed_blocks; first_block += header.window_size) {
+            uint32_t blocks_in_window = number_of_changed_blocks - first_block;
+
+            if (blocks_in_window > header.window_size) {
+                blocks_in_window = header.window_size;
+            }
+
+            if (!receive_data_window(first_block, blocks_in_window, header.transfer_format, header.block_size)) {
+                LOG_ERROR(LOG_EVENT_DATA_RECEIVE_ERROR, "Ошибка при получении блока данных с прошивкой\n");
                 break;
             }
 
-            one_data_block_received = FALSE;
+            uint8_t write_status = TRUE;
 
-            /* 1 раз стираем flash память, только после того, как получили первый блок */
-            if (i == 0) {
-                uint8_t erase_successfull = erase_flash(FLASH_SECTOR_NUMBER);
+            for (uint32_t slot = 0; slot < blocks_in_window && write_status; slot++) {
+                uint8_t* decoded_block = decode_window_block(slot, header.transfer_format, header.block_size);
 
-                if (!erase_successfull) {
-                    printf("Ошибка при стирании flash памяти\n");
+                if (decoded_block == NULL) {
+                    LOG_ERROR(LOG_EVENT_DECOMPRESS_ERROR, "Ошибка распаковки блока данных\n");
+                    write_status = FALSE;
                     break;
                 }
-            }
 
-            /* Копируем зашифрованные данные для дальнейшей расшифровки */
-            memcpy(decoded_data, coded_data, NUMBER_OF_BYTES_DATA_DATA);
+                uint32_t block_address = slot_address + changed_blocks[first_block + slot] * header.block_size;
+                uint32_t sector = get_flash_sector(block_address);
+
+                /* Блоки приходят по возрастанию адреса: переход в следующий сектор завершает предыдущий */
+                if (sector != current_sector) {
+                    if (sector_staged) {
+                        write_status = write_staged_sector(current_sector, delta_map, number_of_data_blocks,
+                                                           header.block_size, &sector_erased);
+                        number_of_erased_sectors += sector_erased;
+                    }
 
-            /* Расшифровываем данные */
-            decrypt_data(encryption_key, decoded_data, NUMBER_OF_BYTES_DATA_DATA);
+                    if (write_status) {
+                        write_status = start_delta_sector(sector, delta_map, number_of_data_blocks, header.block_size,
+                                                          &sector_staged, &sector_erased);
+                        number_of_erased_sectors += sector_erased;
+                    }
 
-            /* Записываем блок данных во flash */
-            uint8_t write_status =
-                write_data_block_to_flash(decoded_data, NUMBER_OF_BYTES_DATA_DATA, address_write_to_memory);
-            address_write_to_memory += NUMBER_OF_BYTES_DATA_DATA;
+                    current_sector = sector;
+                }
+
+                if (!write_status) {
+                    LOG_ERROR(LOG_EVENT_SECTOR_WRITE_ERROR, "Ошибка при записи сектора %lu flash памяти\n",
+                              current_sector);
+                    break;
+                }
+
+                if (sector_staged) {
+                    memcpy((uint8_t*)DELTA_STAGING_ADDRESS + (block_address - get_flash_sector_address(sector)),
+                           decoded_block, header.block_size);
+                } else {
+                    write_status = write_data_block_to_flash(decoded_block, header.block_size, block_address);
+
+                    if (!write_status) {
+                        LOG_ERROR(LOG_EVENT_BLOCK_WRITE_ERROR, "Ошибка при записи блока flash памяти\n");
+                    }
+                }
+            }
 
             if (!write_status) {
-                printf("Ошибка при записи блока flash памяти\n");
                 break;
             }
 
-            /* Последний блок передан успешно */
-            if (i + 1 == number_of_data_blocks) {
-                printf("Прошивка запрограммирована успешно!\n");
+            LOG_INFO(LOG_EVENT_PROGRESS, "[%lu / %lu]\n", first_block + blocks_in_window, number_of_changed_blocks);
+
+            usart_send_status(STATUS_ACK, first_block + blocks_in_window);
+
+            if (first_block + blocks_in_window == number_of_changed_blocks) {
                 all_data_blocks_received = TRUE;
             }
         }
 
+        set_log_level(saved_log_level);
+
         if (!all_data_blocks_received) {
-            printf("Ошибка при обновлении прошивки\n");
+            LOG_ERROR(LOG_EVENT_UPDATE_ERROR, "Ошибка при обновлении прошивки\n");
             break;
         }
 
+        /* Последний сектор, собранный в CCMRAM, записываем после приема всех блоков */
+        if (sector_staged) {
+            if (!write_staged_sector(current_sector, delta_map, number_of_data_blocks, header.block_size,
+                                     &sector_erased)) {
+                LOG_ERROR(LOG_EVENT_SECTOR_WRITE_ERROR, "Ошибка при записи сектора %lu flash памяти\n", current_sector);
+                break;
+            }
+
+            number_of_erased_sectors += sector_erased;
+        }
+
+        LOG_INFO(LOG_EVENT_DELTA_SUMMARY, "Изменено блоков: %lu из %lu, стерто секторов: %lu\n",
+                 number_of_changed_blocks, number_of_data_blocks, number_of_erased_sectors);
+
+        if (!activate_app_slot(&header, slot_address)) {
+            LOG_ERROR(LOG_EVENT_UPDATE_ERROR, "Ошибка при обновлении прошивки\n");
+            break;
+        }
+
+        LOG_INFO(LOG_EVENT_UPDATE_SUCCESS, "Прошивка запрограммирована успешно!\n");
+
         update_successfull = TRUE;
     } while (0);
 
@@ -265,10 +1009,11 @@ flash_ob_check(void) {
     uint8_t result;
 
     if (((OBconfig.OptionType & OPTIONBYTE_RDP) != OPTIONBYTE_RDP) || OBconfig.RDPLevel != OB_RDP_LEVEL_1) {
-        printf("Защита flash памяти выключена\n");
+        LOG_INFO(LOG_EVENT_FLASH_UNLOCKED, "Защита flash памяти выключена\n");
         result = FALSE;
     } else {
-        printf("Защита flash памяти включена (отключение приведет к полному стиранию flash памяти!)\n");
+        LOG_INFO(LOG_EVENT_FLASH_LOCKED,
+                 "Защита flash памяти включена (отключение приведет к полному стиранию flash памяти!)\n");
         result = TRUE;
     }
 
@@ -286,7 +1031,7 @@ flash_lock(void) {
     FLASH_OBProgramInitTypeDef OBconfig;
     HAL_FLASHEx_OBGetConfig(&OBconfig);
 
-    printf("Провожу проверку на наличие защиты flash памяти\n");
+    LOG_INFO(LOG_EVENT_FLASH_CHECK, "Провожу проверку на наличие защиты flash памяти\n");
     uint8_t flash_already_lock = flash_ob_check();
     if (!flash_already_lock) {
         HAL_FLASH_Unlock();
@@ -312,9 +1057,9 @@ flash_lock(void) {
         HAL_FLASH_OB_Launch();
 
         HAL_FLASHEx_OBGetConfig(&OBconfig);
-        printf("Защита flash памяти успешно включена\n");
+        LOG_INFO(LOG_EVENT_FLASH_LOCK_DONE, "Защита flash памяти успешно включена\n");
     } else {
-        printf("Защита flash памяти уже включена, отмена команды\n");
+        LOG_WARNING(LOG_EVENT_FLASH_ALREADY_LOCKED, "Защита flash памяти уже включена, отмена команды\n");
     }
 
     return result;
@@ -330,10 +1075,10 @@ void
 flash_unlock(void) {
     FLASH_OBProgramInitTypeDef OBconfig;
 
-    printf("Провожу проверку на наличие защиты flash памяти\n");
+    LOG_INFO(LOG_EVENT_FLASH_CHECK, "Провожу проверку на наличие защиты flash памяти\n");
     uint8_t flash_lock = flash_ob_check();
     if (flash_lock) {
-        printf("Отключаю защиту flash памяти\n");
+        LOG_INFO(LOG_EVENT_FLASH_UNLOCK_STARTED, "Отключаю защиту flash памяти\n");
 
         HAL_FLASH_Unlock();
         HAL_FLASH_OB_Unlock();
@@ -352,17 +1097,20 @@ flash_unlock(void) {
         /* Перезагрузка регистров option bytes */
         HAL_FLASH_OB_Launch();
     } else {
-        printf("Защита flash памяти уже выключена, отмена команды\n");
+        LOG_WARNING(LOG_EVENT_FLASH_ALREADY_UNLOCKED, "Защита flash памяти уже выключена, отмена команды\n");
     }
 }
 
 
 /**
  * \brief     Эта функция служит для стирания пользовательской прошивки из flash памяти
+ * \note      Стираются оба слота и журнал загрузки, следующая прошивка записывается в слот B.
  */
 // TODO: описание, h
 void erase_program(void) {
-    erase_flash(FLASH_SECTOR_NUMBER);
+    if (erase_app_flash()) {
+        clear_boot_records();
+    }
 }
 
 // TODO: описание, h
@@ -382,9 +1130,9 @@ uint8_t check_key(void) {
             get_key_result = usart_get_key(&encrypted_test_word);
 
             if (get_key_result != GET_KEY_OK) {
-                usart_send_status(STATUS_NACK);
+                usart_send_status(STATUS_NACK, 0);
             } else {
-                usart_send_status(STATUS_ACK);
+                usart_send_status(STATUS_ACK, 0);
                 key_received_successfully = TRUE;
                 break;
             }
@@ -395,7 +1143,7 @@ uint8_t check_key(void) {
         connection_try = 0;
 
         if (!key_received_successfully) {
-            printf("Ошибка при получении пакета \"key\"\n");
+            LOG_ERROR(LOG_EVENT_KEY_RECEIVE_ERROR, "Ошибка при получении пакета \"key\"\n");
             break;
         }
 
@@ -413,19 +1161,184 @@ uint8_t check_key(void) {
 
         if (test_word_finded) {
             usart_send_response(RESPONSE_OK);
-            printf("Ключи шифрования соответствуют!\n");
+            LOG_INFO(LOG_EVENT_KEYS_MATCH, "Ключи шифрования соответствуют!\n");
             result = TRUE;
         } else {
             usart_send_response(RESPONSE_FAIL);
-            printf("Ключи шифрования НЕ соответствуют!\n");
+            LOG_WARNING(LOG_EVENT_KEYS_MISMATCH, "Ключи шифрования НЕ соответствуют!\n");
+            break;
+        }
+
+    } while (0);
+
+    return result;
+}
+
+/* Скорости UART, на которые загрузчик соглашается перейти. USART3 тактируется от APB1 (42 МГц),
+ * при передискретизации 16 ошибка скорости для всех значений списка меньше 1% */
+static const uint32_t supported_baudrates[] = {115200U, 230400U, 460800U, 921600U, 1000000U, 2000000U};
+
+/**
+ * \brief      Эта функция служит для согласования скорости UART с Host приложением.
+ * \note       После ответа RESPONSE_OK обе стороны переходят на новую скорость, и Host приложение
+ *             присылает пакет проверки. Если он не пришел за \ref BAUDRATE_PROBE_TIMEOUT_MS,
+ *             загрузчик возвращается на \ref DEFAULT_UART_BAUDRATE.
+ * \return     result: Результат: TRUE (связь есть на новой или прежней скорости), FALSE (ошибка приема пакета "baud")
+ */
+uint8_t
+set_baudrate(void) {
+    uint8_t connection_try = 0;
+    uint8_t result = FALSE;
+
+    uint32_t baudrate = 0;
+
+    do {
+        get_baud_status_t get_baud_result;
+        uint8_t baud_received_successfully = FALSE;
+
+        /* Получаем пакет типа "baud" */
+        while (connection_try < MAX_USART_CONNECTION_TRY) {
+            get_baud_result = usart_get_baudrate(&baudrate);
+
+            if (get_baud_result != GET_BAUD_OK) {
+                usart_send_status(STATUS_NACK, 0);
+            } else {
+                usart_send_status(STATUS_ACK, 0);
+                baud_received_successfully = TRUE;
+                break;
+            }
+
+            connection_try++;
+        }
+
+        connection_try = 0;
+
+        if (!baud_received_successfully) {
+            LOG_ERROR(LOG_EVENT_BAUD_RECEIVE_ERROR, "Ошибка при получении пакета \"baud\"\n");
+            break;
+        }
+
+        uint8_t baudrate_supported = FALSE;
+
+        for (size_t i = 0; i < sizeof(supported_baudrates) / sizeof(supported_baudrates[0]); i++) {
+            if (supported_baudrates[i] == baudrate) {
+                baudrate_supported = TRUE;
+            }
+        }
+
+        /* Связь остается на прежней скорости, поэтому команда считается выполненной */
+        result = TRUE;
+
+        if (!baudrate_supported) {
+            LOG_ERROR(LOG_EVENT_BAUDRATE_UNSUPPORTED, "Скорость UART %lu бод не поддерживается\n", baudrate);
+            usart_send_response(RESPONSE_FAIL);
+            break;
+        }
+
+        usart_send_response(RESPONSE_OK);
+
+        uint32_t previous_baudrate = huart3.Init.BaudRate;
+
+        if (!usart_set_baudrate(baudrate)) {
+            usart_set_baudrate(previous_baudrate);
+            break;
+        }
+
+        if (usart_get_probe(baudrate, BAUDRATE_PROBE_TIMEOUT_MS)) {
+            /* Сообщение выводим до ответа: после него Host приложение сразу передает следующую команду */
+            LOG_INFO(LOG_EVENT_BAUDRATE_CHANGED, "Скорость UART изменена на %lu бод\n", baudrate);
+            usart_send_response(RESPONSE_OK);
+        } else {
+            usart_set_baudrate(DEFAULT_UART_BAUDRATE);
+            LOG_WARNING(LOG_EVENT_BAUDRATE_PROBE_FAILED, "Проверка скорости UART не пройдена, скорость %lu бод\n",
+                        huart3.Init.BaudRate);
+        }
+    } while (0);
+
+    return result;
+}
+
+/**
+ * \brief       Функция, которая проверяет записанную прошивку по CRC32.
+ * \note        После пакета "header" с размером прошивки загрузчик вычисляет аппаратным блоком CRC32 области flash
+ *              памяти активного слота размером в целое число блоков и отправляет его пакетом
+ *              "response". Как и при разностном обновлении, CRC32 вычисляется по данным, зашифрованным текущим ключом
+ *              (\ref calculate_encrypted_flash_crc), поэтому Host приложение сравнивает его с CRC32 файла прошивки,
+ *              не зная ключа шифрования. Перед пакетом "header" загрузчик отправляет пакет "response"
+ *              с адресом активного слота.
+ * \return      result: Результат: TRUE (CRC32 отправлен), FALSE (ошибка приема header).
+ */
+uint8_t
+verify_firmware(void) {
+    uint8_t result = FALSE;
+
+    do {
+        /* Сообщаем Host приложению слот, прошивка которого проверяется */
+        uint32_t slot_address = get_active_app_slot(NULL);
+        usart_send_response(slot_address);
+
+        header_t header = {0};
+
+        if (!receive_header(&header, slot_address)) {
+            LOG_ERROR(LOG_EVENT_HEADER_RECEIVE_ERROR, "Ошибка при получении header\n");
             break;
         }
 
+        reset_flash_data_cache();
+
+        uint32_t start_cycles = start_time_measurement();
+        uint32_t image_size =
+            get_number_of_data_blocks(header.firmware_size, header.block_size) * header.block_size;
+        uint32_t firmware_crc = calculate_encrypted_flash_crc(slot_address, image_size, encryption_key);
+        uint32_t crc_time_us = get_elapsed_time_us(start_cycles);
+
+        usart_send_response(firmware_crc);
+        LOG_INFO(LOG_EVENT_FIRMWARE_CRC, "CRC32 прошивки: %#lx, вычислен за %lu мкс\n", firmware_crc, crc_time_us);
+        result = TRUE;
     } while (0);
 
     return result;
 }
 
+/**
+ * \brief       Функция, которая возвращает к прошивке слота, который был активен до последнего обновления.
+ * \note        Откат возможен, если прошивка слота для отката не перезаписана и совпадает с CRC32 из журнала
+ *              загрузки. Результат загрузчик отправляет пакетом "response": RESPONSE_OK или RESPONSE_FAIL.
+ * \return      result: Результат: TRUE (слот для отката активен), FALSE (откат невозможен).
+ */
+uint8_t
+rollback_firmware(void) {
+    uint8_t result = FALSE;
+    boot_record_t records[2];
+
+    do {
+        if (get_boot_records(records) < 2) {
+            LOG_ERROR(LOG_EVENT_ROLLBACK_NO_RECORD, "В журнале загрузки нет прошивки для отката\n");
+            break;
+        }
+
+        /* records[0] - запись слота, который был активен до последнего обновления */
+        if (!is_app_slot_valid(records[0].slot_address, records[0].image_size, records[0].image_crc)) {
+            LOG_ERROR(LOG_EVENT_ROLLBACK_SLOT_CORRUPTED,
+                      "Прошивка слота 0x%08lX перезаписана или повреждена, откат невозможен\n",
+                      records[0].slot_address);
+            break;
+        }
+
+        if (!add_boot_record(records[0].slot_address, records[0].image_size, records[0].image_crc)) {
+            LOG_ERROR(LOG_EVENT_JOURNAL_ERROR, "Ошибка при записи журнала загрузки\n");
+            break;
+        }
+
+        LOG_INFO(LOG_EVENT_SLOT_ACTIVE, "Слот 0x%08lX активен\n", records[0].slot_address);
+        result = TRUE;
+    } while (0);
+
+    usart_send_response(result ? RESPONSE_OK : RESPONSE_FAIL);
+
+    return result;
+}
+
 /**
  * \brief     Эта функция служит для выполнения выбранной команды
  * \param[in] command: Какую команду нужно выполнить
@@ -437,43 +1350,69 @@ execute_command(cmd_t command) {
 
     switch (command) {
         case CMD_UPDATE_FIRMWARE:
-            printf("Выбрана команда для обновления прошивки, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_UPDATE, "Выбрана команда для обновления прошивки, выполняю...\n");
             result = update_firmware();
             break;
         case CMD_SET_KEY:
-            printf("Выбрана команда для задания пароля, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_SET_KEY, "Выбрана команда для задания пароля, выполняю...\n");
             result = set_key();
             break;
         case CMD_FLASH_OB_CHECK:
-            printf("Выбрана команда для проверки защиты flash памяти, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_FLASH_CHECK, "Выбрана команда для проверки защиты flash памяти, выполняю...\n");
             flash_ob_check();
             result = TRUE;
             break;
         case CMD_FLASH_LOCK:
-            printf("Выбрана команда для установки защиты flash памяти, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_FLASH_LOCK, "Выбрана команда для установки защиты flash памяти, выполняю...\n");
             result = flash_lock();;
             break;
         case CMD_FLASH_UNLOCK:
-            printf("Выбрана команда для снятия защиты flash памяти, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_FLASH_UNLOCK, "Выбрана команда для снятия защиты flash памяти, выполняю...\n");
             flash_unlock();
             result = TRUE;
             break;
         case CMD_GET_ID:
-            printf("Выбрана команда для получения UID, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_GET_UID, "Выбрана команда для получения UID, выполняю...\n");
             send_uid();
             result = TRUE;
             break;
         case CMD_CHECK_KEY:
-            printf("Выбрана команда для проверки соответствия ключей шифрования, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_CHECK_KEY,
+                     "Выбрана команда для проверки соответствия ключей шифрования, выполняю...\n");
             result = check_key();
             break;
         case CMD_ERASE_PROGRAM:
-            printf("Выбрана команда для стирания пользовательской прошивки из flash памяти, выполняю...\n");
+            LOG_INFO(LOG_EVENT_CMD_ERASE,
+                     "Выбрана команда для стирания пользовательской прошивки из flash памяти, выполняю...\n");
             erase_program();
             result = TRUE;
             break;
+        case CMD_SET_BAUDRATE:
+            LOG_INFO(LOG_EVENT_CMD_SET_BAUDRATE, "Выбрана команда для смены скорости UART, выполняю...\n");
+            result = set_baudrate();
+            break;
+        case CMD_DELTA_UPDATE:
+            LOG_INFO(LOG_EVENT_CMD_DELTA_UPDATE, "Выбрана команда для разностного обновления прошивки, выполняю...\n");
+            result = delta_update_firmware();
+            break;
+        case CMD_START_SESSION:
+            LOG_INFO(LOG_EVENT_CMD_START_SESSION, "Выбрана команда для начала сессии команд, выполняю...\n");
+            result = TRUE;
+            break;
+        case CMD_RESET:
+            LOG_INFO(LOG_EVENT_CMD_END_SESSION, "Выбрана команда для завершения сессии команд, выполняю...\n");
+            result = TRUE;
+            break;
+        case CMD_VERIFY:
+            LOG_INFO(LOG_EVENT_CMD_VERIFY, "Выбрана команда для проверки записанной прошивки, выполняю...\n");
+            result = verify_firmware();
+            break;
+        case CMD_ROLLBACK:
+            LOG_INFO(LOG_EVENT_CMD_ROLLBACK, "Выбрана команда для отката к предыдущей прошивке, выполняю...\n");
+            result = rollback_firmware();
+            break;
         default:
-            printf("Неизвестная команда\n");
+            LOG_ERROR(LOG_EVENT_CMD_UNKNOWN, "Неизвестная команда\n");
             break;
     }
 
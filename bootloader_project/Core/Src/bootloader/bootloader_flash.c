@@ -33,14 +33,93 @@
 
 #include "bootloader/bootloader_flash.h"
 
+/* Ширина записи во flash память определяется диапазоном напряжения питания */
+#if FLASH_PROGRAM_VOLTAGE_RANGE == FLASH_VOLTAGE_RANGE_4
+#define FLASH_PROGRAM_TYPE FLASH_TYPEPROGRAM_DOUBLEWORD
+#define FLASH_PROGRAM_SIZE 8U
+#elif FLASH_PROGRAM_VOLTAGE_RANGE == FLASH_VOLTAGE_RANGE_3
+#define FLASH_PROGRAM_TYPE FLASH_TYPEPROGRAM_WORD
+#define FLASH_PROGRAM_SIZE 4U
+#elif FLASH_PROGRAM_VOLTAGE_RANGE == FLASH_VOLTAGE_RANGE_2
+#define FLASH_PROGRAM_TYPE FLASH_TYPEPROGRAM_HALFWORD
+#define FLASH_PROGRAM_SIZE 2U
+#else
+#define FLASH_PROGRAM_TYPE FLASH_TYPEPROGRAM_BYTE
+#define FLASH_PROGRAM_SIZE 1U
+#endif
+
+/* Адреса начала секторов flash памяти STM32F407xx (1 МБ, один банк), последний элемент - конец flash памяти */
+static const uint32_t flash_sector_addresses[] = {
+    0x08000000U, 0x08004000U, 0x08008000U, 0x0800C000U, 0x08010000U, 0x08020000U, 0x08040000U,
+    0x08060000U, 0x08080000U, 0x080A0000U, 0x080C0000U, 0x080E0000U, 0x08100000U,
+};
+#define NUMBER_OF_FLASH_SECTORS (sizeof(flash_sector_addresses) / sizeof(flash_sector_addresses[0]) - 1U)
+
 /**
- * \brief       Функция, стирает определенный сектор flash памяти.
- * \param[in]   number_of_sector: Номер сектора flash памяти STM32F407xx для стирания.
- * \return      result: Результат стирания: TRUE (flash память сектора успешно очищена),
- *             FALSE (во время стирания flash памяти произошла ошибка).
+ * \brief       Функция, которая определяет сектор flash памяти по адресу.
+ * \param[in]   flash_address: Адрес flash памяти.
+ * \return      number_of_sector: Номер сектора, в котором находится адрес,
+ *              или \ref FLASH_SECTOR_INVALID, если адрес вне flash памяти.
+ */
+uint32_t
+get_flash_sector(uint32_t flash_address) {
+    for (uint32_t sector = 0; sector < NUMBER_OF_FLASH_SECTORS; sector++) {
+        if (flash_address >= flash_sector_addresses[sector] && flash_address < flash_sector_addresses[sector + 1]) {
+            return sector;
+        }
+    }
+
+    return FLASH_SECTOR_INVALID;
+}
+
+/**
+ * \brief       Функция, которая возвращает адрес начала сектора flash памяти.
+ * \param[in]   number_of_sector: Номер сектора flash памяти STM32F407xx.
+ * \return      flash_address: Адрес начала сектора.
+ */
+uint32_t
+get_flash_sector_address(uint32_t number_of_sector) {
+    return flash_sector_addresses[number_of_sector];
+}
+
+/**
+ * \brief       Функция, которая возвращает размер сектора flash памяти.
+ * \param[in]   number_of_sector: Номер сектора flash памяти STM32F407xx.
+ * \return      sector_size: Размер сектора в байтах.
+ */
+uint32_t
+get_flash_sector_size(uint32_t number_of_sector) {
+    return flash_sector_addresses[number_of_sector + 1] - flash_sector_addresses[number_of_sector];
+}
+
+/**
+ * \brief       Функция, которая проверяет, что область flash памяти стерта (все байты равны 0xFF).
+ * \param[in]   flash_address: Адрес начала области, выровненный по 4 байтам.
+ * \param[in]   size: Размер области в байтах, кратный 4.
+ * \return      result: TRUE (область стерта), FALSE (в области есть записанные данные).
  */
 uint8_t
-erase_flash(uint32_t number_of_sector) {
+is_flash_erased(uint32_t flash_address, uint32_t size) {
+    const uint32_t* flash_words = (const uint32_t*)flash_address;
+
+    for (uint32_t i = 0; i < size / 4; i++) {
+        if (flash_words[i] != 0xFFFFFFFFU) {
+            return FALSE;
+        }
+    }
+
+    return TRUE;
+}
+
+/**
+ * \brief       Функция, стирает несколько идущих подряд секторов flash памяти.
+ * \param[in]   first_sector: Номер первого сектора flash памяти STM32F407xx для стирания.
+ * \param[in]   number_of_sectors: Число секторов.
+ * \return      result: Результат стирания: TRUE (flash память секторов успешно очищена),
+ *             FALSE (во время стирания flash памяти произошла ошибка).
+ */
+static uint8_t
+erase_flash_sectors(uint32_t first_sector, uint32_t number_of_sectors) {
     HAL_StatusTypeDef hal_status;
 
     uint8_t result = FALSE;
@@ -50,7 +129,7 @@ erase_flash(uint32_t number_of_sector) {
         hal_status = HAL_FLASH_Unlock();
 
         if (hal_status != HAL_OK) {
-            printf("Ошибка разблокировки памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_UNLOCK_ERROR, "Ошибка разблокировки памяти\n");
             break;
         }
 
@@ -60,15 +139,15 @@ erase_flash(uint32_t number_of_sector) {
 
         /* Заполнение структуры */
         EraseInitStruct.TypeErase = FLASH_TYPEERASE_SECTORS;
-        EraseInitStruct.Sector = number_of_sector;
-        EraseInitStruct.NbSectors = 1;
-        EraseInitStruct.VoltageRange = FLASH_VOLTAGE_RANGE_3;
+        EraseInitStruct.Sector = first_sector;
+        EraseInitStruct.NbSectors = number_of_sectors;
+        EraseInitStruct.VoltageRange = FLASH_PROGRAM_VOLTAGE_RANGE;
 
         /* Стирание сектора памяти */
         hal_status = HAL_FLASHEx_Erase(&EraseInitStruct, &sector_error);
 
         if (hal_status != HAL_OK) {
-            printf("Ошибка стирания памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_ERASE_SECTOR_ERROR, "Ошибка стирания памяти\n");
             break;
         }
 
@@ -76,23 +155,91 @@ erase_flash(uint32_t number_of_sector) {
         hal_status = HAL_FLASH_Lock();
 
         if (hal_status != HAL_OK) {
-            printf("Ошибка блокировки памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_LOCK_ERROR, "Ошибка блокировки памяти\n");
             break;
         }
 
-        printf("Стирание памяти - успешно!\n");
+        LOG_INFO(LOG_EVENT_FLASH_ERASE_DONE, "Стирание памяти - успешно!\n");
         result = TRUE;
     } while (0);
 
     return result;
 }
 
+/**
+ * \brief       Функция, стирает определенный сектор flash памяти.
+ * \param[in]   number_of_sector: Номер сектора flash памяти STM32F407xx для стирания.
+ * \return      result: Результат стирания: TRUE (flash память сектора успешно очищена),
+ *             FALSE (во время стирания flash памяти произошла ошибка).
+ */
+uint8_t
+erase_flash(uint32_t number_of_sector) {
+    return erase_flash_sectors(number_of_sector, 1);
+}
+
+/**
+ * \brief       Функция, стирает всю область пользовательского приложения
+ *              (сектора с \ref APP_FIRST_SECTOR по \ref APP_LAST_SECTOR).
+ * \return      result: Результат стирания: TRUE (область успешно очищена),
+ *             FALSE (во время стирания flash памяти произошла ошибка).
+ */
+uint8_t
+erase_app_flash(void) {
+    return erase_flash_sectors(APP_FIRST_SECTOR, APP_LAST_SECTOR - APP_FIRST_SECTOR + 1U);
+}
+
+/**
+ * \brief       Функция, стирает сектора одного слота пользовательского приложения.
+ * \param[in]   slot_address: Адрес начала слота (\ref APP_SLOT_A_ADDRESS или \ref APP_SLOT_B_ADDRESS).
+ * \return      result: Результат стирания: TRUE (слот успешно очищен),
+ *             FALSE (во время стирания flash памяти произошла ошибка).
+ */
+uint8_t
+erase_app_slot(uint32_t slot_address) {
+    uint32_t first_sector = get_flash_sector(slot_address);
+    uint32_t last_sector = get_flash_sector(slot_address + get_app_slot_size(slot_address) - 1U);
+
+    return erase_flash_sectors(first_sector, last_sector - first_sector + 1U);
+}
+
+/**
+ * \brief       Функция, которая проверяет записанный блок flash памяти по CRC32.
+ * \param[in]  *data: Указатель на данные, которые были записаны, выровненный по 4 байтам.
+ * \param[in]  data_len: Размер данных.
+ * \param[in]  flash_address: Адрес flash памяти, в который записаны данные.
+ * \return     result: Результат проверки: TRUE (данные во flash совпадают), FALSE (данные отличаются)
+ */
+static uint8_t
+verify_flash_block(uint8_t* data, uint32_t data_len, uint32_t flash_address) {
+    uint32_t number_of_words = data_len / 4;
+
+    /* Кэш данных flash памяти может хранить значения, прочитанные до записи */
+    if (FLASH->ACR & FLASH_ACR_DCEN) {
+        __HAL_FLASH_DATA_CACHE_DISABLE();
+        __HAL_FLASH_DATA_CACHE_RESET();
+        __HAL_FLASH_DATA_CACHE_ENABLE();
+    }
+
+    uint32_t data_crc = HAL_CRC_Calculate(&hcrc, (uint32_t*)data, number_of_words);
+    uint32_t flash_crc = HAL_CRC_Calculate(&hcrc, (uint32_t*)flash_address, number_of_words);
+
+    /* Байты, которые не составляют целое слово, сравниваем напрямую */
+    if (data_crc != flash_crc
+        || memcmp(&data[number_of_words * 4], (const uint8_t*)(flash_address + number_of_words * 4), data_len % 4) != 0) {
+        return FALSE;
+    }
+
+    return TRUE;
+}
+
 /**
  * \brief       Функция которая записывает блок данных в flash память.
  * \note        Эта функция используется для записи расшифрованных блоков данных из пакета типа "data".
- * \param[in]  *data: Указатель на блок данных для записи.
+ *              Данные записываются словами ширины \ref FLASH_PROGRAM_SIZE (зависит от \ref FLASH_PROGRAM_VOLTAGE_RANGE),
+ *              после записи блок один раз проверяется по CRC32.
+ * \param[in]  *data: Указатель на блок данных для записи, выровненный по 4 байтам.
  * \param[in]  data_len: Размер блока данных.
- * \param[in]  flash_address: Адрес flash памяти, в который происходит запись.
+ * \param[in]  flash_address: Адрес flash памяти, в который происходит запись, выровненный по \ref FLASH_PROGRAM_SIZE.
  * \return     result: Результат записи: TRUE (блок данных записан успешно), FALSE (ошибка записи)
  */
 uint8_t
@@ -102,7 +249,7 @@ write_data_block_to_flash(uint8_t* data, uint32_t data_len, uint32_t flash_addre
 
     do {
         if (data == NULL) {
-            printf("Пустой указатель\n");
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
             break;
         }
 
@@ -110,25 +257,42 @@ write_data_block_to_flash(uint8_t* data, uint32_t data_len, uint32_t flash_addre
         hal_status = HAL_FLASH_Unlock();
 
         if (hal_status != HAL_OK) {
-            printf("Ошибка разблокировки памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_UNLOCK_ERROR, "Ошибка разблокировки памяти\n");
             break;
         }
 
-        /* Запись блока во flash */
-        for (uint32_t i = 0; i < data_len; i++) {
-            hal_status = HAL_FLASH_Program(FLASH_TYPEPROGRAM_BYTE, (flash_address + i), data[i]);
+        uint32_t offset = 0;
 
-            if (hal_status != HAL_OK) {
-                printf("Ошибка при записи байта в память\n");
-                break;
-            }
+        /* Запись блока во flash словами */
+        for (; offset + FLASH_PROGRAM_SIZE <= data_len && hal_status == HAL_OK; offset += FLASH_PROGRAM_SIZE) {
+            uint64_t program_data = 0;
+
+            memcpy(&program_data, &data[offset], FLASH_PROGRAM_SIZE);
+            hal_status = HAL_FLASH_Program(FLASH_PROGRAM_TYPE, flash_address + offset, program_data);
+        }
+
+        /* Остаток блока, который не составляет целое слово, записываем побайтно */
+        for (; offset < data_len && hal_status == HAL_OK; offset++) {
+            hal_status = HAL_FLASH_Program(FLASH_TYPEPROGRAM_BYTE, flash_address + offset, data[offset]);
         }
 
+        HAL_StatusTypeDef program_status = hal_status;
+
         /* Блокировка доступа к системной памяти */
         hal_status = HAL_FLASH_Lock();
 
+        if (program_status != HAL_OK) {
+            LOG_ERROR(LOG_EVENT_FLASH_WORD_WRITE_ERROR, "Ошибка при записи слова в память\n");
+            break;
+        }
+
         if (hal_status != HAL_OK) {
-            printf("Ошибка блокировки памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_LOCK_ERROR, "Ошибка блокировки памяти\n");
+            break;
+        }
+
+        if (!verify_flash_block(data, data_len, flash_address)) {
+            LOG_ERROR(LOG_EVENT_FLASH_BLOCK_CRC_ERROR, "Ошибка проверки CRC32 записанного блока\n");
             break;
         }
 
@@ -167,21 +331,19 @@ check_settings(void) {
 }
 
 /**
- * \brief      Функция, которая производит сохранение настроек во flash память МК
- * \note       Настройки представляют собой значения uint32_t которые друг за другом располагаются в памяти:
- *             "ключ шифрования прошивки" (изменяем), "ключ шифрования для смены ключа шифрования прошивки" (неизменяем), CRC32 (для проверки)
- * \param[in]  key: Ключ шифрования прошивки.
- * \return     result: Результат записи настроек: TRUE (настройки успешно записаны), FALSE (произошла ошибка записи настроек)
+ * \brief      Функция, которая стирает сектор настроек и записывает в него настройки и записи журнала загрузки.
+ * \param[in]  *settings_buffer: Указатель на \ref NUMBER_OF_SETTINGS_WORDS слов настроек (последнее - CRC32).
+ * \param[in]  *records: Указатель на записи журнала загрузки в порядке их добавления.
+ * \param[in]  number_of_records: Число записей журнала.
+ * \return     result: Результат записи: TRUE (сектор записан), FALSE (произошла ошибка стирания или записи)
  */
-uint8_t
-set_settings(uint32_t key) {
+static uint8_t
+write_settings_sector(const uint32_t* settings_buffer, const boot_record_t* records, uint32_t number_of_records) {
     HAL_StatusTypeDef hal_status;
     uint8_t result = FALSE;
-    uint32_t settings_buffer[NUMBER_OF_SETTINGS_WORDS];
     uint32_t settings_address_offset = 0;
 
     do {
-        printf("Начинаю запись настроек по умолчанию во flash\n");
         /* Стираем весь сектор с настройками, только после стирания мы можем записать данные в него */
         uint8_t erase_succesfull = erase_flash(MEMORY_SECTOR_WITH_SETTINGS);
 
@@ -189,16 +351,10 @@ set_settings(uint32_t key) {
             break;
         }
 
-        /* Формируем буфер с настройками для записи во flash */
-        settings_buffer[0] = key;
-        settings_buffer[1] = DEFAULT_SECRET_ENCRYPTION_KEY;
-        settings_buffer[2] = HAL_CRC_Calculate(&hcrc, settings_buffer, NUMBER_OF_SETTINGS_WORDS - 1);
-
-        /* Записываем во flash память настройки по умолчанию */
         hal_status = HAL_FLASH_Unlock();
 
         if (hal_status != HAL_OK) {
-            printf("Ошибка разблокировки памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_UNLOCK_ERROR, "Ошибка разблокировки памяти\n");
             break;
         }
 
@@ -208,25 +364,282 @@ set_settings(uint32_t key) {
                                            MEMORY_ADDRESS_WITH_SETTINGS + settings_address_offset, settings_buffer[i]);
 
             if (hal_status != HAL_OK) {
-                printf("Ошибка при записи слова настроек в память\n");
+                LOG_ERROR(LOG_EVENT_SETTINGS_WRITE_ERROR, "Ошибка при записи слова настроек в память\n");
                 break;
             }
 
             settings_address_offset += FLASH_BLOCK_OFFSET;
         }
 
+        HAL_StatusTypeDef program_status = hal_status;
+
         /* Блокировка доступа к системной памяти */
         hal_status = HAL_FLASH_Lock();
 
+        if (program_status != HAL_OK) {
+            break;
+        }
+
         if (hal_status != HAL_OK) {
-            printf("Ошибка блокировки памяти\n");
+            LOG_ERROR(LOG_EVENT_FLASH_LOCK_ERROR, "Ошибка блокировки памяти\n");
             break;
         }
 
-        printf("Запись настроек в память - успешно!\n");
+        /* Записи журнала загрузки переносим в начало журнала */
+        uint8_t write_status = TRUE;
+
+        for (uint32_t i = 0; i < number_of_records && write_status; i++) {
+            write_status = write_data_block_to_flash((uint8_t*)&records[i], sizeof(boot_record_t),
+                                                     BOOT_JOURNAL_ADDRESS + i * sizeof(boot_record_t));
+        }
+
+        if (!write_status) {
+            LOG_ERROR(LOG_EVENT_JOURNAL_WRITE_ERROR, "Ошибка при записи журнала загрузки в память\n");
+            break;
+        }
 
         result = TRUE;
     } while (0);
 
     return result;
 }
+
+/**
+ * \brief      Функция, которая производит сохранение настроек во flash память МК
+ * \note       Настройки представляют собой значения uint32_t которые друг за другом располагаются в памяти:
+ *             "ключ шифрования прошивки" (изменяем), "ключ шифрования для смены ключа шифрования прошивки" (неизменяем), CRC32 (для проверки)
+ *             Записи журнала загрузки активного слота и слота для отката сохраняются.
+ * \param[in]  key: Ключ шифрования прошивки.
+ * \return     result: Результат записи настроек: TRUE (настройки успешно записаны), FALSE (произошла ошибка записи настроек)
+ */
+uint8_t
+set_settings(uint32_t key) {
+    uint8_t result = FALSE;
+    uint32_t settings_buffer[NUMBER_OF_SETTINGS_WORDS];
+    boot_record_t records[2];
+
+    do {
+        LOG_INFO(LOG_EVENT_DEFAULT_SETTINGS_WRITE, "Начинаю запись настроек по умолчанию во flash\n");
+
+        /* Формируем буфер с настройками для записи во flash */
+        settings_buffer[0] = key;
+        settings_buffer[1] = DEFAULT_SECRET_ENCRYPTION_KEY;
+        settings_buffer[2] = HAL_CRC_Calculate(&hcrc, settings_buffer, NUMBER_OF_SETTINGS_WORDS - 1);
+
+        /* Записываем во flash память настройки и журнал загрузки, который сотрется вместе с сектором */
+        uint32_t number_of_records = get_boot_records(records);
+
+        if (!write_settings_sector(settings_buffer, records, number_of_records)) {
+            break;
+        }
+
+        LOG_INFO(LOG_EVENT_SETTINGS_WRITE_DONE, "Запись настроек в память - успешно!\n");
+
+        result = TRUE;
+    } while (0);
+
+    return result;
+}
+
+/**
+ * \brief       Функция, которая возвращает размер слота пользовательского приложения.
+ * \param[in]   slot_address: Адрес начала слота (\ref APP_SLOT_A_ADDRESS или \ref APP_SLOT_B_ADDRESS).
+ * \return      slot_size: Размер слота в байтах.
+ */
+uint32_t
+get_app_slot_size(uint32_t slot_address) {
+    if (slot_address == APP_SLOT_A_ADDRESS) {
+        return APP_SLOT_B_ADDRESS - APP_SLOT_A_ADDRESS;
+    }
+
+    return APP_FLASH_END_ADDRESS - APP_SLOT_B_ADDRESS;
+}
+
+/**
+ * \brief       Функция, которая возвращает адрес другого слота пользовательского приложения.
+ * \param[in]   slot_address: Адрес начала слота.
+ * \return      other_slot_address: Адрес начала второго слота.
+ */
+uint32_t
+get_other_app_slot(uint32_t slot_address) {
+    return (slot_address == APP_SLOT_A_ADDRESS) ? APP_SLOT_B_ADDRESS : APP_SLOT_A_ADDRESS;
+}
+
+/**
+ * \brief       Функция, которая проверяет прошивку в слоте пользовательского приложения.
+ * \note        Таблица векторов прошивки должна начинаться с указателя стека в RAM или CCMRAM и адреса обработчика
+ *              сброса внутри слота. Если размер прошивки известен из журнала загрузки, проверяется и ее CRC32.
+ * \param[in]   slot_address: Адрес начала слота.
+ * \param[in]   image_size: Размер прошивки, дополненной до целого числа блоков, или 0, если он неизвестен.
+ * \param[in]   image_crc: CRC32 прошивки из журнала загрузки.
+ * \return      result: TRUE (прошивку можно запускать), FALSE (слот стерт или прошивка повреждена).
+ */
+uint8_t
+is_app_slot_valid(uint32_t slot_address, uint32_t image_size, uint32_t image_crc) {
+    uint32_t stack_pointer = *(__IO uint32_t*)slot_address;
+    uint32_t reset_handler = *(__IO uint32_t*)(slot_address + FLASH_BLOCK_OFFSET);
+    uint32_t slot_size = get_app_slot_size(slot_address);
+
+    /* Стек растет вниз, поэтому указатель стека может указывать на конец RAM */
+    if ((stack_pointer <= SRAM1_BASE || stack_pointer > SRAM2_BASE + 0x4000U)
+        && (stack_pointer <= CCMDATARAM_BASE || stack_pointer > CCMDATARAM_END + 1U)) {
+        return FALSE;
+    }
+
+    if (reset_handler < slot_address || reset_handler >= slot_address + slot_size) {
+        return FALSE;
+    }
+
+    if (image_size == 0) {
+        return TRUE;
+    }
+
+    if (image_size > slot_size) {
+        return FALSE;
+    }
+
+    /* С нулевым ключом CRC32 вычисляется по данным flash памяти без шифрования */
+    return (calculate_encrypted_flash_crc(slot_address, image_size, 0) == image_crc) ? TRUE : FALSE;
+}
+
+/**
+ * \brief       Функция, которая проверяет запись журнала загрузки по CRC32.
+ * \param[in]   *record: Указатель на запись журнала.
+ * \return      result: TRUE (запись записана целиком), FALSE (запись повреждена или прервана).
+ */
+static uint8_t
+is_boot_record_valid(const boot_record_t* record) {
+    uint32_t number_of_words = sizeof(boot_record_t) / 4 - 1;
+
+    if (record->magic != BOOT_RECORD_MAGIC) {
+        return FALSE;
+    }
+
+    return (HAL_CRC_Calculate(&hcrc, (uint32_t*)record, number_of_words) == record->crc) ? TRUE : FALSE;
+}
+
+/**
+ * \brief       Функция, которая находит в журнале загрузки записи активного слота и слота для отката.
+ * \note        Активный слот - слот последней записи с верной CRC32, слот для отката - слот последней записи
+ *              с другим адресом слота перед ней.
+ * \param[out]  *records: Указатель на массив из двух записей: записи возвращаются в порядке их добавления,
+ *              последняя - запись активного слота.
+ * \return      number_of_records: Число найденных записей: 0 (журнал пуст), 1 (отката нет) или 2.
+ */
+uint32_t
+get_boot_records(boot_record_t* records) {
+    uint32_t number_of_records = 0;
+
+    for (uint32_t address = BOOT_JOURNAL_ADDRESS; address + sizeof(boot_record_t) <= BOOT_JOURNAL_END_ADDRESS;
+         address += sizeof(boot_record_t)) {
+        const boot_record_t* record = (const boot_record_t*)address;
+
+        /* Журнал записывается подряд, дальше стертой записи записей нет */
+        if (is_flash_erased(address, sizeof(boot_record_t))) {
+            break;
+        }
+
+        if (!is_boot_record_valid(record)) {
+            continue;
+        }
+
+        if (number_of_records == 0) {
+            number_of_records = 1;
+        } else if (record->slot_address != records[number_of_records - 1].slot_address) {
+            /* Активный слот сменился: прежний становится слотом для отката */
+            records[0] = records[number_of_records - 1];
+            number_of_records = 2;
+        }
+
+        records[number_of_records - 1] = *record;
+    }
+
+    return number_of_records;
+}
+
+/**
+ * \brief       Функция, которая определяет активный слот пользовательского приложения по журналу загрузки.
+ * \note        Если журнал пуст (загрузчик обновлен с версии без слотов), активным считается слот A,
+ *              в котором приложение располагалось раньше.
+ * \param[out]  *record: Указатель на запись активного слота, если она есть (может быть NULL).
+ * \return      slot_address: Адрес начала активного слота.
+ */
+uint32_t
+get_active_app_slot(boot_record_t* record) {
+    boot_record_t records[2];
+    uint32_t number_of_records = get_boot_records(records);
+
+    if (number_of_records == 0) {
+        if (record != NULL) {
+            memset(record, 0, sizeof(boot_record_t));
+        }
+
+        return APP_SLOT_A_ADDRESS;
+    }
+
+    if (record != NULL) {
+        *record = records[number_of_records - 1];
+    }
+
+    return records[number_of_records - 1].slot_address;
+}
+
+/**
+ * \brief       Функция, которая добавляет запись в журнал загрузки, делая слот активным.
+ * \note        Запись программируется одной операцией: до записи ее последнего слова (CRC32) действует
+ *              прежняя запись. Если журнал заполнен, сектор настроек стирается и записывается заново
+ *              с настройками и записями активного слота и слота для отката, затем добавляется новая запись.
+ * \param[in]   slot_address: Адрес начала слота, который становится активным.
+ * \param[in]   image_size: Размер прошивки в слоте, дополненной до целого числа блоков.
+ * \param[in]   image_crc: CRC32 прошивки в слоте без шифрования.
+ * \return      result: Результат: TRUE (слот активен), FALSE (ошибка записи flash памяти).
+ */
+uint8_t
+add_boot_record(uint32_t slot_address, uint32_t image_size, uint32_t image_crc) {
+    boot_record_t records[2];
+    uint32_t number_of_records = get_boot_records(records);
+    uint32_t record_address = BOOT_JOURNAL_ADDRESS;
+
+    /* Новая запись добавляется после последней записанной (в том числе поврежденной) */
+    while (record_address + sizeof(boot_record_t) <= BOOT_JOURNAL_END_ADDRESS
+           && !is_flash_erased(record_address, sizeof(boot_record_t))) {
+        record_address += sizeof(boot_record_t);
+    }
+
+    if (record_address + sizeof(boot_record_t) > BOOT_JOURNAL_END_ADDRESS) {
+        LOG_INFO(LOG_EVENT_JOURNAL_FULL, "Журнал загрузки заполнен, переписываю сектор настроек\n");
+
+        /* Настройки переносим как есть: ключ шифрования может быть еще не прочитан */
+        uint32_t settings_buffer[NUMBER_OF_SETTINGS_WORDS];
+        memcpy(settings_buffer, (const void*)MEMORY_ADDRESS_WITH_SETTINGS, sizeof(settings_buffer));
+
+        if (!write_settings_sector(settings_buffer, records, number_of_records)) {
+            return FALSE;
+        }
+
+        record_address = BOOT_JOURNAL_ADDRESS + number_of_records * sizeof(boot_record_t);
+    }
+
+    boot_record_t record = {0};
+    record.magic = BOOT_RECORD_MAGIC;
+    record.sequence = (number_of_records == 0) ? 1U : records[number_of_records - 1].sequence + 1U;
+    record.slot_address = slot_address;
+    record.image_size = image_size;
+    record.image_crc = image_crc;
+    record.crc = HAL_CRC_Calculate(&hcrc, (uint32_t*)&record, sizeof(boot_record_t) / 4 - 1);
+
+    return write_data_block_to_flash((uint8_t*)&record, sizeof(boot_record_t), record_address);
+}
+
+/**
+ * \brief       Функция, которая очищает журнал загрузки, сохраняя настройки.
+ * \note        После очистки активным считается слот A (см. \ref get_active_app_slot).
+ * \return      result: Результат: TRUE (журнал очищен), FALSE (ошибка стирания или записи flash памяти).
+ */
+uint8_t
+clear_boot_records(void) {
+    uint32_t settings_buffer[NUMBER_OF_SETTINGS_WORDS];
+    memcpy(settings_buffer, (const void*)MEMORY_ADDRESS_WITH_SETTINGS, sizeof(settings_buffer));
+
+    return write_settings_sector(settings_buffer, NULL, 0);
+}
@@ -33,57 +33,239 @@
 
 #include "bootloader/bootloader_uart.h"
 
-//TODO: продумать этот момент, не явно всегда 12 байт
+#if UART_RX_DMA
+/* Кольцевой буфер, в который DMA непрерывно записывает принятые байты */
+static uint8_t usart_rx_buffer[UART_RX_BUFFER_SIZE];
+/* Индекс следующего непрочитанного байта кольцевого буфера */
+static uint32_t usart_rx_read_index = 0;
+#endif
+
 /**
- * \brief       Функция, посылает по USART пакет типа "response".
- * \param[in]   response_data: Данные, которые необходимо послать в пакете "response".
+ * \brief       Функция, которая запускает прием по USART в кольцевой буфер через DMA.
+ * \note        Непрочитанные байты буфера отбрасываются. Если \ref UART_RX_DMA выключен, функция ничего не делает.
  */
 void
-usart_send_response(uint32_t response_data) {
-    uint8_t response_buff_u8[RESPONSE_SIZE];
-    uint32_t response_word_plus_data[(RESPONSE_SIZE / 4) - 1];
-    uint32_t response_crc = 0;
+usart_start_reception(void) {
+#if UART_RX_DMA
+    usart_rx_read_index = 0;
+    HAL_UART_Receive_DMA(&huart3, usart_rx_buffer, UART_RX_BUFFER_SIZE);
+#endif
+}
+
+/**
+ * \brief       Функция, которая останавливает прием по USART через DMA перед переходом в пользовательское приложение.
+ */
+void
+usart_stop_reception(void) {
+#if UART_RX_DMA
+    HAL_UART_DMAStop(&huart3);
+#endif
+}
+
+#if UART_RX_DMA
+/**
+ * \brief       Функция, которую HAL вызывает при ошибке USART (шум, ошибка кадра, переполнение).
+ * \note        HAL останавливает прием через DMA, поэтому перезапускаем его. Поврежденные пакеты
+ *              Host приложение передаст заново по NACK.
+ * \param[in]   huart: Указатель на структуру USART, в котором произошла ошибка.
+ */
+void
+HAL_UART_ErrorCallback(UART_HandleTypeDef* huart) {
+    if (huart == &huart3) {
+        usart_start_reception();
+    }
+}
+#endif
+
+/**
+ * \brief       Функция, которая принимает заданное число байт по USART.
+ * \note        При \ref UART_RX_DMA байты берутся из кольцевого буфера DMA, иначе принимаются опросом HAL_UART_Receive.
+ * \param[out]  *data: Буфер для принятых байт.
+ * \param[in]   size: Число байт.
+ * \param[in]   timeout: Время ожидания всех байт, мс (HAL_MAX_DELAY - без ограничения).
+ * \return      status: HAL_OK (байты приняты), HAL_TIMEOUT (время ожидания истекло), иначе ошибка.
+ */
+static HAL_StatusTypeDef
+usart_receive(uint8_t* data, uint16_t size, uint32_t timeout) {
+#if UART_RX_DMA
+    uint32_t start_tick = HAL_GetTick();
+
+    for (uint16_t i = 0; i < size; i++) {
+        /* Индекс, по которому DMA запишет следующий байт */
+        uint32_t write_index = (UART_RX_BUFFER_SIZE - __HAL_DMA_GET_COUNTER(huart3.hdmarx)) % UART_RX_BUFFER_SIZE;
+
+        while (usart_rx_read_index == write_index) {
+            if (timeout != HAL_MAX_DELAY && HAL_GetTick() - start_tick >= timeout) {
+                return HAL_TIMEOUT;
+            }
+            write_index = (UART_RX_BUFFER_SIZE - __HAL_DMA_GET_COUNTER(huart3.hdmarx)) % UART_RX_BUFFER_SIZE;
+        }
+
+        data[i] = usart_rx_buffer[usart_rx_read_index];
+        usart_rx_read_index = (usart_rx_read_index + 1U) % UART_RX_BUFFER_SIZE;
+    }
+
+    return HAL_OK;
+#else
+    return HAL_UART_Receive(&huart3, data, size, timeout);
+#endif
+}
+
+/**
+ * \brief       Функция, посылает по USART пакет из 12 байт: начало пакета, 4 байта данных и CRC32.
+ * \note        Данные и CRC32 передаются в порядке little-endian. Пакет не завершается переводом строки:
+ *              Host приложение выделяет пакеты из потока по началу пакета и CRC32.
+ * \param[in]   packet_word: Начало пакета (\ref response_word, \ref ack_word, \ref nack_word, \ref ptim_word).
+ * \param[in]   packet_data: Данные, которые необходимо послать в пакете.
+ */
+static void
+usart_send_packet(const char* packet_word, uint32_t packet_data) {
+    uint8_t packet_buff_u8[RESPONSE_SIZE];
+    uint32_t packet_word_plus_data[(RESPONSE_SIZE / 4) - 1];
+    uint32_t packet_crc = 0;
 
     /* Формируем начало посылки */
-    response_buff_u8[0] = response_word[0];
-    response_buff_u8[1] = response_word[1];
-    response_buff_u8[2] = response_word[2];
-    response_buff_u8[3] = response_word[3];
+    packet_buff_u8[0] = packet_word[0];
+    packet_buff_u8[1] = packet_word[1];
+    packet_buff_u8[2] = packet_word[2];
+    packet_buff_u8[3] = packet_word[3];
 
     /* Формируем данные посылки */
-    response_buff_u8[4] = response_data & 0xFF;
-    response_buff_u8[5] = (response_data >> 8) & 0xFF;
-    response_buff_u8[6] = (response_data >> 16) & 0xFF;
-    response_buff_u8[7] = (response_data >> 24) & 0xFF;
+    packet_buff_u8[4] = packet_data & 0xFF;
+    packet_buff_u8[5] = (packet_data >> 8) & 0xFF;
+    packet_buff_u8[6] = (packet_data >> 16) & 0xFF;
+    packet_buff_u8[7] = (packet_data >> 24) & 0xFF;
+
+    packet_word_plus_data[0] = four_uint8t_to_one_uint32t(&packet_buff_u8[0]);
+    packet_word_plus_data[1] = four_uint8t_to_one_uint32t(&packet_buff_u8[4]);
+
+    packet_crc = HAL_CRC_Calculate(&hcrc, packet_word_plus_data, (RESPONSE_SIZE / 4) - 1);
+
+    /* Формируем CRC32 посылки */
+    packet_buff_u8[8] = packet_crc & 0xFF;
+    packet_buff_u8[9] = (packet_crc >> 8) & 0xFF;
+    packet_buff_u8[10] = (packet_crc >> 16) & 0xFF;
+    packet_buff_u8[11] = (packet_crc >> 24) & 0xFF;
 
-    response_word_plus_data[0] = four_uint8t_to_one_uint32t(&response_buff_u8[0]);
-    response_word_plus_data[1] = four_uint8t_to_one_uint32t(&response_buff_u8[4]);
+    HAL_UART_Transmit(&huart3, packet_buff_u8, RESPONSE_SIZE, HAL_MAX_DELAY);
+}
+
+/**
+ * \brief       Функция, посылает по USART пакет типа "loge" с событием журнала.
+ * \note        Пакет: \ref loge_word + 4 байта события (номер события - младшие 16 бит, уровень журнала - следующие
+ *              8 бит, число аргументов - старшие 8 бит) + аргументы по 4 байта + CRC32. Числа передаются в порядке
+ *              little-endian, как в \ref usart_send_packet. Текст события Host приложение берет по его номеру.
+ * \param[in]   level: Уровень журнала события.
+ * \param[in]   event: Номер события.
+ * \param[in]   number_of_arguments: Число аргументов события, не больше \ref LOG_MAX_ARGUMENTS.
+ * \param[in]   arguments: Указатель на аргументы события.
+ */
+void
+usart_send_log_event(log_level_t level, log_event_t event, uint32_t number_of_arguments, const uint32_t* arguments) {
+    uint8_t packet_buff_u8[LOGE_MAX_SIZE];
+    uint32_t packet_words[(LOGE_MAX_SIZE / 4) - 1];
+
+    if (number_of_arguments > LOG_MAX_ARGUMENTS) {
+        number_of_arguments = LOG_MAX_ARGUMENTS;
+    }
+
+    uint32_t number_of_words = 2 + number_of_arguments;
+    uint32_t packet_size = (number_of_words + 1) * 4;
+    uint32_t event_data = (uint32_t) event | ((uint32_t) level << 16) | (number_of_arguments << 24);
 
-    response_crc = HAL_CRC_Calculate(&hcrc, response_word_plus_data, (RESPONSE_SIZE / 4) - 1);
+    /* Формируем начало посылки */
+    packet_buff_u8[0] = loge_word[0];
+    packet_buff_u8[1] = loge_word[1];
+    packet_buff_u8[2] = loge_word[2];
+    packet_buff_u8[3] = loge_word[3];
+
+    /* Формируем событие и его аргументы */
+    for (uint32_t word = 1; word < number_of_words; word++) {
+        uint32_t word_data = (word == 1) ? event_data : arguments[word - 2];
+
+        packet_buff_u8[word * 4] = word_data & 0xFF;
+        packet_buff_u8[word * 4 + 1] = (word_data >> 8) & 0xFF;
+        packet_buff_u8[word * 4 + 2] = (word_data >> 16) & 0xFF;
+        packet_buff_u8[word * 4 + 3] = (word_data >> 24) & 0xFF;
+    }
+
+    for (uint32_t word = 0; word < number_of_words; word++) {
+        packet_words[word] = four_uint8t_to_one_uint32t(&packet_buff_u8[word * 4]);
+    }
+
+    uint32_t packet_crc = HAL_CRC_Calculate(&hcrc, packet_words, number_of_words);
 
     /* Формируем CRC32 посылки */
-    response_buff_u8[8] = response_crc & 0xFF;
-    response_buff_u8[9] = (response_crc >> 8) & 0xFF;
-    response_buff_u8[10] = (response_crc >> 16) & 0xFF;
-    response_buff_u8[11] = (response_crc >> 24) & 0xFF;
+    packet_buff_u8[packet_size - 4] = packet_crc & 0xFF;
+    packet_buff_u8[packet_size - 3] = (packet_crc >> 8) & 0xFF;
+    packet_buff_u8[packet_size - 2] = (packet_crc >> 16) & 0xFF;
+    packet_buff_u8[packet_size - 1] = (packet_crc >> 24) & 0xFF;
 
-    HAL_UART_Transmit(&huart3, response_buff_u8, RESPONSE_SIZE, HAL_MAX_DELAY);
-    HAL_UART_Transmit(&huart3, (uint8_t*)"\n", 1, HAL_MAX_DELAY);
+    HAL_UART_Transmit(&huart3, packet_buff_u8, packet_size, HAL_MAX_DELAY);
+}
+
+/**
+ * \brief       Функция, посылает по USART пакет типа "response".
+ * \param[in]   response_data: Данные, которые необходимо послать в пакете "response".
+ */
+void
+usart_send_response(uint32_t response_data) {
+    usart_send_packet(response_word, response_data);
 }
 
 /**
  * \brief       Функция, которая отправляет по USART пакет типа "status".
- * \param[in]  status: Одно из значений типа \ref status_t.
+ * \param[in]   status: Одно из значений типа \ref status_t.
+ * \param[in]   status_data: Данные пакета. При передаче прошивки в ACK - число записанных блоков,
+ *              в NACK - битовая маска принятых блоков окна. В остальных случаях 0.
  */
 void
-usart_send_status(status_t status) {
-    /* Учитывая нуль терминатор - + 1 байт */
+usart_send_status(status_t status, uint32_t status_data) {
     if (status == STATUS_ACK) {
-        HAL_UART_Transmit(&huart3, (uint8_t*)ack_word, NUMBER_OF_BYTES_ACK + 1, HAL_MAX_DELAY);
+        usart_send_packet(ack_word, status_data);
     } else {
-        HAL_UART_Transmit(&huart3, (uint8_t*)nack_word, NUMBER_OF_BYTES_NACK + 1, HAL_MAX_DELAY);
+        usart_send_packet(nack_word, status_data);
     }
-    HAL_UART_Transmit(&huart3, (uint8_t*)"\n", 1, HAL_MAX_DELAY);
+}
+
+/**
+ * \brief       Функция, которая отправляет по USART пакет типа "ptim" со временем записи окна во flash.
+ * \note        Пакет передается перед ACK окна. По нему Host приложение подстраивает темп передачи под скорость
+ *              записи flash памяти.
+ * \param[in]   program_time_us: Время распаковки, расшифровки и записи окна во flash, мкс.
+ */
+void
+usart_send_program_time(uint32_t program_time_us) {
+    usart_send_packet(ptim_word, program_time_us);
+}
+
+/**
+ * \brief       Функция, которая принимает по USART пакет заданного типа.
+ * \note        Начало пакета ищется побайтно, поэтому после потери байт или помех на линии
+ *              синхронизация восстанавливается на следующем пакете.
+ * \param[in]   packet_word: Начало пакета, которое необходимо найти.
+ * \param[out]  *rx_buffer: Буфер для пакета, не меньше packet_size байт.
+ * \param[in]   packet_size: Полный размер пакета.
+ * \param[in]   timeout: Время ожидания каждой части пакета, мс.
+ * \return      status: Статус приема: HAL_OK (пакет принят), HAL_TIMEOUT (линия свободна), иначе ошибка.
+ */
+static HAL_StatusTypeDef
+usart_receive_packet(const char* packet_word, uint8_t* rx_buffer, size_t packet_size, uint32_t timeout) {
+    size_t word_size = strlen(packet_word);
+
+    HAL_StatusTypeDef receiving_status = usart_receive(rx_buffer, word_size, timeout);
+
+    /* Определяем начало пакета, сдвигаясь на один байт при несовпадении */
+    while (receiving_status == HAL_OK && !find_word(rx_buffer, packet_word)) {
+        memmove(rx_buffer, &rx_buffer[1], word_size - 1);
+        receiving_status = usart_receive(&rx_buffer[word_size - 1], 1, timeout);
+    }
+
+    if (receiving_status == HAL_OK) {
+        receiving_status = usart_receive(&rx_buffer[word_size], packet_size - word_size, timeout);
+    }
+
+    return receiving_status;
 }
 
 /**
@@ -103,15 +285,16 @@ usart_get_cmd(cmd_t* received_command) {
 
     do {
         if (received_command == NULL) {
-            printf("Пустой указатель\n");
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
             status = GET_CMD_ERROR_EMPTY_POINTER;
             break;
         }
 
-        int16_t receiving_status = HAL_UART_Receive(&huart3, &local_rx_buffer[index], CMD_SIZE, HAL_MAX_DELAY);
+        int16_t receiving_status = usart_receive(&local_rx_buffer[index], CMD_SIZE, HAL_MAX_DELAY);
 
         if (receiving_status != HAL_OK) {
-            printf("При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
             status = GET_CMD_ERROR_RECEIVING_STATUS;
             break;
         }
@@ -120,7 +303,7 @@ usart_get_cmd(cmd_t* received_command) {
         uint8_t cmd_word_finded = find_word(&local_rx_buffer[index], command_word);
 
         if (!cmd_word_finded) {
-            printf("Переданные данные не соответствуют пакету типа \"command\"\n");
+            LOG_ERROR(LOG_EVENT_NOT_COMMAND_PACKET, "Переданные данные не соответствуют пакету типа \"command\"\n");
             status = GET_CMD_ERROR_NOT_COMMAND;
             break;
         }
@@ -143,7 +326,7 @@ usart_get_cmd(cmd_t* received_command) {
             check_crc(local_rx_buffer, (NUMBER_OF_BYTES_COMMAND_WORD + NUMBER_OF_BYTES_COMMAND_DATA), crc_bytes);
 
         if (!crc_result) {
-            printf("Ошибка CRC, полученная и вычисленная сумма отличаются\n");
+            LOG_ERROR(LOG_EVENT_PACKET_CRC_ERROR, "Ошибка CRC, полученная и вычисленная сумма отличаются\n");
             status = GET_CMD_ERROR_CRC;
             break;
         }
@@ -155,12 +338,12 @@ usart_get_cmd(cmd_t* received_command) {
 
 /**
  * \brief       Функция, которая получает по USART пакет типа "header".
- * \param[out]  *firmware_size: Указатель на полученный размер прошивки.
+ * \param[out]  *header: Указатель на структуру с полученными данными пакета.
  * \return     status: Статус выполнения операции, если \ref GET_HEADER_OK, то пакет получен успешно,
  *             если что-то другое, произошла ошибка.
  */
 get_header_status_t
-usart_get_header(uint32_t* firmware_size) {
+usart_get_header(header_t* header) {
 
     /* Буфер, в который будут приходить данные */
     uint8_t local_rx_buffer[HEADER_SIZE];
@@ -170,16 +353,17 @@ usart_get_header(uint32_t* firmware_size) {
     get_header_status_t status = GET_HEADER_OK;
 
     do {
-        if (firmware_size == NULL) {
-            printf("Пустой указатель\n");
+        if (header == NULL) {
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
             status = GET_HEADER_ERROR_EMPTY_POINTER;
             break;
         }
 
-        int16_t receiving_status = HAL_UART_Receive(&huart3, &local_rx_buffer[index], HEADER_SIZE, HAL_MAX_DELAY);
+        int16_t receiving_status = usart_receive(&local_rx_buffer[index], HEADER_SIZE, HAL_MAX_DELAY);
 
         if (receiving_status != HAL_OK) {
-            printf("При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
             status = GET_HEADER_ERROR_RECEIVING_STATUS;
             break;
         }
@@ -189,15 +373,28 @@ usart_get_header(uint32_t* firmware_size) {
 
         if (!header_word_finded) {
             /* Переданные данные не соответствуют пакету типа "header" */
-            printf("Переданные данные не соответствуют пакету типа \"header\"\n");
+            LOG_ERROR(LOG_EVENT_NOT_HEADER_PACKET, "Переданные данные не соответствуют пакету типа \"header\"\n");
             status = GET_HEADER_ERROR_NOT_HEADER;
             break;
         }
 
         index += NUMBER_OF_BYTES_HEADER_WORD;
 
-        /* Получаем размер прошивки */
-        *firmware_size = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+        /* Получаем размер прошивки, размер окна передачи, формат передачи блоков, адрес записи, размер блока,
+         * CRC32 образа, уровень журнала во время передачи блоков и участки прошивки */
+        header->firmware_size = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+        header->window_size = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 4]);
+        header->transfer_format = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 8]);
+        header->target_address = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 12]);
+        header->block_size = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 16]);
+        header->image_crc = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 20]);
+        header->transfer_log_level = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 24]);
+        header->number_of_segments = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 28]);
+
+        for (uint32_t segment = 0; segment < MAX_NUMBER_OF_SEGMENTS; segment++) {
+            header->segments[segment].address = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 32 + segment * 8]);
+            header->segments[segment].size = four_uint8t_to_one_uint32t(&local_rx_buffer[index + 36 + segment * 8]);
+        }
 
         index += NUMBER_OF_BYTES_HEADER_DATA;
 
@@ -211,7 +408,7 @@ usart_get_header(uint32_t* firmware_size) {
             check_crc(local_rx_buffer, (NUMBER_OF_BYTES_HEADER_WORD + NUMBER_OF_BYTES_HEADER_DATA), crc_bytes);
 
         if (!crc_result) {
-            printf("Ошибка CRC, полученная и вычисленная сумма отличаются\n");
+            LOG_ERROR(LOG_EVENT_PACKET_CRC_ERROR, "Ошибка CRC, полученная и вычисленная сумма отличаются\n");
             status = GET_HEADER_ERROR_CRC;
             break;
         }
@@ -223,60 +420,169 @@ usart_get_header(uint32_t* firmware_size) {
 
 /**
  * \brief       Функция, которая получает по USART пакет типа "data".
+ * \note        После потери байт внутри окна синхронизация восстанавливается на следующем пакете.
+ * \param[out]  *sequence: Указатель на порядковый номер полученного блока прошивки.
  * \param[out]  *data_buffer: Указатель на полученный буфер с зашифрованными данными прошивки.
+ * \param[in]   block_size: Число байт прошивки в пакете (header_t.block_size).
  * \return     status: Статус выполнения операции, если \ref GET_DATA_OK, то пакет получен успешно,
  *             если что-то другое, произошла ошибка.
  */
 get_data_status_t
-usart_get_data(uint8_t* data_buffer) {
+usart_get_data(uint32_t* sequence, uint8_t* data_buffer, uint32_t block_size) {
 
-    /* Буфер, в который будуд приходить сырые данные */
-    uint8_t local_rx_buffer[DATA_SIZE];
+    /* Буфер, в который будуд приходить сырые данные. Статический: пакет с блоком максимального размера
+     * не помещается в стек */
+    static uint8_t local_rx_buffer[DATA_MAX_SIZE];
     /* Индекс local_rx_buffer */
     size_t index = 0;
     get_data_status_t status = GET_DATA_OK;
 
     do {
-        if (data_buffer == NULL) {
-            printf("Пустой указатель\n");
+        if (sequence == NULL || data_buffer == NULL) {
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
             status = GET_DATA_ERROR_EMPTY_POINTER;
             break;
         }
 
-        uint16_t receiving_status = HAL_UART_Receive(&huart3, &local_rx_buffer[index], DATA_SIZE, HAL_MAX_DELAY);
+        HAL_StatusTypeDef receiving_status = usart_receive_packet(
+            data_word, local_rx_buffer,
+            NUMBER_OF_BYTES_DATA_WORD + NUMBER_OF_BYTES_DATA_SEQUENCE + block_size + NUMBER_OF_BYTES_CRC,
+            DATA_PACKET_TIMEOUT_MS);
+
+        if (receiving_status == HAL_TIMEOUT) {
+            status = GET_DATA_ERROR_TIMEOUT;
+            break;
+        }
 
         if (receiving_status != HAL_OK) {
-            printf("При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
             status = GET_DATA_ERROR_RECEIVING_STATUS;
             break;
         }
 
-        /* Определяем начало пакета типа "data" */
-        uint8_t data_word_finded = find_word(&local_rx_buffer[index], data_word);
+        index += NUMBER_OF_BYTES_DATA_WORD;
+
+        /* Получаем порядковый номер блока */
+        *sequence = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        index += NUMBER_OF_BYTES_DATA_SEQUENCE;
+
+        /* Получаем даннные, которые пришли */
+        memcpy(data_buffer, &local_rx_buffer[index], block_size);
+
+        index += block_size;
 
-        if (!data_word_finded) {
-            printf("Переданные данные не соответствуют пакету типа \"data\"\n");
-            status = GET_DATA_ERROR_NOT_DATA;
+        uint32_t crc_bytes = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        /* Делаем проверку целостности входных данных, путем вычисления CRC.
+        * CRC сумма вычисляется по байтам:
+        * "начало_пакета_data" (символы Ascii) + "номер_блока" + "данные_передаваемые_в_пакете_data" */
+        uint8_t crc_result = check_crc(
+            local_rx_buffer, (NUMBER_OF_BYTES_DATA_WORD + NUMBER_OF_BYTES_DATA_SEQUENCE + block_size), crc_bytes);
+
+        /* Сообщение об ошибке не выводим: передача текста во время приема окна приводит к потере следующих пакетов */
+        if (!crc_result) {
+            status = GET_DATA_ERROR_CRC;
             break;
         }
 
-        index += NUMBER_OF_BYTES_DATA_WORD;
+    } while (0);
+
+    return status;
+}
+
+/**
+ * \brief       Функция, которая получает по USART пакет типа "zdat" со сжатым блоком прошивки.
+ * \note        Пакет: начало пакета + номер блока + размер сжатых данных + сжатые данные, дополненные до кратного 4
+ *              + CRC32. Размер, равный block_size, означает, что блок передан без сжатия.
+ * \param[out]  *sequence: Указатель на порядковый номер полученного блока прошивки.
+ * \param[out]  *data_buffer: Указатель на буфер для сжатых данных, не меньше block_size байт.
+ * \param[out]  *data_size: Указатель на размер сжатых данных.
+ * \param[in]   block_size: Число байт прошивки в блоке (header_t.block_size).
+ * \return     status: Статус выполнения операции, если \ref GET_DATA_OK, то пакет получен успешно,
+ *             если что-то другое, произошла ошибка.
+ */
+get_data_status_t
+usart_get_compressed_data(uint32_t* sequence, uint8_t* data_buffer, uint32_t* data_size, uint32_t block_size) {
+
+    /* Буфер, в который будуд приходить сырые данные. Статический: пакет с блоком максимального размера
+     * не помещается в стек */
+    static uint8_t local_rx_buffer[ZDAT_MAX_SIZE];
+    /* Индекс local_rx_buffer */
+    size_t index = 0;
+    get_data_status_t status = GET_DATA_OK;
+
+    do {
+        if (sequence == NULL || data_buffer == NULL || data_size == NULL) {
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
+            status = GET_DATA_ERROR_EMPTY_POINTER;
+            break;
+        }
+
+        HAL_StatusTypeDef receiving_status =
+            usart_receive_packet(zdat_word, local_rx_buffer, ZDAT_HEADER_SIZE, DATA_PACKET_TIMEOUT_MS);
+
+        if (receiving_status == HAL_TIMEOUT) {
+            status = GET_DATA_ERROR_TIMEOUT;
+            break;
+        }
+
+        if (receiving_status != HAL_OK) {
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            status = GET_DATA_ERROR_RECEIVING_STATUS;
+            break;
+        }
+
+        index += NUMBER_OF_BYTES_ZDAT_WORD;
+
+        /* Получаем порядковый номер блока */
+        *sequence = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        index += NUMBER_OF_BYTES_DATA_SEQUENCE;
+
+        /* Получаем размер сжатых данных. Неверный размер означает поврежденный пакет */
+        *data_size = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        index += NUMBER_OF_BYTES_ZDAT_SIZE;
+
+        if (*data_size == 0 || *data_size > block_size) {
+            status = GET_DATA_ERROR_CRC;
+            break;
+        }
+
+        uint32_t padded_size = (*data_size + 3U) & ~3U;
+
+        receiving_status =
+            usart_receive(&local_rx_buffer[index], padded_size + NUMBER_OF_BYTES_CRC, DATA_PACKET_TIMEOUT_MS);
+
+        if (receiving_status == HAL_TIMEOUT) {
+            status = GET_DATA_ERROR_TIMEOUT;
+            break;
+        }
+
+        if (receiving_status != HAL_OK) {
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            status = GET_DATA_ERROR_RECEIVING_STATUS;
+            break;
+        }
 
         /* Получаем даннные, которые пришли */
-        memcpy(data_buffer, &local_rx_buffer[index], NUMBER_OF_BYTES_DATA_DATA);
+        memcpy(data_buffer, &local_rx_buffer[index], *data_size);
 
-        index += NUMBER_OF_BYTES_DATA_DATA;
+        index += padded_size;
 
         uint32_t crc_bytes = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
 
         /* Делаем проверку целостности входных данных, путем вычисления CRC.
         * CRC сумма вычисляется по байтам:
-        * "начало_пакета_data" (символы Ascii) + "данные_передаваемые_в_пакете_data" */
-        uint8_t crc_result =
-            check_crc(local_rx_buffer, (NUMBER_OF_BYTES_DATA_WORD + NUMBER_OF_BYTES_DATA_DATA), crc_bytes);
+        * "начало_пакета_zdat" + "номер_блока" + "размер_сжатых_данных" + "сжатые_данные_с_дополнением" */
+        uint8_t crc_result = check_crc(local_rx_buffer, index, crc_bytes);
 
+        /* Сообщение об ошибке не выводим: передача текста во время приема окна приводит к потере следующих пакетов */
         if (!crc_result) {
-            printf("Ошибка CRC, полученная и вычисленная сумма отличаются\n");
             status = GET_DATA_ERROR_CRC;
             break;
         }
@@ -303,15 +609,16 @@ usart_get_key(uint32_t* coded_key) {
 
     do {
         if (coded_key == NULL) {
-            printf("Пустой указатель\n");
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
             status = GET_KEY_ERROR_EMPTY_POINTER;
             break;
         }
 
-        int16_t receiving_status = HAL_UART_Receive(&huart3, &local_rx_buffer[index], KEY_SIZE, HAL_MAX_DELAY);
+        int16_t receiving_status = usart_receive(&local_rx_buffer[index], KEY_SIZE, HAL_MAX_DELAY);
 
         if (receiving_status != HAL_OK) {
-            printf("При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
             status = GET_KEY_ERROR_RECEIVING_STATUS;
             break;
         }
@@ -320,7 +627,7 @@ usart_get_key(uint32_t* coded_key) {
         uint8_t key_word_finded = find_word(&local_rx_buffer[index], key_word);
 
         if (!key_word_finded) {
-            printf("Переданные данные не соответствуют пакету типа \"key\"\n");
+            LOG_ERROR(LOG_EVENT_NOT_KEY_PACKET, "Переданные данные не соответствуют пакету типа \"key\"\n");
             status = GET_KEY_ERROR_NOT_KEY;
             break;
         }
@@ -341,7 +648,7 @@ usart_get_key(uint32_t* coded_key) {
             check_crc(local_rx_buffer, (NUMBER_OF_BYTES_KEY_WORD + NUMBER_OF_BYTES_KEY_DATA), crc_bytes);
 
         if (!crc_result) {
-            printf("Ошибка CRC, полученная и вычисленная сумма отличаются\n");
+            LOG_ERROR(LOG_EVENT_PACKET_CRC_ERROR, "Ошибка CRC, полученная и вычисленная сумма отличаются\n");
             status = GET_KEY_ERROR_CRC;
             break;
         }
@@ -350,3 +657,236 @@ usart_get_key(uint32_t* coded_key) {
 
     return status;
 }
+
+/**
+ * \brief       Функция, которая получает по USART пакет типа "baud".
+ * \param[out]  *baudrate: Указатель на полученную скорость UART.
+ * \return     status: Статус выполнения операции, если \ref GET_BAUD_OK, то пакет получен успешно,
+ *             если что-то другое, произошла ошибка.
+ */
+get_baud_status_t
+usart_get_baudrate(uint32_t* baudrate) {
+    /* Буфер, в который будут приходить данные */
+    uint8_t local_rx_buffer[BAUD_SIZE];
+    /* Индекс local_rx_buffer */
+    size_t index = 0;
+
+    get_baud_status_t status = GET_BAUD_OK;
+
+    do {
+        if (baudrate == NULL) {
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
+            status = GET_BAUD_ERROR_EMPTY_POINTER;
+            break;
+        }
+
+        int16_t receiving_status = usart_receive(&local_rx_buffer[index], BAUD_SIZE, HAL_MAX_DELAY);
+
+        if (receiving_status != HAL_OK) {
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            status = GET_BAUD_ERROR_RECEIVING_STATUS;
+            break;
+        }
+
+        /* Определяем начало пакета типа "baud" */
+        uint8_t baud_word_finded = find_word(&local_rx_buffer[index], baud_word);
+
+        if (!baud_word_finded) {
+            LOG_ERROR(LOG_EVENT_NOT_BAUD_PACKET, "Переданные данные не соответствуют пакету типа \"baud\"\n");
+            status = GET_BAUD_ERROR_NOT_BAUD;
+            break;
+        }
+
+        index += NUMBER_OF_BYTES_BAUD_WORD;
+
+        *baudrate = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        index += NUMBER_OF_BYTES_BAUD_DATA;
+
+        uint32_t crc_bytes = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        /* Делаем проверку целостности входных данных, путем вычисления CRC.
+         * CRC сумма вычисляется по байтам:
+         * "начало_пакета_baud" (символы Ascii) + "данные_передаваемые_в_пакете_baud" */
+        uint8_t crc_result =
+            check_crc(local_rx_buffer, (NUMBER_OF_BYTES_BAUD_WORD + NUMBER_OF_BYTES_BAUD_DATA), crc_bytes);
+
+        if (!crc_result) {
+            LOG_ERROR(LOG_EVENT_PACKET_CRC_ERROR, "Ошибка CRC, полученная и вычисленная сумма отличаются\n");
+            status = GET_BAUD_ERROR_CRC;
+            break;
+        }
+
+    } while (0);
+
+    return status;
+}
+
+/**
+ * \brief       Функция, которая получает по USART пакет типа "dmap".
+ * \note        Бит i маски (байт i / 8, бит i % 8) равен 1, если блок прошивки i изменился и будет передан.
+ * \param[out]  *delta_map: Указатель на буфер для маски, не меньше \ref NUMBER_OF_BYTES_DMAP_DATA байт.
+ * \return     status: Статус выполнения операции, если \ref GET_DMAP_OK, то пакет получен успешно,
+ *             если что-то другое, произошла ошибка.
+ */
+get_dmap_status_t
+usart_get_delta_map(uint8_t* delta_map) {
+    /* Буфер, в который будут приходить данные */
+    uint8_t local_rx_buffer[DMAP_SIZE];
+    /* Индекс local_rx_buffer */
+    size_t index = 0;
+
+    get_dmap_status_t status = GET_DMAP_OK;
+
+    do {
+        if (delta_map == NULL) {
+            LOG_ERROR(LOG_EVENT_NULL_POINTER, "Пустой указатель\n");
+            status = GET_DMAP_ERROR_EMPTY_POINTER;
+            break;
+        }
+
+        int16_t receiving_status = usart_receive(&local_rx_buffer[index], DMAP_SIZE, HAL_MAX_DELAY);
+
+        if (receiving_status != HAL_OK) {
+            LOG_ERROR(LOG_EVENT_UART_RECEIVE_ERROR,
+                      "При использовании HAL функции для получения данных по UART возникла ошибка\n");
+            status = GET_DMAP_ERROR_RECEIVING_STATUS;
+            break;
+        }
+
+        /* Определяем начало пакета типа "dmap" */
+        uint8_t dmap_word_finded = find_word(&local_rx_buffer[index], dmap_word);
+
+        if (!dmap_word_finded) {
+            LOG_ERROR(LOG_EVENT_NOT_DMAP_PACKET, "Переданные данные не соответствуют пакету типа \"dmap\"\n");
+            status = GET_DMAP_ERROR_NOT_DMAP;
+            break;
+        }
+
+        index += NUMBER_OF_BYTES_DMAP_WORD;
+
+        memcpy(delta_map, &local_rx_buffer[index], NUMBER_OF_BYTES_DMAP_DATA);
+
+        index += NUMBER_OF_BYTES_DMAP_DATA;
+
+        uint32_t crc_bytes = four_uint8t_to_one_uint32t(&local_rx_buffer[index]);
+
+        /* Делаем проверку целостности входных данных, путем вычисления CRC.
+         * CRC сумма вычисляется по байтам:
+         * "начало_пакета_dmap" (символы Ascii) + "данные_передаваемые_в_пакете_dmap" */
+        uint8_t crc_result =
+            check_crc(local_rx_buffer, (NUMBER_OF_BYTES_DMAP_WORD + NUMBER_OF_BYTES_DMAP_DATA), crc_bytes);
+
+        if (!crc_result) {
+            LOG_ERROR(LOG_EVENT_PACKET_CRC_ERROR, "Ошибка CRC, полученная и вычисленная сумма отличаются\n");
+            status = GET_DMAP_ERROR_CRC;
+            break;
+        }
+
+    } while (0);
+
+    return status;
+}
+
+/**
+ * \brief       Функция, которая ждет от Host приложения пакет проверки скорости UART.
+ * \note        Пакет проверки: \ref test_word + скорость UART + CRC32. Пакеты, принятые с ошибкой
+ *              (например, пока Host приложение еще не переключилось), пропускаются до истечения времени ожидания.
+ * \param[in]   baudrate: Скорость, на которой должен прийти пакет проверки.
+ * \param[in]   timeout: Время ожидания пакета проверки, мс.
+ * \return      result: Результат: TRUE (пакет проверки получен), FALSE (время ожидания истекло).
+ */
+uint8_t
+usart_get_probe(uint32_t baudrate, uint32_t timeout) {
+    uint8_t local_rx_buffer[TEST_SIZE];
+    uint8_t result = FALSE;
+    uint32_t start_tick = HAL_GetTick();
+    uint32_t elapsed_time;
+
+    /* Время считается разностью тиков, как в HAL: переполнение счетчика тиков не влияет на ожидание */
+    while (!result && (elapsed_time = HAL_GetTick() - start_tick) < timeout) {
+        HAL_StatusTypeDef receiving_status =
+            usart_receive_packet(test_word, local_rx_buffer, TEST_SIZE, timeout - elapsed_time);
+
+        if (receiving_status != HAL_OK) {
+            continue;
+        }
+
+        uint32_t probe_baudrate = four_uint8t_to_one_uint32t(&local_rx_buffer[NUMBER_OF_BYTES_TEST_WORD]);
+        uint32_t crc_bytes =
+            four_uint8t_to_one_uint32t(&local_rx_buffer[NUMBER_OF_BYTES_TEST_WORD + NUMBER_OF_BYTES_TEST_DATA]);
+
+        if (probe_baudrate == baudrate
+            && check_crc(local_rx_buffer, (NUMBER_OF_BYTES_TEST_WORD + NUMBER_OF_BYTES_TEST_DATA), crc_bytes)) {
+            result = TRUE;
+        }
+    }
+
+    return result;
+}
+
+/**
+ * \brief       Функция, которая ждет от Host приложения пакет входа в режим загрузчика.
+ * \note        Пакет "boot": \ref boot_word + \ref BOOTLOADER_ENTRY_MAGIC + CRC32. Пакеты, принятые с ошибкой,
+ *              пропускаются до истечения времени ожидания.
+ * \param[in]   timeout: Время ожидания пакета, мс.
+ * \return      result: Результат: TRUE (пакет получен), FALSE (время ожидания истекло).
+ */
+uint8_t
+usart_get_boot_request(uint32_t timeout) {
+    uint8_t local_rx_buffer[BOOT_SIZE];
+    uint8_t result = FALSE;
+    uint32_t start_tick = HAL_GetTick();
+    uint32_t elapsed_time;
+
+    /* Время считается разностью тиков, как в HAL: переполнение счетчика тиков не влияет на ожидание */
+    while (!result && (elapsed_time = HAL_GetTick() - start_tick) < timeout) {
+        HAL_StatusTypeDef receiving_status =
+            usart_receive_packet(boot_word, local_rx_buffer, BOOT_SIZE, timeout - elapsed_time);
+
+        if (receiving_status != HAL_OK) {
+            continue;
+        }
+
+        uint32_t boot_magic = four_uint8t_to_one_uint32t(&local_rx_buffer[NUMBER_OF_BYTES_BOOT_WORD]);
+        uint32_t crc_bytes =
+            four_uint8t_to_one_uint32t(&local_rx_buffer[NUMBER_OF_BYTES_BOOT_WORD + NUMBER_OF_BYTES_BOOT_DATA]);
+
+        if (boot_magic == BOOTLOADER_ENTRY_MAGIC
+            && check_crc(local_rx_buffer, (NUMBER_OF_BYTES_BOOT_WORD + NUMBER_OF_BYTES_BOOT_DATA), crc_bytes)) {
+            result = TRUE;
+        }
+    }
+
+    return result;
+}
+
+/**
+ * \brief       Функция, которая перенастраивает USART на новую скорость.
+ * \note        HAL_UART_Transmit возвращается только после окончания передачи последнего байта,
+ *              поэтому уже отправленные пакеты не искажаются.
+ * \param[in]   baudrate: Новая скорость UART в бод.
+ * \return      result: Результат: TRUE (скорость установлена), FALSE (ошибка инициализации UART).
+ */
+uint8_t
+usart_set_baudrate(uint32_t baudrate) {
+    uint8_t result = FALSE;
+
+    /* HAL_UART_DeInit не вызываем: он отключает выводы UART, и Host приложение получает мусорный байт.
+     * Повторный HAL_UART_Init только перенастраивает регистры USART */
+    huart3.Init.BaudRate = baudrate;
+
+#if UART_RX_DMA
+    /* Байты, принятые на прежней скорости, не нужны: прием через DMA начинается заново */
+    HAL_UART_DMAStop(&huart3);
+#endif
+
+    if (HAL_UART_Init(&huart3) == HAL_OK) {
+        result = TRUE;
+    }
+
+    usart_start_reception();
+
+    return result;
+}
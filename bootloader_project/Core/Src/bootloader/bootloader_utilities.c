@@ -33,6 +33,9 @@
 
 #include "bootloader/bootloader_utilities.h"
 
+/* Текущий уровень журнала: сообщения с уровнем больше него не передаются */
+static log_level_t log_level = LOG_LEVEL;
+
 /**
  * \brief           Функция, которая превращает массив uint8_t с 4 элементами
  *                  в uint32_t с сохранением порядка байт (big-endian).
@@ -47,7 +50,7 @@ four_uint8t_to_one_uint32t(uint8_t* p_bytes) {
 
     /* Проверка на пустой указатель */
     if (p_bytes == NULL) {
-        printf("four_uint8t_to_one_uint32t - Пустой указатель\n");
+        LOG_ERROR(LOG_EVENT_CONVERT_NULL_POINTER, "four_uint8t_to_one_uint32t - Пустой указатель\n");
         result = 0;
         return result;
     }
@@ -115,8 +118,9 @@ find_word(uint8_t* source, const char* destination) {
 
 /**
  * \brief       Функция, которая проверяет переданные данные путем вычисления CRC32 MPEG-2.
- * \note        CRC32 вычисляется аппаратно.
- * \param[in]  *data: Указатель на исходные данные.
+ * \note        CRC32 вычисляется аппаратно прямо по буферу приема, без копирования во временный массив.
+ *              Учитываются только целые 4 байтные слова данных.
+ * \param[in]  *data: Указатель на исходные данные, выравнивание по 4 байтам не требуется.
  * \param[in]  data_size: Размер исходных данных.
  * \param[in]  input_crc: Полученный вместе с данными CRC32.
  * \return     result: Результат проверки: TRUE (данные переданы корректно), FALSE (возникла ошибка при передачи данных).
@@ -131,21 +135,19 @@ check_crc(uint8_t* data, size_t data_size, uint32_t input_crc) {
         return result;
     }
 
-    size_t temp_data_size = data_size / sizeof(uint32_t);
-    uint32_t temp_data[temp_data_size];
-
-    /* Создаем временный массив uint32_t, чтобы использовать правильный порядок
-     * байт в памяти для дальнейшего использования аппаратного вычисления CRC */
-    memcpy(temp_data, data, data_size);
-    for (int i = 0; i < data_size / 4; i++) {
-        temp_data[i] = ((temp_data[i] & 0x000000FF) << 24) | ((temp_data[i] & 0x0000FF00) << 8)
-                       | ((temp_data[i] & 0x00FF0000) >> 8) | ((temp_data[i] & 0xFF000000) >> 24);
-    }
-
     /* Используем аппаратные средства для вычисления CRC. В STM32F407xx нет возможности
      * настроить алгоритм вычисления CRC, используются только настройки по умолчанию, а именно:
      * Алгоритм CRC32 MPEG-2 */
-    uint32_t calculated_crc = HAL_CRC_Calculate(&hcrc, temp_data, temp_data_size);
+    __HAL_CRC_DR_RESET(&hcrc);
+
+    /* Host приложение считает CRC по байтам в порядке передачи, поэтому каждое слово переставляется в порядок
+     * big-endian. Cortex-M4 читает невыровненное слово одной инструкцией LDR, а слова пишутся прямо в регистр
+     * данных CRC, как в \ref calculate_encrypted_flash_crc */
+    for (size_t i = 0; i < data_size / 4; i++) {
+        hcrc.Instance->DR = __REV(__UNALIGNED_UINT32_READ(&data[i * 4]));
+    }
+
+    uint32_t calculated_crc = hcrc.Instance->DR;
 
 //    printf("Входные CRC байты - %08lx\n", input_crc);
 //    printf("Вычисленные STM32 CRC байты - %08lx\n", calculated_crc);
@@ -160,6 +162,120 @@ check_crc(uint8_t* data, size_t data_size, uint32_t input_crc) {
     return result;
 }
 
+/**
+ * \brief       Функция, которая вычисляет CRC32 MPEG-2 блока flash памяти, зашифрованного ключом.
+ * \note        Результат совпадает с CRC32, которую Host приложение вычисляет по блоку зашифрованной прошивки,
+ *              поэтому блоки установленной и новой прошивки можно сравнивать, не передавая сами данные.
+ *              Слово flash памяти шифруется XOR с ключом и переставляется в порядок big-endian для аппаратного блока CRC.
+ * \param[in]   flash_address: Адрес начала блока, выровненный по 4 байтам.
+ * \param[in]   size: Размер блока в байтах, кратный 4.
+ * \param[in]   key: Ключ шифрования.
+ * \return      crc: Вычисленная CRC32.
+ */
+uint32_t
+calculate_encrypted_flash_crc(uint32_t flash_address, size_t size, uint32_t key) {
+    const uint32_t* flash_words = (const uint32_t*)flash_address;
+
+    __HAL_CRC_DR_RESET(&hcrc);
+
+    /* Слова пишем прямо в регистр данных CRC: вызов HAL_CRC_Accumulate на каждое слово в несколько раз медленнее */
+    for (size_t i = 0; i < size / 4; i++) {
+        hcrc.Instance->DR = __REV(flash_words[i] ^ key);
+    }
+
+    return hcrc.Instance->DR;
+}
+
+/**
+ * \brief       Функция, которая распаковывает блок, сжатый в формате LZ4 block.
+ * \note        Последовательность LZ4: байт-токен (старшие 4 бита - число литералов, младшие - длина совпадения - 4),
+ *              дополнительные байты длин (пока байт равен 255), литералы, смещение совпадения (2 байта, little-endian).
+ *              Последняя последовательность содержит только литералы. Окно совпадений - это сам выходной буфер,
+ *              поэтому дополнительная память для распаковки не нужна.
+ * \param[in]   *source: Указатель на сжатые данные.
+ * \param[in]   source_size: Размер сжатых данных.
+ * \param[out]  *destination: Указатель на буфер для распакованных данных.
+ * \param[in]   destination_size: Размер буфера для распакованных данных.
+ * \return      size: Размер распакованных данных, или 0, если сжатые данные повреждены.
+ */
+uint32_t
+lz4_decompress_block(const uint8_t* source, uint32_t source_size, uint8_t* destination, uint32_t destination_size) {
+    uint32_t source_index = 0;
+    uint32_t destination_index = 0;
+
+    if (source == NULL || destination == NULL) {
+        return 0;
+    }
+
+    while (source_index < source_size) {
+        uint8_t token = source[source_index++];
+
+        /* Копируем литералы */
+        uint32_t literals_size = token >> 4;
+
+        if (literals_size == 15) {
+            uint8_t length_byte;
+            do {
+                if (source_index >= source_size) {
+                    return 0;
+                }
+                length_byte = source[source_index++];
+                literals_size += length_byte;
+            } while (length_byte == 255);
+        }
+
+        if (literals_size > source_size - source_index || literals_size > destination_size - destination_index) {
+            return 0;
+        }
+
+        memcpy(&destination[destination_index], &source[source_index], literals_size);
+        source_index += literals_size;
+        destination_index += literals_size;
+
+        /* Последняя последовательность заканчивается литералами */
+        if (source_index == source_size) {
+            break;
+        }
+
+        /* Копируем совпадение */
+        if (source_size - source_index < 2) {
+            return 0;
+        }
+
+        uint32_t offset = source[source_index] | (source[source_index + 1] << 8);
+        source_index += 2;
+
+        if (offset == 0 || offset > destination_index) {
+            return 0;
+        }
+
+        uint32_t match_size = (token & 0x0F) + 4;
+
+        if ((token & 0x0F) == 15) {
+            uint8_t length_byte;
+            do {
+                if (source_index >= source_size) {
+                    return 0;
+                }
+                length_byte = source[source_index++];
+                match_size += length_byte;
+            } while (length_byte == 255);
+        }
+
+        if (match_size > destination_size - destination_index) {
+            return 0;
+        }
+
+        /* Совпадение может перекрывать само себя (например, повторяющийся байт 0xFF), поэтому копируем побайтно */
+        for (uint32_t i = 0; i < match_size; i++) {
+            destination[destination_index] = destination[destination_index - offset];
+            destination_index++;
+        }
+    }
+
+    return destination_index;
+}
+
 /**
  * \brief       Функция, которая проверяет наличие последовательности байт
  *              в списке поддерживаемых загрузчиком команд.
@@ -195,6 +311,24 @@ check_cmd_type(uint32_t cmd_type_bytes) {
         case CMD_ERASE_PROGRAM:
             type = CMD_ERASE_PROGRAM;
             break;
+        case CMD_SET_BAUDRATE:
+            type = CMD_SET_BAUDRATE;
+            break;
+        case CMD_DELTA_UPDATE:
+            type = CMD_DELTA_UPDATE;
+            break;
+        case CMD_START_SESSION:
+            type = CMD_START_SESSION;
+            break;
+        case CMD_RESET:
+            type = CMD_RESET;
+            break;
+        case CMD_VERIFY:
+            type = CMD_VERIFY;
+            break;
+        case CMD_ROLLBACK:
+            type = CMD_ROLLBACK;
+            break;
         default:
             type = CMD_UNKNOWN;
             break;
@@ -203,12 +337,75 @@ check_cmd_type(uint32_t cmd_type_bytes) {
     return type;
 }
 
+/**
+ * \brief       Функция, которая начинает измерение времени по счетчику тактов ядра (DWT CYCCNT).
+ * \note        Счетчик включается при первом вызове. Интервал измерения не должен превышать 2^32 тактов (25 с при 168 МГц).
+ * \return      start_cycles: Значение счетчика тактов в начале измерения.
+ */
+uint32_t
+start_time_measurement(void) {
+    if ((DWT->CTRL & DWT_CTRL_CYCCNTENA_Msk) == 0) {
+        CoreDebug->DEMCR |= CoreDebug_DEMCR_TRCENA_Msk;
+        DWT->CYCCNT = 0;
+        DWT->CTRL |= DWT_CTRL_CYCCNTENA_Msk;
+    }
+
+    return DWT->CYCCNT;
+}
+
+/**
+ * \brief       Функция, которая возвращает время, прошедшее с начала измерения.
+ * \param[in]   start_cycles: Значение, которое вернула \ref start_time_measurement.
+ * \return      elapsed_time_us: Прошедшее время, мкс.
+ */
+uint32_t
+get_elapsed_time_us(uint32_t start_cycles) {
+    return (DWT->CYCCNT - start_cycles) / (SystemCoreClock / 1000000U);
+}
+
+/**
+ * \brief       Функция, которая возвращает текущий уровень журнала.
+ * \return      log_level: Текущий уровень журнала.
+ */
+log_level_t
+get_log_level(void) {
+    return log_level;
+}
+
+/**
+ * \brief       Функция, которая устанавливает уровень журнала.
+ * \note        Например, на время передачи блоков прошивки (header_t.transfer_log_level), чтобы сообщения
+ *              не занимали UART.
+ * \param[in]   level: Новый уровень журнала.
+ */
+void
+set_log_level(log_level_t level) {
+    log_level = level;
+}
+
+/**
+ * \brief       Функция, которая передает событие журнала пакетом "loge", если его уровень не больше текущего.
+ * \note        Вызывается макросами \ref LOG_ERROR, \ref LOG_WARNING, \ref LOG_INFO, \ref LOG_DEBUG.
+ * \param[in]   level: Уровень журнала события.
+ * \param[in]   event: Номер события.
+ * \param[in]   number_of_arguments: Число аргументов события.
+ * \param[in]   arguments: Указатель на аргументы события.
+ */
+void
+log_event(log_level_t level, log_event_t event, uint32_t number_of_arguments, const uint32_t* arguments) {
+    if (level > log_level) {
+        return;
+    }
+
+    usart_send_log_event(level, event, number_of_arguments, arguments);
+}
+
 /**
  * \brief     Эта функция производить программную перезагрузку МК через 3 секунды
  */
 void
 restart(void) {
-    printf("Перезагрузка микроконтроллера через 3 секунды\n");
+    LOG_INFO(LOG_EVENT_RESTART_SCHEDULED, "Перезагрузка микроконтроллера через 3 секунды\n");
 
     uint32_t end_tick = HAL_GetTick() + 3000;
 
@@ -216,7 +413,7 @@ restart(void) {
         uint32_t current_tick = HAL_GetTick();
 
         if (current_tick > end_tick) {
-            printf("Перезагрузка МК!\n");
+            LOG_INFO(LOG_EVENT_RESTART, "Перезагрузка МК!\n");
             NVIC_SystemReset();
             break;
         }
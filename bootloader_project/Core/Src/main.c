@@ -53,7 +53,7 @@ static void MX_GPIO_Init(void);
 static void MX_USART3_UART_Init(void);
 static void MX_CRC_Init(void);
 /* USER CODE BEGIN PFP */
-static void go_to_application(void);
+static void go_to_application(uint32_t app_address);
 /* USER CODE END PFP */
 
 /* Private user code ---------------------------------------------------------*/
@@ -93,7 +93,7 @@ int main(void)
   MX_CRC_Init();
   /* USER CODE BEGIN 2 */
 
-  printf("Загрузчик версии: (%d.%d)\n", bl_version[0], bl_version[1]);
+  LOG_INFO(LOG_EVENT_BOOTLOADER_VERSION, "Загрузчик версии: (%d.%d)\n", bl_version[0], bl_version[1]);
 
   HAL_GPIO_WritePin(GPIOD, GPIO_PIN_12, GPIO_PIN_SET); /* Включаем зеленый светодиод */
 
@@ -106,8 +106,17 @@ int main(void)
       bootloader_mode();
   }
 
+  /* Выбираем слот с исправной прошивкой */
+  uint32_t app_address = select_app_slot();
+
+  if (app_address == 0) {
+      LOG_WARNING(LOG_EVENT_NO_VALID_APP,
+                  "Нет исправной прошивки пользовательского приложения, переходим в режим загрузчика\n");
+      bootloader_mode();
+  }
+
   /* Переходим в User application */
-  go_to_application();
+  go_to_application(app_address);
 
   /* USER CODE END 2 */
 
@@ -221,7 +230,13 @@ static void MX_USART3_UART_Init(void)
     Error_Handler();
   }
   /* USER CODE BEGIN USART3_Init 2 */
-
+#if UART_HW_FLOW_CONTROL
+  huart3.Init.HwFlowCtl = UART_HWCONTROL_RTS_CTS;
+  if (HAL_UART_Init(&huart3) != HAL_OK)
+  {
+    Error_Handler();
+  }
+#endif
   /* USER CODE END USART3_Init 2 */
 
 }
@@ -270,23 +285,24 @@ int _write(int fd, char *ptr, int len) {
 }
 
 
-void go_to_application(void) {
+void go_to_application(uint32_t app_address) {
 
     void (*app_reset_handler)(void);
 
-    printf("Переходим в User application\n");
+    LOG_INFO(LOG_EVENT_JUMP_TO_APP, "Переходим в User application (слот 0x%08lX)\n", app_address);
 
 
     /* 1. Настройте MSP, считав значение из сектора с пользовательским приложением. */
-    uint32_t msp_value = *(volatile uint32_t *) APP_FLASH_START_ADDRESS;
-    printf("Значение MSP: %#lx\n", msp_value);
+    uint32_t msp_value = *(volatile uint32_t *) app_address;
+    LOG_DEBUG(LOG_EVENT_APP_MSP, "Значение MSP: %#lx\n", msp_value);
 
     //__set_MSP(msp_value);
-    //SCB->VTOR = APP_FLASH_START_ADDRESS;
+    /* Таблица векторов приложения находится в начале его слота */
+    SCB->VTOR = app_address;
 
-    /* 2. Теперь извлеките адрес обработчика сброса пользовательского приложения из местоположения APP_FLASH_START_ADDRESS + FLASH_BLOCK_OFFSET */
-    uint32_t resethandler_address = *(volatile uint32_t *) (APP_FLASH_START_ADDRESS + FLASH_BLOCK_OFFSET);
-    printf("Адрес обработчика сброса User application: %#lx\r\n", resethandler_address);
+    /* 2. Теперь извлеките адрес обработчика сброса пользовательского приложения из местоположения app_address + FLASH_BLOCK_OFFSET */
+    uint32_t resethandler_address = *(volatile uint32_t *) (app_address + FLASH_BLOCK_OFFSET);
+    LOG_DEBUG(LOG_EVENT_APP_RESET_HANDLER, "Адрес обработчика сброса User application: %#lx\r\n", resethandler_address);
 
     app_reset_handler = (void *) resethandler_address;
 
@@ -22,6 +22,7 @@
 #include "stm32f4xx_it.h"
 /* Private includes ----------------------------------------------------------*/
 /* USER CODE BEGIN Includes */
+#include <bootloader/bootloader.h>
 /* USER CODE END Includes */
 
 /* Private typedef -----------------------------------------------------------*/
@@ -213,5 +214,14 @@ void USART3_IRQHandler(void)
 }
 
 /* USER CODE BEGIN 1 */
+#if UART_RX_DMA
+/**
+  * @brief This function handles DMA1 stream1 global interrupt (USART3_RX).
+  */
+void DMA1_Stream1_IRQHandler(void)
+{
+  HAL_DMA_IRQHandler(&hdma_usart3_rx);
+}
+#endif
 
 /* USER CODE END 1 */
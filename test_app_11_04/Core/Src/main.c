@@ -41,6 +41,10 @@
 #define ID_1 (*(unsigned long *)0x1FFF7A10)
 #define ID_2 (*(unsigned long *)0x1FFF7A14)
 #define ID_3 (*(unsigned long *)0x1FFF7A18)
+
+/* Must match BOOTLOADER_ENTRY_MAGIC and BOOTLOADER_ENTRY_FLAG in bootloader_settings.h of the bootloader */
+#define BOOTLOADER_ENTRY_MAGIC 0xB007B007U
+#define BOOTLOADER_ENTRY_FLAG (RTC->BKP0R)
 /* USER CODE END PM */
 
 /* Private variables ---------------------------------------------------------*/
@@ -55,7 +59,7 @@ void SystemClock_Config(void);
 static void MX_GPIO_Init(void);
 static void MX_USART3_UART_Init(void);
 /* USER CODE BEGIN PFP */
-
+static void wait_bootloader_request(uint32_t timeout);
 /* USER CODE END PFP */
 
 /* Private user code ---------------------------------------------------------*/
@@ -107,9 +111,9 @@ int main(void)
 
     /* USER CODE BEGIN 3 */
 	HAL_GPIO_WritePin(GPIOD, GPIO_PIN_14, GPIO_PIN_SET); // Red LED ON
-	HAL_Delay(5000);
+	wait_bootloader_request(5000);
 	HAL_GPIO_WritePin(GPIOD, GPIO_PIN_14, GPIO_PIN_RESET); // Red LED OFF
-	HAL_Delay(5000);
+	wait_bootloader_request(5000);
 
   }
   /* USER CODE END 3 */
@@ -227,6 +231,40 @@ int _write(int fd, char* ptr, int len) {
     return len;
 }
 
+/**
+ * @brief Waits for the "boot" packet from the host application during timeout ms.
+ *        On receipt sets the bootloader entry flag and resets, so the bootloader starts
+ *        without the User button.
+ */
+static void wait_bootloader_request(uint32_t timeout)
+{
+  /* "BOOT" + BOOTLOADER_ENTRY_MAGIC (big-endian), CRC is not checked */
+  const uint8_t boot_packet[] = {'B', 'O', 'O', 'T', 0xB0, 0x07, 0xB0, 0x07};
+  uint32_t end_tick = HAL_GetTick() + timeout;
+  uint32_t matched = 0;
+  uint8_t received_byte;
+
+  while (HAL_GetTick() < end_tick) {
+    if (HAL_UART_Receive(&huart3, &received_byte, 1, 10) != HAL_OK) {
+      continue;
+    }
+
+    if (received_byte == boot_packet[matched]) {
+      matched++;
+    } else {
+      matched = (received_byte == boot_packet[0]) ? 1 : 0;
+    }
+
+    if (matched == sizeof(boot_packet)) {
+      printf("Bootloader requested, restarting\n");
+      __HAL_RCC_PWR_CLK_ENABLE();
+      HAL_PWR_EnableBkUpAccess();
+      BOOTLOADER_ENTRY_FLAG = BOOTLOADER_ENTRY_MAGIC;
+      NVIC_SystemReset();
+    }
+  }
+}
+
 
 /* USER CODE END 4 */
 
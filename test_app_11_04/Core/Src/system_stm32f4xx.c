@@ -105,8 +105,11 @@
 #else
 #define VECT_TAB_BASE_ADDRESS   FLASH_BASE      /*!< Vector Table base address field.
                                                      This value must be a multiple of 0x200. */
-#define VECT_TAB_OFFSET         0x00010000U     /*!< Vector Table base offset field.
+#ifndef VECT_TAB_OFFSET
+#define VECT_TAB_OFFSET         0x00010000U     /*!< Vector Table base offset field (bootloader slot A,
+                                                     slot B build defines 0x00080000U).
                                                      This value must be a multiple of 0x200. */
+#endif /* VECT_TAB_OFFSET */
 #endif /* VECT_TAB_SRAM */
 #endif /* USER_VECT_TAB_ADDRESS */
 /******************************************************************************/